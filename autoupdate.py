@@ -2,20 +2,33 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import bisect
+import contextlib
+import heapq
+import itertools
 import json
 import os
 import errno
 import re
 import subprocess
+import tempfile
+import threading
 import time
-import urllib2
 import urlparse
+from multiprocessing import managers
 
 import cherrypy
 
 import autoupdate_lib
+import cache_manager
 import common_util
+import devserver_client
+import devserver_pool
+import generation_scheduler
+import host_db
+import host_log
 import log_util
+import metrics
 
 
 # Module-local log function.
@@ -29,12 +42,27 @@ METADATA_FILE = 'update.meta'
 KERNEL_METADATA_FILE = 'kernel_update.meta'
 CACHE_DIR = 'cache'
 
+# Default maximum number of payloads generated at the same time.
+DEFAULT_MAX_GENERATIONS = 2
+
+# Seconds after which a payload generation lock is taken to be abandoned, even
+# if the process holding it is still running.
+_GENERATION_LOCK_MAX_AGE = 2 * 60 * 60
+
+# Number of hosts or log entries read at once when streaming host info.
+_HOST_LOG_PAGE_SIZE = 500
+
 
 class AutoupdateError(Exception):
   """Exception classes used by this module."""
   pass
 
 
+class GenerationPendingError(AutoupdateError):
+  """Raised when a payload is still being generated."""
+  pass
+
+
 def _ChangeUrlPort(url, new_port):
   """Return the URL passed in with a different port"""
   scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
@@ -50,6 +78,12 @@ def _ChangeUrlPort(url, new_port):
 
   return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
 
+@contextlib.contextmanager
+def _NoOpContext():
+  """A context that does nothing."""
+  yield
+
+
 def _NonePathJoin(*args):
   """os.path.join that filters None's from the argument list."""
   return os.path.join(*filter(None, args))
@@ -60,51 +94,434 @@ class HostInfo(object):
 
   Members:
     attrs: Static attributes (legacy)
-    log: Complete log of recorded client entries
+    log: Log of recorded client entries, a host_log.HostLog
   """
 
-  def __init__(self):
+  def __init__(self, host_id=None, max_log_entries=host_log.DEFAULT_MAX_ENTRIES,
+               log_archive=None):
     # A dictionary of current attributes pertaining to the host.
     self.attrs = {}
 
-    # A list of pairs consisting of a timestamp and a dictionary of recorded
-    # attributes.
-    self.log = []
+    # The most recent recorded entries, each a timestamp and the recorded
+    # attributes; older ones are moved to the log archive, if any.
+    self.log = host_log.HostLog(host_id, max_entries=max_log_entries,
+                                archive=log_archive)
 
   def __repr__(self):
     return 'attrs=%s, log=%s' % (self.attrs, self.log)
 
-  def AddLogEntry(self, entry):
-    """Append a new log entry."""
-    # Append a timestamp.
+  def AddLogEntry(self, entry, seq):
+    """Append a new log entry, numbered |seq|."""
+    # A timestamp is added to the entry.
     assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
-    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
     # Add entry to hosts' message log.
-    self.log.append(entry)
+    self.log.Append(entry, seq)
+
+
+def _MergeLogEntries(recent, archived, limit):
+  """Returns the first log entries of those in memory and in the archive.
+
+  Entries recorded after the ones in memory were selected are left for the
+  next page, and entries moved to the archive since are among the recent ones.
+
+  Args:
+    recent: list of (host identifier, entry) pairs selected from memory.
+    archived: list of (seq, host identifier, entry) tuples then selected from
+              the archive, up to the last entry recorded when |recent| were.
+    limit: maximum number of entries to return, None for all of them.
+  Returns:
+    A list of (host identifier, entry) pairs in the order they were recorded.
+  """
+  recent_seqs = set(entry['seq'] for _, entry in recent)
+  entries = heapq.merge(
+      ((seq, host_id, entry) for seq, host_id, entry in archived
+       if seq not in recent_seqs),
+      ((entry['seq'], host_id, entry) for host_id, entry in recent))
+  return [(host_id, entry)
+          for _, host_id, entry in itertools.islice(entries, limit)]
 
 
 class HostInfoTable(object):
   """Records information about a set of hosts who engage in update activity.
 
+  All methods that modify the table operate on the table as a whole, so that
+  it can also be shared between processes through a SharedStateManager.
+
   Members:
     table: Table of information on hosts.
   """
 
-  def __init__(self):
+  def __init__(self, max_log_entries=host_log.DEFAULT_MAX_ENTRIES,
+               log_archive_path=None,
+               log_archive_bytes=host_log.DEFAULT_MAX_FILE_BYTES,
+               db_path=None):
+    """Initializes the table.
+
+    Args:
+      max_log_entries: number of log entries kept in memory per host.
+      log_archive_path: file to append the entries dropped from memory to,
+                        None to forget them.
+      log_archive_bytes: size of the log archive before it is rotated.
+      db_path: SQLite database to persist host attributes in, None to only
+               keep them in memory.
+    """
     # A dictionary of host information. Keys are normally IP addresses.
     self.table = {}
+    self._lock = threading.Lock()
+    self._max_log_entries = max_log_entries
+    self._log_archive = None
+    # Sequence number of the last log entry.
+    self._log_seq = 0
+    if log_archive_path:
+      self._log_archive = host_log.HostLogArchive(log_archive_path,
+                                                  max_bytes=log_archive_bytes)
+      self._log_seq = self._log_archive.GetMaxSeq()
+    # Attributes are still read from memory; the database restores them on
+    # restart and answers queries by attribute.
+    self._db = None
+    if db_path:
+      self._db = host_db.HostDatabase(db_path)
+      for host_id, attrs in self._db.Load():
+        self.GetInitHostInfo(host_id).attrs = attrs
 
   def __repr__(self):
     return '%s' % self.table
 
   def GetInitHostInfo(self, host_id):
     """Return a host's info object, or create a new one if none exists."""
-    return self.table.setdefault(host_id, HostInfo())
+    host_info = self.table.get(host_id)
+    if not host_info:
+      host_info = HostInfo(host_id, max_log_entries=self._max_log_entries,
+                           log_archive=self._log_archive)
+      self.table[host_id] = host_info
+    return host_info
 
   def GetHostInfo(self, host_id):
     """Return an info object for given host, if such exists."""
     return self.table.get(host_id)
 
+  def RecordPing(self, host_id, attrs, log_entry=None):
+    """Records the attributes reported by a host in an update ping.
+
+    Args:
+      host_id: the host identifier (normally its IP address).
+      attrs: dictionary of attributes to update.
+      log_entry: if not None, a dictionary to append to the host's log.
+    Returns:
+      The update label forced for this host by HandleSetUpdatePing, if any.
+      The label is cleared, so it only applies to one update ping.
+    """
+    with self._lock:
+      host_info = self.GetInitHostInfo(host_id)
+      host_info.attrs.update(attrs)
+      if log_entry is not None:
+        self._log_seq += 1
+        host_info.AddLogEntry(log_entry, self._log_seq)
+      forced_update_label = host_info.attrs.pop('forced_update_label', None)
+      self._StoreAttrs(host_id, host_info)
+      return forced_update_label
+
+  def SetAttr(self, host_id, name, value):
+    """Sets a single attribute of a host, creating the host if needed."""
+    with self._lock:
+      host_info = self.GetInitHostInfo(host_id)
+      host_info.attrs[name] = value
+      self._StoreAttrs(host_id, host_info)
+
+  def _StoreAttrs(self, host_id, host_info):
+    """Queues the attributes of a host for the database; call with _lock."""
+    if self._db:
+      self._db.Store(host_id, dict(host_info.attrs))
+
+  def GetAttrs(self, host_id):
+    """Returns a copy of a host's attributes, or None for unknown hosts."""
+    with self._lock:
+      host_info = self.GetHostInfo(host_id)
+      return dict(host_info.attrs) if host_info else None
+
+  def GetAttrsPage(self, after_host_id=None, limit=None):
+    """Returns the attributes of hosts in the order of their identifiers.
+
+    Args:
+      after_host_id: only return hosts whose identifier sorts after this one,
+                     all of them if None.
+      limit: maximum number of hosts to return, None for all of them.
+    Returns:
+      A list of (host identifier, copy of attributes) pairs.
+    """
+    with self._lock:
+      host_ids = sorted(self.table)
+      start = 0
+      if after_host_id is not None:
+        start = bisect.bisect_right(host_ids, after_host_id)
+      end = len(host_ids) if limit is None else start + limit
+      return [(host_id, dict(self.table[host_id].attrs))
+              for host_id in host_ids[start:end]]
+
+  def FindHosts(self, version=None, board=None, event_type=None,
+                event_result=None, after_host_id=None, limit=None):
+    """Returns the hosts matching all of the given criteria.
+
+    Args:
+      version: only return hosts last known to run this version.
+      board: only return hosts of this board.
+      event_type: only return hosts whose last event is of this type.
+      event_result: only return hosts whose last event had this result.
+      after_host_id: only return hosts whose identifier sorts after this one.
+      limit: maximum number of hosts to return, None for all of them.
+    Returns:
+      A list of (host identifier, copy of attributes) pairs in the order of
+      their identifiers.
+    """
+    if self._db:
+      return self._db.FindHosts(version=version, board=board,
+                                event_type=event_type,
+                                event_result=event_result,
+                                after_host_id=after_host_id, limit=limit)
+
+    # Without a database, look at every host.
+    criteria = [(name, value) for name, value in
+                (('last_known_version', version), ('board', board),
+                 ('last_event_type', event_type),
+                 ('last_event_status', event_result))
+                if value is not None]
+    hosts = []
+    for host_id, attrs in self.GetAttrsPage(after_host_id=after_host_id):
+      if limit is not None and len(hosts) >= limit:
+        break
+      if all(attrs.get(name) == value for name, value in criteria):
+        hosts.append((host_id, attrs))
+    return hosts
+
+  def GetRolloutProgress(self, board=None):
+    """Returns the number of hosts on each version, per board.
+
+    Args:
+      board: only count the hosts of this board, all of them if None.
+    Returns:
+      A dictionary of {version: number of hosts} dictionaries keyed by board.
+    """
+    if self._db:
+      return self._db.GetRolloutProgress(board=board)
+
+    progress = {}
+    with self._lock:
+      for host_info in self.table.itervalues():
+        host_board = host_info.attrs.get('board')
+        if board is not None and host_board != board:
+          continue
+        versions = progress.setdefault(host_board, {})
+        version = host_info.attrs.get('last_known_version')
+        versions[version] = versions.get(version, 0) + 1
+    return progress
+
+  def GetHostIds(self):
+    """Returns the sorted identifiers of the hosts with attributes or logs."""
+    with self._lock:
+      host_ids = set(self.table)
+    if self._log_archive:
+      host_ids.update(self._log_archive.GetHostIds())
+    return sorted(host_ids)
+
+  @staticmethod
+  def _IterLogRecords(host_info, after_seq, log_filter):
+    """Yields (seq, host, record) for the selected records of a host."""
+    host_id = host_info.log.host_id
+    for record in host_info.log.IterRecords(after_seq, log_filter):
+      yield record.seq, host_id, record
+
+  def GetLogArchivePath(self):
+    """Returns the path of the log archive, None if entries are not archived."""
+    return self._log_archive and self._log_archive.path
+
+  def QueryRecentLogs(self, host_id=None, after_seq=0, limit=None, since=None,
+                      until=None, event_type=None, event_result=None):
+    """Returns the log entries held in memory, as QueryLogs() does.
+
+    Returns:
+      A (entries, seq) tuple: the list of (host identifier, entry dictionary)
+      pairs selected, and the sequence number of the last entry recorded by
+      then. Entries archived by then complete the selection, up to that
+      sequence number.
+    """
+    log_filter = host_log.LogFilter(since=since, until=until,
+                                    event_type=event_type,
+                                    event_result=event_result)
+    with self._lock:
+      if host_id is None:
+        host_infos = self.table.values()
+      else:
+        host_infos = filter(None, [self.GetHostInfo(host_id)])
+      # Each host's records are in order, so merging them keeps them so.
+      records = heapq.merge(*[
+          self._IterLogRecords(host_info, after_seq, log_filter)
+          for host_info in host_infos])
+      recent = list(itertools.islice(records, limit))
+      max_seq = self._log_seq
+    return ([(entry_host_id, record.ToDict())
+             for _, entry_host_id, record in recent], max_seq)
+
+  def QueryLogs(self, host_id=None, after_seq=0, limit=None, since=None,
+                until=None, event_type=None, event_result=None):
+    """Returns log entries in the order they were recorded.
+
+    Args:
+      host_id: only return the entries of this host, of all hosts if None.
+      after_seq: only return entries with a higher sequence number, i.e.
+                 recorded after the entry with this `seq'.
+      limit: maximum number of entries to return, None for all of them.
+      since: only return entries recorded at or after this time, in seconds
+             since the epoch; None for no lower bound.
+      until: only return entries recorded before this time; None for no upper
+             bound.
+      event_type: only return entries of this event type, None for any.
+      event_result: only return entries with this event result, None for any.
+    Returns:
+      A list of (host identifier, entry dictionary) pairs. The `seq' of the
+      last entry is the cursor to pass as |after_seq| for the next page.
+    """
+    recent, max_seq = self.QueryRecentLogs(
+        host_id=host_id, after_seq=after_seq, limit=limit, since=since,
+        until=until, event_type=event_type, event_result=event_result)
+    if not self._log_archive:
+      return recent
+
+    # Reading the archive takes long; don't hold up update pings meanwhile.
+    archived = self._log_archive.Query(
+        host_id=host_id, after_seq=after_seq, limit=limit,
+        log_filter=host_log.LogFilter(since=since, until=until,
+                                      event_type=event_type,
+                                      event_result=event_result),
+        until_seq=max_seq)
+    return _MergeLogEntries(recent, archived, limit)
+
+  def GetLog(self, host_id):
+    """Returns a copy of a host's log, or None for unknown hosts.
+
+    Entries moved to the log archive come first.
+    """
+    # The host may have been seen before a restart, only in the archive.
+    log = [entry for _, entry in self.QueryLogs(host_id=host_id)]
+    if not log and self.GetAttrs(host_id) is None:
+      return None
+    return log
+
+  def GetAllLogs(self):
+    """Returns a dictionary of all host logs keyed by host identifier."""
+    logs = dict((host_id, []) for host_id in self.GetHostIds())
+    for host_id, entry in self.QueryLogs():
+      logs.setdefault(host_id, []).append(entry)
+    return logs
+
+
+class UpdateBudget(object):
+  """Limits the number of update checks that are answered with an update."""
+
+  def __init__(self, max_updates=-1):
+    """Initializes the budget.
+
+    Args:
+      max_updates: number of updates to provision; negative for unlimited.
+    """
+    self._remaining = max_updates
+    self._lock = threading.Lock()
+
+  def Consume(self):
+    """Takes one update from the budget; returns False if none are left."""
+    with self._lock:
+      if self._remaining == 0:
+        return False
+      if self._remaining > 0:
+        self._remaining -= 1
+      return True
+
+
+class SharedStateManager(managers.BaseManager):
+  """Serves host information, the update budget and the cache to processes.
+
+  Start the manager before forking server processes, then hand the proxies
+  returned by HostInfoTable(), UpdateBudget() and CacheManager() to each
+  process' Autoupdate object, so all of them see the same state.
+  """
+  pass
+
+
+SharedStateManager.register('HostInfoTable', HostInfoTable)
+SharedStateManager.register('UpdateBudget', UpdateBudget)
+SharedStateManager.register('CacheManager', cache_manager.CacheManager,
+                            proxytype=cache_manager.CacheManagerProxy)
+
+
+def _IterJsonList(items):
+  """Yields a JSON list of |items|, piece by piece."""
+  yield '['
+  for index, item in enumerate(items):
+    yield '%s%s' % (', ' if index else '', json.dumps(item))
+  yield ']'
+
+
+def _GetFileSignature(path):
+  """Returns a tuple identifying the current contents of |path|.
+
+  Returns None if the file does not exist.
+  """
+  try:
+    file_stat = os.stat(path)
+  except OSError:
+    return None
+  return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+          file_stat.st_mtime)
+
+
+class PayloadResponseCache(object):
+  """Remembers which payload answers an update check.
+
+  Each entry holds the URL and metadata of the payload served for a key,
+  along with the signatures of the files the answer was derived from. An
+  entry is only used while none of these files have changed.
+  """
+
+  def __init__(self):
+    self._entries = {}
+    self._lock = threading.Lock()
+    self._hits = 0
+    self._misses = 0
+    self._invalidations = 0
+
+  def Get(self, key):
+    """Returns the (url, metadata) cached for |key|, None if absent or stale."""
+    with self._lock:
+      entry = self._entries.get(key)
+    if entry:
+      signatures, url, metadata_obj = entry
+      if all(_GetFileSignature(path) == signature
+             for path, signature in signatures):
+        with self._lock:
+          self._hits += 1
+        return url, metadata_obj
+
+    with self._lock:
+      self._misses += 1
+      if entry:
+        self._invalidations += 1
+        self._entries.pop(key, None)
+    return None
+
+  def Put(self, key, paths, url, metadata_obj):
+    """Caches the payload served for |key|, valid until any of |paths| change.
+    """
+    signatures = [(path, _GetFileSignature(path)) for path in paths]
+    with self._lock:
+      self._entries[key] = (signatures, url, metadata_obj)
+
+  def GetStats(self):
+    """Returns a dictionary of cache statistics."""
+    with self._lock:
+      return {'entries': len(self._entries),
+              'hits': self._hits,
+              'misses': self._misses,
+              'invalidations': self._invalidations}
+
 
 class UpdateMetadata(object):
   """Object containing metadata about an update payload."""
@@ -129,6 +546,7 @@ class Autoupdate(object):
     src_image:       if specified, creates a delta payload from this image.
     proxy_port:      port of local proxy to tell client to connect to you
                      through.
+    static_port:     port of the dedicated payload server, if any.
     vm:              set for VM images (doesn't patch kernel)
     board:           board for the image. Needed for pre-generating of updates.
     copy_to_static_root:  copies images generated from the cache to ~/static.
@@ -137,6 +555,22 @@ class Autoupdate(object):
     remote_payload:   whether provisioned payload is remotely staged.
     max_updates:      maximum number of updates we'll try to provision.
     host_log:         record full history of host update events.
+    host_infos:       HostInfoTable (or a proxy to a shared one) to use.
+    update_budget:    UpdateBudget (or a proxy to a shared one) to use instead
+                      of one derived from max_updates.
+    max_generations:  maximum number of payloads generated at the same time.
+    generation_wait:  seconds an update check waits for its payload to be
+                      generated before it is answered with no update; None to
+                      wait until it is done.
+    cache_manager:    CacheManager of the payload cache directory, if any.
+    delta_index:      DeltaIndex of pregenerated delta payloads, if any.
+    max_request_size: largest update request accepted, in bytes.
+    remote_file_info: devserver_client.RemoteFileInfoCache remote payload
+                      attributes are looked up in; one is created if not set.
+    pool:             devserver_pool.DevserverPool payloads are sharded across,
+                      if any.
+    mirror_selector:  mirror_selector.MirrorSelector of the mirrors payloads
+                      are offered from, if any.
   """
 
   _PAYLOAD_URL_PREFIX = '/static/'
@@ -149,11 +583,16 @@ class Autoupdate(object):
 
   def __init__(self, serve_only=None, test_image=False, urlbase=None,
                forced_image=None, payload_path=None,
-               proxy_port=None, src_image='', vm=False, board=None,
+               proxy_port=None, static_port=None, src_image='', vm=False,
+               board=None,
                copy_to_static_root=True, private_key=None,
                critical_update=False, remote_payload=False, max_updates= -1,
                host_log=False, devserver_dir=None, scripts_dir=None,
-               static_dir=None):
+               static_dir=None, host_infos=None, update_budget=None,
+               max_generations=DEFAULT_MAX_GENERATIONS, generation_wait=None,
+               cache_manager=None, delta_index=None,
+               max_request_size=autoupdate_lib.DEFAULT_MAX_REQUEST_SIZE,
+               remote_file_info=None, pool=None, mirror_selector=None):
     self.devserver_dir = devserver_dir,
     self.scripts_dir = scripts_dir
     self.static_dir = static_dir
@@ -168,13 +607,15 @@ class Autoupdate(object):
     self.payload_path = payload_path
     self.src_image = src_image
     self.proxy_port = proxy_port
+    self.static_port = static_port
     self.vm = vm
     self.board = board
     self.copy_to_static_root = copy_to_static_root
     self.private_key = private_key
     self.critical_update = critical_update
     self.remote_payload = remote_payload
-    self.max_updates = max_updates
+    self.update_budget = (update_budget if update_budget is not None
+                          else UpdateBudget(max_updates))
     self.host_log = host_log
 
     # Path to pre-generated file.
@@ -184,7 +625,36 @@ class Autoupdate(object):
     # information about a given host.  A host is identified by its IP address.
     # The info stored for each host includes a complete log of events for this
     # host, as well as a dictionary of current attributes derived from events.
-    self.host_infos = HostInfoTable()
+    self.host_infos = (host_infos if host_infos is not None
+                       else HostInfoTable())
+
+    # Payloads served for previous update checks.
+    self.response_cache = PayloadResponseCache()
+
+    # (stat signature, MD5) of images and keys, keyed by path.
+    self._file_md5s = {}
+
+    # Payload generation jobs.
+    self.generation_scheduler = generation_scheduler.GenerationScheduler(
+        max_generations, pool_name='generation')
+    self.generation_wait = generation_wait
+    self.cache_manager = cache_manager
+    self.delta_index = delta_index
+    self.max_request_size = max_request_size
+    # Attributes of payloads staged on remote devservers.
+    self.remote_file_info = (remote_file_info if remote_file_info is not None
+                             else devserver_client.RemoteFileInfoCache())
+    self.pool = pool
+    self.mirror_selector = mirror_selector
+
+  @classmethod
+  def _ReadMetadataFromDict(cls, file_attr_dict):
+    """Returns metadata obj from a dictionary of file attributes."""
+    sha1 = file_attr_dict.get(cls.SHA1_ATTR)
+    sha256 = file_attr_dict.get(cls.SHA256_ATTR)
+    size = file_attr_dict.get(cls.SIZE_ATTR)
+    is_delta = file_attr_dict.get(cls.ISDELTA_ATTR)
+    return UpdateMetadata(sha1, sha256, size, is_delta)
 
   @classmethod
   def _ReadMetadataFromStream(cls, stream):
@@ -195,11 +665,7 @@ class Autoupdate(object):
     except IOError:
       return None
 
-    sha1 = file_attr_dict.get(cls.SHA1_ATTR)
-    sha256 = file_attr_dict.get(cls.SHA256_ATTR)
-    size = file_attr_dict.get(cls.SIZE_ATTR)
-    is_delta = file_attr_dict.get(cls.ISDELTA_ATTR)
-    return UpdateMetadata(sha1, sha256, size, is_delta)
+    return cls._ReadMetadataFromDict(file_attr_dict)
 
   @staticmethod
   def _ReadMetadataFromFile(payload_dir, legacy_image):
@@ -223,8 +689,11 @@ class Autoupdate(object):
       metadata_file = os.path.join(payload_dir, METADATA_FILE)
     else:
       metadata_file = os.path.join(payload_dir, KERNEL_METADATA_FILE)
-    with open(metadata_file, 'w') as file_handle:
+    # Written aside and renamed so that concurrent readers never see it partial.
+    fd, temp_path = tempfile.mkstemp(dir=payload_dir)
+    with os.fdopen(fd, 'w') as file_handle:
       json.dump(file_dict, file_handle)
+    os.rename(temp_path, metadata_file)
 
   def _GetLatestImageDir(self, board):
     """Returns the latest image dir based on shell script."""
@@ -307,6 +776,19 @@ class Autoupdate(object):
     _Log('Running %s', ' '.join(update_command))
     subprocess.check_call(update_command)
 
+  def _GetFileMd5(self, path):
+    """Returns the MD5 of |path|, only hashing it if it changed since last time.
+    """
+    signature = _GetFileSignature(path)
+    if signature is None:
+      return common_util.GetFileMd5(path)
+
+    known_signature, md5 = self._file_md5s.get(path, (None, None))
+    if known_signature != signature:
+      md5 = common_util.GetFileMd5(path)
+      self._file_md5s[path] = (signature, md5)
+    return md5
+
   def FindCachedUpdateImageSubDir(self, src_image, dest_image):
     """Find directory to store a cached update.
 
@@ -324,29 +806,34 @@ class Autoupdate(object):
     """
     update_dir = ''
     if src_image:
-      update_dir += common_util.GetFileMd5(src_image) + '_'
+      update_dir += self._GetFileMd5(src_image) + '_'
 
-    update_dir += common_util.GetFileMd5(dest_image)
+    update_dir += self._GetFileMd5(dest_image)
     if self.private_key:
-      update_dir += '+' + common_util.GetFileMd5(self.private_key)
+      update_dir += '+' + self._GetFileMd5(self.private_key)
 
     if not self.vm:
       update_dir += '+patched_kernel'
 
     return os.path.join(CACHE_DIR, update_dir)
 
-  def GenerateUpdateImage(self, image_path, output_dir, legacy_image):
+  def GenerateUpdateImage(self, image_path, output_dir, legacy_image,
+                          src_image=None):
     """Force generates an update payload based on the given image_path.
 
     Args:
-      src_image: image we are updating from (Null/empty for non-delta)
       image_path: full path to the image.
       output_dir: the directory to write the update payloads to
+      legacy_image: whether to generate a payload without the kernel.
+      src_image: image we are updating from (Null/empty for non-delta);
+                 defaults to the src_image member.
     Raises:
       AutoupdateError if it failed to generate either update or stateful
         payload.
     """
     _Log('Generating update for image %s', image_path)
+    if src_image is None:
+      src_image = self.src_image
 
     try:
       os.makedirs(output_dir)
@@ -355,29 +842,79 @@ class Autoupdate(object):
         pass
 
     try:
-      self.GenerateUpdateFile(self.src_image, image_path, output_dir,
-                              legacy_image)
+      with metrics.PAYLOAD_GENERATION.Time(
+          ('delta' if src_image else 'full',)):
+        self.GenerateUpdateFile(src_image, image_path, output_dir,
+                                legacy_image)
     except subprocess.CalledProcessError:
       os.system('rm -rf "%s"' % output_dir)
       raise AutoupdateError('Failed to generate update in %s' % output_dir)
 
+  def _PinnedCacheEntry(self, path):
+    """Returns a context keeping the cache entry of |path| from eviction."""
+    if self.cache_manager:
+      return self.cache_manager.Pinned(path)
+    return _NoOpContext()
+
+  def _ScheduleUpdateImage(self, image_path, output_dir, update_payload,
+                           legacy_image, src_image):
+    """Generates |update_payload|, joining any generation already under way.
+
+    Args:
+      image_path: full path to the image.
+      output_dir: the directory to write the update payloads to.
+      update_payload: the payload file expected in output_dir.
+      legacy_image: whether to generate a payload without the kernel.
+      src_image: image we are updating from (empty for non-delta).
+    Raises:
+      GenerationPendingError if the payload was not generated within
+        generation_wait seconds.
+      AutoupdateError if it failed to generate the payload.
+    """
+    def _Generate():
+      # Other devserver processes may be generating the same payload.
+      with self._PinnedCacheEntry(output_dir), common_util.BreakableFileLock(
+          output_dir, _GENERATION_LOCK_MAX_AGE):
+        if not os.path.exists(update_payload):
+          self.GenerateUpdateImage(image_path, output_dir, legacy_image,
+                                   src_image)
+        if self.cache_manager:
+          self.cache_manager.Update(output_dir)
+
+    try:
+      self.generation_scheduler.Run(
+          update_payload, 'generation of %s' % update_payload, _Generate,
+          self.generation_wait)
+    except generation_scheduler.GenerationPending as e:
+      raise GenerationPendingError(str(e))
+
   def GenerateUpdateImageWithCache(self, image_path, static_image_dir,
-                                   legacy_image):
+                                   legacy_image, src_image=None,
+                                   copy_to_static_root=None):
     """Force generates an update payload based on the given image_path.
 
     Args:
       image_path: full path to the image.
       static_image_dir: the directory to move images to after generating.
+      legacy_image: whether to generate a payload without the kernel.
+      src_image: image to generate a delta from, empty for a full payload;
+                 defaults to the src_image member.
+      copy_to_static_root: whether to copy the payload to static_image_dir;
+                           defaults to the copy_to_static_root member.
     Returns:
       update directory relative to static_image_dir. None if it should
       serve from the static_image_dir.
     Raises:
       AutoupdateError if it we need to generate a payload and fail to do so.
     """
-    _Log('Generating update for src %s image %s', self.src_image, image_path)
+    if src_image is None:
+      src_image = self.src_image
+    if copy_to_static_root is None:
+      copy_to_static_root = self.copy_to_static_root
+    _Log('Generating update for src %s image %s', src_image, image_path)
 
     # Which sub_dir of static_image_dir should hold our cached update image
-    cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image, image_path)
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image, image_path)
     _Log('Caching in sub_dir "%s"', cache_sub_dir)
 
     # The cached payloads exist in a cache dir
@@ -389,34 +926,47 @@ class Autoupdate(object):
                                           cache_sub_dir, KERNEL_UPDATE_FILE)
 
     full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
-    # Check to see if this cache directory is valid.
-    if not os.path.exists(cache_update_payload):
-      self.GenerateUpdateImage(image_path, full_cache_dir, legacy_image)
+    with self._PinnedCacheEntry(full_cache_dir):
+      # Check to see if this cache directory is valid.
+      is_cached = os.path.exists(cache_update_payload)
+      if self.cache_manager:
+        self.cache_manager.RecordUse(cache_update_payload, is_cached)
+      if not is_cached:
+        self._ScheduleUpdateImage(image_path, full_cache_dir,
+                                  cache_update_payload, legacy_image,
+                                  src_image)
+
+      # Generate the cache file.
+      self.GetLocalPayloadAttrs(full_cache_dir, legacy_image)
+      if legacy_image:
+        cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
+      else:
+        cache_metadata_file = os.path.join(full_cache_dir,
+                                           KERNEL_METADATA_FILE)
 
-    # Generate the cache file.
-    self.GetLocalPayloadAttrs(full_cache_dir, legacy_image)
-    if legacy_image:
-      cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
-    else:
-      cache_metadata_file = os.path.join(full_cache_dir, KERNEL_METADATA_FILE)
+      # Generation complete, copy if requested.
+      if copy_to_static_root:
+        # The final results exist directly in static
+        if legacy_image:
+          update_payload = os.path.join(static_image_dir,
+                                        UPDATE_FILE)
+          metadata_file = os.path.join(static_image_dir, METADATA_FILE)
+        else:
+          update_payload = os.path.join(static_image_dir,
+                                        KERNEL_UPDATE_FILE)
+          metadata_file = os.path.join(static_image_dir, KERNEL_METADATA_FILE)
 
-    # Generation complete, copy if requested.
-    if self.copy_to_static_root:
-      # The final results exist directly in static
-      if legacy_image:
-        update_payload = os.path.join(static_image_dir,
-                                      UPDATE_FILE)
-        metadata_file = os.path.join(static_image_dir, METADATA_FILE)
+        common_util.CopyFile(cache_update_payload, update_payload)
+        common_util.CopyFile(cache_metadata_file, metadata_file)
+        return None
       else:
-        update_payload = os.path.join(static_image_dir,
-                                      KERNEL_UPDATE_FILE)
-        metadata_file = os.path.join(static_image_dir, KERNEL_METADATA_FILE)
+        return cache_sub_dir
 
-      common_util.CopyFile(cache_update_payload, update_payload)
-      common_util.CopyFile(cache_metadata_file, metadata_file)
-      return None
-    else:
-      return cache_sub_dir
+  def GetLatestImage(self, board):
+    """Returns the version and path of the latest image built for |board|."""
+    latest_image_dir = self._GetLatestImageDir(board)
+    return (self._GetVersionFromDir(latest_image_dir),
+            os.path.join(latest_image_dir, self._GetImageName()))
 
   def GenerateLatestUpdateImage(self, board, client_version,
                                 static_image_dir, legacy_image):
@@ -436,9 +986,7 @@ class Autoupdate(object):
       AutoupdateError if it failed to generate the payload or can't update
         the given client_version.
     """
-    latest_image_dir = self._GetLatestImageDir(board)
-    latest_version = self._GetVersionFromDir(latest_image_dir)
-    latest_image_path = os.path.join(latest_image_dir, self._GetImageName())
+    latest_version, latest_image_path = self.GetLatestImage(board)
 
      # Check to see whether or not we should update.
     if client_version != 'ForcedUpdate' and not self._CanUpdate(
@@ -446,6 +994,20 @@ class Autoupdate(object):
       raise AutoupdateError('Update check received but no update available '
                             'for client')
 
+    # Prefer a pregenerated delta from the client's version.
+    if (self.delta_index and legacy_image and
+        os.path.abspath(static_image_dir) == os.path.abspath(self.static_dir)):
+      delta_dir = self.delta_index.Lookup(board, client_version,
+                                          latest_version)
+      delta_payload = delta_dir and os.path.join(static_image_dir, delta_dir,
+                                                 UPDATE_FILE)
+      if delta_payload and os.path.exists(delta_payload):
+        _Log('Serving pregenerated delta from %s in %s', client_version,
+             delta_dir)
+        if self.cache_manager:
+          self.cache_manager.RecordUse(delta_payload, True)
+        return delta_dir
+
     return self.GenerateUpdateImageWithCache(latest_image_path,
                                              static_image_dir=static_image_dir,
                                              legacy_image=legacy_image)
@@ -499,8 +1061,13 @@ class Autoupdate(object):
     """
     _Log('Pre-generating the update payload')
     # Does not work with labels so just use static dir.
-    pregenerated_update = self.GenerateUpdatePayload(self.board, '0.0.0.0',
-                                                     self.static_dir)
+    while True:
+      try:
+        pregenerated_update = self.GenerateUpdatePayload(self.board, '0.0.0.0',
+                                                         self.static_dir)
+        break
+      except GenerationPendingError:
+        _Log('Still waiting for the update payload')
     print 'PREGENERATED_UPDATE=%s' % _NonePathJoin(pregenerated_update,
                                                    UPDATE_FILE)
     return pregenerated_update
@@ -528,18 +1095,18 @@ class Autoupdate(object):
                                self._FILEINFO_URL_PREFIX)
     _Log('Retrieving file info for remote payload via %s', fileinfo_url)
     try:
-      conn = urllib2.urlopen(fileinfo_url)
-      metadata_obj = Autoupdate._ReadMetadataFromStream(conn)
-      # These fields are required for remote calls.
-      if not metadata_obj:
-        raise AutoupdateError('Failed to obtain remote payload info')
+      file_info = self.remote_file_info.GetFileInfo(fileinfo_url)
+    except devserver_client.DevserverClientError as e:
+      raise AutoupdateError('Failed to obtain remote payload info: %s' % e)
 
-      if not metadata_obj.is_delta_format:
-        metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
+    # These fields are required for remote calls.
+    if not isinstance(file_info, dict):
+      raise AutoupdateError('Failed to obtain remote payload info')
+    metadata_obj = Autoupdate._ReadMetadataFromDict(file_info)
+    if not metadata_obj.is_delta_format:
+      metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
 
-      return metadata_obj
-    except IOError as e:
-      raise AutoupdateError('Failed to obtain remote payload info: %s', e)
+    return metadata_obj
 
   def GetLocalPayloadAttrs(self, payload_dir, legacy_image):
     """Returns hashes, size and delta flag of a local update payload.
@@ -571,19 +1138,26 @@ class Autoupdate(object):
 
     return metadata_obj
 
-  def _ProcessUpdateComponents(self, app, event):
+  @staticmethod
+  def _GetClientIp():
+    """Returns the IP address of the client, without any IPv6 data."""
+    return cherrypy.request.remote.ip.split(':')[-1]
+
+  def _ProcessUpdateComponents(self, app, event, record=True):
     """Processes the app and event components of an update request.
 
+    The host's attributes and event are recorded if |record| is set.
+
     Returns tuple containing forced_update_label, client_version, board and
     app_id
     """
     # Initialize an empty dictionary for event attributes to log.
     log_message = {}
+    # Current attributes of the host derived from this request.
+    host_attrs = {}
 
     # Determine request IP, strip any IPv6 data for simplicity.
-    client_ip = cherrypy.request.remote.ip.split(':')[-1]
-    # Obtain (or init) info object for this client.
-    curr_host_info = self.host_infos.GetInitHostInfo(client_ip)
+    client_ip = self._GetClientIp()
 
     client_version = 'ForcedUpdate'
     board = None
@@ -598,7 +1172,8 @@ class Autoupdate(object):
       log_message['version'] = client_version
       log_message['track'] = channel
       log_message['board'] = board
-      curr_host_info.attrs['last_known_version'] = client_version
+      host_attrs['last_known_version'] = client_version
+      host_attrs['board'] = board
 
     if event:
       event_result = int(event[0].getAttribute('eventresult'))
@@ -607,25 +1182,33 @@ class Autoupdate(object):
                                  if event[0].hasAttribute('previousversion')
                                  else None)
       # Store attributes to legacy host info structure
-      curr_host_info.attrs['last_event_status'] = event_result
-      curr_host_info.attrs['last_event_type'] = event_type
+      host_attrs['last_event_status'] = event_result
+      host_attrs['last_event_type'] = event_type
       # Add attributes to log message
       log_message['event_result'] = event_result
       log_message['event_type'] = event_type
       if client_previous_version is not None:
         log_message['previous_version'] = client_previous_version
 
-    # Log host event, if so instructed.
-    if self.host_log:
-      curr_host_info.AddLogEntry(log_message)
+    # Record the host's attributes and log its event, if so instructed.
+    forced_update_label = None
+    if record:
+      forced_update_label = self.host_infos.RecordPing(
+          client_ip, host_attrs, log_message if self.host_log else None)
+
+    return forced_update_label, client_version, board, app_id
 
-    return (curr_host_info.attrs.pop('forced_update_label', None),
-            client_version, board, app_id)
+  def _GetStaticUrl(self, payload_host=None):
+    """Returns the static url base that should prefix all payload responses.
 
-  def _GetStaticUrl(self):
-    """Returns the static url base that should prefix all payload responses."""
+    Args:
+      payload_host: base URL of the devserver payloads are downloaded from, if
+          not the one handling the request.
+    """
     x_forwarded_host = cherrypy.request.headers.get('X-Forwarded-Host')
-    if x_forwarded_host:
+    if payload_host:
+      hostname = payload_host
+    elif x_forwarded_host:
       hostname = 'http://' + x_forwarded_host
     else:
       hostname = cherrypy.request.base
@@ -637,6 +1220,10 @@ class Autoupdate(object):
     else:
       static_urlbase = '%s/static' % hostname
 
+    # Payloads are downloaded from the dedicated payload server, if any.
+    if self.static_port and not self.urlbase:
+      static_urlbase = _ChangeUrlPort(static_urlbase, self.static_port)
+
     # If we have a proxy port, adjust the URL we instruct the client to
     # use to go through the proxy.
     if self.proxy_port:
@@ -646,6 +1233,88 @@ class Autoupdate(object):
     _Log('Handling update ping as %s', hostname)
     return static_urlbase
 
+  def _CanCacheResponse(self):
+    """Returns whether the payload served depends on its files only.
+
+    The latest image for a board depends on the client version and on which
+    images exist, so it is looked up on every update check.
+    """
+    return bool(self.serve_only or self.payload_path or self.forced_image)
+
+  def _GetLocalPayload(self, board, client_version, static_urlbase, label,
+                       legacy_image, cache_key):
+    """Returns the URL and metadata of the local payload to serve.
+
+    Generates the payload if necessary and caches the result under |cache_key|
+    if it may be reused for later update checks.
+    """
+    static_image_dir = _NonePathJoin(self.static_dir, label)
+    rel_path = None
+
+    # Serving files only, don't generate an update.
+    if not self.serve_only:
+      # Generate payload if necessary.
+      rel_path = self.GenerateUpdatePayload(board, client_version,
+                                            static_image_dir, legacy_image)
+
+    if legacy_image:
+      filename = UPDATE_FILE
+      metadata_filename = METADATA_FILE
+    else:
+      filename = KERNEL_UPDATE_FILE
+      metadata_filename = KERNEL_METADATA_FILE
+    url = '/'.join(filter(None, [static_urlbase, label, rel_path, filename]))
+    local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
+    metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir, legacy_image)
+
+    if self._CanCacheResponse():
+      paths = [os.path.join(local_payload_dir, filename),
+               os.path.join(local_payload_dir, metadata_filename)]
+      paths.extend(filter(None, [self.payload_path, self.forced_image,
+                                 self.src_image]))
+      self.response_cache.Put(cache_key, paths, url, metadata_obj)
+
+    return url, metadata_obj
+
+  def _IsForwardedUpdateCheck(self):
+    """Returns whether the request was forwarded by a member of the pool."""
+    member = cherrypy.request.headers.get(devserver_pool.FORWARDED_HEADER)
+    if not self.pool or not member:
+      return False
+    if self.pool.IsForwardedBy(member, cherrypy.request.remote.ip):
+      return True
+    _Log('Ignoring update check from %s claiming to be forwarded by %s',
+         cherrypy.request.remote.ip, member)
+    return False
+
+  def _GetPayloadKey(self, label, board, legacy_image):
+    """Returns the identity of the payload served for an update check.
+
+    Update checks for the same key are answered with the same payload, so it
+    is what payloads are sharded across a pool by.
+    """
+    return '/'.join([label or '', board or '',
+                     'legacy' if legacy_image else 'kernel'])
+
+  def _GetMirrorUrls(self, url, static_urlbase, protocol, size):
+    """Returns the URLs of payload |url| on the least loaded mirrors first.
+
+    Only the mirrors found to serve the payload, a file of |size| bytes, are
+    offered. Only protocol 3.0 clients are given more than one URL.
+    """
+    if not url.startswith(static_urlbase):
+      return [url]
+    # Mirrors serve payloads under the same paths as this devserver.
+    path = urlparse.urlsplit(url).path
+    urls = []
+    for mirror in self.mirror_selector.RankMirrors(
+        None if protocol == '3.0' else 1, path=path, size=size):
+      if mirror is None:
+        urls.append(url)
+      else:
+        urls.append(mirror + path)
+    return urls
+
   def HandleUpdatePing(self, data, label=None):
     """Handles an update ping from an update client.
 
@@ -654,19 +1323,23 @@ class Autoupdate(object):
       label: optional label for the update.
     Returns:
       Update payload message for client.
+    Raises:
+      autoupdate_lib.InvalidUpdateRequestException if |data| is not a valid
+      update request.
     """
-    # Get the static url base that will form that base of our update url e.g.
-    # http://hostname:8080/static/update.gz.
-    static_urlbase = self._GetStaticUrl()
-
     _Log(data)
     # Parse the XML we got into the components we care about.
-    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(data)
+    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(
+        data, self.max_request_size)
+
+    # Update checks forwarded by another member of the pool were recorded and
+    # counted there.
+    forwarded = self._IsForwardedUpdateCheck()
 
     # #########################################################################
     # Process attributes of the update check.
     forced_update_label, client_version, board, app_id = self._ProcessUpdateComponents(
-        app, event)
+        app, event, record=not forwarded)
 
     if app_id == '{e96281a6-d1af-4bde-9a0a-97b76e56dc57}':
       legacy_image = True
@@ -681,9 +1354,7 @@ class Autoupdate(object):
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
     # In case max_updates is used, return no response if max reached.
-    if self.max_updates > 0:
-      self.max_updates -= 1
-    elif self.max_updates == 0:
+    if not forwarded and not self.update_budget.Consume():
       _Log('Request received but max number of updates handled')
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
@@ -697,6 +1368,24 @@ class Autoupdate(object):
 
       label = forced_update_label
 
+    # Payloads of a pool are served by the members they are assigned to.
+    payload_host = None
+    if self.pool:
+      payload_host = self.pool.local_member
+      if not forwarded:
+        member = self.pool.PickMember(
+            self._GetPayloadKey(label, board, legacy_image),
+            self._GetClientIp())
+        if member != payload_host:
+          try:
+            return self.pool.ForwardUpdateCheck(member, label, data)
+          except devserver_pool.DevserverPoolError as e:
+            _Log('%s; handling the update check here', e)
+
+    # Get the static url base that will form that base of our update url e.g.
+    # http://hostname:8080/static/update.gz.
+    static_urlbase = self._GetStaticUrl(payload_host)
+
     # #########################################################################
     # Finally its time to generate the omaha response to give to client that
     # lets them know where to find the payload and its associated metadata.
@@ -716,57 +1405,183 @@ class Autoupdate(object):
         # Get remote payload attributes.
         metadata_obj = self._GetRemotePayloadAttrs(url)
       else:
-        static_image_dir = _NonePathJoin(self.static_dir, label)
-        rel_path = None
-
-        # Serving files only, don't generate an update.
-        if not self.serve_only:
-          # Generate payload if necessary.
-          rel_path = self.GenerateUpdatePayload(board, client_version,
-                                                static_image_dir, legacy_image)
+        cache_key = (label, board, legacy_image, static_urlbase)
+        cached = None
+        if self._CanCacheResponse():
+          cached = self.response_cache.Get(cache_key)
 
-        if legacy_image:
-          filename = UPDATE_FILE
+        if cached:
+          url, metadata_obj = cached
         else:
-          filename = KERNEL_UPDATE_FILE
-        url = '/'.join(filter(None, [static_urlbase, label, rel_path,
-                                     filename]))
-        local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
-        metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir, legacy_image)
+          url, metadata_obj = self._GetLocalPayload(
+              board, client_version, static_urlbase, label, legacy_image,
+              cache_key)
 
     except AutoupdateError as e:
       # Raised if we fail to generate an update payload.
       _Log('Failed to process an update: %r', e)
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
-    _Log('Responding to client to use url %s to get image', url)
+    # Offer the payload from the least loaded mirrors, if any.
+    urls = [url]
+    if self.mirror_selector and not self.remote_payload:
+      urls = self._GetMirrorUrls(url, static_urlbase, protocol,
+                                 metadata_obj.size)
+
+    _Log('Responding to client to use url %s to get image', ', '.join(urls))
     return autoupdate_lib.GetUpdateResponse(
-        metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
-        metadata_obj.is_delta_format, protocol, self.critical_update)
+        metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, urls[0],
+        metadata_obj.is_delta_format, protocol, self.critical_update,
+        fallback_urls=urls[1:])
 
   def HandleHostInfoPing(self, ip):
     """Returns host info dictionary for the given IP in JSON format."""
     assert ip, 'No ip provided.'
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).attrs)
+    attrs = self.host_infos.GetAttrs(ip)
+    if attrs is not None:
+      return json.dumps(attrs)
 
-  def HandleHostLogPing(self, ip):
-    """Returns a complete log of events for host in JSON format."""
-    # If all events requested, return a dictionary of logs keyed by IP address.
-    if ip == 'all':
-      return json.dumps(
-          dict([(key, self.host_infos.table[key].log)
-                for key in self.host_infos.table]))
+  def HandleAllHostInfoPing(self, cursor=None, limit=None):
+    """Yields a JSON dictionary of the info of hosts, piece by piece.
 
-    # Otherwise we're looking for a specific IP address, so find its log.
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).log)
+    Args:
+      cursor: only include hosts whose IP sorts after this one.
+      limit: maximum number of hosts to include, None for all of them.
+    """
+    yield '{'
+    separator = ''
+    for page in self._IterPages(limit):
+      host_attrs = self.host_infos.GetAttrsPage(after_host_id=cursor,
+                                                limit=page)
+      for host_id, attrs in host_attrs:
+        yield '%s%s: %s' % (separator, json.dumps(host_id), json.dumps(attrs))
+        separator = ', '
+        cursor = host_id
+      if len(host_attrs) < page:
+        break
+    yield '}'
+
+  def HandleFindHostsPing(self, cursor=None, limit=None, **criteria):
+    """Yields a JSON dictionary of the info of matching hosts, piece by piece.
+
+    Args:
+      cursor: only include hosts whose IP sorts after this one.
+      limit: maximum number of hosts to include, None for all of them.
+      criteria: host criteria, as for HostInfoTable.FindHosts.
+    """
+    yield '{'
+    separator = ''
+    for page in self._IterPages(limit):
+      hosts = self.host_infos.FindHosts(after_host_id=cursor, limit=page,
+                                        **criteria)
+      for host_id, attrs in hosts:
+        yield '%s%s: %s' % (separator, json.dumps(host_id), json.dumps(attrs))
+        separator = ', '
+        cursor = host_id
+      if len(hosts) < page:
+        break
+    yield '}'
+
+  def HandleRolloutPing(self, board=None):
+    """Returns the number of hosts on each version per board in JSON format."""
+    return json.dumps(self.host_infos.GetRolloutProgress(board=board))
+
+  @staticmethod
+  def _IterPages(limit):
+    """Yields the sizes of the pages to read to get |limit| items in total."""
+    while limit is None or limit > 0:
+      page = _HOST_LOG_PAGE_SIZE if limit is None else min(limit,
+                                                          _HOST_LOG_PAGE_SIZE)
+      yield page
+      if limit is not None:
+        limit -= page
+
+  def _OpenLogReader(self, host_id=None):
+    """Returns a reader of the host log archive, None without an archive.
 
-    # If no events were logged for this IP, return an empty log.
-    return json.dumps([])
+    Args:
+      host_id: only read the events of this host, of all hosts if None.
+    """
+    path = self.host_infos.GetLogArchivePath()
+    return path and host_log.HostLogReader(path, host_id=host_id)
+
+  def _IterLogEntries(self, host_id, cursor, limit, log_reader, **filters):
+    """Yields the (host, entry) log entries selected, page by page.
+
+    Args:
+      host_id: only yield the entries of this host, of all hosts if None.
+      cursor: only yield entries recorded after the one with this `seq'.
+      limit: maximum number of entries to yield, None for all of them.
+      log_reader: a HostLogReader of the log archive, None without one. It
+                  keeps its position between pages, so that the archive is
+                  read once rather than once per page.
+      filters: event filters, as for HostInfoTable.QueryLogs.
+    """
+    log_filter = host_log.LogFilter(**filters)
+    for page in self._IterPages(limit):
+      entries, max_seq = self.host_infos.QueryRecentLogs(
+          host_id=host_id, after_seq=cursor, limit=page, **filters)
+      if log_reader:
+        log_reader.CatchUp()
+        entries = _MergeLogEntries(
+            entries, log_reader.Query(host_id=host_id, after_seq=cursor,
+                                      limit=page, log_filter=log_filter,
+                                      until_seq=max_seq), page)
+      for entry in entries:
+        yield entry
+      if len(entries) < page:
+        break
+      cursor = entries[-1][1]['seq']
+
+  def HandleHostLogPing(self, ip, cursor=None, limit=None, **filters):
+    """Yields a log of events in JSON format, piece by piece.
+
+    Without a cursor, limit or filters, the log is a list of events for a
+    single IP, or a dictionary of such lists keyed by IP address if |ip| is
+    `all'. Otherwise, it is a dictionary of the selected events, in the order
+    they were recorded, and the cursor to get the following ones with.
+
+    Args:
+      ip: the IP address of a host, or `all'.
+      cursor: only include events recorded after the one with this `seq'.
+      limit: maximum number of events to include, None for all of them.
+      filters: event filters, as for HostInfoTable.QueryLogs.
+    """
+    host_id = None if ip == 'all' else ip
+    log_reader = self._OpenLogReader(host_id)
+    try:
+      if (cursor is None and limit is None and
+          all(value is None for value in filters.itervalues())):
+        if host_id is not None:
+          for chunk in _IterJsonList(entry for _, entry in self._IterLogEntries(
+              host_id, 0, None, log_reader)):
+            yield chunk
+          return
+
+        # Every host's log is read page by page, all from the same reader.
+        yield '{'
+        for index, log_host_id in enumerate(self.host_infos.GetHostIds()):
+          yield '%s%s: ' % (', ' if index else '', json.dumps(log_host_id))
+          for chunk in _IterJsonList(entry for _, entry in self._IterLogEntries(
+              log_host_id, 0, None, log_reader)):
+            yield chunk
+        yield '}'
+        return
+
+      cursor = cursor or 0
+      yield '{"entries": ['
+      for index, (entry_host_id, entry) in enumerate(
+          self._IterLogEntries(host_id, cursor, limit, log_reader, **filters)):
+        entry['host'] = entry_host_id
+        cursor = entry['seq']
+        yield '%s%s' % (', ' if index else '', json.dumps(entry))
+      yield '], "cursor": %d}' % cursor
+    finally:
+      if log_reader:
+        log_reader.Close()
 
   def HandleSetUpdatePing(self, ip, label):
     """Sets forced_update_label for a given host."""
     assert ip, 'No ip provided.'
     assert label, 'No label provided.'
-    self.host_infos.GetInitHostInfo(ip).attrs['forced_update_label'] = label
+    self.host_infos.SetAttr(ip, 'forced_update_label', label)
@@ -7,11 +7,20 @@
 import datetime
 import os
 import time
-from xml.dom import minidom
+from xml.parsers import expat
 
 
 APP_ID = 'e96281a6-d1af-4bde-9a0a-97b76e56dc57'
 
+# Omaha protocol versions of the update requests understood.
+SUPPORTED_PROTOCOLS = ('2.0', '3.0')
+
+# Default upper bound for the size of an update request, in bytes.
+DEFAULT_MAX_REQUEST_SIZE = 64 * 1024
+
+# Number of bytes of an update request parsed at a time.
+_REQUEST_CHUNK_SIZE = 8 * 1024
+
 # Responses for the various Omaha protocols indexed by the protocol version.
 UPDATE_RESPONSE = {}
 UPDATE_RESPONSE['2.0'] = """<?xml version="1.0" encoding="UTF-8"?>
@@ -41,7 +50,7 @@ UPDATE_RESPONSE['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
       <ping status="ok"/>
       <updatecheck status="ok">
         <urls>
-          <url codebase="%(codebase)s/"/>
+          %(urls)s
         </urls>
         <manifest version="9999.0.0">
           <packages>
@@ -88,10 +97,18 @@ NO_UPDATE_RESPONSE['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
   """
 
 
-class UnknownProtocolRequestedException(Exception):
+class InvalidUpdateRequestException(Exception):
+  """Raised when an update request cannot be parsed."""
+
+
+class UnknownProtocolRequestedException(InvalidUpdateRequestException):
   """Raised when an supported protocol is specified."""
 
 
+class UpdateRequestTooLargeException(InvalidUpdateRequestException):
+  """Raised when an update request exceeds the maximum request size."""
+
+
 def GetSecondsSinceMidnight():
   """Returns the seconds since midnight as a decimal value."""
   now = time.localtime()
@@ -120,8 +137,63 @@ def GetSubstitutedResponse(response_dict, protocol, response_values):
   return response_xml
 
 
+# Fully substituted update responses, less the per-request fields, keyed by
+# the arguments of GetUpdateResponse().
+_update_response_templates = {}
+
+# Upper bound for the number of entries in _update_response_templates.
+_MAX_UPDATE_RESPONSE_TEMPLATES = 256
+
+
+def _EscapeTemplateValue(value):
+  """Returns |value| as a string that survives a %-substitution unchanged."""
+  return str(value).replace('%', '%%')
+
+
+def _GetUpdateResponseTemplate(sha1, sha256, size, url, is_delta_format,
+                               protocol, critical_update, fallback_urls):
+  """Returns the update response with only the per-request fields left open.
+
+  The returned string still has to be substituted with the 'time_elapsed' and
+  'deadline' values of the request it answers.
+  """
+  key = (sha1, sha256, size, url, is_delta_format, protocol, critical_update,
+         fallback_urls)
+  template = _update_response_templates.get(key)
+  if template is not None:
+    return template
+
+  response_values = {}
+  response_values['appid'] = APP_ID
+  response_values['time_elapsed'] = '%(time_elapsed)s'
+  response_values['sha1'] = _EscapeTemplateValue(sha1)
+  response_values['sha256'] = _EscapeTemplateValue(sha256)
+  response_values['size'] = _EscapeTemplateValue(size)
+  response_values['url'] = _EscapeTemplateValue(url)
+  filename = os.path.basename(url)
+  response_values['urls'] = '\n          '.join(
+      '<url codebase="%s/"/>' % _EscapeTemplateValue(os.path.dirname(u))
+      for u in (url,) + fallback_urls)
+  response_values['filename'] = _EscapeTemplateValue(filename)
+  response_values['is_delta_format'] = _EscapeTemplateValue(is_delta_format)
+  extra_attributes = []
+  if critical_update:
+    # The date string looks like '20111115' (2011-11-15). As of writing,
+    # there's no particular format for the deadline value that the
+    # client expects -- it's just empty vs. non-empty.
+    extra_attributes.append('deadline="%(deadline)s"')
+
+  response_values['extra_attr'] = ' '.join(extra_attributes)
+  template = GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+
+  if len(_update_response_templates) >= _MAX_UPDATE_RESPONSE_TEMPLATES:
+    _update_response_templates.clear()
+  _update_response_templates[key] = template
+  return template
+
+
 def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
-                      critical_update=False):
+                      critical_update=False, fallback_urls=()):
   """Returns a protocol-specific response to the client for a new update.
 
   Args:
@@ -132,28 +204,19 @@ def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
     is_delta_format: true if url refers to a delta payload
     protocol: client's protocol version from the request Xml.
     critical_update: whether this is a critical update.
+    fallback_urls: other places to find the update blob, under the same file
+                   name, in the order the client should try them. Only
+                   protocol 3.0 has room for them.
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  response_values['sha1'] = sha1
-  response_values['sha256'] = sha256
-  response_values['size'] = size
-  response_values['url'] = url
-  (codebase, filename) = os.path.split(url)
-  response_values['codebase'] = codebase
-  response_values['filename'] = filename
-  response_values['is_delta_format'] = is_delta_format
-  extra_attributes = []
-  if critical_update:
-    # The date string looks like '20111115' (2011-11-15). As of writing,
-    # there's no particular format for the deadline value that the
-    # client expects -- it's just empty vs. non-empty.
-    date_str = datetime.date.today().strftime('%Y%m%d')
-    extra_attributes.append('deadline="%s"' % date_str)
-
-  response_values['extra_attr'] = ' '.join(extra_attributes)
-  return GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+  template = _GetUpdateResponseTemplate(sha1, sha256, size, url,
+                                        is_delta_format, protocol,
+                                        critical_update, tuple(fallback_urls))
+  return template % {
+      'time_elapsed': GetSecondsSinceMidnight(),
+      'deadline': datetime.date.today().strftime('%Y%m%d'),
+  }
 
 
 def GetNoUpdateResponse(protocol):
@@ -168,29 +231,126 @@ def GetNoUpdateResponse(protocol):
   return GetSubstitutedResponse(NO_UPDATE_RESPONSE, protocol, response_values)
 
 
-def ParseUpdateRequest(request_string):
+class RequestElement(object):
+  """An element of an update request.
+
+  Offers the attribute accessors of a DOM element, so that it can be used in
+  place of the minidom elements update requests used to be parsed into.
+
+  Members:
+    tagName:    qualified name of the element, e.g. o:app.
+    attributes: dictionary of the attributes of the element.
+  """
+
+  # pylint: disable=C0103
+
+  def __init__(self, tag_name, attributes):
+    self.tagName = tag_name
+    self.attributes = attributes
+
+  def __repr__(self):
+    return '<%s %s>' % (self.tagName, self.attributes)
+
+  def getAttribute(self, name):
+    """Returns the value of attribute |name|, '' if it is not set."""
+    return self.attributes.get(name, '')
+
+  def hasAttribute(self, name):
+    """Returns whether attribute |name| is set."""
+    return name in self.attributes
+
+
+class _UpdateRequestParser(object):
+  """Picks the elements of interest out of an update request in one pass.
+
+  No document tree is built: the protocol is read off the root element, which
+  determines the names of the elements kept, and everything else is skipped.
+  """
+
+  def __init__(self):
+    self.protocol = None
+    self.app = None
+    self.events = []
+    self.update_checks = []
+    # Lists the elements of each name are added to, once the protocol is
+    # known.
+    self._element_lists = None
+    self._app_name = None
+
+    self._parser = expat.ParserCreate()
+    self._parser.StartElementHandler = self._StartElement
+    self._parser.StartDoctypeDeclHandler = self._StartDoctype
+    self._parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+
+  def _StartDoctype(self, *_):
+    # Entity declarations could make a small request expand without bound.
+    raise InvalidUpdateRequestException('Document type declarations are not '
+                                        'allowed in update requests')
+
+  def _StartElement(self, name, attributes):
+    if self._element_lists is None:
+      self.protocol = attributes.get('protocol', '')
+      if self.protocol not in SUPPORTED_PROTOCOLS:
+        raise UnknownProtocolRequestedException('Supported protocols are %s' %
+                                                (SUPPORTED_PROTOCOLS,))
+      prefix = 'o:' if self.protocol == '2.0' else ''
+      self._app_name = prefix + 'app'
+      self._element_lists = {prefix + 'event': self.events,
+                             prefix + 'updatecheck': self.update_checks}
+      return
+
+    if name == self._app_name:
+      if self.app is None:
+        self.app = RequestElement(name, attributes)
+      return
+    element_list = self._element_lists.get(name)
+    if element_list is not None:
+      element_list.append(RequestElement(name, attributes))
+
+  def Feed(self, data, is_final):
+    """Parses the next part of the request.
+
+    Raises:
+      InvalidUpdateRequestException if the request is invalid.
+    """
+    try:
+      self._parser.Parse(data, is_final)
+    except expat.ExpatError as e:
+      raise InvalidUpdateRequestException('Invalid update request: %s' % e)
+
+
+def ParseUpdateRequest(request, max_size=DEFAULT_MAX_REQUEST_SIZE):
   """Returns a tuple containing information parsed from an update request.
 
+  The request is parsed as it is read, keeping only the elements returned.
+
   Args:
-    request_dom: an xml string containing the update request.
-  Returns tuple consisting of protocol string, app element, event element and
-    update_check element.
+    request: the XML update request, either a string or a file-like object
+        it is read from.
+    max_size: largest request accepted, in bytes; None for no limit.
+  Returns tuple consisting of protocol string, app element (None if there is
+    none), list of event elements and list of update_check elements. The
+    elements are RequestElements.
   Raises UnknownProtocolRequestedException if we do not understand the
-    protocol.
+    protocol, UpdateRequestTooLargeException if the request exceeds max_size
+    and InvalidUpdateRequestException if it is not a valid request otherwise.
   """
-  request_dom = minidom.parseString(request_string)
-  protocol = request_dom.firstChild.getAttribute('protocol')
-  supported_protocols = '2.0', '3.0'
-  if protocol not in supported_protocols:
-    raise UnknownProtocolRequestedException('Supported protocols are %s' %
-                                            supported_protocols)
-
-  element_dict = {}
-  for name in ['event', 'app', 'updatecheck']:
-    element_dict[name] = 'o:' + name if protocol == '2.0' else name
-
-  app = request_dom.firstChild.getElementsByTagName(element_dict['app'])[0]
-  event = request_dom.getElementsByTagName(element_dict['event'])
-  update_check = request_dom.getElementsByTagName(element_dict['updatecheck'])
-
-  return protocol, app, event, update_check
+  parser = _UpdateRequestParser()
+  if isinstance(request, basestring):
+    if max_size is not None and len(request) > max_size:
+      raise UpdateRequestTooLargeException(
+          'Update request exceeds %d bytes' % max_size)
+    parser.Feed(request, True)
+  else:
+    size = 0
+    while True:
+      chunk = request.read(_REQUEST_CHUNK_SIZE)
+      size += len(chunk)
+      if max_size is not None and size > max_size:
+        raise UpdateRequestTooLargeException(
+            'Update request exceeds %d bytes' % max_size)
+      parser.Feed(chunk, not chunk)
+      if not chunk:
+        break
+
+  return parser.protocol, parser.app, parser.events, parser.update_checks
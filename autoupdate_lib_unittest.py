@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for autoupdate_lib module."""
+
+import StringIO
+import unittest
+from xml.dom import minidom
+
+import autoupdate_lib
+
+
+_REQUEST_V2 = """<?xml version="1.0" encoding="UTF-8"?>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" protocol="2.0">
+  <o:os version="Indy" platform="Chrome OS"></o:os>
+  <o:app appid="{%s}" version="1.2.3" board="x86-generic">
+    <o:updatecheck></o:updatecheck>
+    <o:event eventtype="3" eventresult="1" previousversion="1.2.2"></o:event>
+  </o:app>
+</o:gupdate>
+""" % autoupdate_lib.APP_ID
+
+_REQUEST_V3 = """<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0" ismachine="1">
+  <os version="Indy" platform="Chrome OS"></os>
+  <app appid="{%s}" version="1.2.3" track="dev-channel">
+    <event eventtype="13" eventresult="1"></event>
+  </app>
+</request>
+""" % autoupdate_lib.APP_ID
+
+
+class ParseUpdateRequestTest(unittest.TestCase):
+
+  def testProtocol2(self):
+    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V2)
+    self.assertEqual(protocol, '2.0')
+    self.assertEqual(app.getAttribute('version'), '1.2.3')
+    self.assertEqual(app.getAttribute('board'), 'x86-generic')
+    self.assertEqual(app.getAttribute('track'), '')
+    self.assertFalse(app.hasAttribute('track'))
+    self.assertEqual(len(update_check), 1)
+    self.assertEqual(len(event), 1)
+    self.assertEqual(event[0].getAttribute('eventtype'), '3')
+    self.assertTrue(event[0].hasAttribute('previousversion'))
+
+  def testProtocol3(self):
+    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V3)
+    self.assertEqual(protocol, '3.0')
+    self.assertEqual(app.getAttribute('track'), 'dev-channel')
+    self.assertEqual(update_check, [])
+    self.assertEqual(event[0].getAttribute('eventtype'), '13')
+
+  def testStream(self):
+    self.assertEqual(
+        autoupdate_lib.ParseUpdateRequest(StringIO.StringIO(_REQUEST_V3))[0],
+        '3.0')
+    self.assertRaises(autoupdate_lib.UpdateRequestTooLargeException,
+                      autoupdate_lib.ParseUpdateRequest,
+                      StringIO.StringIO(_REQUEST_V3 + ' ' * 20000),
+                      max_size=10000)
+
+  def testSizeLimit(self):
+    self.assertRaises(autoupdate_lib.UpdateRequestTooLargeException,
+                      autoupdate_lib.ParseUpdateRequest, _REQUEST_V2,
+                      max_size=len(_REQUEST_V2) - 1)
+    self.assertEqual(autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V2, max_size=len(_REQUEST_V2))[0], '2.0')
+    self.assertEqual(autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V2 + ' ' * 100000, max_size=None)[0], '2.0')
+
+  def testInvalidRequests(self):
+    self.assertRaises(autoupdate_lib.UnknownProtocolRequestedException,
+                      autoupdate_lib.ParseUpdateRequest,
+                      _REQUEST_V3.replace('3.0', '4.0'))
+    self.assertRaises(autoupdate_lib.InvalidUpdateRequestException,
+                      autoupdate_lib.ParseUpdateRequest, _REQUEST_V3[:-20])
+    self.assertRaises(autoupdate_lib.InvalidUpdateRequestException,
+                      autoupdate_lib.ParseUpdateRequest, '')
+    self.assertRaises(
+        autoupdate_lib.InvalidUpdateRequestException,
+        autoupdate_lib.ParseUpdateRequest,
+        '<!DOCTYPE r [<!ENTITY a "aaaa">]><request protocol="3.0">&a;'
+        '</request>')
+
+
+class GetUpdateResponseTest(unittest.TestCase):
+
+  def testFallbackUrls(self):
+    urls = ['http://host%d/static/update.gz' % i for i in range(3)]
+    response = autoupdate_lib.GetUpdateResponse(
+        'sha1', 'sha256', 10, urls[0], False, '3.0',
+        fallback_urls=urls[1:])
+    dom = minidom.parseString(response)
+    self.assertEqual([url.getAttribute('codebase')
+                      for url in dom.getElementsByTagName('url')],
+                     ['http://host%d/static/' % i for i in range(3)])
+    self.assertEqual(
+        dom.getElementsByTagName('package')[0].getAttribute('name'),
+        'update.gz')
+
+    # Protocol 2.0 only has room for one URL.
+    response = autoupdate_lib.GetUpdateResponse(
+        'sha1', 'sha256', 10, urls[0], False, '2.0',
+        fallback_urls=urls[1:])
+    dom = minidom.parseString(response)
+    self.assertEqual(
+        dom.getElementsByTagName('updatecheck')[0].getAttribute('codebase'),
+        urls[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,17 +7,25 @@
 """Unit tests for autoupdate.py."""
 
 import json
+import multiprocessing
 import os
 import shutil
 import socket
+import tempfile
+import threading
 import unittest
 
 import cherrypy
+from cherrypy.lib import httputil
 import mox
 
 import autoupdate
 import autoupdate_lib
 import common_util
+import delta_pregenerator
+import devserver_pool
+import host_log
+import mirror_selector
 
 
 _TEST_REQUEST = """
@@ -93,6 +101,28 @@ class AutoupdateTest(mox.MoxTestBase):
                      (src_hash, target_hash, key_hash))
     self.mox.VerifyAll()
 
+  def testFindCachedUpdateImageSubDirMemoizesDigests(self):
+    """Test that unchanged images are only hashed once."""
+    self.mox.StubOutWithMock(common_util, 'GetFileMd5')
+    target_image = os.path.join(self.static_image_dir, 'image.bin')
+    with open(target_image, 'w') as fh:
+      fh.write('image')
+
+    common_util.GetFileMd5(target_image).AndReturn('12345')
+    common_util.GetFileMd5(target_image).AndReturn('67890')
+
+    self.mox.ReplayAll()
+    au_mock = self._DummyAutoupdateConstructor(vm=True)
+    for _ in range(3):
+      self.assertEqual(au_mock.FindCachedUpdateImageSubDir(None, target_image),
+                       os.path.join(autoupdate.CACHE_DIR, '12345'))
+
+    with open(target_image, 'w') as fh:
+      fh.write('new image')
+    self.assertEqual(au_mock.FindCachedUpdateImageSubDir(None, target_image),
+                     os.path.join(autoupdate.CACHE_DIR, '67890'))
+    self.mox.VerifyAll()
+
   def testGenerateLatestUpdateImageWithForced(self):
     self.mox.StubOutWithMock(autoupdate.Autoupdate,
                              'GenerateUpdateImageWithCache')
@@ -135,7 +165,7 @@ class AutoupdateTest(mox.MoxTestBase):
                                  mox.IsA(autoupdate.UpdateMetadata))
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, self.url, False, '3.0',
-        False).AndReturn(self.payload)
+        False, fallback_urls=[]).AndReturn(self.payload)
 
     self.mox.ReplayAll()
     au_mock.forced_image = self.forced_image_path
@@ -166,7 +196,7 @@ class AutoupdateTest(mox.MoxTestBase):
                                  mox.IsA(autoupdate.UpdateMetadata))
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, self.url, False, '3.0',
-        False).AndReturn(self.payload)
+        False, fallback_urls=[]).AndReturn(self.payload)
 
     self.mox.ReplayAll()
     self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
@@ -192,6 +222,77 @@ class AutoupdateTest(mox.MoxTestBase):
     r = autoupdate._ChangeUrlPort('ftp://fuzzy', 8085)
     self.assertEqual(r, 'ftp://fuzzy:8085')
 
+  def testHandleHostLogPing(self):
+    au_mock = self._DummyAutoupdateConstructor()
+    au_mock.host_infos = autoupdate.HostInfoTable()
+    for index in range(3):
+      au_mock.host_infos.RecordPing('1.2.3.4', {'version': str(index)},
+                                    {'event_type': index})
+    au_mock.host_infos.RecordPing('5.6.7.8', {}, {'event_type': 3})
+    self.mox.ReplayAll()
+
+    def _Log(*args, **kwargs):
+      return json.loads(''.join(au_mock.HandleHostLogPing(*args, **kwargs)))
+
+    self.assertEqual([entry['event_type'] for entry in _Log('1.2.3.4')],
+                     [0, 1, 2])
+    self.assertEqual(_Log('unknown'), [])
+    self.assertEqual(sorted(_Log('all')), ['1.2.3.4', '5.6.7.8'])
+
+    page = _Log('all', cursor=1, limit=2)
+    self.assertEqual([(entry['host'], entry['seq'])
+                      for entry in page['entries']],
+                     [('1.2.3.4', 2), ('1.2.3.4', 3)])
+    self.assertEqual(page['cursor'], 3)
+    page = _Log('all', cursor=page['cursor'], event_type=3)
+    self.assertEqual([entry['host'] for entry in page['entries']], ['5.6.7.8'])
+    page = _Log('all', cursor=page['cursor'])
+    self.assertEqual(page, {'entries': [], 'cursor': 4})
+
+    infos = json.loads(''.join(au_mock.HandleAllHostInfoPing(limit=1)))
+    self.assertEqual(infos, {'1.2.3.4': {'version': '2'}})
+    infos = json.loads(''.join(au_mock.HandleAllHostInfoPing(
+        cursor='1.2.3.4')))
+    self.assertEqual(infos, {'5.6.7.8': {}})
+    self.mox.VerifyAll()
+
+  def testHandleHostLogPingWithArchive(self):
+    au_mock = self._DummyAutoupdateConstructor()
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    self.mox.StubOutWithMock(autoupdate, '_HOST_LOG_PAGE_SIZE')
+    autoupdate._HOST_LOG_PAGE_SIZE = 2
+    parse_line = host_log._ParseLine
+    parsed = []
+    def _ParseLine(line):
+      parsed.append(line)
+      return parse_line(line)
+    self.mox.StubOutWithMock(host_log, '_ParseLine')
+    host_log._ParseLine = _ParseLine
+    try:
+      au_mock.host_infos = autoupdate.HostInfoTable(
+          max_log_entries=1, log_archive_path=os.path.join(test_dir, 'log'))
+      for index in range(4):
+        for host_id in ['1.1.1.1', '2.2.2.2']:
+          au_mock.host_infos.RecordPing(host_id, {}, {'event_type': index})
+      au_mock.host_infos.RecordPing('3.3.3.3', {})
+      logs = au_mock.host_infos.GetAllLogs()
+      self.mox.ReplayAll()
+
+      del parsed[:]
+      self.assertEqual(json.loads(''.join(au_mock.HandleHostLogPing('all'))),
+                       logs)
+      # Each of the 6 archived entries was read once to find it, and once
+      # when it was its page's turn.
+      self.assertEqual(len(parsed), 12)
+      page = json.loads(''.join(au_mock.HandleHostLogPing('all', cursor=0)))
+      self.assertEqual([entry['seq'] for entry in page['entries']],
+                       range(1, 9))
+      self.assertEqual(
+          [entry['event_type'] for entry in json.loads(''.join(
+              au_mock.HandleHostLogPing('2.2.2.2')))], [0, 1, 2, 3])
+    finally:
+      shutil.rmtree(test_dir)
+
   def testHandleHostInfoPing(self):
     au_mock = self._DummyAutoupdateConstructor()
     self.assertRaises(AssertionError, au_mock.HandleHostInfoPing, None)
@@ -247,7 +348,7 @@ class AutoupdateTest(mox.MoxTestBase):
                                  mox.IsA(autoupdate.UpdateMetadata))
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, new_url, False, '3.0',
-        False).AndReturn(self.payload)
+        False, fallback_urls=[]).AndReturn(self.payload)
 
     self.mox.ReplayAll()
     au_mock.HandleSetUpdatePing('127.0.0.1', test_label)
@@ -315,12 +416,397 @@ class AutoupdateTest(mox.MoxTestBase):
         autoupdate.UpdateMetadata(self.sha1, self.sha256, self.size, False))
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, remote_url, False,
-        '3.0', False).AndReturn(self.payload)
+        '3.0', False, fallback_urls=[]).AndReturn(self.payload)
 
     self.mox.ReplayAll()
     self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
     self.mox.VerifyAll()
 
+  def testScheduleUpdateImagePending(self):
+    au_mock = self._DummyAutoupdateConstructor(generation_wait=0)
+    release = threading.Event()
+    au_mock.GenerateUpdateImage = lambda *args: release.wait()
+    output_dir = os.path.join(self.static_image_dir, 'cache', 'some_hash')
+    os.makedirs(os.path.dirname(output_dir))
+    update_gz = os.path.join(output_dir, autoupdate.UPDATE_FILE)
+    try:
+      for _ in range(2):
+        self.assertRaises(autoupdate.GenerationPendingError,
+                          au_mock._ScheduleUpdateImage,
+                          self.forced_image_path, output_dir, update_gz, True,
+                          '')
+      self.assertEqual(len(au_mock.generation_scheduler.GetStatus()), 1)
+    finally:
+      release.set()
+
+  def testGenerateLatestUpdateImageWithDelta(self):
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GetLatestImage')
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'GenerateUpdateImageWithCache')
+    delta_index = delta_pregenerator.DeltaIndex(
+        os.path.join(self.static_image_dir, 'deltas.json'))
+    delta_index.Record(self.test_board, '1.0.0', '2.0.0', 'cache/delta')
+    au_mock = self._DummyAutoupdateConstructor(delta_index=delta_index)
+    os.makedirs(os.path.join(self.static_image_dir, 'cache', 'delta'))
+    with open(os.path.join(self.static_image_dir, 'cache', 'delta',
+                           autoupdate.UPDATE_FILE), 'w') as fh:
+      fh.write('')
+
+    au_mock.GetLatestImage(self.test_board).MultipleTimes().AndReturn(
+        ('2.0.0', self.forced_image_path))
+    au_mock.GenerateUpdateImageWithCache(
+        self.forced_image_path, static_image_dir=self.static_image_dir,
+        legacy_image=True).AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(au_mock.GenerateLatestUpdateImage(
+        self.test_board, '1.0.0', self.static_image_dir, True), 'cache/delta')
+    # Clients without a delta get the full payload.
+    self.assertEqual(au_mock.GenerateLatestUpdateImage(
+        self.test_board, '1.5.0', self.static_image_dir, True), None)
+    self.mox.VerifyAll()
+
+  def testHandleUpdatePingCachesResponse(self):
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GetLocalPayloadAttrs')
+    au_mock = self._DummyAutoupdateConstructor(serve_only=True)
+    url = 'http://%s/static/archive/update.gz' % self.hostname
+    metadata_obj = autoupdate.UpdateMetadata(self.sha1, self.sha256, self.size,
+                                             False)
+
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    with open(update_gz, 'w') as fh:
+      fh.write('')
+
+    au_mock.GetLocalPayloadAttrs(self.static_image_dir, True).AndReturn(
+        metadata_obj)
+    autoupdate_lib.GetUpdateResponse(
+        self.sha1, self.sha256, self.size, url, False, '3.0',
+        False, fallback_urls=[]).MultipleTimes().AndReturn(self.payload)
+    au_mock.GetLocalPayloadAttrs(self.static_image_dir, True).AndReturn(
+        metadata_obj)
+
+    self.mox.ReplayAll()
+    test_data = _TEST_REQUEST.replace('<app ', '<app appid="{%s}" ' %
+                                      autoupdate_lib.APP_ID) % self.test_dict
+    self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
+    self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
+
+    # A new payload invalidates the cached response.
+    with open(update_gz, 'w') as fh:
+      fh.write('new payload')
+    self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
+    self.mox.VerifyAll()
+    self.assertEqual(au_mock.response_cache.GetStats(),
+                     {'entries': 1, 'hits': 1, 'misses': 2,
+                      'invalidations': 1})
+
+  def testHandleUpdatePingInPool(self):
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GetLocalPayloadAttrs')
+    self.mox.StubOutWithMock(devserver_pool.DevserverPool,
+                             'ForwardUpdateCheck')
+    self.mox.StubOutWithMock(devserver_pool.socket, 'getaddrinfo')
+    local = 'http://%s' % self.hostname
+    remote = 'http://otherhost:8080'
+    pool = devserver_pool.DevserverPool([local, remote], local)
+    au_mock = self._DummyAutoupdateConstructor(serve_only=True, pool=pool)
+    labels = {}
+    for i in range(20):
+      label = 'label%d' % i
+      labels.setdefault(pool.GetOwners(
+          au_mock._GetPayloadKey(label, self.test_board, True))[0], label)
+    metadata_obj = autoupdate.UpdateMetadata(self.sha1, self.sha256, self.size,
+                                             False)
+    test_data = _TEST_REQUEST.replace('<app ', '<app appid="{%s}" ' %
+                                      autoupdate_lib.APP_ID) % self.test_dict
+
+    # Payloads of this member are served here, others by their owner.
+    au_mock.GetLocalPayloadAttrs(
+        os.path.join(self.static_image_dir, labels[local]), True).AndReturn(
+            metadata_obj)
+    autoupdate_lib.GetUpdateResponse(
+        self.sha1, self.sha256, self.size,
+        '%s/static/archive/%s/update.gz' % (local, labels[local]), False,
+        '3.0', False, fallback_urls=[]).AndReturn(self.payload)
+    pool.ForwardUpdateCheck(remote, labels[remote], test_data).AndReturn(
+        'forwarded')
+    # unless the update check was forwarded here.
+    au_mock.GetLocalPayloadAttrs(
+        os.path.join(self.static_image_dir, labels[remote]), True).AndReturn(
+            metadata_obj)
+    autoupdate_lib.GetUpdateResponse(
+        self.sha1, self.sha256, self.size,
+        '%s/static/archive/%s/update.gz' % (local, labels[remote]), False,
+        '3.0', False, fallback_urls=[]).AndReturn(self.payload)
+
+    devserver_pool.socket.getaddrinfo('otherhost', None).AndReturn(
+        [(2, 1, 6, '', ('192.168.0.1', 0))])
+
+    self.mox.ReplayAll()
+    self.assertEqual(au_mock.HandleUpdatePing(test_data, labels[local]),
+                     self.payload)
+    self.assertEqual(au_mock.HandleUpdatePing(test_data, labels[remote]),
+                     'forwarded')
+    cherrypy.request.headers[devserver_pool.FORWARDED_HEADER] = remote
+    old_remote = cherrypy.request.remote
+    try:
+      # The header is ignored unless the request comes from that member.
+      cherrypy.request.remote = httputil.Host('192.168.0.2', 1234)
+      self.assertFalse(au_mock._IsForwardedUpdateCheck())
+      cherrypy.request.remote = httputil.Host('192.168.0.1', 1234)
+      self.assertEqual(au_mock.HandleUpdatePing(test_data, labels[remote]),
+                       self.payload)
+    finally:
+      cherrypy.request.remote = old_remote
+      del cherrypy.request.headers[devserver_pool.FORWARDED_HEADER]
+    self.mox.VerifyAll()
+    self.assertEqual(pool.GetStatus()['local'], 1)
+    self.assertEqual(pool.GetStatus()['forwarded'], 1)
+
+  def testHandleUpdatePingWithMirrors(self):
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GetLocalPayloadAttrs')
+    selector = self.mox.CreateMock(mirror_selector.MirrorSelector)
+    au_mock = self._DummyAutoupdateConstructor(serve_only=True,
+                                               mirror_selector=selector)
+    url = 'http://%s/static/archive/update.gz' % self.hostname
+    metadata_obj = autoupdate.UpdateMetadata(self.sha1, self.sha256, self.size,
+                                             False)
+
+    au_mock.GetLocalPayloadAttrs(self.static_image_dir, True).AndReturn(
+        metadata_obj)
+    selector.RankMirrors(None, path='/static/archive/update.gz',
+                         size=self.size).AndReturn(
+                             ['http://mirror:8080', None])
+    autoupdate_lib.GetUpdateResponse(
+        self.sha1, self.sha256, self.size,
+        'http://mirror:8080/static/archive/update.gz', False, '3.0', False,
+        fallback_urls=[url]).AndReturn(self.payload)
+
+    self.mox.ReplayAll()
+    test_data = _TEST_REQUEST.replace('<app ', '<app appid="{%s}" ' %
+                                      autoupdate_lib.APP_ID) % self.test_dict
+    self.assertEqual(au_mock.HandleUpdatePing(test_data), self.payload)
+    self.mox.VerifyAll()
+
+
+class PayloadResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    self.payload = os.path.join(self.test_dir, 'update.gz')
+    with open(self.payload, 'w') as fh:
+      fh.write('payload')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testGet(self):
+    cache = autoupdate.PayloadResponseCache()
+    missing = os.path.join(self.test_dir, 'update.meta')
+    self.assertEqual(cache.Get('key'), None)
+    cache.Put('key', [self.payload, missing], 'url', 'metadata')
+    self.assertEqual(cache.Get('key'), ('url', 'metadata'))
+    self.assertEqual(cache.Get('other key'), None)
+
+    # Creating a file that did not exist also invalidates the entry.
+    with open(missing, 'w') as fh:
+      fh.write('{}')
+    self.assertEqual(cache.Get('key'), None)
+    self.assertEqual(cache.GetStats(), {'entries': 0, 'hits': 1, 'misses': 3,
+                                        'invalidations': 1})
+
+
+class HostInfoTableTest(unittest.TestCase):
+
+  def testRecordPing(self):
+    table = autoupdate.HostInfoTable()
+    self.assertEqual(table.RecordPing('1.2.3.4', {'last_known_version': '1'}),
+                     None)
+    table.SetAttr('1.2.3.4', 'forced_update_label', 'some/label')
+    self.assertEqual(
+        table.RecordPing('1.2.3.4', {'last_known_version': '2'}, {'a': 1}),
+        'some/label')
+    self.assertEqual(table.GetAttrs('1.2.3.4'), {'last_known_version': '2'})
+    self.assertEqual(len(table.GetLog('1.2.3.4')), 1)
+    self.assertEqual(table.GetAllLogs().keys(), ['1.2.3.4'])
+    self.assertEqual(table.GetAttrs('5.6.7.8'), None)
+    self.assertEqual(table.GetLog('5.6.7.8'), None)
+
+  def testLogArchive(self):
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      archive_path = os.path.join(test_dir, 'host.log')
+      table = autoupdate.HostInfoTable(max_log_entries=1,
+                                       log_archive_path=archive_path)
+      for version in ['1', '2', '3']:
+        table.RecordPing('1.2.3.4', {}, {'version': version})
+      self.assertEqual([entry['version'] for entry in table.GetLog('1.2.3.4')],
+                       ['1', '2', '3'])
+
+      # Archived entries outlive the table.
+      table = autoupdate.HostInfoTable(max_log_entries=1,
+                                       log_archive_path=archive_path)
+      self.assertEqual(
+          [entry['version'] for entry in table.GetAllLogs()['1.2.3.4']],
+          ['1', '2'])
+      self.assertEqual(len(table.GetLog('1.2.3.4')), 2)
+    finally:
+      shutil.rmtree(test_dir)
+
+  def testGetLogDuringPings(self):
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      table = autoupdate.HostInfoTable(
+          max_log_entries=1, log_archive_path=os.path.join(test_dir, 'log'))
+      table.RecordPing('1.1.1.1', {}, {'version': '1'})
+      table.RecordPing('1.1.1.1', {}, {'version': '2'})
+
+      archive_query = table._log_archive.Query
+      def _Query(**kwargs):
+        # Would wait forever if the archive was read with the lock held.
+        recorder = threading.Thread(target=table.RecordPing,
+                                    args=('2.2.2.2', {}, {'version': '3'}))
+        recorder.start()
+        recorder.join()
+        return archive_query(**kwargs)
+      table._log_archive.Query = _Query
+
+      self.assertEqual([entry['version'] for entry in table.GetLog('1.1.1.1')],
+                       ['1', '2'])
+      self.assertEqual(sorted(table.GetAllLogs()), ['1.1.1.1', '2.2.2.2'])
+    finally:
+      shutil.rmtree(test_dir)
+
+  def testQueryLogs(self):
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      table = autoupdate.HostInfoTable(
+          max_log_entries=2, log_archive_path=os.path.join(test_dir, 'log'))
+      for index in range(4):
+        for host_id in ['1.1.1.1', '2.2.2.2']:
+          table.RecordPing(host_id, {},
+                           {'version': str(index), 'event_type': index % 2})
+
+      def _Entries(**kwargs):
+        return [(host_id, entry['version'], entry['seq'])
+                for host_id, entry in table.QueryLogs(**kwargs)]
+
+      self.assertEqual(_Entries(limit=3), [('1.1.1.1', '0', 1),
+                                           ('2.2.2.2', '0', 2),
+                                           ('1.1.1.1', '1', 3)])
+      # Pages span the archive and the entries in memory.
+      self.assertEqual(_Entries(after_seq=3, limit=3), [('2.2.2.2', '1', 4),
+                                                        ('1.1.1.1', '2', 5),
+                                                        ('2.2.2.2', '2', 6)])
+      self.assertEqual(_Entries(host_id='2.2.2.2', event_type=1),
+                       [('2.2.2.2', '1', 4), ('2.2.2.2', '3', 8)])
+      self.assertEqual(_Entries(after_seq=8), [])
+      self.assertEqual(table.GetHostIds(), ['1.1.1.1', '2.2.2.2'])
+      self.assertEqual(table.GetAttrsPage(after_host_id='1.1.1.1'),
+                       [('2.2.2.2', {})])
+    finally:
+      shutil.rmtree(test_dir)
+
+  def testQueryLogsDuringPings(self):
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      table = autoupdate.HostInfoTable(
+          max_log_entries=1, log_archive_path=os.path.join(test_dir, 'log'))
+      for version in ['1', '2']:
+        table.RecordPing('1.1.1.1', {}, {'version': version})
+
+      archive_query = table._log_archive.Query
+      def _Query(**kwargs):
+        # Pings go on while the archive is read, moving entries to it.
+        recorder = threading.Thread(target=table.RecordPing,
+                                    args=('1.1.1.1', {}, {'version': '3'}))
+        recorder.start()
+        recorder.join()
+        return archive_query(**kwargs)
+      table._log_archive.Query = _Query
+
+      # Entries are neither repeated nor, past the page, skipped.
+      self.assertEqual([(entry['version'], entry['seq'])
+                        for _, entry in table.QueryLogs()],
+                       [('1', 1), ('2', 2)])
+      self.assertEqual([entry['seq'] for _, entry in table.QueryLogs(
+          after_seq=2)], [3])
+    finally:
+      shutil.rmtree(test_dir)
+
+  def testFindHosts(self):
+    table = autoupdate.HostInfoTable()
+    table.RecordPing('1.1.1.1', {'last_known_version': '1', 'board': 'x86'})
+    table.RecordPing('2.2.2.2', {'last_known_version': '2', 'board': 'x86',
+                                 'last_event_status': 0})
+    self.assertEqual(table.FindHosts(version='2'),
+                     [('2.2.2.2', {'last_known_version': '2', 'board': 'x86',
+                                   'last_event_status': 0})])
+    self.assertEqual([host_id for host_id, _ in table.FindHosts(board='x86')],
+                     ['1.1.1.1', '2.2.2.2'])
+    self.assertEqual(table.FindHosts(event_result=1), [])
+    self.assertEqual(table.GetRolloutProgress(), {'x86': {'1': 1, '2': 1}})
+
+  def testHostDatabase(self):
+    test_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      db_path = os.path.join(test_dir, 'hosts.db')
+      table = autoupdate.HostInfoTable(db_path=db_path)
+      table.RecordPing('1.1.1.1', {'last_known_version': '1', 'board': 'x86'})
+      table.SetAttr('1.1.1.1', 'forced_update_label', 'some/label')
+      table.RecordPing('2.2.2.2', {'last_known_version': '2', 'board': 'x86'})
+      self.assertEqual(table.FindHosts(version='2'),
+                       [('2.2.2.2', {'last_known_version': '2',
+                                     'board': 'x86'})])
+      self.assertEqual(table.GetRolloutProgress(board='x86'),
+                       {'x86': {'1': 1, '2': 1}})
+
+      # Attributes, including pending forced labels, outlive the table.
+      table = autoupdate.HostInfoTable(db_path=db_path)
+      self.assertEqual(table.GetAttrs('1.1.1.1')['forced_update_label'],
+                       'some/label')
+      self.assertEqual(table.RecordPing('1.1.1.1', {}), 'some/label')
+      self.assertEqual(table.GetHostIds(), ['1.1.1.1', '2.2.2.2'])
+    finally:
+      shutil.rmtree(test_dir)
+
+
+class UpdateBudgetTest(unittest.TestCase):
+
+  def testUnlimited(self):
+    budget = autoupdate.UpdateBudget()
+    for _ in range(100):
+      self.assertTrue(budget.Consume())
+
+  def testLimited(self):
+    budget = autoupdate.UpdateBudget(2)
+    self.assertTrue(budget.Consume())
+    self.assertTrue(budget.Consume())
+    self.assertFalse(budget.Consume())
+
+
+def _ConsumeInChild(host_infos, update_budget):
+  host_infos.SetAttr('1.2.3.4', 'forced_update_label', 'child/label')
+  update_budget.Consume()
+
+
+class SharedStateManagerTest(unittest.TestCase):
+
+  def testStateIsShared(self):
+    manager = autoupdate.SharedStateManager()
+    manager.start()
+    try:
+      host_infos = manager.HostInfoTable()
+      update_budget = manager.UpdateBudget(1)
+      child = multiprocessing.Process(target=_ConsumeInChild,
+                                      args=(host_infos, update_budget))
+      child.start()
+      child.join()
+
+      self.assertEqual(host_infos.RecordPing('1.2.3.4', {}), 'child/label')
+      self.assertFalse(update_budget.Consume())
+    finally:
+      manager.shutdown()
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,236 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""In-memory index of the builds available for each build target.
+
+Builds are served from <static_dir>/<target>/<build>. Rather than listing and
+parsing a target directory on every latest build query, the index keeps the
+builds of each target it was asked about sorted by version, overall and per
+milestone, so that the latest build is the last element of a list.
+
+The index is kept current through inotify when pyinotify is available.
+Otherwise, a target is rescanned whenever its directory changed. Either way,
+every target is rescanned periodically to catch anything missed.
+"""
+
+import bisect
+import distutils.version
+import os
+import re
+import threading
+import time
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('BUILDS', message, *args)
+
+
+# Default number of seconds after which a target is rescanned regardless.
+DEFAULT_RESCAN_INTERVAL = 300
+
+# Milestone a build belongs to, e.g. R17 for R17-1413.0.0-a1-b1346.
+_MILESTONE_RE = re.compile(r'^(R\d+)-', re.IGNORECASE)
+
+
+def _GetMilestone(build):
+  """Returns the milestone of |build| in upper case, None if it has none."""
+  match = _MILESTONE_RE.match(build)
+  return match.group(1).upper() if match else None
+
+
+class _TargetBuilds(object):
+  """Sorted builds of a single target."""
+
+  def __init__(self, builds, mtime):
+    self.mtime = mtime
+    self.scan_time = time.time()
+    self.builds = []
+    self.milestones = {}
+    for build in builds:
+      self.Add(build)
+
+  def Add(self, build):
+    version = distutils.version.LooseVersion(build)
+    index = bisect.bisect_left(self.builds, version)
+    if index < len(self.builds) and str(self.builds[index]) == build:
+      return
+    self.builds.insert(index, version)
+    milestone = _GetMilestone(build)
+    if milestone:
+      bisect.insort(self.milestones.setdefault(milestone, []), version)
+
+  def Remove(self, build):
+    version = distutils.version.LooseVersion(build)
+    for builds in (self.builds, self.milestones.get(_GetMilestone(build))):
+      if not builds:
+        continue
+      index = bisect.bisect_left(builds, version)
+      if index < len(builds) and str(builds[index]) == build:
+        del builds[index]
+
+  def GetLatest(self, milestone=None):
+    """Returns the latest build, None if there is none."""
+    if not milestone:
+      builds = self.builds
+    elif _GetMilestone(milestone + '-') == milestone.upper():
+      builds = self.milestones.get(milestone.upper())
+    else:
+      # Not a milestone of the form Rxx, fall back to matching it anywhere in
+      # the build string.
+      builds = [build for build in self.builds
+                if milestone.upper() in str(build)]
+    return str(builds[-1]) if builds else None
+
+
+class BuildVersionIndex(object):
+  """Answers latest build queries from an in-memory index of each target.
+
+  Members:
+    static_dir:      directory where builds are served from.
+    rescan_interval: number of seconds after which a target is rescanned.
+  """
+
+  def __init__(self, static_dir, rescan_interval=DEFAULT_RESCAN_INTERVAL,
+               use_inotify=True):
+    self.static_dir = static_dir
+    self.rescan_interval = rescan_interval
+    self._lock = threading.Lock()
+    self._targets = {}
+    self._use_inotify = use_inotify and pyinotify is not None
+    self._watch_manager = None
+    self._watches = {}
+
+  def _StartNotifier(self):
+    """Starts watching target directories; call with _lock held.
+
+    This happens on first use rather than on creation, so that the notifier
+    thread runs in the process serving the queries.
+    """
+    self._watch_manager = pyinotify.WatchManager()
+    notifier = pyinotify.ThreadedNotifier(self._watch_manager,
+                                          self._ProcessEvent)
+    notifier.daemon = True
+    notifier.start()
+    _Log('Watching build directories with inotify')
+
+  def _Watch(self, target, target_path):
+    """Adds an inotify watch for |target|; call with _lock held."""
+    if not self._use_inotify or target in self._watches:
+      return
+    if not self._watch_manager:
+      self._StartNotifier()
+    mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+            pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+            pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+    watches = self._watch_manager.add_watch(target_path, mask)
+    if watches.get(target_path, -1) >= 0:
+      self._watches[target] = watches[target_path]
+
+  def _ProcessEvent(self, event):
+    """Applies an inotify |event| to the builds of the affected target."""
+    target_path = event.path.rstrip(os.sep)
+    target = os.path.relpath(target_path, self.static_dir)
+    with self._lock:
+      builds = self._targets.get(target)
+      if event.mask & (pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF |
+                       pyinotify.IN_IGNORED | pyinotify.IN_Q_OVERFLOW):
+        # Start over with the next query.
+        self._targets.pop(target, None)
+        self._watches.pop(target, None)
+      elif builds:
+        if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+          builds.Add(event.name)
+        elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+          builds.Remove(event.name)
+
+  def _IsCurrent(self, target, builds, mtime):
+    """Returns whether |builds| reflect the directory of |target|."""
+    if time.time() - builds.scan_time > self.rescan_interval:
+      return False
+    if target in self._watches:
+      return True
+    # With coarse timestamps, the directory may have changed again within the
+    # second it was listed in without its mtime changing.
+    return mtime == builds.mtime and builds.scan_time - mtime > 1
+
+  def _GetTargetBuilds(self, target):
+    """Returns the up to date _TargetBuilds of |target|.
+
+    Raises:
+      CommonUtilError: if the directory of |target| does not exist.
+    """
+    target_path = os.path.join(self.static_dir, target)
+    try:
+      mtime = os.stat(target_path).st_mtime
+    except OSError:
+      mtime = None
+    if mtime is None or not os.path.isdir(target_path):
+      with self._lock:
+        self._targets.pop(target, None)
+      raise common_util.CommonUtilError('Cannot find path %s' % target_path)
+
+    with self._lock:
+      builds = self._targets.get(target)
+      if builds and self._IsCurrent(target, builds, mtime):
+        return builds
+      # Watch before listing so that no build goes unnoticed in between.
+      self._Watch(target, target_path)
+
+    builds = _TargetBuilds(os.listdir(target_path), mtime)
+    with self._lock:
+      self._targets[target] = builds
+    return builds
+
+  def GetLatestBuildVersion(self, target, milestone=None):
+    """Retrieves the latest build version for a given target.
+
+    Args:
+      target: The build target, typically a combination of the board and the
+          type of build e.g. x86-mario-release.
+      milestone: For latest build set to None, for builds only in a specific
+          milestone set to a str of format Rxx (e.g. R16). Default: None.
+
+    Returns:
+      The full build string, e.g. R17-1234.0.0-a1-b983.
+
+    Raises:
+      CommonUtilError: If the latest build cannot be determined, because the
+          target directory does not exist or no builds are left after
+          filtering on milestone.
+    """
+    builds = self._GetTargetBuilds(target)
+    with self._lock:
+      latest = builds.GetLatest(milestone)
+    if not latest:
+      raise common_util.CommonUtilError(
+          'Could not determine build for %s' % target)
+    return latest
+
+  def GetLatestBuildVersions(self, targets, milestone=None):
+    """Retrieves the latest build versions for many targets at once.
+
+    Args:
+      targets: list of build targets.
+      milestone: as for GetLatestBuildVersion.
+
+    Returns:
+      A dictionary mapping each target to its latest build string, or to None
+      if it cannot be determined.
+    """
+    latest = {}
+    for target in targets:
+      try:
+        latest[target] = self.GetLatestBuildVersion(target, milestone)
+      except common_util.CommonUtilError:
+        latest[target] = None
+    return latest
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for build_index module."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import build_index
+import common_util
+
+
+class BuildVersionIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.static_dir = tempfile.mkdtemp('build_index_unittest')
+    self.index = build_index.BuildVersionIndex(self.static_dir,
+                                               use_inotify=False)
+    self._AddBuilds('board', ['R17-1413.0.0-a1-b1346', 'R17-18.0.0-a1-b1346',
+                              'R16-2241.0.0-a0-b2', 'R9-3000.0.0-a1-b1'])
+    os.mkdir(os.path.join(self.static_dir, 'empty'))
+
+  def tearDown(self):
+    shutil.rmtree(self.static_dir)
+
+  def _AddBuilds(self, target, builds, age=60):
+    target_path = os.path.join(self.static_dir, target)
+    if not os.path.isdir(target_path):
+      os.mkdir(target_path)
+    for build in builds:
+      os.mkdir(os.path.join(target_path, build))
+    # Make the change visible to a check of the directory's mtime.
+    mtime = int(time.time()) - age
+    os.utime(target_path, (mtime, mtime))
+
+  def testGetLatestBuildVersion(self):
+    self.assertEqual(self.index.GetLatestBuildVersion('board'),
+                     'R17-1413.0.0-a1-b1346')
+    self.assertEqual(self.index.GetLatestBuildVersion('board', 'R16'),
+                     'R16-2241.0.0-a0-b2')
+    self.assertEqual(self.index.GetLatestBuildVersion('board', 'r9'),
+                     'R9-3000.0.0-a1-b1')
+    self.assertEqual(self.index.GetLatestBuildVersion('board', '2241'),
+                     'R16-2241.0.0-a0-b2')
+
+  def testErrors(self):
+    self.assertRaises(common_util.CommonUtilError,
+                      self.index.GetLatestBuildVersion, 'empty')
+    self.assertRaises(common_util.CommonUtilError,
+                      self.index.GetLatestBuildVersion, 'board', 'R18')
+    self.assertRaises(common_util.CommonUtilError,
+                      self.index.GetLatestBuildVersion, 'missing')
+
+  def testChanges(self):
+    self.assertEqual(self.index.GetLatestBuildVersion('board', 'R16'),
+                     'R16-2241.0.0-a0-b2')
+    self._AddBuilds('board', ['R16-2242.0.0-a0-b3'], age=30)
+    self.assertEqual(self.index.GetLatestBuildVersion('board', 'R16'),
+                     'R16-2242.0.0-a0-b3')
+
+    shutil.rmtree(os.path.join(self.static_dir, 'board'))
+    self.assertRaises(common_util.CommonUtilError,
+                      self.index.GetLatestBuildVersion, 'board')
+
+  def testRescan(self):
+    self.index.GetLatestBuildVersion('board')
+    # A change the index cannot notice by itself.
+    target_path = os.path.join(self.static_dir, 'board')
+    mtime = os.stat(target_path).st_mtime
+    os.mkdir(os.path.join(target_path, 'R18-1.0.0-a1-b1'))
+    os.utime(target_path, (mtime, mtime))
+    self.assertEqual(self.index.GetLatestBuildVersion('board'),
+                     'R17-1413.0.0-a1-b1346')
+
+    self.index.rescan_interval = 0
+    time.sleep(0.01)
+    self.assertEqual(self.index.GetLatestBuildVersion('board'),
+                     'R18-1.0.0-a1-b1')
+
+  def testGetLatestBuildVersions(self):
+    self.assertEqual(
+        self.index.GetLatestBuildVersions(['board', 'empty', 'missing'], 'R17'),
+        {'board': 'R17-1413.0.0-a1-b1346', 'empty': None, 'missing': None})
+
+
+class TargetBuildsTest(unittest.TestCase):
+
+  def testAddRemove(self):
+    builds = build_index._TargetBuilds(['R17-2.0.0-a1-b1', 'R17-10.0.0-a1-b1'],
+                                       0)
+    builds.Add('R17-10.0.0-a1-b1')
+    builds.Add('R16-20.0.0-a1-b1')
+    self.assertEqual(len(builds.builds), 3)
+    self.assertEqual(builds.GetLatest(), 'R17-10.0.0-a1-b1')
+    builds.Remove('R17-10.0.0-a1-b1')
+    self.assertEqual(builds.GetLatest(), 'R17-2.0.0-a1-b1')
+    self.assertEqual(builds.GetLatest('R16'), 'R16-20.0.0-a1-b1')
+    builds.Remove('R16-20.0.0-a1-b1')
+    self.assertEqual(builds.GetLatest('R16'), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,298 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Size-bounded LRU management of the payload cache directory.
+
+Every subdirectory of the cache directory holds the payload(s) generated for
+one image (or pair of images, for deltas). The cache manager keeps track of the
+size and last use of each entry and, whenever entries are added, evicts the
+least recently used ones until the cache fits its byte budget and the disk
+keeps a minimum amount of free space. Entries that are being generated or
+downloaded are pinned and never evicted.
+
+A CacheManager only knows of the pins and uses recorded in its own process.
+Devserver worker processes therefore share a single one, served by a
+multiprocessing manager through CacheManagerProxy, which is then also the only
+process evicting entries.
+"""
+
+import contextlib
+import os
+import shutil
+import threading
+import time
+from multiprocessing import managers
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CACHE', message, *args)
+
+
+# Suffix of the lock files guarding the generation of an entry.
+_LOCK_FILE_SUFFIX = '.lock'
+
+
+def _GetTreeSize(path):
+  """Returns the total size in bytes of the files under |path|."""
+  total = 0
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      try:
+        total += os.lstat(os.path.join(dir_path, file_name)).st_size
+      except OSError:
+        pass
+  return total
+
+
+def _GetTreeMtime(path):
+  """Returns the latest modification time of |path| and anything under it."""
+  latest = os.stat(path).st_mtime
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      try:
+        latest = max(latest,
+                     os.lstat(os.path.join(dir_path, file_name)).st_mtime)
+      except OSError:
+        pass
+  return latest
+
+
+@contextlib.contextmanager
+def _Pinned(cache, path):
+  """A context during which |cache| does not evict the entry of |path|."""
+  cache.Pin(path)
+  try:
+    yield
+  finally:
+    cache.Unpin(path)
+
+
+class _Entry(object):
+  """State of a single cache entry."""
+
+  __slots__ = ('size', 'last_access', 'pins')
+
+  def __init__(self, size, last_access):
+    self.size = size
+    self.last_access = last_access
+    self.pins = 0
+
+
+class CacheManager(object):
+  """Tracks the entries of a cache directory and evicts the least used ones.
+
+  Members:
+    cache_dir:      the directory being managed.
+    max_bytes:      upper bound for the total size of the cache, None for no
+                    bound.
+    min_free_bytes: free disk space to maintain on the cache's file system,
+                    None for no minimum.
+  """
+
+  def __init__(self, cache_dir, max_bytes=None, min_free_bytes=None):
+    self.cache_dir = os.path.realpath(cache_dir)
+    self.max_bytes = max_bytes
+    self.min_free_bytes = min_free_bytes
+    self._lock = threading.Lock()
+    self._entries = {}
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+    self._evicted_bytes = 0
+
+  def _GetEntryName(self, path):
+    """Returns the name of the entry containing |path|, None if not cached."""
+    rel_path = os.path.relpath(os.path.realpath(path), self.cache_dir)
+    if rel_path.startswith(os.pardir) or rel_path == os.curdir:
+      return None
+    return rel_path.split(os.sep, 1)[0]
+
+  def Scan(self):
+    """(Re)reads all entries from the cache directory.
+
+    The last use of an entry found on disk is taken to be its latest
+    modification.
+    """
+    entries = {}
+    for name in os.listdir(self.cache_dir):
+      path = os.path.join(self.cache_dir, name)
+      if os.path.isdir(path) and not os.path.islink(path):
+        entries[name] = _Entry(_GetTreeSize(path), _GetTreeMtime(path))
+
+    with self._lock:
+      for name, known in self._entries.iteritems():
+        entry = entries.get(name)
+        if entry:
+          entry.pins = known.pins
+          entry.last_access = max(entry.last_access, known.last_access)
+        elif known.pins:
+          # Still being generated.
+          entries[name] = known
+      self._entries = entries
+
+  def _Measure(self, name):
+    """Records the current size of entry |name|, marking it as just used."""
+    size = _GetTreeSize(os.path.join(self.cache_dir, name))
+    with self._lock:
+      entry = self._entries.setdefault(name, _Entry(size, time.time()))
+      entry.size = size
+      entry.last_access = time.time()
+
+  def RecordUse(self, path, hit):
+    """Records a lookup of |path| in the cache.
+
+    Args:
+      path: path of the file looked up.
+      hit: whether it was found in the cache.
+    """
+    name = self._GetEntryName(path)
+    if not name:
+      return
+
+    with self._lock:
+      if hit:
+        self._hits += 1
+      else:
+        self._misses += 1
+      entry = self._entries.get(name)
+      if entry:
+        entry.last_access = time.time()
+
+    # The entry may have been created by another devserver process.
+    if hit and (not entry or not entry.size):
+      self._Measure(name)
+
+  def Update(self, path):
+    """Records a new or changed entry containing |path| and trims the cache."""
+    name = self._GetEntryName(path)
+    if name:
+      self._Measure(name)
+      self.Evict()
+
+  def Pin(self, path):
+    """Keeps the entry containing |path| from eviction until Unpin(path)."""
+    name = self._GetEntryName(path)
+    if name:
+      with self._lock:
+        entry = self._entries.setdefault(name, _Entry(0, time.time()))
+        entry.pins += 1
+
+  def Unpin(self, path):
+    """Undoes one Pin(path), marking the entry as just used."""
+    name = self._GetEntryName(path)
+    if not name:
+      return
+    exists = os.path.isdir(os.path.join(self.cache_dir, name))
+    with self._lock:
+      entry = self._entries.get(name)
+      if entry:
+        entry.pins -= 1
+        entry.last_access = time.time()
+        # Forget entries whose generation failed.
+        if not entry.pins and not exists:
+          del self._entries[name]
+
+  def Pinned(self, path):
+    """A context during which the entry containing |path| is not evicted."""
+    return _Pinned(self, path)
+
+  def _GetFreeBytes(self):
+    fs_stat = os.statvfs(self.cache_dir)
+    return fs_stat.f_bavail * fs_stat.f_frsize
+
+  def _NeedsEviction(self, total_bytes):
+    if self.max_bytes is not None and total_bytes > self.max_bytes:
+      return True
+    if self.min_free_bytes is not None:
+      return self._GetFreeBytes() < self.min_free_bytes
+    return False
+
+  def _IsEvictable(self, name, entry):
+    if entry.pins:
+      return False
+    # Another process may be generating this entry.
+    return not os.path.exists(
+        os.path.join(self.cache_dir, name + _LOCK_FILE_SUFFIX))
+
+  def Evict(self):
+    """Evicts least recently used entries until the cache is within bounds.
+
+    Returns:
+      The list of evicted entry names.
+    """
+    evicted = []
+    with self._lock:
+      total_bytes = sum(entry.size for entry in self._entries.itervalues())
+      candidates = sorted(self._entries.iteritems(),
+                          key=lambda item: item[1].last_access)
+
+    for name, entry in candidates:
+      if not self._NeedsEviction(total_bytes):
+        break
+      with self._lock:
+        if not self._IsEvictable(name, entry) or (
+            self._entries.get(name) is not entry):
+          continue
+        del self._entries[name]
+
+      _Log('Evicting %s (%d bytes)', name, entry.size)
+      shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+      total_bytes -= entry.size
+      evicted.append(name)
+      with self._lock:
+        self._evictions += 1
+        self._evicted_bytes += entry.size
+
+    return evicted
+
+  def GetStats(self):
+    """Returns a dictionary of cache occupancy and usage statistics."""
+    with self._lock:
+      return {
+          'entries': len(self._entries),
+          'bytes': sum(entry.size for entry in self._entries.itervalues()),
+          'pinned': sum(1 for entry in self._entries.itervalues()
+                        if entry.pins),
+          'max_bytes': self.max_bytes,
+          'min_free_bytes': self.min_free_bytes,
+          'free_bytes': self._GetFreeBytes(),
+          'hits': self._hits,
+          'misses': self._misses,
+          'evictions': self._evictions,
+          'evicted_bytes': self._evicted_bytes,
+      }
+
+
+class CacheManagerProxy(managers.BaseProxy):
+  """A CacheManager living in a multiprocessing manager process."""
+
+  _exposed_ = ('Scan', 'RecordUse', 'Update', 'Pin', 'Unpin', 'Evict',
+               'GetStats')
+
+  def Scan(self):
+    return self._callmethod('Scan')
+
+  def RecordUse(self, path, hit):
+    return self._callmethod('RecordUse', (path, hit))
+
+  def Update(self, path):
+    return self._callmethod('Update', (path,))
+
+  def Pin(self, path):
+    return self._callmethod('Pin', (path,))
+
+  def Unpin(self, path):
+    return self._callmethod('Unpin', (path,))
+
+  def Pinned(self, path):
+    return _Pinned(self, path)
+
+  def Evict(self):
+    return self._callmethod('Evict')
+
+  def GetStats(self):
+    return self._callmethod('GetStats')
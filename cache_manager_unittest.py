@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for cache_manager module."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from multiprocessing import managers
+
+import cache_manager
+
+
+class _CacheServer(managers.BaseManager):
+  pass
+
+
+_CacheServer.register('CacheManager', cache_manager.CacheManager,
+                      proxytype=cache_manager.CacheManagerProxy)
+
+
+def _Download(cache, payload, started, done):
+  """Pins |payload| in |cache| as a download in another process would."""
+  with cache.Pinned(payload):
+    started.set()
+    done.wait()
+
+
+class CacheManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp('cache_manager_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def _AddEntry(self, name, size, age=0):
+    entry_dir = os.path.join(self.cache_dir, name)
+    os.mkdir(entry_dir)
+    payload = os.path.join(entry_dir, 'update.gz')
+    with open(payload, 'w') as f:
+      f.write('x' * size)
+    mtime = time.time() - age
+    os.utime(payload, (mtime, mtime))
+    os.utime(entry_dir, (mtime, mtime))
+    return payload
+
+  def _Entries(self):
+    return sorted(name for name in os.listdir(self.cache_dir))
+
+  def testScanAndEvict(self):
+    self._AddEntry('old', 100, age=300)
+    self._AddEntry('older', 100, age=400)
+    self._AddEntry('new', 100, age=100)
+    cache = cache_manager.CacheManager(self.cache_dir, max_bytes=150)
+    cache.Scan()
+    self.assertEqual(cache.GetStats()['bytes'], 300)
+
+    self.assertEqual(cache.Evict(), ['older', 'old'])
+    self.assertEqual(self._Entries(), ['new'])
+    stats = cache.GetStats()
+    self.assertEqual((stats['entries'], stats['bytes'], stats['evictions'],
+                      stats['evicted_bytes']), (1, 100, 2, 200))
+
+  def testRecordUse(self):
+    old_payload = self._AddEntry('old', 100, age=300)
+    self._AddEntry('new', 100, age=100)
+    cache = cache_manager.CacheManager(self.cache_dir, max_bytes=250)
+    cache.Scan()
+
+    # Using an entry makes it the most recently used one.
+    cache.RecordUse(old_payload, True)
+    cache.RecordUse(os.path.join(self.cache_dir, 'missing', 'update.gz'),
+                    False)
+    new_payload = self._AddEntry('newest', 100)
+    cache.Update(new_payload)
+    self.assertEqual(self._Entries(), ['newest', 'old'])
+    stats = cache.GetStats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+  def testPinnedEntriesAreKept(self):
+    old_payload = self._AddEntry('old', 100, age=300)
+    self._AddEntry('new', 100, age=100)
+    cache = cache_manager.CacheManager(self.cache_dir, max_bytes=0)
+    cache.Scan()
+
+    with cache.Pinned(old_payload):
+      self.assertEqual(cache.GetStats()['pinned'], 1)
+      self.assertEqual(cache.Evict(), ['new'])
+    self.assertEqual(cache.Evict(), ['old'])
+
+  def testEntriesBeingGeneratedAreKept(self):
+    self._AddEntry('old', 100, age=300)
+    with open(os.path.join(self.cache_dir, 'old.lock'), 'w'):
+      pass
+    cache = cache_manager.CacheManager(self.cache_dir, max_bytes=0)
+    cache.Scan()
+    self.assertEqual(cache.Evict(), [])
+
+    # Pins of entries that are not on disk yet survive a rescan.
+    generated_dir = os.path.join(self.cache_dir, 'generated')
+    with cache.Pinned(generated_dir):
+      cache.Scan()
+      self.assertEqual(cache.GetStats()['pinned'], 1)
+    self.assertEqual(cache.GetStats()['entries'], 1)
+
+  def testSharedBetweenProcesses(self):
+    old_payload = self._AddEntry('old', 100, age=300)
+    self._AddEntry('new', 100, age=100)
+    server = _CacheServer()
+    server.start()
+    try:
+      cache = server.CacheManager(self.cache_dir, max_bytes=0)
+      cache.Scan()
+      started = multiprocessing.Event()
+      done = multiprocessing.Event()
+      download = multiprocessing.Process(
+          target=_Download, args=(cache, old_payload, started, done))
+      download.start()
+      try:
+        self.assertTrue(started.wait(10))
+        # The pin of the other process keeps its entry.
+        self.assertEqual(cache.Evict(), ['new'])
+      finally:
+        done.set()
+        download.join()
+      self.assertEqual(cache.GetStats()['pinned'], 0)
+      self.assertEqual(cache.Evict(), ['old'])
+    finally:
+      server.shutdown()
+
+  def testFreeDiskWatermark(self):
+    self._AddEntry('old', 100, age=300)
+    cache = cache_manager.CacheManager(self.cache_dir, min_free_bytes=0)
+    cache.Scan()
+    self.assertEqual(cache.Evict(), [])
+
+    cache.min_free_bytes = cache.GetStats()['free_bytes'] * 2
+    self.assertEqual(cache.Evict(), ['old'])
+
+  def testPathsOutsideCache(self):
+    cache = cache_manager.CacheManager(self.cache_dir)
+    outside = os.path.join(os.path.dirname(self.cache_dir), 'update.gz')
+    cache.RecordUse(outside, True)
+    with cache.Pinned(outside):
+      pass
+    self.assertEqual(cache.GetStats()['entries'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
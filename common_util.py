@@ -6,19 +6,29 @@
 
 import base64
 import binascii
+import bisect
+import collections
+import contextlib
 import distutils.version
 import errno
+import fnmatch
 import hashlib
+import json
 import os
 import random
 import re
 import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
 
 import lockfile
 
 import gsutil_util
 import log_util
+import metrics
 
 
 # Module-local log function.
@@ -34,6 +44,9 @@ DEVSERVER_LOCK_FILE = 'devserver'
 
 _HASH_BLOCK_SIZE = 8192
 
+# Seconds between checks of whether a lock being waited for was abandoned.
+_LOCK_POLL_INTERVAL = 1
+
 
 def CommaSeparatedList(value_list, is_quoted=False):
   """Concatenates a list of strings.
@@ -151,6 +164,71 @@ def ReleaseLock(static_dir, tag, destroy=False):
     raise CommonUtilError(str(e))
 
 
+def IsProcessAlive(pid):
+  """Returns whether process |pid| of this host is running."""
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno == errno.EPERM
+  return True
+
+
+def _GetStaleLockId(lock_file, max_age):
+  """Returns the inode of |lock_file| if it was abandoned, None otherwise.
+
+  A lock is abandoned if the process recorded in it is no longer running, or
+  if it was taken more than |max_age| seconds ago.
+  """
+  try:
+    with open(lock_file) as f:
+      owner = f.read().split()
+    lock_stat = os.stat(lock_file)
+  except (IOError, OSError):
+    return None
+  if max_age is not None and time.time() - lock_stat.st_mtime > max_age:
+    return lock_stat.st_ino
+  if (len(owner) == 2 and owner[0] == socket.gethostname() and
+      owner[1].isdigit() and not IsProcessAlive(int(owner[1]))):
+    return lock_stat.st_ino
+  return None
+
+
+@contextlib.contextmanager
+def BreakableFileLock(path, max_age=None):
+  """A context holding lockfile.FileLock(path), taken over when abandoned.
+
+  The holder records its host and PID in the lock file. A waiter breaks the
+  lock if that process died without releasing it, e.g. because it crashed,
+  or if the lock is older than |max_age| seconds (None for no limit).
+  """
+  lock = lockfile.FileLock(path)
+  while True:
+    try:
+      lock.acquire(timeout=_LOCK_POLL_INTERVAL)
+      break
+    except lockfile.LockTimeout:
+      stale_id = _GetStaleLockId(lock.lock_file, max_age)
+      try:
+        # Unless another waiter already broke it and took the lock.
+        if stale_id is not None and os.stat(lock.lock_file).st_ino == stale_id:
+          _Log('Breaking abandoned lock %s', lock.lock_file)
+          os.unlink(lock.lock_file)
+      except OSError:
+        pass
+
+  try:
+    with open(lock.lock_file, 'w') as f:
+      f.write('%s %d\n' % (socket.gethostname(), os.getpid()))
+    yield
+  finally:
+    if lock.i_am_locking():
+      lock.release()
+    else:
+      # Leave alone whoever took it over.
+      _Log('Lock %s was broken while held', lock.lock_file)
+      os.unlink(lock.unique_name)
+
+
 def GetLatestBuildVersion(static_dir, target, milestone=None):
   """Retrieves the latest build version for a given board.
 
@@ -213,16 +291,101 @@ def GetControlFile(static_dir, build, control_path):
     # crosbug.com/25040
     return 'Unknown control path %s' % control_path
 
-  with open(control_path, 'r') as control_file:
-    return control_file.read()
+  return _control_file_cache.Read(control_path)
+
+
+# Name of the control file manifest written into each build directory.
+CONTROL_FILE_MANIFEST = 'control_files.json'
+
+# Control file manifests loaded so far, by autotest directory.
+_control_file_manifests = {}
+_control_file_manifests_lock = threading.Lock()
+
+
+def _IsControlFile(file_name):
+  return file_name.startswith('control.') or file_name == 'control'
 
 
-def GetControlFileList(static_dir, build):
+def _ScanControlFiles(autotest_dir):
+  """Returns the sorted paths of all control files under |autotest_dir|."""
+  control_files = []
+  for dir_path, _, files in os.walk(autotest_dir):
+    rel_dir = os.path.relpath(dir_path, autotest_dir)
+    for file_entry in files:
+      if _IsControlFile(file_entry):
+        control_files.append(os.path.normpath(os.path.join(rel_dir,
+                                                           file_entry)))
+  return sorted(control_files)
+
+
+def _GetControlFileManifest(static_dir, build):
+  """Returns the control files of |build|, relative to its autotest dir.
+
+  The list comes from a manifest, built by walking the autotest directory on
+  first use and kept in memory as well as in the build directory for other
+  devserver processes. A manifest is valid as long as the modification time
+  of the autotest directory it was built from does not change; staged builds
+  are not expected to change otherwise.
+
+  Returns:
+    A (control files, control files by test name) tuple, where the first is
+    a sorted list of paths and the second maps the name of each test, i.e. of
+    the directory holding its control files, to a list of their paths.
+
+  Raises:
+    CommonUtilError: If path is outside of sandbox.
+    OSError: If the autotest dir does not exist.
+  """
+  build_dir = os.path.join(static_dir, build)
+  autotest_dir = os.path.join(build_dir, 'autotest')
+  if not SafeSandboxAccess(static_dir, autotest_dir):
+    raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
+
+  mtime = os.stat(autotest_dir).st_mtime
+  with _control_file_manifests_lock:
+    manifest = _control_file_manifests.get(autotest_dir)
+  if manifest and manifest[0] == mtime:
+    return manifest[1:]
+
+  manifest_path = os.path.join(build_dir, CONTROL_FILE_MANIFEST)
+  try:
+    with open(manifest_path) as manifest_file:
+      manifest = json.load(manifest_file)
+  except (IOError, ValueError):
+    manifest = None
+
+  if not manifest or manifest.get('autotest_mtime') != mtime:
+    manifest = {'autotest_mtime': mtime,
+                'control_files': _ScanControlFiles(autotest_dir)}
+    try:
+      fd, temp_path = tempfile.mkstemp(dir=build_dir)
+      with os.fdopen(fd, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+      os.rename(temp_path, manifest_path)
+    except (IOError, OSError) as e:
+      _Log('Failed to write control file manifest %s: %s', manifest_path, e)
+
+  control_files = manifest['control_files']
+  by_test_name = {}
+  for control_file in control_files:
+    test_name = os.path.basename(os.path.dirname(control_file))
+    by_test_name.setdefault(test_name, []).append(control_file)
+  with _control_file_manifests_lock:
+    _control_file_manifests[autotest_dir] = (mtime, control_files,
+                                             by_test_name)
+  return control_files, by_test_name
+
+
+def GetControlFileList(static_dir, build, prefix=None, test_name=None):
   """List all control|control. files in the specified board/build path.
 
   Args:
     static_dir: Directory where builds are served from.
     build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    prefix: If set, only list control files whose path relative to the
+        Autotest root starts with it, e.g. client/site_tests.
+    test_name: If set, only list the control files of this test, i.e. those
+        in a directory by that name, e.g. sleeptest.
 
   Raises:
     CommonUtilError: If path is outside of sandbox.
@@ -230,37 +393,282 @@ def GetControlFileList(static_dir, build):
   Returns:
     String of each file separated by a newline.
   """
-  autotest_dir = os.path.join(static_dir, build, 'autotest/')
-  if not SafeSandboxAccess(static_dir, autotest_dir):
-    raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
-
-  control_files = set()
-  if not os.path.exists(autotest_dir):
+  try:
+    control_files, by_test_name = _GetControlFileManifest(static_dir, build)
+  except OSError:
     # TODO(scottz): Come up with some sort of error mechanism.
     # crosbug.com/25040
-    return 'Unknown build path %s' % autotest_dir
+    return 'Unknown build path %s' % os.path.join(static_dir, build,
+                                                  'autotest/')
 
-  for entry in os.walk(autotest_dir):
-    dir_path, _, files = entry
-    for file_entry in files:
-      if file_entry.startswith('control.') or file_entry == 'control':
-        control_files.add(os.path.join(dir_path,
-                                       file_entry).replace(autotest_dir, ''))
+  if test_name:
+    control_files = by_test_name.get(test_name, [])
+
+  if prefix:
+    prefix = prefix.lstrip('/')
+    # The manifest is sorted, so the matches are contiguous.
+    start = bisect.bisect_left(control_files, prefix)
+    end = start
+    while end < len(control_files) and control_files[end].startswith(prefix):
+      end += 1
+    control_files = control_files[start:end]
 
   return '\n'.join(control_files)
 
 
+class ControlFileCache(object):
+  """A size-bounded LRU cache of control file contents.
+
+  Entries are keyed by path and only used while the file's identity (device,
+  inode, size and modification time) is unchanged.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+
+  def Get(self, file_path):
+    """Returns the cached contents of |file_path|, None if unknown or stale.
+
+    Raises:
+      OSError: If the file does not exist.
+    """
+    identity = _GetFileIdentity(file_path)
+    with self._lock:
+      entry = self._entries.get(file_path)
+      if not entry or entry[0] != identity:
+        return None
+      # Most recently used entries go last.
+      del self._entries[file_path]
+      self._entries[file_path] = entry
+      return entry[1]
+
+  def Read(self, file_path):
+    """Returns the contents of |file_path|, reading it only if needed.
+
+    Raises:
+      IOError, OSError: If the file cannot be read.
+    """
+    contents = self.Get(file_path)
+    if contents is not None:
+      return contents
+
+    identity = _GetFileIdentity(file_path)
+    with open(file_path, 'r') as control_file:
+      contents = control_file.read()
+    if len(contents) > self.max_bytes:
+      return contents
+
+    with self._lock:
+      old_entry = self._entries.pop(file_path, None)
+      if old_entry:
+        self._bytes -= len(old_entry[1])
+      self._entries[file_path] = (identity, contents)
+      self._bytes += len(contents)
+      while self._bytes > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self._bytes -= len(evicted)
+    return contents
+
+
+# Upper bound for the total size of the control files kept in memory.
+_CONTROL_FILE_CACHE_BYTES = 32 * 1024 * 1024
+
+_control_file_cache = ControlFileCache(_CONTROL_FILE_CACHE_BYTES)
+
+
+def GetControlFiles(static_dir, build, control_paths=None, pattern=None):
+  """Retrieves the contents of many control files of a build at once.
+
+  Only the control files listed in the build's control file manifest are
+  served, so that the requested paths need not be checked one by one.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    control_paths: List of paths of control files, relative to the Autotest
+        root.
+    pattern: Shell-style wildcard matched against the paths of all control
+        files of the build, e.g. client/site_tests/*/control. Note that '*'
+        also matches '/'.
+
+  Raises:
+    CommonUtilError: If path is outside of sandbox or the build is unknown.
+
+  Returns:
+    A dictionary mapping the requested paths to the contents of the control
+    files, or to None for paths that are not control files of the build.
+  """
+  try:
+    control_files, _ = _GetControlFileManifest(static_dir, build)
+  except OSError:
+    raise CommonUtilError('Unknown build path %s' % os.path.join(
+        static_dir, build, 'autotest/'))
+
+  known = set(control_files)
+  requested = [control_path.lstrip('/')
+               for control_path in control_paths or []]
+  if pattern:
+    requested.extend(fnmatch.filter(control_files, pattern.lstrip('/')))
+
+  autotest_dir = os.path.join(static_dir, build, 'autotest')
+  contents = {}
+  for control_path in requested:
+    if control_path not in known or control_path in contents:
+      contents.setdefault(control_path, None)
+      continue
+    file_path = os.path.join(autotest_dir, control_path)
+    try:
+      control = _control_file_cache.Get(file_path)
+      if control is None:
+        # Control files may be symlinks; check where they lead before they
+        # are first read.
+        if not SafeSandboxAccess(static_dir, file_path):
+          raise CommonUtilError('Invalid control file "%s".' % file_path)
+        control = _control_file_cache.Read(file_path)
+    except EnvironmentError:
+      control = None
+    contents[control_path] = control
+  return contents
+
+
 def GetFileSize(file_path):
   """Returns the size in bytes of the file given."""
   return os.path.getsize(file_path)
 
 
-# Hashlib is strange and doesn't actually define these in a sane way that
-# pylint can find them. Disable checks for them.
-# pylint: disable=E1101,W0106
+def _GetFileIdentity(file_path):
+  """Returns a (device, inode, size, mtime_ns) tuple identifying a file."""
+  file_stat = os.stat(file_path)
+  mtime_ns = getattr(file_stat, 'st_mtime_ns',
+                     int(round(file_stat.st_mtime * 1e9)))
+  return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, mtime_ns
+
+
+def GetFileETag(file_path):
+  """Returns an HTTP entity tag that changes whenever the file does."""
+  return '"%x-%x-%x-%x"' % _GetFileIdentity(file_path)
+
+
+class FileDigestIndex(object):
+  """A persistent index of file digests.
+
+  Digests are stored in an SQLite database, keyed by the device, inode, size
+  and modification time of the file they were computed from, so that the
+  digests of unchanged files survive restarts. Any change to a file changes its
+  key; stale entries are never returned.
+
+  The index may be used from several threads and, through separate
+  connections, from several processes.
+  """
+
+  _DIGESTS = ('sha1', 'sha256', 'md5')
+
+  def __init__(self, db_path):
+    """Opens (and creates, if needed) the index stored in |db_path|."""
+    self.db_path = db_path
+    self._lock = threading.Lock()
+    self._conn = None
+    self._conn_pid = None
+    with self._lock:
+      self._GetConnection().execute(
+          'CREATE TABLE IF NOT EXISTS digests ('
+          '  dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+          '  sha1 BLOB, sha256 BLOB, md5 BLOB,'
+          '  PRIMARY KEY (dev, ino, size, mtime_ns))')
+
+  def _GetConnection(self):
+    """Returns this process' connection to the database; call with _lock."""
+    # Connections must not be shared with forked children.
+    if self._conn_pid != os.getpid():
+      self._conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+      self._conn.text_factory = str
+      self._conn_pid = os.getpid()
+    return self._conn
+
+  def Lookup(self, identity):
+    """Returns a dictionary of the digests stored for a file identity."""
+    with self._lock:
+      row = self._GetConnection().execute(
+          'SELECT sha1, sha256, md5 FROM digests '
+          'WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+          identity).fetchone()
+    if not row:
+      return {}
+    return dict((name, str(digest))
+                for name, digest in zip(self._DIGESTS, row) if digest)
+
+  def Store(self, identity, digests):
+    """Records |digests| of a file identity, keeping any others stored."""
+    values = [sqlite3.Binary(digests[name]) if name in digests else None
+              for name in self._DIGESTS]
+    with self._lock:
+      conn = self._GetConnection()
+      try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT OR IGNORE INTO digests (dev, ino, size, mtime_ns) '
+            'VALUES (?, ?, ?, ?)', identity)
+        conn.execute(
+            'UPDATE digests SET sha1 = COALESCE(?, sha1), '
+            'sha256 = COALESCE(?, sha256), md5 = COALESCE(?, md5) '
+            'WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+            values + list(identity))
+        conn.execute('COMMIT')
+      except sqlite3.Error as e:
+        _Log('Failed to store digests in %s: %s', self.db_path, e)
+        try:
+          conn.execute('ROLLBACK')
+        except sqlite3.Error:
+          pass
+
+  def GetDigests(self, file_path, names):
+    """Returns the digests |names| of a file, computing missing ones.
+
+    All missing digests are computed in a single pass over the file.
+
+    Args:
+      file_path: path to the file.
+      names: iterable of digest names ('sha1', 'sha256' and/or 'md5').
+    Returns:
+      A dictionary of binary digests keyed by name.
+    """
+    identity = _GetFileIdentity(file_path)
+    digests = self.Lookup(identity)
+    missing = [name for name in names if name not in digests]
+    if missing:
+      computed = _ComputeFileHashes(file_path, missing)
+      # Do not record digests of a file that changed while being hashed.
+      if _GetFileIdentity(file_path) == identity:
+        self.Store(identity, computed)
+      digests.update(computed)
+    return dict((name, digests[name]) for name in names)
+
+
+# The digest index consulted by GetFileHashes(), if any.
+_digest_index = None
+
+
+def SetDigestIndex(index):
+  """Makes GetFileHashes() use (and populate) a FileDigestIndex.
+
+  Args:
+    index: a FileDigestIndex, or None to always hash files.
+  """
+  # pylint: disable=W0603
+  global _digest_index
+  _digest_index = index
+
+
 def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
   """Computes and returns a list of requested hashes.
 
+  Hashes are looked up in the digest index set by SetDigestIndex(), if any.
+
   Args:
     file_path: path to file to be hashed
     do_sha1:   whether or not to compute a SHA1 hash
@@ -270,32 +678,33 @@ def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
     A dictionary containing binary hash values, keyed by 'sha1', 'sha256' and
     'md5', respectively.
   """
-  hashes = {}
-  if (do_sha1 or do_sha256 or do_md5):
-    # Initialize hashers.
-    hasher_sha1 = hashlib.sha1() if do_sha1 else None
-    hasher_sha256 = hashlib.sha256() if do_sha256 else None
-    hasher_md5 = hashlib.md5() if do_md5 else None
-
-    # Read blocks from file, update hashes.
-    with open(file_path, 'rb') as fd:
-      while True:
-        block = fd.read(_HASH_BLOCK_SIZE)
-        if not block:
-          break
-        hasher_sha1 and hasher_sha1.update(block)
-        hasher_sha256 and hasher_sha256.update(block)
-        hasher_md5 and hasher_md5.update(block)
-
-    # Update return values.
-    if hasher_sha1:
-      hashes['sha1'] = hasher_sha1.digest()
-    if hasher_sha256:
-      hashes['sha256'] = hasher_sha256.digest()
-    if hasher_md5:
-      hashes['md5'] = hasher_md5.digest()
-
-  return hashes
+  names = [name for name, wanted in (('sha1', do_sha1),
+                                     ('sha256', do_sha256),
+                                     ('md5', do_md5)) if wanted]
+  if not names:
+    return {}
+  if _digest_index:
+    return _digest_index.GetDigests(file_path, names)
+  return _ComputeFileHashes(file_path, names)
+
+
+def _ComputeFileHashes(file_path, names):
+  """Hashes a file with each of the digests |names| in a single pass."""
+  hashers = dict((name, getattr(hashlib, name)()) for name in names)
+
+  # Read blocks from file, update hashes.
+  hashed_bytes = 0
+  with metrics.HASH_COMPUTATION.Time(), open(file_path, 'rb') as fd:
+    while True:
+      block = fd.read(_HASH_BLOCK_SIZE)
+      if not block:
+        break
+      hashed_bytes += len(block)
+      for hasher in hashers.itervalues():
+        hasher.update(block)
+  metrics.HASHED_BYTES.Inc(amount=hashed_bytes)
+
+  return dict((name, hasher.digest()) for name, hasher in hashers.iteritems())
 
 
 def GetFileSha1(file_path):
@@ -314,6 +723,17 @@ def GetFileMd5(file_path):
 
 
 def CopyFile(source, dest):
-  """Copies a file from |source| to |dest|."""
+  """Copies a file from |source| to |dest|.
+
+  |dest| is replaced atomically, so that it is never seen partially written
+  by concurrent readers, e.g. clients downloading the previous copy.
+  """
   _Log('Copy File %s -> %s' % (source, dest))
-  shutil.copy(source, dest)
+  fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)))
+  os.close(fd)
+  try:
+    shutil.copy(source, temp_path)
+    os.rename(temp_path, dest)
+  except:
+    os.remove(temp_path)
+    raise
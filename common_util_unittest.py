@@ -6,10 +6,14 @@
 
 """Unit tests for common_util module."""
 
+import errno
 import os
 import shutil
+import socket
 import subprocess
 import tempfile
+import threading
+import time
 import unittest
 
 import mox
@@ -147,5 +151,268 @@ class CommonUtilTest(mox.MoxTestBase):
         os.path.join('server', 'site_tests', 'network_VPN', 'control'))
     self.assertEqual(control_content, 'hello!')
 
+  def testGetControlFileList(self):
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    autotest_dir = os.path.join(self._static_dir, build, 'autotest')
+    for control_path in ['server/site_tests/network_VPN/control',
+                         'client/site_tests/sleeptest/control',
+                         'client/site_tests/sleeptest/control.long',
+                         'client/tests/sleeptest/control',
+                         'client/site_tests/sleeptest/notcontrol']:
+      control_path = os.path.join(autotest_dir, control_path)
+      if not os.path.isdir(os.path.dirname(control_path)):
+        os.makedirs(os.path.dirname(control_path))
+      with open(control_path, 'w') as f:
+        f.write('hello!')
+
+    self.assertEqual(
+        common_util.GetControlFileList(self._static_dir, build).split('\n'),
+        ['client/site_tests/sleeptest/control',
+         'client/site_tests/sleeptest/control.long',
+         'client/tests/sleeptest/control',
+         'server/site_tests/network_VPN/control'])
+    self.assertTrue(os.path.exists(os.path.join(
+        self._static_dir, build, common_util.CONTROL_FILE_MANIFEST)))
+
+    # Listings come from the manifest, without walking the autotest dir.
+    self.mox.StubOutWithMock(os, 'walk')
+    self.mox.ReplayAll()
+    self.assertEqual(
+        common_util.GetControlFileList(self._static_dir, build,
+                                       prefix='/client/site_tests'),
+        'client/site_tests/sleeptest/control\n'
+        'client/site_tests/sleeptest/control.long')
+    self.assertEqual(
+        common_util.GetControlFileList(self._static_dir, build,
+                                       prefix='client', test_name='sleeptest'),
+        'client/site_tests/sleeptest/control\n'
+        'client/site_tests/sleeptest/control.long\n'
+        'client/tests/sleeptest/control')
+    self.assertEqual(
+        common_util.GetControlFileList(self._static_dir, build,
+                                       test_name='network_VPN'),
+        'server/site_tests/network_VPN/control')
+    self.mox.VerifyAll()
+    self.mox.UnsetStubs()
+
+    # Changing the autotest dir invalidates the manifest.
+    os.makedirs(os.path.join(autotest_dir, 'new_test'))
+    with open(os.path.join(autotest_dir, 'new_test', 'control'), 'w') as f:
+      f.write('hello!')
+    mtime = os.stat(autotest_dir).st_mtime + 10
+    os.utime(autotest_dir, (mtime, mtime))
+    self.assertEqual(
+        common_util.GetControlFileList(self._static_dir, build,
+                                       test_name='new_test'),
+        'new_test/control')
+
+  def testGetControlFiles(self):
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    autotest_dir = os.path.join(self._static_dir, build, 'autotest')
+    for test in ['sleeptest', 'dummy_Pass']:
+      os.makedirs(os.path.join(autotest_dir, 'client', 'site_tests', test))
+      with open(os.path.join(autotest_dir, 'client', 'site_tests', test,
+                             'control'), 'w') as f:
+        f.write(test)
+    os.symlink('/etc/passwd',
+               os.path.join(autotest_dir, 'client', 'site_tests', 'sleeptest',
+                            'control.evil'))
+
+    self.assertEqual(
+        common_util.GetControlFiles(
+            self._static_dir, build,
+            control_paths=['/client/site_tests/sleeptest/control',
+                           'client/site_tests/sleeptest/missing',
+                           '../../../../etc/passwd']),
+        {'client/site_tests/sleeptest/control': 'sleeptest',
+         'client/site_tests/sleeptest/missing': None,
+         '../../../../etc/passwd': None})
+    self.assertEqual(
+        common_util.GetControlFiles(self._static_dir, build,
+                                    pattern='client/*/control'),
+        {'client/site_tests/sleeptest/control': 'sleeptest',
+         'client/site_tests/dummy_Pass/control': 'dummy_Pass'})
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetControlFiles, self._static_dir, build,
+                      pattern='*/control.evil')
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetControlFiles, self._static_dir,
+                      'test-board-1/R1-1.0.0', pattern='*')
+
+  def testGetControlFileListUnknownBuild(self):
+    self.assertTrue(common_util.GetControlFileList(
+        self._static_dir, 'test-board-1/R1-1.0.0').startswith(
+            'Unknown build path'))
+
+  def testIsProcessAlive(self):
+    self.assertTrue(common_util.IsProcessAlive(os.getpid()))
+    process = subprocess.Popen(['true'])
+    process.wait()
+    self.assertFalse(common_util.IsProcessAlive(process.pid))
+
+    # Processes of other users cannot be signalled, but are running.
+    self.mox.StubOutWithMock(os, 'kill')
+    os.kill(1, 0).AndRaise(OSError(errno.EPERM, 'Operation not permitted'))
+    self.mox.ReplayAll()
+    self.assertTrue(common_util.IsProcessAlive(1))
+    self.mox.VerifyAll()
+
+
+class ControlFileCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp('common_util_unittest')
+    self._cache = common_util.ControlFileCache(10)
+
+  def tearDown(self):
+    shutil.rmtree(self._test_dir)
+
+  def _Write(self, name, contents, age=0):
+    file_path = os.path.join(self._test_dir, name)
+    with open(file_path, 'w') as f:
+      f.write(contents)
+    mtime = time.time() - age
+    os.utime(file_path, (mtime, mtime))
+    return file_path
+
+  def testRead(self):
+    first = self._Write('first', 'abcd', age=10)
+    self.assertEqual(self._cache.Get(first), None)
+    self.assertEqual(self._cache.Read(first), 'abcd')
+    self.assertEqual(self._cache.Get(first), 'abcd')
+
+    # Changed files are read again.
+    self._Write('first', 'efgh')
+    self.assertEqual(self._cache.Get(first), None)
+    self.assertEqual(self._cache.Read(first), 'efgh')
+
+  def testEviction(self):
+    first = self._Write('first', 'abcd', age=10)
+    second = self._Write('second', 'efgh', age=10)
+    third = self._Write('third', 'ijkl', age=10)
+    self._cache.Read(first)
+    self._cache.Read(second)
+    self._cache.Get(first)
+    self._cache.Read(third)
+    self.assertEqual(self._cache.Get(second), None)
+    self.assertEqual(self._cache.Get(first), 'abcd')
+    self.assertEqual(self._cache.Get(third), 'ijkl')
+
+    self.assertEqual(self._cache.Read(self._Write('big', 'x' * 20)), 'x' * 20)
+    self.assertEqual(self._cache.Get(first), 'abcd')
+
+
+class BreakableFileLockTest(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp('common_util_unittest')
+    self._path = os.path.join(self._test_dir, 'payload')
+    self._lock_file = self._path + '.lock'
+
+  def tearDown(self):
+    shutil.rmtree(self._test_dir)
+
+  def _Abandon(self, owner, age=0):
+    """Leaves a lock behind as if taken by |owner| |age| seconds ago."""
+    with open(self._lock_file, 'w') as f:
+      f.write(owner)
+    mtime = time.time() - age
+    os.utime(self._lock_file, (mtime, mtime))
+
+  def testLock(self):
+    with common_util.BreakableFileLock(self._path):
+      with open(self._lock_file) as f:
+        self.assertEqual(f.read(), '%s %d\n' % (socket.gethostname(),
+                                                os.getpid()))
+    self.assertEqual(os.listdir(self._test_dir), [])
+
+  def testBreaksLockOfDeadProcess(self):
+    process = subprocess.Popen(['true'])
+    process.wait()
+    self._Abandon('%s %d' % (socket.gethostname(), process.pid))
+    with common_util.BreakableFileLock(self._path):
+      pass
+    self.assertEqual(os.listdir(self._test_dir), [])
+
+  def testBreaksOldLock(self):
+    self._Abandon('otherhost 1', age=100)
+    with common_util.BreakableFileLock(self._path, max_age=10):
+      pass
+    self.assertEqual(os.listdir(self._test_dir), [])
+
+  def testWaitsForLiveProcess(self):
+    self._Abandon('%s %d' % (socket.gethostname(), os.getpid()), age=100)
+    acquired = threading.Event()
+    def _Lock():
+      with common_util.BreakableFileLock(self._path):
+        acquired.set()
+    waiter = threading.Thread(target=_Lock)
+    waiter.start()
+    self.assertFalse(acquired.wait(1.5))
+    os.unlink(self._lock_file)
+    waiter.join()
+    self.assertTrue(acquired.is_set())
+
+
+class FileDigestIndexTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._test_dir = tempfile.mkdtemp('common_util_unittest')
+    self._db_path = os.path.join(self._test_dir, 'digests.db')
+    self._file_path = os.path.join(self._test_dir, 'update.gz')
+    with open(self._file_path, 'w') as f:
+      f.write('payload')
+
+  def tearDown(self):
+    common_util.SetDigestIndex(None)
+    shutil.rmtree(self._test_dir)
+
+  def testGetFileHashes(self):
+    expected = common_util.GetFileHashes(self._file_path, do_sha1=True,
+                                         do_sha256=True, do_md5=True)
+    common_util.SetDigestIndex(common_util.FileDigestIndex(self._db_path))
+    self.assertEqual(
+        common_util.GetFileHashes(self._file_path, do_sha1=True,
+                                  do_sha256=True, do_md5=True), expected)
+
+    # Indexed digests are not computed again, not even after a restart.
+    common_util.SetDigestIndex(common_util.FileDigestIndex(self._db_path))
+    self.mox.StubOutWithMock(common_util, '_ComputeFileHashes')
+    self.mox.ReplayAll()
+    self.assertEqual(
+        common_util.GetFileHashes(self._file_path, do_sha1=True),
+        {'sha1': expected['sha1']})
+    self.mox.VerifyAll()
+
+  def testComputesMissingDigestsOnce(self):
+    index = common_util.FileDigestIndex(self._db_path)
+    sha1 = index.GetDigests(self._file_path, ['sha1'])['sha1']
+
+    self.mox.StubOutWithMock(common_util, '_ComputeFileHashes')
+    common_util._ComputeFileHashes(
+        self._file_path, ['sha256', 'md5']).AndReturn(
+            {'sha256': 'sha256 digest', 'md5': 'md5 digest'})
+    self.mox.ReplayAll()
+    self.assertEqual(index.GetDigests(self._file_path,
+                                      ['sha1', 'sha256', 'md5']),
+                     {'sha1': sha1, 'sha256': 'sha256 digest',
+                      'md5': 'md5 digest'})
+    self.assertEqual(index.GetDigests(self._file_path, ['md5', 'sha256']),
+                     {'sha256': 'sha256 digest', 'md5': 'md5 digest'})
+    self.mox.VerifyAll()
+
+  def testChangedFile(self):
+    index = common_util.FileDigestIndex(self._db_path)
+    old_digest = index.GetDigests(self._file_path, ['sha1'])['sha1']
+    with open(self._file_path, 'w') as f:
+      f.write('another payload')
+    new_digest = index.GetDigests(self._file_path, ['sha1'])['sha1']
+    self.assertNotEqual(old_digest, new_digest)
+    self.assertEqual(
+        new_digest, common_util.GetFileHashes(self._file_path,
+                                              do_sha1=True)['sha1'])
+
+
 if __name__ == '__main__':
   unittest.main()
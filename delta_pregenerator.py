@@ -0,0 +1,221 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Background generation of full and delta payloads for new images.
+
+Delta payloads are much smaller than full ones, but only exist if they were
+generated beforehand. The pregenerator watches the latest image built for each
+board and, whenever a new one shows up, generates its full payload along with
+deltas from the most recent previously seen images. Generated deltas are
+recorded in a DeltaIndex, which Autoupdate consults to hand clients a delta
+from the version they report.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from cherrypy.process import plugins
+
+import autoupdate
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREGEN', message, *args)
+
+
+# Number of images remembered per board.
+_MAX_HISTORY = 16
+
+# Seconds before checking again on a payload still being generated, doubled
+# after each check up to the maximum.
+_MIN_RETRY_INTERVAL = 1
+_MAX_RETRY_INTERVAL = 30
+
+
+class DeltaIndex(object):
+  """Persistent index of pregenerated delta payloads.
+
+  Records, per board, the images seen in order of appearance, and the cache
+  directory holding the delta payload for each (source version, target
+  version) pair. The index is stored as JSON and reloaded whenever another
+  process changed it.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._mtime = None
+    self._history = {}
+    self._deltas = {}
+
+  def _Load(self):
+    """Reloads the index if its file changed; call with _lock held."""
+    try:
+      mtime = os.stat(self.path).st_mtime
+    except OSError:
+      return
+    if mtime == self._mtime:
+      return
+
+    try:
+      with open(self.path) as index_file:
+        contents = json.load(index_file)
+    except (IOError, ValueError) as e:
+      _Log('Failed to read delta index %s: %s', self.path, e)
+      return
+
+    self._mtime = mtime
+    self._history = contents.get('history', {})
+    self._deltas = dict(
+        ((delta['board'], delta['src_version'], delta['target_version']),
+         delta['payload_dir']) for delta in contents.get('deltas', []))
+
+  def _Save(self):
+    """Writes the index atomically; call with _lock held."""
+    contents = {
+        'history': self._history,
+        'deltas': [{'board': board, 'src_version': src_version,
+                    'target_version': target_version,
+                    'payload_dir': payload_dir}
+                   for (board, src_version, target_version), payload_dir
+                   in sorted(self._deltas.iteritems())],
+    }
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+    with os.fdopen(fd, 'w') as index_file:
+      json.dump(contents, index_file, indent=2)
+    os.rename(temp_path, self.path)
+    self._mtime = os.stat(self.path).st_mtime
+
+  def GetHistory(self, board):
+    """Returns the (version, image path) pairs seen for |board|, oldest first.
+    """
+    with self._lock:
+      self._Load()
+      return [tuple(image) for image in self._history.get(board, [])]
+
+  def AddImage(self, board, version, image_path):
+    """Records |version| as the most recent image seen for |board|."""
+    with self._lock:
+      self._Load()
+      history = [image for image in self._history.get(board, [])
+                 if image[0] != version]
+      history.append([version, image_path])
+      self._history[board] = history[-_MAX_HISTORY:]
+      self._Save()
+
+  def Record(self, board, src_version, target_version, payload_dir):
+    """Records the directory of the delta from |src_version|."""
+    with self._lock:
+      self._Load()
+      self._deltas[(board, src_version, target_version)] = payload_dir
+      self._Save()
+
+  def Lookup(self, board, src_version, target_version):
+    """Returns the directory of the delta from |src_version|, None if unknown.
+    """
+    with self._lock:
+      self._Load()
+      return self._deltas.get((board, src_version, target_version))
+
+
+class DeltaPregenerator(object):
+  """Generates payloads for the latest image of some boards."""
+
+  def __init__(self, updater, boards, num_sources, index):
+    """Initializes the pregenerator.
+
+    Args:
+      updater: the Autoupdate object to generate payloads with.
+      boards: list of boards to watch.
+      num_sources: number of previous images to generate deltas from.
+      index: the DeltaIndex recording generated deltas.
+    """
+    self._updater = updater
+    self._boards = boards
+    self._num_sources = num_sources
+    self._index = index
+
+  def _Generate(self, image_path, src_image):
+    """Generates a payload into the cache, returns its directory."""
+    retry_interval = _MIN_RETRY_INTERVAL
+    while True:
+      try:
+        return self._updater.GenerateUpdateImageWithCache(
+            image_path, static_image_dir=self._updater.static_dir,
+            legacy_image=True, src_image=src_image, copy_to_static_root=False)
+      except autoupdate.GenerationPendingError:
+        # Still being generated, possibly by another devserver process.
+        time.sleep(retry_interval)
+        retry_interval = min(2 * retry_interval, _MAX_RETRY_INTERVAL)
+
+  def PregenerateBoard(self, board):
+    """Generates the payloads for the latest image of |board|.
+
+    Raises:
+      AutoupdateError if generating a payload failed.
+    """
+    version, image_path = self._updater.GetLatestImage(board)
+    history = self._index.GetHistory(board)
+    if history and history[-1][0] == version:
+      return
+
+    _Log('New image %s for %s, generating payloads', version, board)
+    self._Generate(image_path, '')
+
+    sources = [image for image in history if image[0] != version]
+    for src_version, src_image in sources[-self._num_sources:]:
+      if self._index.Lookup(board, src_version, version):
+        continue
+      if not os.path.exists(src_image):
+        _Log('Image %s of %s is gone, not generating a delta from it',
+             src_version, board)
+        continue
+      payload_dir = self._Generate(image_path, src_image)
+      self._index.Record(board, src_version, version, payload_dir)
+      _Log('Generated delta %s -> %s for %s in %s', src_version, version,
+           board, payload_dir)
+
+    self._index.AddImage(board, version, image_path)
+
+  def RunOnce(self):
+    """Generates the payloads for every board that has a new image."""
+    for board in self._boards:
+      try:
+        self.PregenerateBoard(board)
+      except (autoupdate.AutoupdateError, EnvironmentError) as e:
+        _Log('Failed to pregenerate payloads for %s: %s', board, e)
+
+
+class DeltaPregeneratorPlugin(plugins.SimplePlugin):
+  """Runs a DeltaPregenerator periodically alongside the CherryPy engine."""
+
+  def __init__(self, bus, pregenerator, interval):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.pregenerator = pregenerator
+    self.interval = interval
+    self._stopping = threading.Event()
+    self._thread = None
+
+  def _Run(self):
+    while not self._stopping.is_set():
+      self.pregenerator.RunOnce()
+      self._stopping.wait(self.interval)
+
+  def start(self):
+    _Log('Checking for new images every %d seconds', self.interval)
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._Run,
+                                    name='DeltaPregenerator')
+    # Generation may take minutes; don't hold up shutdown for it.
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+    self._thread = None
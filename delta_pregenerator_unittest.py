@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for delta_pregenerator module."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mox
+
+import autoupdate
+import delta_pregenerator
+
+
+class DeltaIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('delta_pregenerator_unittest')
+    self.index_path = os.path.join(self.test_dir, 'deltas.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testPersistence(self):
+    index = delta_pregenerator.DeltaIndex(self.index_path)
+    self.assertEqual(index.GetHistory('board'), [])
+    index.AddImage('board', '1.0.0', '/images/1.0.0/image.bin')
+    index.AddImage('board', '1.1.0', '/images/1.1.0/image.bin')
+    index.Record('board', '1.0.0', '1.1.0', 'cache/delta')
+
+    index = delta_pregenerator.DeltaIndex(self.index_path)
+    self.assertEqual(index.GetHistory('board'),
+                     [('1.0.0', '/images/1.0.0/image.bin'),
+                      ('1.1.0', '/images/1.1.0/image.bin')])
+    self.assertEqual(index.Lookup('board', '1.0.0', '1.1.0'), 'cache/delta')
+    self.assertEqual(index.Lookup('board', '1.0.0', '1.2.0'), None)
+    self.assertEqual(index.Lookup('other', '1.0.0', '1.1.0'), None)
+
+
+class DeltaPregeneratorTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.test_dir = tempfile.mkdtemp('delta_pregenerator_unittest')
+    self.index = delta_pregenerator.DeltaIndex(
+        os.path.join(self.test_dir, 'deltas.json'))
+    self.updater = self.mox.CreateMock(autoupdate.Autoupdate)
+    self.updater.static_dir = self.test_dir
+    self.pregenerator = delta_pregenerator.DeltaPregenerator(
+        self.updater, ['board'], 2, self.index)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Image(self, version):
+    image_path = os.path.join(self.test_dir, version)
+    with open(image_path, 'w') as image_file:
+      image_file.write(version)
+    return image_path
+
+  def _ExpectGenerate(self, image_path, src_image, payload_dir):
+    self.updater.GenerateUpdateImageWithCache(
+        image_path, static_image_dir=self.test_dir, legacy_image=True,
+        src_image=src_image, copy_to_static_root=False).AndReturn(payload_dir)
+
+  def testGeneratesDeltasFromRecentImages(self):
+    images = dict((version, self._Image(version))
+                  for version in ['1', '2', '3', '4'])
+    for version in ['1', '2', '3']:
+      self.index.AddImage('board', version, images[version])
+
+    self.updater.GetLatestImage('board').AndReturn(('4', images['4']))
+    self._ExpectGenerate(images['4'], '', 'cache/full')
+    self._ExpectGenerate(images['4'], images['2'], 'cache/2_4')
+    self._ExpectGenerate(images['4'], images['3'], 'cache/3_4')
+    # Nothing to do until the next image shows up.
+    self.updater.GetLatestImage('board').AndReturn(('4', images['4']))
+
+    self.mox.ReplayAll()
+    self.pregenerator.RunOnce()
+    self.pregenerator.RunOnce()
+    self.mox.VerifyAll()
+
+    self.assertEqual(self.index.Lookup('board', '2', '4'), 'cache/2_4')
+    self.assertEqual(self.index.Lookup('board', '3', '4'), 'cache/3_4')
+    self.assertEqual(self.index.Lookup('board', '1', '4'), None)
+    self.assertEqual(self.index.GetHistory('board')[-1], ('4', images['4']))
+
+  def testSkipsMissingImages(self):
+    image_path = self._Image('2')
+    self.index.AddImage('board', '1', os.path.join(self.test_dir, 'missing'))
+
+    self.updater.GetLatestImage('board').AndReturn(('2', image_path))
+    self._ExpectGenerate(image_path, '', 'cache/full')
+
+    self.mox.ReplayAll()
+    self.pregenerator.RunOnce()
+    self.mox.VerifyAll()
+    self.assertEqual(self.index.Lookup('board', '1', '2'), None)
+
+  def testWaitsForPendingGeneration(self):
+    image_path = self._Image('1')
+    self.mox.StubOutWithMock(time, 'sleep')
+    self.updater.GetLatestImage('board').AndReturn(('1', image_path))
+    # Retries back off instead of spinning.
+    for retry_interval in [1, 2]:
+      self.updater.GenerateUpdateImageWithCache(
+          image_path, static_image_dir=self.test_dir, legacy_image=True,
+          src_image='', copy_to_static_root=False).AndRaise(
+              autoupdate.GenerationPendingError('pending'))
+      time.sleep(retry_interval)
+    self._ExpectGenerate(image_path, '', 'cache/full')
+
+    self.mox.ReplayAll()
+    self.pregenerator.RunOnce()
+    self.mox.VerifyAll()
+    self.assertEqual(self.index.GetHistory('board'), [('1', image_path)])
+
+  def testFailure(self):
+    self.updater.GetLatestImage('board').AndRaise(
+        autoupdate.AutoupdateError('no image'))
+
+    self.mox.ReplayAll()
+    self.pregenerator.RunOnce()
+    self.mox.VerifyAll()
+    self.assertEqual(self.index.GetHistory('board'), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,22 +6,44 @@
 
 """A CherryPy-based webserver to host images and build packages."""
 
+import base64
 import cherrypy
+import contextlib
+import functools
+import hmac
 import json
 import logging
 import optparse
 import os
 import re
+import shutil
+import signal
 import socket
+import StringIO
 import sys
-import subprocess
+import tarfile
 import tempfile
 import threading
+import time
 import types
 
 import autoupdate
+import autoupdate_lib
+import build_index
+import cache_manager
 import common_util
+import delta_pregenerator
+import devserver_client
+import devserver_pool
+import host_log
 import log_util
+import metrics
+import mirror_selector
+import payload_server
+import prefork
+import profiling
+import symbolicator
+import update_listener
 
 
 # Module-local log function.
@@ -29,11 +51,38 @@ def _Log(message, *args):
   return log_util.LogWithTag('DEVSERVER', message, *args)
 
 
-CACHED_ENTRIES = 12
+# Default free disk space to maintain when caching payloads, in MB.
+DEFAULT_MIN_FREE_DISK_MB = 4096
 
 # Sets up global to share between classes.
 updater = None
 
+# Dedicated payload server, if enabled with --static_port.
+static_server = None
+
+# Manager of the payload cache, unless in serve-only mode.
+payload_cache = None
+
+# Index of the builds served, for latest build queries.
+build_versions = None
+
+# Symbolicator of uploaded minidumps.
+dump_symbolicator = None
+
+# Load of this devserver, as reported to those it is a mirror of.
+load_monitor = None
+
+# Secret enabling profiling, if set with --profile_token.
+profile_token = None
+
+# Saved request profiles and the sampling profiler, if profiling is enabled.
+profile_store = None
+stack_sampler = None
+
+# Header asking for a request to be profiled, and naming the saved profile in
+# the response.
+_PROFILE_HEADER = 'X-Devserver-Profile'
+
 
 class DevServerError(Exception):
   """Exception class used by this module."""
@@ -103,9 +152,8 @@ def _PrintDocStringAsHTML(func):
   return '\n'.join(html_doc)
 
 
-def _GetConfig(options):
-  """Returns the configuration for the devserver."""
-
+def _GetSocketHost():
+  """Returns the wildcard address the devserver should listen on."""
   # On a system with IPv6 not compiled into the kernel,
   # AF_INET6 sockets will return a socket.error exception.
   # On such systems, fall-back to IPv4.
@@ -115,6 +163,108 @@ def _GetConfig(options):
   except socket.error:
     socket_host = '0.0.0.0'
 
+  return socket_host
+
+
+def _PinCachedPayload():
+  """Keeps a cached payload from being evicted while it is being downloaded."""
+  if not payload_cache:
+    return
+  rel_path = cherrypy.request.path_info[len('/static/'):]
+  pinned = payload_cache.Pinned(os.path.join(updater.static_dir, rel_path))
+  pinned.__enter__()
+  cherrypy.request.hooks.attach('on_end_request',
+                                lambda: pinned.__exit__(None, None, None))
+
+cherrypy.tools.pin_cached_payload = cherrypy.Tool('on_start_resource',
+                                                  _PinCachedPayload)
+
+
+def _GetMetricsHandler(path_info):
+  """Returns the handler a request for |path_info| is counted under."""
+  parts = path_info.strip('/').split('/')
+  if parts[0] == 'api' and len(parts) > 1:
+    return 'api/%s' % parts[1]
+  return parts[0] or 'index'
+
+
+def _RecordRequestMetrics():
+  """Records the latency and outcome of a request in the metrics."""
+  handler = _GetMetricsHandler(cherrypy.request.path_info)
+  is_download = handler == 'static'
+  metrics.THREAD_POOL_BUSY.Inc(('http',))
+  if is_download:
+    metrics.ACTIVE_DOWNLOADS.Inc(('static',))
+
+  def _RecordEnd():
+    # Runs once the response body has been sent, streamed or not.
+    response = cherrypy.response
+    metrics.THREAD_POOL_BUSY.Dec(('http',))
+    code = str(response.status).split()[0]
+    # Keep arbitrary paths out of the metrics.
+    label = 'unknown' if code == '404' else handler
+    metrics.REQUESTS.Inc((label, code))
+    metrics.REQUEST_LATENCY.Observe(time.time() - response.time, (label,))
+    if is_download:
+      metrics.ACTIVE_DOWNLOADS.Dec(('static',))
+      if code in ('200', '206'):
+        metrics.STATIC_BYTES.Inc(
+            ('static',), int(response.headers.get('Content-Length', 0)))
+
+  cherrypy.request.hooks.attach('on_end_request', _RecordEnd)
+
+cherrypy.tools.request_metrics = cherrypy.Tool('on_start_resource',
+                                               _RecordRequestMetrics)
+
+
+def _CheckProfileToken(token):
+  """Checks that |token| allows profiling.
+
+  Raises:
+    cherrypy.HTTPError: if profiling is disabled or the token is wrong.
+  """
+  if not profile_token:
+    raise cherrypy.HTTPError('403 Forbidden',
+                             'Error: profiling is disabled, see '
+                             '--profile_token')
+  if not hmac.compare_digest(str(token), profile_token):
+    raise cherrypy.HTTPError('403 Forbidden', 'Error: wrong profiling token')
+
+
+def _ProfileRequest():
+  """Runs the request handler under cProfile, if asked to.
+
+  Requests are profiled when they carry the profiling token, either in a
+  profile= parameter or in the X-Devserver-Profile header. The response
+  then names the saved profile in the X-Devserver-Profile header.
+  """
+  request = cherrypy.request
+  token = request.params.pop('profile', None)
+  if token is None:
+    token = request.headers.get(_PROFILE_HEADER)
+  if token is None or request.handler is None:
+    return
+  _CheckProfileToken(token)
+
+  handler = request.handler
+  path_info = request.path_info
+  name = profile_store.NewName(_GetMetricsHandler(path_info))
+  cherrypy.response.headers[_PROFILE_HEADER] = name
+
+  def _Save(profile):
+    profile_store.Save(name, profile)
+    _Log('Saved profile of %s as %s', path_info, name)
+
+  request.handler = lambda: profiling.ProfileCall(handler, _Save)
+
+cherrypy.tools.profile_request = cherrypy.Tool('before_handler',
+                                               _ProfileRequest)
+
+
+def _GetConfig(options):
+  """Returns the configuration for the devserver."""
+  socket_host = _GetSocketHost()
+
   base_config = { 'global':
                   { 'server.log_request_headers': True,
                     'server.protocol_version': 'HTTP/1.1',
@@ -123,8 +273,9 @@ def _GetConfig(options):
                     'response.timeout': 6000,
                     'request.show_tracebacks': True,
                     'server.socket_timeout': 60,
-                    'tools.staticdir.root':
-                      os.path.dirname(os.path.abspath(sys.argv[0])),
+                    'tools.request_metrics.on': True,
+                    'tools.profile_request.on': True,
+                    'tools.staticdir.root': os.path.abspath(options.data_dir),
                   },
                   '/api':
                   {
@@ -145,6 +296,7 @@ def _GetConfig(options):
                   '/static':
                   { 'tools.staticdir.dir': 'static',
                     'tools.staticdir.on': True,
+                    'tools.pin_cached_payload.on': True,
                     'response.timeout': 10000,
                   },
                 }
@@ -258,47 +410,159 @@ def _GetDefaultBoardID(scripts_dir):
     return 'amd64-generic'
 
 
+def _IgnoreStopSignals():
+  """Keeps the state manager process running until it is shut down.
+
+  Stop signals are usually sent to the whole process group. Were the state
+  manager to exit on them, exiting workers would retry reaching it for a while
+  for every proxy they hold. The devserver shuts the manager down on exit.
+  """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _ParseNumber(name, value, number_type):
+  """Returns request parameter |name| as a |number_type|, None if not set.
+
+  Raises:
+    cherrypy.HTTPError: if the value is not a number.
+  """
+  if value is None or value == '':
+    return None
+  try:
+    return number_type(value)
+  except ValueError:
+    raise cherrypy.HTTPError('400 Bad Request',
+                             'Error: %s= must be a number' % name)
+
+
 class ApiRoot(object):
   """RESTful API for Dev Server information."""
   exposed = True
 
   @cherrypy.expose
-  def hostinfo(self, ip):
+  def hostinfo(self, ip, cursor=None, limit=None):
     """Returns a JSON dictionary containing information about the given ip.
 
     Args:
-      ip: address of host whose info is requested
+      ip: address of host whose info is requested, or `all'
+      cursor: with ip=all, only include hosts whose address sorts after this
+          one, e.g. the last one of the previous page
+      limit: with ip=all, maximum number of hosts to include
     Returns:
       A JSON dictionary containing all or some of the following fields:
         last_event_type (int):        last update event type received
         last_event_status (int):      last update event status received
         last_known_version (string):  last known version reported in update ping
+        board (string):               board reported in update ping
         forced_update_label (string): update label to force next update ping to
                                       use, set by setnextupdate
       See the OmahaEvent class in update_engine/omaha_request_action.h for
       event type and status code definitions. If the ip does not exist an empty
       string is returned.
+      With ip=all, a JSON dictionary of such dictionaries keyed by address, in
+      address order, streamed as it is read.
 
     Example URL:
       http://myhost/api/hostinfo?ip=192.168.1.5
+      http://myhost/api/hostinfo?ip=all&cursor=192.168.1.5&limit=100
     """
+    if ip == 'all':
+      return updater.HandleAllHostInfoPing(
+          cursor=cursor, limit=_ParseNumber('limit', limit, int))
     return updater.HandleHostInfoPing(ip)
 
+  hostinfo._cp_config = {'response.stream': True}
+
+  @cherrypy.expose
+  def hosts(self, version=None, board=None, event_type=None,
+            event_result=None, cursor=None, limit=None):
+    """Returns a JSON dictionary of the info of the hosts matching a query.
+
+    Hosts are selected by their last update ping. With --host_db, the query
+    is answered from the indexes of the database.
+
+    Args:
+      version: only include hosts last known to run this version
+      board: only include hosts of this board
+      event_type: only include hosts whose last event is of this type
+      event_result: only include hosts whose last event had this result, e.g.
+          0 for hosts whose last event failed
+      cursor: only include hosts whose address sorts after this one, e.g. the
+          last one of the previous page
+      limit: maximum number of hosts to include
+    Returns:
+      A JSON dictionary of host info dictionaries, as described under
+      /api/hostinfo, keyed by address in address order and streamed as it is
+      read.
+
+    Example URL:
+      http://myhost/api/hosts?version=0.14.1234.0&board=x86-mario
+      http://myhost/api/hosts?event_result=0&limit=100
+    """
+    return updater.HandleFindHostsPing(
+        cursor=cursor, limit=_ParseNumber('limit', limit, int),
+        version=version, board=board,
+        event_type=_ParseNumber('event_type', event_type, int),
+        event_result=_ParseNumber('event_result', event_result, int))
+
+  hosts._cp_config = {'response.stream': True}
+
+  @cherrypy.expose
+  def rollout(self, board=None):
+    """Returns a JSON dictionary of the number of hosts on each version.
+
+    Args:
+      board: only count the hosts of this board
+    Returns:
+      A JSON dictionary of {version: number of hosts} dictionaries keyed by
+      board, as last reported by the hosts.
+
+    Example URL:
+      http://myhost/api/rollout?board=x86-mario
+    """
+    return updater.HandleRolloutPing(board=board)
+
   @cherrypy.expose
-  def hostlog(self, ip):
+  def hostlog(self, ip, cursor=None, limit=None, since=None, until=None,
+              event_type=None, event_result=None):
     """Returns a JSON object containing a log of host event.
 
     Args:
       ip: address of host whose event log is requested, or `all'
+      cursor: only include events recorded after the one with this `seq',
+          e.g. the cursor returned with the previous page
+      limit: maximum number of events to include
+      since: only include events at or after this time, in seconds since the
+          epoch
+      until: only include events before this time, in seconds since the epoch
+      event_type: only include events of this type
+      event_result: only include events with this result
     Returns:
       A JSON encoded list (log) of dictionaries (events), each of which
-      containing a `timestamp' and other event fields, as described under
-      /api/hostinfo.
+      containing a `timestamp', a sequence number `seq' and other event
+      fields, as described under /api/hostinfo. With ip=all, a dictionary of
+      such lists keyed by address.
+      If any of cursor, limit or the filters are given, a JSON dictionary with
+      the following fields instead:
+        entries (list): the selected events in the order they were recorded,
+                        each with an additional `host' field
+        cursor (int):   the cursor to get the following events with
+      Either way, the log is streamed as it is read.
 
     Example URL:
       http://myhost/api/hostlog?ip=192.168.1.5
+      http://myhost/api/hostlog?ip=all&cursor=1234&limit=100&event_type=3
     """
-    return updater.HandleHostLogPing(ip)
+    return updater.HandleHostLogPing(
+        ip, cursor=_ParseNumber('cursor', cursor, int),
+        limit=_ParseNumber('limit', limit, int),
+        since=_ParseNumber('since', since, float),
+        until=_ParseNumber('until', until, float),
+        event_type=_ParseNumber('event_type', event_type, int),
+        event_result=_ParseNumber('event_result', event_result, int))
+
+  hostlog._cp_config = {'response.stream': True}
 
   @cherrypy.expose
   def setnextupdate(self, ip):
@@ -329,6 +593,8 @@ class ApiRoot(object):
         size (int):      the file size in bytes
         sha1 (string):   a base64 encoded SHA1 hash
         sha256 (string): a base64 encoded SHA256 hash
+      The response has an ETag; requests whose If-None-Match matches it are
+      answered with 304 Not Modified.
 
     Example URL:
       http://myhost/api/fileinfo/some/path/to/file
@@ -337,15 +603,314 @@ class ApiRoot(object):
     if not os.path.exists(file_path):
       raise DevServerError('file not found: %s' % file_path)
     try:
+      # Lets other devservers revalidate the info they cached without the
+      # file being hashed again.
+      etag = common_util.GetFileETag(file_path)
+      cherrypy.response.headers['ETag'] = etag
+      if_none_match = cherrypy.request.headers.get('If-None-Match', '')
+      if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        cherrypy.response.status = 304
+        return ''
+
       file_size = os.path.getsize(file_path)
-      file_sha1 = common_util.GetFileSha1(file_path)
-      file_sha256 = common_util.GetFileSha256(file_path)
+      hashes = common_util.GetFileHashes(file_path, do_sha1=True,
+                                         do_sha256=True)
+      file_sha1 = base64.b64encode(hashes['sha1'])
+      file_sha256 = base64.b64encode(hashes['sha256'])
     except os.error, e:
       raise DevServerError('failed to get info for file %s: %s' %
                            (file_path, str(e)))
     return json.dumps(
         {'size': file_size, 'sha1': file_sha1, 'sha256': file_sha256})
 
+  @cherrypy.expose
+  def payloadstats(self):
+    """Returns transfer statistics of the dedicated payload server.
+
+    Returns:
+      A JSON encoded dictionary keyed by payload path (relative to the static
+      directory), each value containing the following fields:
+        requests (int):     number of download requests received
+        bytes_served (int): total number of payload bytes sent
+        active (int):       number of downloads currently in progress
+      The dictionary is empty unless the devserver runs with --static_port.
+
+    Example URL:
+      http://myhost/api/payloadstats
+    """
+    if not static_server:
+      return json.dumps({})
+    return json.dumps(static_server.stats.GetStats())
+
+  @cherrypy.expose
+  def cachestats(self):
+    """Returns occupancy and usage statistics of the payload cache.
+
+    Returns:
+      A JSON encoded dictionary with the following fields:
+        entries (int):        number of cached payload directories
+        bytes (int):          total size of the cache
+        pinned (int):         entries being generated or downloaded
+        max_bytes (int):      size limit of the cache, null if unlimited
+        min_free_bytes (int): disk space kept free
+        free_bytes (int):     disk space currently free
+        hits (int):           lookups that found their payload cached
+        misses (int):         lookups that had to generate their payload
+        evictions (int):      number of entries evicted
+        evicted_bytes (int):  total size of the entries evicted
+      The dictionary is empty in serve-only mode. With --workers, the cache
+      and its statistics are shared by all worker processes.
+
+    Example URL:
+      http://myhost/api/cachestats
+    """
+    if not payload_cache:
+      return json.dumps({})
+    return json.dumps(payload_cache.GetStats())
+
+  @cherrypy.expose
+  def generationstatus(self):
+    """Returns the payload generations that are queued or running.
+
+    Returns:
+      A JSON encoded list of generations, oldest first, each a dictionary with
+      the following fields:
+        description (string): what is being generated
+        state (string):       'queued' or 'running'
+        elapsed (float):      seconds spent in this state
+        waiters (int):        number of update checks waiting for it
+      With --workers, only the generations of the worker process handling this
+      request are listed.
+
+    Example URL:
+      http://myhost/api/generationstatus
+    """
+    return json.dumps(updater.generation_scheduler.GetStatus())
+
+  @cherrypy.expose
+  def responsecachestats(self):
+    """Returns statistics of the cache of update check responses.
+
+    Returns:
+      A JSON encoded dictionary with the following fields:
+        entries (int):       number of payloads currently cached
+        hits (int):          update checks answered from the cache
+        misses (int):        update checks that had to look up their payload
+        invalidations (int): cached payloads dropped because their files
+                             changed
+      With --workers, the statistics are those of the worker process handling
+      this request.
+
+    Example URL:
+      http://myhost/api/responsecachestats
+    """
+    return json.dumps(updater.response_cache.GetStats())
+
+  @cherrypy.expose
+  def poolstats(self):
+    """Returns the devserver pool and how update checks were routed in it.
+
+    With --pool, each payload is served by the member(s) it is assigned to
+    by consistent hashing; update checks for it received by other members
+    are forwarded there.
+
+    Returns:
+      A JSON encoded dictionary with the following fields, or null without
+      --pool:
+        members (list):       base URLs of the members
+        local_member (str):   base URL of this devserver
+        replicas (int):       number of members each payload is served by
+        local (int):          update checks whose payload is served here
+        forwarded (int):      update checks forwarded to another member
+        forward_errors (int): forwarded update checks that failed and were
+                              handled here instead
+      With --workers, the statistics are those of the worker process handling
+      this request.
+
+    Example URL:
+      http://myhost/api/poolstats
+    """
+    return json.dumps(updater.pool and updater.pool.GetStatus())
+
+  @cherrypy.expose
+  def load(self):
+    """Returns the load of this devserver, for selecting among mirrors.
+
+    Returns:
+      A JSON encoded dictionary with the following fields:
+        active_downloads (int):       payload downloads in progress
+        egress_bytes_per_sec (float): bandwidth of the payload downloads
+                                      completed recently
+        disk_queue_depth (int):       I/O requests in progress on the disk
+                                      payloads are on, null if unknown
+
+    Example URL:
+      http://myhost/api/load
+    """
+    return json.dumps(load_monitor.GetReport())
+
+  @cherrypy.expose
+  def mirrorstats(self):
+    """Returns the load of the mirrors payloads are offered from.
+
+    With --mirrors, update checks are answered with the payload URLs of the
+    least loaded of this devserver ('local') and its mirrors first.
+
+    Returns:
+      A JSON encoded dictionary, or null without --mirrors, with an entry
+      per mirror holding:
+        report (dict):      its last load report, see /api/load
+        report_age (float): seconds since the report was received
+        score (float):      its load, in downloads, including those of
+                            payload URLs offered since the report
+        assigned (int):     payload URLs offered since the report
+        available (bool):   whether its report is recent enough for it to
+                            be offered first
+        errors (int):       failed polls of its load
+      With --workers, the statistics are those of the worker process handling
+      this request.
+
+    Example URL:
+      http://myhost/api/mirrorstats
+    """
+    return json.dumps(updater.mirror_selector and
+                      updater.mirror_selector.GetStatus())
+
+  @cherrypy.expose
+  def remotefileinfostats(self):
+    """Returns statistics of the remote payload info cache.
+
+    With --remote_payload, the attributes of payloads are looked up on the
+    remote devserver, through kept-alive connections, and cached.
+
+    Returns:
+      A JSON encoded dictionary with the following fields:
+        entries (int):             number of payloads whose info is cached
+        hits (int):                lookups answered from the cache
+        fetches (int):             lookups for which the info was fetched
+        revalidations (int):       lookups for which the remote devserver
+                                   confirmed the cached info was current
+        coalesced (int):           lookups that waited on another lookup of
+                                   the same payload
+        errors (int):              lookups that failed
+        connections_created (int): connections opened to remote devservers
+        connections_reused (int):  requests sent on a kept-alive connection
+        connections_idle (int):    kept-alive connections currently unused
+      With --workers, the statistics are those of the worker process handling
+      this request.
+
+    Example URL:
+      http://myhost/api/remotefileinfostats
+    """
+    return json.dumps(updater.remote_file_info.GetStats())
+
+  @cherrypy.expose
+  def symbolicatestats(self):
+    """Returns statistics of minidump symbolication.
+
+    Returns:
+      A JSON encoded dictionary with the following fields:
+        cached_traces (int): number of stack traces currently cached
+        hits (int):          minidumps answered from the cache
+        misses (int):        minidumps that had to be symbolicated
+        jobs (list):         symbolications queued or running, in the format
+                             of /api/generationstatus
+      With --workers, the statistics are those of the worker process handling
+      this request.
+
+    Example URL:
+      http://myhost/api/symbolicatestats
+    """
+    return json.dumps(dump_symbolicator.GetStats())
+
+  @cherrypy.expose
+  def profiles(self, name=None, sort='cumulative', limit=50, token=None):
+    """Lists or shows the saved request profiles.
+
+    Any request carrying the profiling token set with --profile_token, in a
+    profile= parameter or in the X-Devserver-Profile header, is run under
+    cProfile; the name of its saved profile is returned in the
+    X-Devserver-Profile response header.
+
+    Args:
+      name: name of the profile to show; all profiles are listed if not given
+      sort: pstats sort key of the functions shown, e.g. cumulative, time or
+          calls
+      limit: number of functions shown
+      token: the profiling token, unless sent in the X-Devserver-Profile
+          header
+    Returns:
+      A JSON encoded list of the names of the saved profiles, oldest first,
+      or the statistics of profile |name| as text. Profiles are also saved in
+      DATA_DIR/profiles, for use with pstats.
+
+    Example URL:
+      http://myhost/update?profile=TOKEN
+      http://myhost/api/profiles?token=TOKEN
+      http://myhost/api/profiles?token=TOKEN&name=NAME&sort=time
+    """
+    _CheckProfileToken(token or cherrypy.request.headers.get(_PROFILE_HEADER))
+    if name is None:
+      return json.dumps(profile_store.List())
+    cherrypy.response.headers['Content-Type'] = 'text/plain'
+    try:
+      return profile_store.Format(name, sort=sort,
+                                  limit=_ParseNumber('limit', limit, int))
+    except profiling.ProfilingError as e:
+      raise cherrypy.HTTPError('400 Bad Request', str(e))
+
+  @cherrypy.expose
+  def sampler(self, action='status', interval=None, token=None):
+    """Controls the sampling profiler.
+
+    The sampling profiler records the stacks of all threads at a regular
+    interval, while it runs. With --workers, each worker has its own.
+
+    Args:
+      action: one of
+          status: returns the state of the profiler
+          start:  starts sampling, or changes the interval
+          stop:   stops sampling, keeping the samples
+          dump:   returns the samples
+          clear:  forgets the samples
+      interval: with action=start, seconds between samples (default: 0.01)
+      token: the profiling token, unless sent in the X-Devserver-Profile
+          header
+    Returns:
+      With action=dump, the recorded stacks in the collapsed format of flame
+      graph tools, one per line with the number of times it was seen, most
+      frequent first. Otherwise, a JSON encoded dictionary with the following
+      fields:
+        running (bool):   whether the profiler is sampling
+        interval (float): seconds between samples, null if not running
+        samples (int):    number of samples recorded
+        stacks (int):     number of distinct stacks recorded
+
+    Example URL:
+      http://myhost/api/sampler?token=TOKEN&action=start&interval=0.005
+      http://myhost/api/sampler?token=TOKEN&action=dump
+    """
+    _CheckProfileToken(token or cherrypy.request.headers.get(_PROFILE_HEADER))
+    if action == 'dump':
+      cherrypy.response.headers['Content-Type'] = 'text/plain'
+      return stack_sampler.Dump()
+    if action == 'start':
+      interval = _ParseNumber('interval', interval, float)
+      try:
+        stack_sampler.Start(profiling.DEFAULT_SAMPLE_INTERVAL
+                            if interval is None else interval)
+      except profiling.ProfilingError as e:
+        raise cherrypy.HTTPError('400 Bad Request', str(e))
+    elif action == 'stop':
+      stack_sampler.Stop()
+    elif action == 'clear':
+      stack_sampler.Clear()
+    elif action != 'status':
+      raise cherrypy.HTTPError('400 Bad Request',
+                               'Error: unknown action %s' % action)
+    return json.dumps(stack_sampler.GetStatus())
+
+
 class DevServerRoot(object):
   """The Root Class for the Dev Server.
 
@@ -396,30 +961,64 @@ class DevServerRoot(object):
     binary-formatted minidump to symbolicate.
 
     It is up to the caller to ensure that the symbols they want are currently
-    staged.
+    staged. Stack traces are cached by minidump content, so symbolicating the
+    same minidump again is immediate as long as the symbols do not change.
 
     Args:
       minidump: The binary minidump file to symbolicate.
     """
-    to_return = ''
-    with tempfile.NamedTemporaryFile() as local:
-      while True:
-        data = minidump.file.read(8192)
-        if not data:
-          break
-        local.write(data)
-      local.flush()
-      stackwalk = subprocess.Popen(['minidump_stackwalk',
-                                    local.name,
-                                    updater.static_dir + '/debug/breakpad'],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-      to_return, error_text = stackwalk.communicate()
-      if stackwalk.returncode != 0:
-        raise DevServerError("Can't generate stack trace: %s (rc=%d)" % (
-            error_text, stackwalk.returncode))
-
-    return to_return
+    try:
+      return dump_symbolicator.Symbolicate(minidump.file)
+    except symbolicator.SymbolicatorError as e:
+      raise DevServerError(str(e))
+
+  @cherrypy.expose
+  def symbolicate_dumps(self, **params):
+    """Symbolicates many minidumps in parallel, streaming back the results.
+
+    Callers will need to POST to this URL with a body of MIME-type
+    "multipart/form-data", with one file per minidump, under any field name.
+    Tarballs (files whose name ends in .tar) are unpacked and each of their
+    members is symbolicated.
+
+    Args:
+      Any number of minidump files or tarballs of minidumps.
+    Returns:
+      One JSON dictionary per line and per minidump, in the order they
+      complete, with the following fields:
+        name (string):        file name of the minidump, or its path within
+                              its tarball
+        stack_trace (string): the symbolicated stack trace, unless it failed
+        error (string):       why symbolication failed, if it did
+    """
+    if not params:
+      return _PrintDocStringAsHTML(self.symbolicate_dumps)
+
+    dumps = []
+    for value in params.itervalues():
+      parts = value if isinstance(value, list) else [value]
+      for part in parts:
+        if not hasattr(part, 'file'):
+          continue
+        name = part.filename or part.name
+        if name.endswith('.tar'):
+          dumps.extend(_ExtractDumps(part.file))
+        else:
+          dumps.append((name, part.file))
+
+    def _Stream():
+      for name, stack_trace, error in dump_symbolicator.SymbolicateAll(dumps):
+        result = {'name': name}
+        if error is None:
+          result['stack_trace'] = stack_trace
+        else:
+          result['error'] = error
+        yield json.dumps(result) + '\n'
+
+    cherrypy.response.headers['Content-Type'] = 'application/x-json-stream'
+    return _Stream()
+
+  symbolicate_dumps._cp_config = {'response.stream': True}
 
   @cherrypy.expose
   def latestbuild(self, **params):
@@ -428,23 +1027,30 @@ class DevServerRoot(object):
     Args:
       target: The build target, typically a combination of the board and the
           type of build e.g. x86-mario-release.
+      targets: Comma separated list of build targets, instead of target=.
       milestone: The milestone to filter builds on. E.g. R16. Optional, if not
           provided the latest RXX build will be returned.
     Returns:
       A string representation of the latest build if one exists, i.e.
           R19-1993.0.0-a1-b1480.
       An empty string if no latest could be found.
+      With targets=, a JSON dictionary mapping each target to its latest
+          build, or null if none could be found.
     """
     if not params:
       return _PrintDocStringAsHTML(self.latestbuild)
 
+    if 'targets' in params:
+      targets = [target for target in params['targets'].split(',') if target]
+      return json.dumps(build_versions.GetLatestBuildVersions(
+          targets, milestone=params.get('milestone')))
+
     if 'target' not in params:
       raise cherrypy.HTTPError('500 Internal Server Error',
                                'Error: target= is required!')
     try:
-      return common_util.GetLatestBuildVersion(
-          updater.static_dir, params['target'],
-          milestone=params.get('milestone'))
+      return build_versions.GetLatestBuildVersion(
+          params['target'], milestone=params.get('milestone'))
     except common_util.CommonUtilError as errmsg:
       raise cherrypy.HTTPError('500 Internal Server Error', str(errmsg))
 
@@ -455,6 +1061,8 @@ class DevServerRoot(object):
     Example URL:
       To List all control files:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0
+      To list the control files of a test:
+      http://dev-server/controlfiles?build=x86-alex-release/R18-1514.0.0&test_name=sleeptest
       To return the contents of a path:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0&control_path=client/sleeptest/control
 
@@ -463,6 +1071,9 @@ class DevServerRoot(object):
       control_path: If you want the contents of a control file set this
         to the path. E.g. client/site_tests/sleeptest/control
         Optional, if not provided return a list of control files is returned.
+      prefix: Only list control files whose path starts with this, e.g.
+        client/site_tests. Optional.
+      test_name: Only list the control files of this test. Optional.
     Returns:
       Contents of a control file if control_path is provided.
       A list of control files if no control_path is provided.
@@ -476,11 +1087,87 @@ class DevServerRoot(object):
 
     if 'control_path' not in params:
       return common_util.GetControlFileList(
-          updater.static_dir, params['build'])
+          updater.static_dir, params['build'], prefix=params.get('prefix'),
+          test_name=params.get('test_name'))
     else:
       return common_util.GetControlFile(
           updater.static_dir, params['build'], params['control_path'])
 
+  @cherrypy.expose
+  def controlfilebundle(self, **params):
+    """Return the contents of many control files of a build at once.
+
+    Example URL:
+      http://dev-server/controlfilebundle?build=x86-alex-release/R18-1514.0.0&glob=client/site_tests/*/control
+
+    Args:
+      build: The build i.e. x86-alex-release/R18-1514.0.0-a1-b1450.
+      control_paths: Comma separated list of control file paths, e.g.
+        client/site_tests/sleeptest/control.
+      glob: Shell-style wildcard selecting control files by path, e.g.
+        client/site_tests/*/control. Either control_paths or glob (or both)
+        must be provided.
+      format: json (the default) or tar.
+    Returns:
+      With format=json, a JSON dictionary mapping each requested path to the
+        contents of the control file, or null if there is no such control
+        file.
+      With format=tar, a tarball of the requested control files that exist.
+    """
+    if not params:
+      return _PrintDocStringAsHTML(self.controlfilebundle)
+
+    if 'build' not in params:
+      raise cherrypy.HTTPError('500 Internal Server Error',
+                               'Error: build= is required!')
+    if 'control_paths' not in params and 'glob' not in params:
+      raise cherrypy.HTTPError('500 Internal Server Error',
+                               'Error: control_paths= or glob= is required!')
+    bundle_format = params.get('format', 'json')
+    if bundle_format not in ('json', 'tar'):
+      raise cherrypy.HTTPError('500 Internal Server Error',
+                               'Error: unknown format %s' % bundle_format)
+
+    control_paths = [path for path in params.get('control_paths', '').split(',')
+                     if path]
+    try:
+      contents = common_util.GetControlFiles(
+          updater.static_dir, params['build'], control_paths=control_paths,
+          pattern=params.get('glob'))
+    except common_util.CommonUtilError as errmsg:
+      raise cherrypy.HTTPError('500 Internal Server Error', str(errmsg))
+
+    if bundle_format == 'json':
+      cherrypy.response.headers['Content-Type'] = 'application/json'
+      return json.dumps(contents)
+
+    bundle = StringIO.StringIO()
+    with contextlib.closing(tarfile.open(fileobj=bundle, mode='w')) as tar:
+      for control_path, control in sorted(contents.iteritems()):
+        if control is None:
+          continue
+        info = tarfile.TarInfo(control_path)
+        info.size = len(control)
+        info.mode = 0644
+        tar.addfile(info, StringIO.StringIO(control))
+    cherrypy.response.headers['Content-Type'] = 'application/x-tar'
+    return bundle.getvalue()
+
+  @cherrypy.expose
+  def metrics(self):
+    """Returns the devserver metrics in the Prometheus text format.
+
+    The metrics include request counts and latency histograms per handler,
+    payload generation and hashing times, bytes served from /static and the
+    payload server, active downloads and the load of each thread pool. With
+    --workers, the metrics of all workers are added up.
+
+    Example URL:
+      http://myhost/metrics
+    """
+    cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return metrics.Render()
+
   @cherrypy.expose
   def index(self):
     """Presents a welcome message and documentation links."""
@@ -521,14 +1208,45 @@ class DevServerRoot(object):
     """
     label = '/'.join(args)
     body_length = int(cherrypy.request.headers.get('Content-Length', 0))
+    if body_length > updater.max_request_size:
+      raise cherrypy.HTTPError('413 Request Entity Too Large',
+                               'Update requests are limited to %d bytes' %
+                               updater.max_request_size)
     data = cherrypy.request.rfile.read(body_length)
-    return updater.HandleUpdatePing(data, label)
+    try:
+      return updater.HandleUpdatePing(data, label)
+    except autoupdate_lib.InvalidUpdateRequestException as e:
+      raise cherrypy.HTTPError('400 Bad Request', str(e))
+
 
+def _ExtractDumps(tar_file):
+  """Returns (name, file object) pairs for the minidumps in a tarball.
 
-def _CleanCache(cache_dir, wipe):
+  Members are copied to temporary files, since tar members cannot be read
+  independently of one another.
+
+  Raises:
+    cherrypy.HTTPError: if the tarball is invalid.
+  """
+  dumps = []
+  try:
+    with contextlib.closing(tarfile.open(fileobj=tar_file)) as tar:
+      for member in tar:
+        if not member.isfile():
+          continue
+        dump_file = tempfile.TemporaryFile()
+        shutil.copyfileobj(tar.extractfile(member), dump_file)
+        dumps.append((member.name, dump_file))
+  except tarfile.TarError as e:
+    raise cherrypy.HTTPError('400 Bad Request', 'Invalid tarball: %s' % e)
+  return dumps
+
+
+def _CleanCache(cache, cache_dir, wipe):
   """Wipes any excess cached items in the cache_dir.
 
   Args:
+    cache: the CacheManager of the directory we are wiping from.
     cache_dir: the directory we are wiping from.
     wipe: If True, wipe all the contents -- not just the excess.
   """
@@ -538,13 +1256,9 @@ def _CleanCache(cache_dir, wipe):
     if os.system(cmd) != 0:
       _Log('Failed to clear the cache with %s' % cmd)
       sys.exit(1)
-  else:
-    # Clear all but the last N cached updates
-    cmd = ('cd %s; ls -tr | head --lines=-%d | xargs rm -rf' %
-           (cache_dir, CACHED_ENTRIES))
-    if os.system(cmd) != 0:
-      _Log('Failed to clean up old delta cache files with %s' % cmd)
-      sys.exit(1)
+
+  cache.Scan()
+  cache.Evict()
 
 
 def main():
@@ -554,13 +1268,34 @@ def main():
   root_dir = os.path.realpath('%s/../..' % devserver_dir)
   serve_only = False
 
+  # We allow global use here to share with cherrypy classes.
+  # pylint: disable=W0603
+  global updater, static_server, payload_cache, build_versions
+  global dump_symbolicator, profile_token, profile_store, stack_sampler
+  global load_monitor
+
   usage = 'usage: %prog [options]'
   parser = optparse.OptionParser(usage=usage)
   parser.add_option('--archive_dir',
                     metavar='PATH',
                     help='Enables serve-only mode. Serves archived builds only')
+  parser.add_option('--async_update_port',
+                    metavar='PORT', default=None, type='int',
+                    help='also handle update pings on an event-driven listener '
+                    'on this port, independent of the server thread pool')
+  parser.add_option('--async_update_threads',
+                    metavar='NUM', default=16, type='int',
+                    help='number of worker threads processing update pings '
+                    'received by the event-driven listener (default: 16)')
   parser.add_option('--board', default=_GetDefaultBoardID(scripts_dir),
                     help='when pre-generating update, board for latest image')
+  parser.add_option('--build_rescan_interval',
+                    metavar='SECONDS', type='int',
+                    default=build_index.DEFAULT_RESCAN_INTERVAL,
+                    help='rescan the builds of a target for latest build '
+                    'queries at least this often, in addition to change '
+                    'notifications (default: %d)' %
+                    build_index.DEFAULT_RESCAN_INTERVAL)
   parser.add_option('--clear_cache',
                     action='store_true', default=False,
                     help='clear out all cached updates and exit')
@@ -571,15 +1306,44 @@ def main():
                     metavar='PATH',
                     default=os.path.dirname(os.path.abspath(sys.argv[0])),
                     help='writable directory where static lives')
+  parser.add_option('--digest_index',
+                    metavar='PATH', default=None,
+                    help='persistent index of payload digests, reused across '
+                    'restarts (default: DATA_DIR/file_digests.db); pass an '
+                    'empty path to always hash files')
   parser.add_option('--exit',
                     action='store_true',
                     help='do not start server (yet pregenerate/clear cache)')
   parser.add_option('--for_vm',
                     dest='vm', action='store_true',
                     help='update is for a vm image')
+  parser.add_option('--generation_wait',
+                    metavar='SECONDS', default=30, type='float',
+                    help='time an update check waits for its payload to be '
+                    'generated before the client is told to retry later '
+                    '(default: 30)')
+  parser.add_option('--host_db',
+                    metavar='PATH',
+                    help='persist host info in this SQLite database, so that '
+                    'it survives restarts and can be queried with /api/hosts '
+                    'and /api/rollout without scanning every host')
   parser.add_option('--host_log',
                     action='store_true', default=False,
                     help='record history of host update events (/api/hostlog)')
+  parser.add_option('--host_log_entries',
+                    metavar='NUM', default=host_log.DEFAULT_MAX_ENTRIES,
+                    type='int',
+                    help='number of events per host kept in memory with '
+                    '--host_log (default: %d)' % host_log.DEFAULT_MAX_ENTRIES)
+  parser.add_option('--host_log_file',
+                    metavar='PATH',
+                    help='append host events that no longer fit in memory to '
+                    'this file, rather than dropping them')
+  parser.add_option('--host_log_file_mb',
+                    metavar='MB', type='int',
+                    default=host_log.DEFAULT_MAX_FILE_BYTES / (1024 * 1024),
+                    help='size at which --host_log_file is rotated (default: '
+                    '%d)' % (host_log.DEFAULT_MAX_FILE_BYTES / (1024 * 1024)))
   parser.add_option('--image',
                     metavar='FILE',
                     help='Force update using this image. Can only be used when '
@@ -588,18 +1352,74 @@ def main():
   parser.add_option('--logfile',
                     metavar='PATH',
                     help='log output to this file instead of stdout')
+  parser.add_option('--max_cache_mb',
+                    metavar='MB', default=None, type='int',
+                    help='evict least recently used payloads from the cache '
+                    'beyond this size (default: unlimited)')
+  parser.add_option('--max_update_request_kb',
+                    metavar='KB', type='int',
+                    default=autoupdate_lib.DEFAULT_MAX_REQUEST_SIZE / 1024,
+                    help='reject update requests larger than this (default: '
+                    '%d)' % (autoupdate_lib.DEFAULT_MAX_REQUEST_SIZE / 1024))
   parser.add_option('--max_updates',
                     metavar='NUM', default=-1, type='int',
                     help='maximum number of update checks handled positively '
                          '(default: unlimited)')
+  parser.add_option('--min_free_disk_mb',
+                    metavar='MB', default=DEFAULT_MIN_FREE_DISK_MB, type='int',
+                    help='evict least recently used payloads from the cache '
+                    'to keep this much disk space free (default: %d)' %
+                    DEFAULT_MIN_FREE_DISK_MB)
+  parser.add_option('--pregenerate_deltas',
+                    metavar='NUM', default=0, type='int',
+                    help='watch for new latest images of --board and generate '
+                    'their full payload and deltas from the NUM previously '
+                    'seen images in the background (default: 0, disabled)')
+  parser.add_option('--pregenerate_interval',
+                    metavar='SECONDS', default=300, type='int',
+                    help='how often to check for new images with '
+                    '--pregenerate_deltas (default: 300)')
   parser.add_option('-p', '--pregenerate_update',
                     action='store_true', default=False,
                     help='pre-generate update payload. Can only be used when '
                     'not in serve-only mode as it is used to generate a '
                     'payload.')
+  parser.add_option('--max_generations',
+                    metavar='NUM', default=autoupdate.DEFAULT_MAX_GENERATIONS,
+                    type='int',
+                    help='maximum number of payloads generated at the same '
+                    'time (default: %d)' % autoupdate.DEFAULT_MAX_GENERATIONS)
+  parser.add_option('--max_symbolicators',
+                    metavar='NUM', default=symbolicator.DEFAULT_MAX_WORKERS,
+                    type='int',
+                    help='maximum number of minidumps symbolicated at the same '
+                    'time (default: %d)' % symbolicator.DEFAULT_MAX_WORKERS)
+  parser.add_option('--mirror_urls',
+                    metavar='NUM', default=mirror_selector.DEFAULT_MAX_URLS,
+                    type='int',
+                    help='number of payload URLs offered to protocol 3.0 '
+                    'clients with --mirrors (default: %d)' %
+                    mirror_selector.DEFAULT_MAX_URLS)
+  parser.add_option('--mirrors',
+                    metavar='URLS',
+                    help='comma separated base URLs of devservers serving '
+                    'the same payloads; payloads are offered from the least '
+                    'loaded of them and this devserver')
   parser.add_option('--payload',
                     metavar='PATH',
                     help='use update payload from specified directory')
+  parser.add_option('--pool',
+                    metavar='URLS',
+                    help='comma separated base URLs of a pool of devservers, '
+                    'including this one, that payloads are sharded across')
+  parser.add_option('--pool_member',
+                    metavar='URL',
+                    help='base URL of this devserver in --pool (default: the '
+                    'member on --port)')
+  parser.add_option('--pool_replicas',
+                    metavar='NUM', default=1, type='int',
+                    help='number of members of --pool each payload is served '
+                    'by (default: 1)')
   parser.add_option('--port',
                     default=8080, type='int',
                     help='port for the dev server to use (default: 8080)')
@@ -609,12 +1429,26 @@ def main():
   parser.add_option('--production',
                     action='store_true', default=False,
                     help='have the devserver use production values')
+  parser.add_option('--profile_token',
+                    metavar='TOKEN',
+                    help='enable profiling of requests carrying this secret '
+                    'and the sampling profiler (/api/profiles, /api/sampler)')
   parser.add_option('--proxy_port',
                     metavar='PORT', default=None, type='int',
                     help='port to have the client connect to (testing support)')
   parser.add_option('--remote_payload',
                     action='store_true', default=False,
                     help='Payload is being served from a remote machine')
+  parser.add_option('--remote_payload_ttl',
+                    metavar='SECONDS', type='float',
+                    default=devserver_client.DEFAULT_FILE_INFO_TTL,
+                    help='with --remote_payload, time payload info is reused '
+                    'before being revalidated with the remote devserver '
+                    '(default: %d)' % devserver_client.DEFAULT_FILE_INFO_TTL)
+  parser.add_option('--static_port',
+                    metavar='PORT', default=None, type='int',
+                    help='serve /static payloads from a dedicated zero-copy '
+                    'server on this port, with support for resumed downloads')
   parser.add_option('--src_image',
                     metavar='PATH', default='',
                     help='source image for generating delta updates from')
@@ -624,10 +1458,18 @@ def main():
   parser.add_option('-u', '--urlbase',
                     metavar='URL',
                     help='base URL for update images, other than the devserver')
+  parser.add_option('--workers',
+                    metavar='NUM', default=1, type='int',
+                    help='number of pre-forked server processes; host info, '
+                    'the update budget and the payload cache are shared '
+                    'between them (default: 1)')
   (options, _) = parser.parse_args()
 
   static_dir = os.path.realpath('%s/static' % options.data_dir)
   os.system('mkdir -p %s' % static_dir)
+  # The payload server maps /static URLs onto this directory, which keeps the
+  # archive symlink intact in serve-only mode.
+  static_root = static_dir
 
   if options.archive_dir:
   # TODO(zbehan) Remove legacy support:
@@ -654,19 +1496,80 @@ def main():
         options.image):
       parser.error('Incompatible flags detected for serve_only mode.')
 
-  elif os.path.exists(cache_dir):
-    _CleanCache(cache_dir, options.clear_cache)
-  else:
-    os.makedirs(cache_dir)
+  delta_index = None
+  if options.pregenerate_deltas:
+    if serve_only or not options.board:
+      parser.error('--pregenerate_deltas requires --board and cannot be used '
+                   'in serve-only mode.')
+    delta_index = delta_pregenerator.DeltaIndex(
+        os.path.join(cache_dir, 'deltas.json'))
+
+  pool = None
+  if options.pool:
+    if options.urlbase or options.remote_payload:
+      parser.error('--pool cannot be used with --urlbase or --remote_payload.')
+    try:
+      members = options.pool.split(',')
+      pool = devserver_pool.DevserverPool(
+          members, (options.pool_member or
+                    devserver_pool.FindLocalMember(members, options.port)),
+          replicas=options.pool_replicas)
+    except devserver_pool.DevserverPoolError as e:
+      parser.error(str(e))
+    _Log('Serving payloads as %s of pool %s' %
+         (pool.local_member, ', '.join(pool.members)))
+
+  load_monitor = mirror_selector.LoadMonitor(static_root)
+  selector = None
+  if options.mirrors:
+    if options.pool or options.remote_payload:
+      parser.error('--mirrors cannot be used with --pool or --remote_payload.')
+    if options.mirror_urls < 1:
+      parser.error('--mirror_urls must be at least 1.')
+    selector = mirror_selector.MirrorSelector(
+        options.mirrors.split(','), load_monitor, max_urls=options.mirror_urls)
+
+  state_manager = None
+  if options.workers > 1:
+    # Keep state that must be consistent across workers in a separate process.
+    state_manager = autoupdate.SharedStateManager()
+    state_manager.start(_IgnoreStopSignals)
+
+  if not serve_only:
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    max_cache_bytes = None
+    if options.max_cache_mb is not None:
+      max_cache_bytes = options.max_cache_mb * 1024 * 1024
+    # Workers share the cache, so that none evicts what another uses.
+    cache_class = (state_manager.CacheManager if state_manager else
+                   cache_manager.CacheManager)
+    payload_cache = cache_class(
+        cache_dir, max_bytes=max_cache_bytes,
+        min_free_bytes=options.min_free_disk_mb * 1024 * 1024)
+    _CleanCache(payload_cache, cache_dir, options.clear_cache)
+
+  digest_index = options.digest_index
+  if digest_index is None:
+    digest_index = os.path.join(options.data_dir, 'file_digests.db')
+  if digest_index:
+    _Log('Using digest index %s' % digest_index)
+    common_util.SetDigestIndex(common_util.FileDigestIndex(digest_index))
 
   _Log('Using cache directory %s' % cache_dir)
   _Log('Data dir is %s' % options.data_dir)
   _Log('Source root is %s' % root_dir)
   _Log('Serving from %s' % static_dir)
 
-  # We allow global use here to share with cherrypy classes.
-  # pylint: disable=W0603
-  global updater
+  host_info_args = (options.host_log_entries, options.host_log_file,
+                    options.host_log_file_mb * 1024 * 1024, options.host_db)
+  update_budget = None
+  if state_manager:
+    host_infos = state_manager.HostInfoTable(*host_info_args)
+    update_budget = state_manager.UpdateBudget(options.max_updates)
+  else:
+    host_infos = autoupdate.HostInfoTable(*host_info_args)
+
   updater = autoupdate.Autoupdate(
       devserver_dir=devserver_dir,
       scripts_dir=scripts_dir,
@@ -677,6 +1580,7 @@ def main():
       forced_image=options.image,
       payload_path=options.payload,
       proxy_port=options.proxy_port,
+      static_port=options.static_port,
       src_image=options.src_image,
       vm=options.vm,
       board=options.board,
@@ -686,8 +1590,30 @@ def main():
       remote_payload=options.remote_payload,
       max_updates=options.max_updates,
       host_log=options.host_log,
+      host_infos=host_infos,
+      update_budget=update_budget,
+      max_generations=options.max_generations,
+      generation_wait=options.generation_wait,
+      cache_manager=payload_cache,
+      delta_index=delta_index,
+      max_request_size=options.max_update_request_kb * 1024,
+      remote_file_info=devserver_client.RemoteFileInfoCache(
+          ttl=options.remote_payload_ttl),
+      pool=pool,
+      mirror_selector=selector,
   )
 
+  build_versions = build_index.BuildVersionIndex(
+      static_dir, rescan_interval=options.build_rescan_interval)
+  dump_symbolicator = symbolicator.Symbolicator(
+      os.path.join(static_dir, 'debug', 'breakpad'),
+      max_workers=options.max_symbolicators)
+  if options.profile_token:
+    profile_token = options.profile_token
+    profile_store = profiling.ProfileStore(
+        os.path.join(options.data_dir, 'profiles'))
+    stack_sampler = profiling.SamplingProfiler()
+
   if options.pregenerate_update:
     updater.PreGenerateUpdate()
 
@@ -702,7 +1628,58 @@ def main():
       cherrypy.config.update({'log.error_file': options.logfile,
                               'log.access_file': options.logfile})
 
-    cherrypy.quickstart(DevServerRoot(), config=_GetConfig(options))
+    if options.static_port:
+      static_server = payload_server.PayloadServer(
+          (_GetSocketHost(), options.static_port), static_root,
+          cache_manager=payload_cache)
+      # Workers share the listening socket; those losing the race for a
+      # connection must not block in accept().
+      static_server.socket.setblocking(False)
+      payload_server.PayloadServerPlugin(
+          cherrypy.engine, static_server).subscribe()
+
+    if options.async_update_port:
+      update_server = update_listener.AsyncUpdateServer(
+          (_GetSocketHost(), options.async_update_port),
+          functools.partial(update_listener.HandleUpdateRequest, updater,
+                            options.port),
+          options.async_update_threads,
+          max_body_size=options.max_update_request_kb * 1024)
+      update_listener.AsyncUpdateServerPlugin(
+          cherrypy.engine, update_server).subscribe()
+
+    # Plugins that must only run in one process, even with --workers.
+    single_plugins = []
+    if delta_index:
+      pregenerator = delta_pregenerator.DeltaPregenerator(
+          updater, [options.board], options.pregenerate_deltas, delta_index)
+      single_plugins.append(delta_pregenerator.DeltaPregeneratorPlugin(
+          cherrypy.engine, pregenerator, options.pregenerate_interval))
+
+    if selector:
+      selector_plugin = mirror_selector.MirrorSelectorPlugin(cherrypy.engine,
+                                                             selector)
+      selector_plugin.subscribe()
+
+    config = _GetConfig(options)
+    metrics.THREAD_POOL_SIZE.Set(
+        config['global'].get('server.thread_pool',
+                             cherrypy.server.thread_pool), ('http',))
+
+    if options.workers > 1:
+      # Each worker only sees its own requests; add up their metrics.
+      metrics.SetSharedDir(os.path.join(options.data_dir, 'metrics'))
+      metrics.SnapshotPlugin(cherrypy.engine).subscribe()
+      try:
+        prefork.Serve(DevServerRoot(), config, options.workers,
+                      first_worker_plugins=single_plugins)
+      finally:
+        # The state manager ignores stop signals, see _IgnoreStopSignals().
+        state_manager.shutdown()
+    else:
+      for plugin in single_plugins:
+        plugin.subscribe()
+      cherrypy.quickstart(DevServerRoot(), config=config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,274 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""HTTP client for calls from one devserver to another.
+
+In remote payload mode, every update check needs the attributes of a payload
+staged on another devserver. Rather than opening a connection and having the
+remote devserver answer from scratch each time:
+  - Connections are kept alive and reused, per remote server.
+  - File info is cached for a while. Once stale, it is revalidated with the
+    ETag the remote devserver sent, which spares it rehashing an unchanged
+    file and sending it again.
+  - Concurrent lookups of the same file share a single request.
+"""
+
+import collections
+import httplib
+import json
+import socket
+import threading
+import time
+import urlparse
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CLIENT', message, *args)
+
+
+# Default number of seconds to wait for a remote devserver.
+DEFAULT_TIMEOUT = 30
+
+# Default number of idle connections kept open per remote server.
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
+
+# Default number of seconds file info is used without revalidation.
+DEFAULT_FILE_INFO_TTL = 60
+
+# Default number of files whose info is cached.
+DEFAULT_MAX_FILE_INFOS = 1000
+
+# Methods retried on a new connection if a reused one turns out to be closed.
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class DevserverClientError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+# A response: its status, headers (lower case names) and body.
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class ConnectionPool(object):
+  """Keep-alive HTTP/1.1 connections to remote servers, shared by threads.
+
+  A connection is used by one request at a time; connections left idle are
+  kept for later requests to the same server, up to max_idle per server.
+  """
+
+  def __init__(self, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS,
+               timeout=DEFAULT_TIMEOUT):
+    self.max_idle = max_idle
+    self.timeout = timeout
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._created = 0
+    self._reused = 0
+
+  def _Acquire(self, scheme, netloc):
+    """Returns a (connection, whether it was reused) tuple."""
+    with self._lock:
+      idle = self._idle.get((scheme, netloc))
+      if idle:
+        self._reused += 1
+        return idle.pop(), True
+      self._created += 1
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+    return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+  def _Release(self, scheme, netloc, conn):
+    with self._lock:
+      idle = self._idle.setdefault((scheme, netloc), [])
+      if len(idle) < self.max_idle:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def Request(self, method, url, body=None, headers=None,
+              retry_on_stale=False):
+    """Sends a request and returns its Response.
+
+    Requests failing on a reused connection, which the server may have closed
+    while it was idle, are sent again on another connection if idempotent.
+
+    Args:
+      method: the HTTP method.
+      url: the URL to request.
+      body: the request body, if any.
+      headers: dictionary of request headers.
+      retry_on_stale: also send again requests of other methods, for requests
+                      that are safe to repeat, e.g. without side effects.
+    Raises:
+      DevserverClientError if the request could not be completed.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if scheme not in ('http', 'https') or not netloc:
+      raise DevserverClientError('Unsupported URL %s' % url)
+    path = path or '/'
+    if query:
+      path += '?' + query
+
+    while True:
+      conn, reused = self._Acquire(scheme, netloc)
+      try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        data = response.read()
+      except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        # The server may have closed the connection while it was idle. A
+        # timeout rather means that the server is slow.
+        if reused and (method in _IDEMPOTENT_METHODS or (
+            retry_on_stale and not isinstance(e, socket.timeout))):
+          continue
+        raise DevserverClientError('%s %s failed: %r' % (method, url, e))
+
+      if response.will_close:
+        conn.close()
+      else:
+        self._Release(scheme, netloc, conn)
+      return Response(response.status, dict(response.getheaders()), data)
+
+  def Close(self):
+    """Closes the idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for conns in idle.itervalues():
+      for conn in conns:
+        conn.close()
+
+  def GetStats(self):
+    """Returns the number of connections created, reused and idle."""
+    with self._lock:
+      return {'connections_created': self._created,
+              'connections_reused': self._reused,
+              'connections_idle': sum(len(conns)
+                                      for conns in self._idle.itervalues())}
+
+
+class _FileInfo(object):
+  """Cached info of a remote file."""
+
+  def __init__(self, info, etag, fetch_time):
+    self.info = info
+    self.etag = etag
+    self.fetch_time = fetch_time
+
+
+class _Lookup(object):
+  """A file info request and the lookups waiting on it."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class RemoteFileInfoCache(object):
+  """Info of files on remote devservers, as returned by their /api/fileinfo.
+
+  Members:
+    ttl:         number of seconds file info is used without revalidation.
+    max_entries: number of files whose info is cached; the least recently
+                 fetched are dropped first.
+  """
+
+  def __init__(self, connection_pool=None, ttl=DEFAULT_FILE_INFO_TTL,
+               max_entries=DEFAULT_MAX_FILE_INFOS):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._pool = connection_pool or ConnectionPool()
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._lookups = {}
+    self._hits = 0
+    self._fetches = 0
+    self._revalidations = 0
+    self._coalesced = 0
+    self._errors = 0
+
+  def _Fetch(self, url, cached):
+    """Requests the info at |url|, revalidating |cached| if set."""
+    headers = {}
+    if cached and cached.etag:
+      headers['If-None-Match'] = cached.etag
+    response = self._pool.Request('GET', url, headers=headers)
+
+    if response.status == httplib.NOT_MODIFIED and cached:
+      with self._lock:
+        self._revalidations += 1
+      return cached.info, cached.etag
+    if response.status != httplib.OK:
+      raise DevserverClientError('%s returned %d' % (url, response.status))
+    try:
+      info = json.loads(response.body)
+    except ValueError as e:
+      raise DevserverClientError('Invalid file info from %s: %s' % (url, e))
+    with self._lock:
+      self._fetches += 1
+    return info, response.headers.get('etag')
+
+  def GetFileInfo(self, url):
+    """Returns the file info dictionary at |url|, an /api/fileinfo URL.
+
+    The dictionary is shared with other callers and must not be modified.
+
+    Raises:
+      DevserverClientError if the info could not be obtained.
+    """
+    with self._lock:
+      cached = self._entries.get(url)
+      if cached and time.time() - cached.fetch_time < self.ttl:
+        self._hits += 1
+        return cached.info
+      lookup = self._lookups.get(url)
+      waiting = lookup is not None
+      if waiting:
+        self._coalesced += 1
+      else:
+        lookup = self._lookups[url] = _Lookup()
+
+    if waiting:
+      lookup.done.wait()
+      if lookup.error:
+        raise lookup.error
+      return lookup.result
+
+    try:
+      info, etag = self._Fetch(url, cached)
+      with self._lock:
+        self._entries.pop(url, None)
+        self._entries[url] = _FileInfo(info, etag, time.time())
+        while len(self._entries) > self.max_entries:
+          self._entries.popitem(last=False)
+      lookup.result = info
+      return info
+    except DevserverClientError as e:
+      _Log('Failed to get file info %s: %s', url, e)
+      with self._lock:
+        self._errors += 1
+      lookup.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._lookups[url]
+      lookup.done.set()
+
+  def GetStats(self):
+    """Returns statistics of the cache and of its connections."""
+    with self._lock:
+      stats = {'entries': len(self._entries),
+               'hits': self._hits,
+               'fetches': self._fetches,
+               'revalidations': self._revalidations,
+               'coalesced': self._coalesced,
+               'errors': self._errors}
+    stats.update(self._pool.GetStats())
+    return stats
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for devserver_client module."""
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import unittest
+
+import devserver_client
+
+
+class _FileInfoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the server's file info with an ETag, over kept-alive connections.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    server = self.server
+    with server.lock:
+      server.requests.append((self.path, self.headers.get('If-None-Match'),
+                              self.client_address[1]))
+    time.sleep(server.delay)
+    if self.path == '/missing':
+      status, body = 404, ''
+    elif self.headers.get('If-None-Match') == server.etag:
+      status, body = 304, ''
+    else:
+      status, body = 200, json.dumps(server.info)
+    self.send_response(status)
+    self.send_header('ETag', server.etag)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    # Drop the connection without telling the client, as on an idle timeout.
+    self.close_connection = int(server.drop_connections)
+
+
+class _FileInfoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class RemoteFileInfoCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = _FileInfoServer(('127.0.0.1', 0), _FileInfoHandler)
+    self._server.lock = threading.Lock()
+    self._server.requests = []
+    self._server.delay = 0
+    self._server.drop_connections = False
+    self._server.etag = '"1"'
+    self._server.info = {'size': 10, 'sha1': 'a', 'sha256': 'b'}
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.start()
+    self._url = 'http://%s:%d/api/fileinfo/update.gz' % (
+        self._server.server_address)
+    self._pool = devserver_client.ConnectionPool()
+    self._cache = devserver_client.RemoteFileInfoCache(self._pool, ttl=60)
+
+  def tearDown(self):
+    self._pool.Close()
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+  def testCacheAndRevalidate(self):
+    self.assertEqual(self._cache.GetFileInfo(self._url)['size'], 10)
+    self.assertEqual(self._cache.GetFileInfo(self._url)['size'], 10)
+    self.assertEqual(len(self._server.requests), 1)
+
+    # Once stale, the info is revalidated.
+    self._cache.ttl = 0
+    self.assertEqual(self._cache.GetFileInfo(self._url)['size'], 10)
+    self.assertEqual(self._server.requests[-1][1], '"1"')
+
+    # and refetched if it changed.
+    self._server.etag = '"2"'
+    self._server.info = {'size': 20}
+    self.assertEqual(self._cache.GetFileInfo(self._url)['size'], 20)
+
+    stats = self._cache.GetStats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['fetches'], 2)
+    self.assertEqual(stats['revalidations'], 1)
+    self.assertEqual(stats['entries'], 1)
+    # All requests went over one kept-alive connection.
+    self.assertEqual(stats['connections_created'], 1)
+    self.assertEqual(stats['connections_reused'], 2)
+    self.assertEqual(len(set(port for _, _, port in self._server.requests)), 1)
+
+  def testCoalescing(self):
+    self._server.delay = 0.2
+    results = []
+
+    def _Lookup():
+      results.append(self._cache.GetFileInfo(self._url))
+
+    threads = [threading.Thread(target=_Lookup) for _ in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(results), 5)
+    self.assertEqual(len(self._server.requests), 1)
+    self.assertEqual(self._cache.GetStats()['coalesced'], 4)
+
+  def testErrors(self):
+    missing_url = 'http://%s:%d/missing' % self._server.server_address
+    self.assertRaises(devserver_client.DevserverClientError,
+                      self._cache.GetFileInfo, missing_url)
+    self.assertRaises(devserver_client.DevserverClientError,
+                      self._cache.GetFileInfo, 'ftp://host/file')
+    self.assertEqual(self._cache.GetStats()['errors'], 2)
+
+  def testMaxEntries(self):
+    self._cache.max_entries = 2
+    for i in range(3):
+      self._cache.GetFileInfo('%s?%d' % (self._url, i))
+    self.assertEqual(self._cache.GetStats()['entries'], 2)
+
+  def testDroppedConnection(self):
+    self._server.drop_connections = True
+    self._cache.ttl = 0
+    for _ in range(3):
+      self.assertEqual(self._cache.GetFileInfo(self._url)['size'], 10)
+    # Each request found the kept-alive connection closed and reconnected.
+    self.assertEqual(self._cache.GetStats()['connections_created'], 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,224 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Sharding of payloads across a pool of devservers.
+
+Every member of a pool knows all of its members. Each payload is assigned to
+one or more members by consistent hashing of its identity, so that only those
+members generate, stage and keep it in their page cache. An update check
+received by any other member is forwarded to one of them, and the client is
+told to download the payload from there.
+
+Members are placed on a hash ring at many points each. Adding or removing a
+member only moves the payloads of the ring arcs it gains or loses, about one
+in the number of members.
+"""
+
+import bisect
+import hashlib
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+import devserver_client
+
+
+# Default number of points of each member on the hash ring.
+DEFAULT_VIRTUAL_NODES = 100
+
+# Header marking an update check forwarded by another member, naming it.
+FORWARDED_HEADER = 'X-Devserver-Pool-Forwarded'
+
+# Number of seconds the resolved addresses of a member are trusted for.
+_ADDRESS_TTL = 300
+
+
+class DevserverPoolError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def _Hash(value):
+  """Returns a hash of string |value| that is the same in every process."""
+  return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+def NormalizeMemberUrl(url):
+  """Returns the base URL of a member, e.g. http://host:8080."""
+  url = url.strip().rstrip('/')
+  if '://' not in url:
+    url = 'http://' + url
+  return url
+
+
+def FindLocalMember(members, port):
+  """Returns the member of |members| listening on |port|.
+
+  Raises:
+    DevserverPoolError if there is not exactly one.
+  """
+  local = set()
+  for member in members:
+    parsed = urlparse.urlsplit(NormalizeMemberUrl(member))
+    if (parsed.port or 80) == port:
+      local.add(NormalizeMemberUrl(member))
+  if len(local) != 1:
+    raise DevserverPoolError('Cannot tell which member of the pool is on port '
+                             '%d, %d are' % (port, len(local)))
+  return local.pop()
+
+
+class HashRing(object):
+  """A consistent hash ring of members."""
+
+  def __init__(self, members, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+    if not members:
+      raise DevserverPoolError('A hash ring needs at least one member')
+    self.members = sorted(set(members))
+    points = []
+    for member in self.members:
+      for i in range(virtual_nodes):
+        points.append((_Hash('%s#%d' % (member, i)), member))
+    points.sort()
+    self._hashes = [point_hash for point_hash, _ in points]
+    self._members = [member for _, member in points]
+
+  def GetNodes(self, key, count=1):
+    """Returns the first |count| distinct members clockwise from |key|."""
+    count = min(count, len(self.members))
+    nodes = []
+    index = bisect.bisect(self._hashes, _Hash(key))
+    while len(nodes) < count:
+      member = self._members[index % len(self._members)]
+      if member not in nodes:
+        nodes.append(member)
+      index += 1
+    return nodes
+
+
+class DevserverPool(object):
+  """The pool a devserver is a member of.
+
+  Members:
+    members:      base URLs of all members, including this one.
+    local_member: base URL of this devserver.
+    replicas:     number of members each payload is assigned to.
+  """
+
+  def __init__(self, members, local_member, replicas=1,
+               virtual_nodes=DEFAULT_VIRTUAL_NODES, connection_pool=None):
+    self.members = sorted(set(NormalizeMemberUrl(m) for m in members))
+    self.local_member = NormalizeMemberUrl(local_member)
+    if self.local_member not in self.members:
+      raise DevserverPoolError('%s is not a member of the pool %s' %
+                               (self.local_member, ', '.join(self.members)))
+    if replicas < 1:
+      raise DevserverPoolError('Payloads need at least one replica')
+    self.replicas = replicas
+    self._ring = HashRing(self.members, virtual_nodes)
+    # Each idle connection ties up a server thread of the member it is to.
+    self._connections = (connection_pool or
+                         devserver_client.ConnectionPool(max_idle=1))
+    self._lock = threading.Lock()
+    self._local = 0
+    self._forwarded = 0
+    self._forward_errors = 0
+    # (time resolved, set of IP addresses) of members, keyed by base URL.
+    self._addresses = {}
+
+  def IsMember(self, url):
+    """Returns whether |url| is the base URL of a member."""
+    return bool(url) and NormalizeMemberUrl(url) in self.members
+
+  def _GetAddresses(self, member):
+    """Returns the set of IP addresses the host of |member| resolves to."""
+    now = time.time()
+    with self._lock:
+      cached = self._addresses.get(member)
+    if cached and now - cached[0] < _ADDRESS_TTL:
+      return cached[1]
+
+    try:
+      addresses = set(info[4][0] for info in socket.getaddrinfo(
+          urlparse.urlsplit(member).hostname, None))
+    except socket.error:
+      addresses = set()
+    with self._lock:
+      self._addresses[member] = (now, addresses)
+    return addresses
+
+  def IsForwardedBy(self, url, client_ip):
+    """Returns whether a request from |client_ip| was forwarded by |url|.
+
+    Any client can name a member in FORWARDED_HEADER; the request is only
+    taken to be forwarded if it comes from one of the addresses of that member.
+
+    Args:
+      url: base URL of the member the request claims to be forwarded by.
+      client_ip: IP address the request was received from.
+    """
+    if not self.IsMember(url):
+      return False
+    if client_ip.startswith('::ffff:') and '.' in client_ip:
+      client_ip = client_ip[len('::ffff:'):]
+    return client_ip in self._GetAddresses(NormalizeMemberUrl(url))
+
+  def GetOwners(self, payload_key):
+    """Returns the members the payload identified by |payload_key| is on."""
+    return self._ring.GetNodes(payload_key, self.replicas)
+
+  def PickMember(self, payload_key, client_id):
+    """Returns the member that should serve a payload to a client.
+
+    This devserver if it is one of the owners of the payload; otherwise one
+    of the owners, the same one for a given client.
+    """
+    owners = self.GetOwners(payload_key)
+    if self.local_member in owners:
+      member = self.local_member
+    else:
+      member = owners[_Hash(client_id) % len(owners)]
+    with self._lock:
+      if member == self.local_member:
+        self._local += 1
+      else:
+        self._forwarded += 1
+    return member
+
+  def ForwardUpdateCheck(self, member, label, data):
+    """Has |member| handle an update check and returns its response.
+
+    Raises:
+      DevserverPoolError if the member could not handle it.
+    """
+    url = '%s/update' % member
+    if label:
+      url += '/' + urllib.quote(label)
+    try:
+      # Forwarded update checks are neither counted nor recorded by the
+      # member, so they can be sent again.
+      response = self._connections.Request(
+          'POST', url, data, {'Content-Type': 'text/xml',
+                              FORWARDED_HEADER: self.local_member},
+          retry_on_stale=True)
+      if response.status != 200:
+        raise DevserverPoolError('%s returned %d' % (url, response.status))
+    except (devserver_client.DevserverClientError, DevserverPoolError) as e:
+      with self._lock:
+        self._forward_errors += 1
+      raise DevserverPoolError('Failed to forward update check to %s: %s' %
+                               (member, e))
+    return response.body
+
+  def GetStatus(self):
+    """Returns the pool configuration and the update checks routed so far."""
+    with self._lock:
+      return {'members': self.members,
+              'local_member': self.local_member,
+              'replicas': self.replicas,
+              'local': self._local,
+              'forwarded': self._forwarded,
+              'forward_errors': self._forward_errors}
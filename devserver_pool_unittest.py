@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for devserver_pool module."""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+
+import devserver_pool
+
+
+_MEMBERS = ['http://127.0.0.1:%d' % port for port in range(8081, 8086)]
+
+
+class _UpdateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers update checks with the path and header they were received with.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers['Content-Length']))
+    body = '%s %s' % (self.path,
+                      self.headers.get(devserver_pool.FORWARDED_HEADER))
+    self.send_response(500 if self.path.endswith('broken') else 200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    # Drop the connection without telling the client, as on an idle timeout.
+    self.close_connection = int(self.server.drop_connections)
+
+
+class _UpdateServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class HashRingTest(unittest.TestCase):
+
+  def testGetNodes(self):
+    ring = devserver_pool.HashRing(_MEMBERS)
+    nodes = ring.GetNodes('x86-generic', 3)
+    self.assertEqual(len(set(nodes)), 3)
+    self.assertEqual(ring.GetNodes('x86-generic'), nodes[:1])
+    self.assertEqual(len(ring.GetNodes('x86-generic', 10)), len(_MEMBERS))
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      devserver_pool.HashRing, [])
+
+  def testBalanceAndMovement(self):
+    keys = ['label-%d/board' % i for i in range(2000)]
+    ring = devserver_pool.HashRing(_MEMBERS)
+    owners = dict((key, ring.GetNodes(key)[0]) for key in keys)
+    for member in _MEMBERS:
+      count = owners.values().count(member)
+      self.assertTrue(200 < count < 600, count)
+
+    # Only keys of the removed member move, to the remaining members.
+    smaller = devserver_pool.HashRing(_MEMBERS[:-1])
+    for key in keys:
+      if owners[key] != _MEMBERS[-1]:
+        self.assertEqual(smaller.GetNodes(key)[0], owners[key])
+
+    # An added member only takes keys, about its share of them.
+    larger = devserver_pool.HashRing(_MEMBERS + ['http://127.0.0.1:8086'])
+    moved = [key for key in keys if larger.GetNodes(key)[0] != owners[key]]
+    self.assertTrue(len(moved) < len(keys) / 4, len(moved))
+    for key in moved:
+      self.assertEqual(larger.GetNodes(key)[0], 'http://127.0.0.1:8086')
+
+
+class DevserverPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = _UpdateServer(('127.0.0.1', 0), _UpdateHandler)
+    self._server.drop_connections = False
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.start()
+    self._member = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+  def testFindLocalMember(self):
+    self.assertEqual(devserver_pool.FindLocalMember(
+        ['host1:8080', 'host2:8081/'], 8081), 'http://host2:8081')
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      devserver_pool.FindLocalMember,
+                      ['host1:8080', 'host2:8080'], 8080)
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      devserver_pool.FindLocalMember, ['host1:8080'], 8081)
+
+  def testPickMember(self):
+    pool = devserver_pool.DevserverPool(_MEMBERS, _MEMBERS[0], replicas=2)
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      devserver_pool.DevserverPool, _MEMBERS,
+                      'http://127.0.0.1:9999')
+    clients = ['192.168.0.%d' % i for i in range(50)]
+    for key in ['label-%d' % i for i in range(20)]:
+      owners = pool.GetOwners(key)
+      self.assertEqual(len(owners), 2)
+      picked = set(pool.PickMember(key, client) for client in clients)
+      if _MEMBERS[0] in owners:
+        self.assertEqual(picked, set([_MEMBERS[0]]))
+      else:
+        # Clients are spread across the owners.
+        self.assertEqual(picked, set(owners))
+    status = pool.GetStatus()
+    self.assertEqual(status['local'] + status['forwarded'], 20 * 50)
+
+  def testForwardUpdateCheck(self):
+    local = 'http://127.0.0.1:1'
+    pool = devserver_pool.DevserverPool([local, self._member], local)
+    self.assertTrue(pool.IsMember(self._member + '/'))
+    self.assertFalse(pool.IsMember(None))
+    self.assertEqual(pool.ForwardUpdateCheck(self._member, 'a b', '<request/>'),
+                     '/update/a%20b ' + local)
+    self.assertEqual(pool.ForwardUpdateCheck(self._member, '', '<request/>'),
+                     '/update ' + local)
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      pool.ForwardUpdateCheck, self._member, 'broken', '')
+    self.assertRaises(devserver_pool.DevserverPoolError,
+                      pool.ForwardUpdateCheck, local, '', '')
+    self.assertEqual(pool.GetStatus()['forward_errors'], 2)
+
+  def testForwardAfterIdleTimeout(self):
+    local = 'http://127.0.0.1:1'
+    pool = devserver_pool.DevserverPool([local, self._member], local)
+    self._server.drop_connections = True
+    for _ in range(3):
+      self.assertEqual(pool.ForwardUpdateCheck(self._member, '', '<request/>'),
+                       '/update ' + local)
+    self.assertEqual(pool.GetStatus()['forward_errors'], 0)
+
+  def testIsForwardedBy(self):
+    pool = devserver_pool.DevserverPool(
+        ['http://127.0.0.1:8081', 'http://localhost:8082'],
+        'http://127.0.0.1:8081')
+    self.assertTrue(pool.IsForwardedBy('http://localhost:8082', '127.0.0.1'))
+    self.assertTrue(pool.IsForwardedBy('127.0.0.1:8081/', '::ffff:127.0.0.1'))
+    # Only members can forward, and only from their own addresses.
+    self.assertFalse(pool.IsForwardedBy('http://localhost:8083', '127.0.0.1'))
+    self.assertFalse(pool.IsForwardedBy('http://localhost:8082',
+                                        '192.168.0.1'))
+    self.assertFalse(pool.IsForwardedBy(None, '127.0.0.1'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,155 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Single-flight scheduling of payload generation jobs.
+
+Generating a payload takes minutes, and a whole lab of clients may ask for the
+same one at once. The scheduler runs at most one job per key, lets every
+request for that key wait on it, and bounds the number of jobs that run at the
+same time. Requests that cannot wait any longer are told so instead of being
+held until the job completes.
+"""
+
+import threading
+import time
+from multiprocessing import pool
+
+import log_util
+import metrics
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('GENERATE', message, *args)
+
+
+class GenerationPending(Exception):
+  """Raised when a job did not complete within the time a caller could wait."""
+  pass
+
+
+class _Job(object):
+  """A generation job and the requests waiting on it."""
+
+  def __init__(self, key, description, func):
+    self.key = key
+    self.description = description
+    self.func = func
+    self.queued_time = time.time()
+    self.start_time = None
+    self.waiters = 0
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class GenerationScheduler(object):
+  """Runs generation jobs, at most one per key and a bounded number at once."""
+
+  def __init__(self, max_jobs, pool_name=None):
+    """Initializes the scheduler.
+
+    Args:
+      max_jobs: maximum number of jobs running at the same time.
+      pool_name: name of the jobs' thread pool in the metrics, None to leave
+                 it out of them.
+    """
+    self._max_jobs = max_jobs
+    self._pool_name = pool_name
+    if pool_name:
+      metrics.THREAD_POOL_SIZE.Set(max_jobs, (pool_name,))
+    self._lock = threading.Lock()
+    self._jobs = {}
+    # Created on first use, so that a scheduler created before forking works
+    # in every child process.
+    self._pool = None
+
+  def _RunJob(self, job):
+    """Runs |job|; called on a pool thread."""
+    with self._lock:
+      job.start_time = time.time()
+    _Log('Started %s', job.description)
+    if self._pool_name:
+      metrics.THREAD_POOL_QUEUED.Dec((self._pool_name,))
+      metrics.THREAD_POOL_BUSY.Inc((self._pool_name,))
+    try:
+      job.result = job.func()
+    except Exception as e:
+      _Log('Failed %s: %r', job.description, e)
+      job.error = e
+    else:
+      _Log('Completed %s in %.1f seconds', job.description,
+           time.time() - job.start_time)
+    finally:
+      if self._pool_name:
+        metrics.THREAD_POOL_BUSY.Dec((self._pool_name,))
+
+    with self._lock:
+      del self._jobs[job.key]
+    job.done.set()
+
+  def Run(self, key, description, func, timeout=None):
+    """Runs |func| unless a job for |key| is already queued or running.
+
+    Either way, waits for the job for |key| to complete and returns its result.
+
+    Args:
+      key: identifies the output of the job; jobs with equal keys are assumed
+           to produce the same output.
+      description: human readable description of the job.
+      func: callable doing the work.
+      timeout: number of seconds to wait for the job, None to wait for as long
+               as it takes.
+    Returns:
+      The value returned by |func|.
+    Raises:
+      GenerationPending if the job did not complete within |timeout|; it keeps
+        running and later calls with the same key will wait on it.
+      Any exception raised by |func|.
+    """
+    with self._lock:
+      job = self._jobs.get(key)
+      if not job:
+        job = _Job(key, description, func)
+        self._jobs[key] = job
+        if not self._pool:
+          self._pool = pool.ThreadPool(self._max_jobs)
+        if self._pool_name:
+          metrics.THREAD_POOL_QUEUED.Inc((self._pool_name,))
+        self._pool.apply_async(self._RunJob, (job,))
+      job.waiters += 1
+
+    try:
+      if not job.done.wait(timeout):
+        raise GenerationPending('%s has not completed yet' % description)
+    finally:
+      with self._lock:
+        job.waiters -= 1
+
+    if job.error:
+      raise job.error
+    return job.result
+
+  def GetStatus(self):
+    """Returns a list describing the queued and running jobs.
+
+    Each job is described by a dictionary with the following fields:
+      description (string): the job description.
+      state (string):       'queued' or 'running'.
+      elapsed (float):      seconds spent in this state.
+      waiters (int):        number of requests currently waiting for the job.
+    """
+    now = time.time()
+    status = []
+    with self._lock:
+      for job in sorted(self._jobs.itervalues(), key=lambda j: j.queued_time):
+        if job.start_time is None:
+          state, since = 'queued', job.queued_time
+        else:
+          state, since = 'running', job.start_time
+        status.append({'description': job.description,
+                       'state': state,
+                       'elapsed': round(now - since, 1),
+                       'waiters': job.waiters})
+    return status
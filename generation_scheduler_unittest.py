@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for generation_scheduler module."""
+
+import threading
+import time
+import unittest
+
+import generation_scheduler
+
+
+class GenerationSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scheduler = generation_scheduler.GenerationScheduler(1)
+    self.release = threading.Event()
+    self.calls = []
+
+  def tearDown(self):
+    self.release.set()
+
+  def _Job(self, result):
+    self.calls.append(result)
+    self.release.wait()
+    return result
+
+  def testSingleFlight(self):
+    results = []
+
+    def _Request():
+      results.append(self.scheduler.Run('key', 'job', lambda: self._Job('a')))
+
+    threads = [threading.Thread(target=_Request) for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    self.release.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results, ['a'] * 10)
+    self.assertEqual(self.calls, ['a'])
+    self.assertEqual(self.scheduler.GetStatus(), [])
+
+  def testPending(self):
+    self.assertRaises(generation_scheduler.GenerationPending,
+                      self.scheduler.Run, 'key1', 'job 1',
+                      lambda: self._Job('1'), 0.1)
+    self.assertRaises(generation_scheduler.GenerationPending,
+                      self.scheduler.Run, 'key2', 'job 2',
+                      lambda: self._Job('2'), 0.1)
+
+    status = self.scheduler.GetStatus()
+    self.assertEqual([(job['description'], job['state'], job['waiters'])
+                      for job in status],
+                     [('job 1', 'running', 0), ('job 2', 'queued', 0)])
+
+    # Later requests pick up the result of the job.
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(
+        self.scheduler.Run('key2', 'job 2', lambda: self._Job('other'))))
+    waiter.start()
+    while self.scheduler.GetStatus()[1]['waiters'] != 1:
+      time.sleep(0.01)
+    self.release.set()
+    waiter.join()
+    self.assertEqual(results, ['2'])
+    self.assertEqual(self.calls, ['1', '2'])
+
+  def testError(self):
+    def _Fail():
+      raise ValueError('failed')
+
+    self.assertRaises(ValueError, self.scheduler.Run, 'key', 'job', _Fail)
+    self.assertEqual(self.scheduler.GetStatus(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,230 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent storage of host attributes.
+
+The attributes of each host (last known version, board, last event and any
+pending forced update label) are kept in an SQLite database, so that they
+survive devserver restarts and can be queried by version, board or last event
+through indexes rather than by scanning every host.
+
+Update pings must not wait for the disk: changed attributes are only queued,
+and a background thread writes them in batches, one transaction per batch.
+The database is in WAL mode, so queries do not block the writer.
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOSTDB', message, *args)
+
+
+# Default number of seconds between writes of the queued attributes.
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Number of queued hosts that triggers a write before the interval is over.
+_MAX_BATCH = 500
+
+# Host attributes stored in columns of their own, to be indexed.
+_COLUMNS = (('version', 'last_known_version'),
+            ('board', 'board'),
+            ('event_type', 'last_event_type'),
+            ('event_result', 'last_event_status'))
+
+
+class HostDatabase(object):
+  """Stores host attributes in an SQLite database, writing them in batches.
+
+  Members:
+    db_path: path to the database.
+    flush_interval: number of seconds between writes of queued attributes.
+  """
+
+  def __init__(self, db_path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    """Opens (and creates, if needed) the database stored in |db_path|."""
+    self.db_path = db_path
+    self.flush_interval = flush_interval
+    self._lock = threading.Lock()
+    self._conn = None
+    self._conn_pid = None
+    # Attributes waiting to be written, keyed by host; only the latest
+    # attributes of a host are written.
+    self._pending_lock = threading.Lock()
+    self._pending = {}
+    self._wakeup = threading.Event()
+    self._writer_pid = None
+    with self._lock:
+      conn = self._GetConnection()
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute(
+          'CREATE TABLE IF NOT EXISTS hosts ('
+          '  ip TEXT PRIMARY KEY, version TEXT, board TEXT,'
+          '  event_type INTEGER, event_result INTEGER, attrs TEXT)')
+      conn.execute('CREATE INDEX IF NOT EXISTS hosts_version '
+                   'ON hosts (version)')
+      conn.execute('CREATE INDEX IF NOT EXISTS hosts_board_version '
+                   'ON hosts (board, version)')
+      conn.execute('CREATE INDEX IF NOT EXISTS hosts_last_event '
+                   'ON hosts (event_result, event_type)')
+
+  def _GetConnection(self):
+    """Returns this process' connection to the database; call with _lock."""
+    # Connections must not be shared with forked children.
+    if self._conn_pid != os.getpid():
+      self._conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+      self._conn.text_factory = str
+      # With WAL, committed transactions survive a devserver crash, only an
+      # OS crash may lose the last ones.
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      self._conn_pid = os.getpid()
+    return self._conn
+
+  def _StartWriter(self):
+    """Starts the writer thread of this process; call with _pending_lock.
+
+    This happens on first use rather than on creation, so that the thread
+    runs in the process recording the attributes.
+    """
+    self._writer_pid = os.getpid()
+    writer = threading.Thread(target=self._RunWriter, name='HostDatabase')
+    writer.daemon = True
+    writer.start()
+    # Do not lose the last batch on a clean exit.
+    atexit.register(self.Flush)
+
+  def _RunWriter(self):
+    while True:
+      self._wakeup.wait(self.flush_interval)
+      self._wakeup.clear()
+      self.Flush()
+
+  def Load(self):
+    """Returns the stored (host identifier, attributes) pairs.
+
+    Attributes still queued are included.
+    """
+    self.Flush()
+    with self._lock:
+      rows = self._GetConnection().execute(
+          'SELECT ip, attrs FROM hosts').fetchall()
+    return [(host_id, json.loads(attrs)) for host_id, attrs in rows]
+
+  def Store(self, host_id, attrs):
+    """Queues the attributes of a host for writing.
+
+    Args:
+      host_id: the host identifier (normally its IP address).
+      attrs: dictionary of all attributes of the host; it must not be changed
+             afterwards.
+    """
+    with self._pending_lock:
+      self._pending[host_id] = attrs
+      if self._writer_pid != os.getpid():
+        self._StartWriter()
+      if len(self._pending) >= _MAX_BATCH:
+        self._wakeup.set()
+
+  def Flush(self):
+    """Writes all queued attributes in a single transaction."""
+    # Batches are taken and written under the same lock, so that they are
+    # written in order: an older batch never overwrites a newer one.
+    with self._lock:
+      with self._pending_lock:
+        pending, self._pending = self._pending, {}
+      if not pending:
+        return
+
+      rows = [[host_id] + [attrs.get(name) for _, name in _COLUMNS] +
+              [json.dumps(attrs)]
+              for host_id, attrs in pending.iteritems()]
+      conn = self._GetConnection()
+      try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(
+            'INSERT OR REPLACE INTO hosts '
+            '(ip, version, board, event_type, event_result, attrs) '
+            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('COMMIT')
+      except sqlite3.Error as e:
+        _Log('Failed to store %d hosts in %s: %s', len(rows), self.db_path, e)
+        try:
+          conn.execute('ROLLBACK')
+        except sqlite3.Error:
+          pass
+        # Try again with the next batch, unless the host changed since.
+        with self._pending_lock:
+          for host_id, attrs in pending.iteritems():
+            self._pending.setdefault(host_id, attrs)
+
+  def FindHosts(self, version=None, board=None, event_type=None,
+                event_result=None, after_host_id=None, limit=None):
+    """Returns the hosts matching all of the given criteria.
+
+    Args:
+      version: only return hosts last known to run this version.
+      board: only return hosts of this board.
+      event_type: only return hosts whose last event is of this type.
+      event_result: only return hosts whose last event had this result.
+      after_host_id: only return hosts whose identifier sorts after this one.
+      limit: maximum number of hosts to return, None for all of them.
+    Returns:
+      A list of (host identifier, attributes) pairs in the order of their
+      identifiers.
+    """
+    self.Flush()
+    clauses = []
+    values = []
+    for column, value in (('version', version), ('board', board),
+                          ('event_type', event_type),
+                          ('event_result', event_result)):
+      if value is not None:
+        clauses.append('%s = ?' % column)
+        values.append(value)
+    if after_host_id is not None:
+      clauses.append('ip > ?')
+      values.append(after_host_id)
+    query = 'SELECT ip, attrs FROM hosts'
+    if clauses:
+      query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY ip'
+    if limit is not None:
+      query += ' LIMIT ?'
+      values.append(limit)
+
+    with self._lock:
+      rows = self._GetConnection().execute(query, values).fetchall()
+    return [(host_id, json.loads(attrs)) for host_id, attrs in rows]
+
+  def GetRolloutProgress(self, board=None):
+    """Returns the number of hosts on each version, per board.
+
+    Args:
+      board: only count the hosts of this board, all of them if None.
+    Returns:
+      A dictionary of {version: number of hosts} dictionaries keyed by board.
+    """
+    self.Flush()
+    query = 'SELECT board, version, COUNT(*) FROM hosts'
+    values = []
+    if board is not None:
+      query += ' WHERE board = ?'
+      values.append(board)
+    query += ' GROUP BY board, version'
+
+    with self._lock:
+      rows = self._GetConnection().execute(query, values).fetchall()
+    progress = {}
+    for row_board, version, count in rows:
+      progress.setdefault(row_board, {})[version] = count
+    return progress
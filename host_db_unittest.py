@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_db module."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import host_db
+
+
+def _Attrs(version, board, event_type=None, event_result=None):
+  attrs = {'last_known_version': version, 'board': board}
+  if event_type is not None:
+    attrs['last_event_type'] = event_type
+    attrs['last_event_status'] = event_result
+  return attrs
+
+
+class HostDatabaseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('host_db_unittest')
+    self.db_path = os.path.join(self.test_dir, 'hosts.db')
+    # Only write when told to.
+    self.db = host_db.HostDatabase(self.db_path, flush_interval=3600)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testPersistence(self):
+    self.db.Store('1.1.1.1', _Attrs('1.0', 'x86'))
+    self.db.Store('1.1.1.1', dict(_Attrs('2.0', 'x86'),
+                                  forced_update_label='some/label'))
+    self.db.Flush()
+
+    db = host_db.HostDatabase(self.db_path)
+    self.assertEqual(db.Load(), [('1.1.1.1',
+                                  {'last_known_version': '2.0',
+                                   'board': 'x86',
+                                   'forced_update_label': 'some/label'})])
+
+  def testFindHosts(self):
+    self.db.Store('1.1.1.1', _Attrs('1.0', 'x86', 3, 1))
+    self.db.Store('2.2.2.2', _Attrs('2.0', 'x86', 3, 0))
+    self.db.Store('3.3.3.3', _Attrs('2.0', 'arm', 3, 1))
+    self.db.Store('4.4.4.4', _Attrs('2.0', 'arm'))
+
+    def _HostIds(**kwargs):
+      return [host_id for host_id, _ in self.db.FindHosts(**kwargs)]
+
+    # Queued attributes are written before querying.
+    self.assertEqual(_HostIds(version='2.0'),
+                     ['2.2.2.2', '3.3.3.3', '4.4.4.4'])
+    self.assertEqual(_HostIds(version='2.0', board='arm'),
+                     ['3.3.3.3', '4.4.4.4'])
+    self.assertEqual(_HostIds(event_result=0), ['2.2.2.2'])
+    self.assertEqual(_HostIds(event_type=3, event_result=1),
+                     ['1.1.1.1', '3.3.3.3'])
+    self.assertEqual(_HostIds(after_host_id='1.1.1.1', limit=2),
+                     ['2.2.2.2', '3.3.3.3'])
+    self.assertEqual(self.db.FindHosts(version='1.0'),
+                     [('1.1.1.1', _Attrs('1.0', 'x86', 3, 1))])
+
+  def testGetRolloutProgress(self):
+    self.db.Store('1.1.1.1', _Attrs('1.0', 'x86'))
+    self.db.Store('2.2.2.2', _Attrs('2.0', 'x86'))
+    self.db.Store('3.3.3.3', _Attrs('2.0', 'x86'))
+    self.db.Store('4.4.4.4', _Attrs('2.0', 'arm'))
+    self.assertEqual(self.db.GetRolloutProgress(),
+                     {'x86': {'1.0': 1, '2.0': 2}, 'arm': {'2.0': 1}})
+    self.assertEqual(self.db.GetRolloutProgress(board='arm'),
+                     {'arm': {'2.0': 1}})
+
+  def testConcurrentFlushes(self):
+    self.db.Store('1.1.1.1', dict(_Attrs('1.0', 'x86'),
+                                  forced_update_label='some/label'))
+    paused = threading.Event()
+    resume = threading.Event()
+
+    class _PausingJson(object):
+      """Pauses the first flush once it has taken its batch."""
+      loads = staticmethod(json.loads)
+
+      @staticmethod
+      def dumps(value):
+        if not paused.is_set():
+          paused.set()
+          resume.wait()
+        return json.dumps(value)
+
+    host_db.json = _PausingJson
+    try:
+      first = threading.Thread(target=self.db.Flush)
+      first.start()
+      self.assertTrue(paused.wait(10))
+      # The label is consumed while the older batch is being written.
+      self.db.Store('1.1.1.1', _Attrs('2.0', 'x86'))
+      second = threading.Thread(target=self.db.Flush)
+      second.start()
+      second.join(0.5)
+      resume.set()
+      first.join()
+      second.join()
+    finally:
+      host_db.json = json
+
+    self.assertEqual(host_db.HostDatabase(self.db_path).Load(),
+                     [('1.1.1.1', _Attrs('2.0', 'x86'))])
+
+  def testWriterThread(self):
+    db = host_db.HostDatabase(self.db_path, flush_interval=0.01)
+    db.Store('1.1.1.1', _Attrs('1.0', 'x86'))
+    for _ in range(500):
+      if host_db.HostDatabase(self.db_path).FindHosts():
+        break
+      db._wakeup.wait(0.01)
+    self.assertEqual(host_db.HostDatabase(self.db_path).FindHosts(),
+                     [('1.1.1.1', _Attrs('1.0', 'x86'))])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,561 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Bounded storage of host update event logs.
+
+Each host keeps its most recent events in memory, in a fixed-size ring buffer
+of compact records. Events that fall out of a ring buffer are appended to an
+optional on-disk log, which is rotated once it grows too large, so that a
+long-running devserver neither grows without bound nor loses history it has
+room for on disk.
+
+Every event is numbered with a sequence number, increasing across all hosts,
+which serves as a cursor for reading the logs page by page.
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOSTLOG', message, *args)
+
+
+# Default number of events kept in memory per host.
+DEFAULT_MAX_ENTRIES = 1000
+
+# Default size of the on-disk log before it is rotated.
+DEFAULT_MAX_FILE_BYTES = 64 * 1024 * 1024
+
+# Default number of rotated on-disk logs kept.
+DEFAULT_BACKUP_COUNT = 4
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _GetLogPaths(path, backup_count):
+  """Returns the paths of the logs of an archive, oldest first."""
+  paths = ['%s.%d' % (path, index) for index in range(backup_count, 0, -1)]
+  paths.append(path)
+  return paths
+
+
+def _ParseLine(line):
+  """Returns the (host, time, entry) of an event line, None if corrupt."""
+  try:
+    entry = json.loads(line)
+    return entry.pop('host'), entry.pop('time'), entry
+  except (ValueError, KeyError):
+    return None
+
+
+class LogFilter(object):
+  """Selects events by time, type and result.
+
+  Members:
+    since:        only select events at or after this time, in seconds since
+                  the epoch; None for no lower bound.
+    until:        only select events before this time; None for no upper
+                  bound.
+    event_type:   only select events of this type, None for any.
+    event_result: only select events with this result, None for any.
+  """
+
+  def __init__(self, since=None, until=None, event_type=None,
+               event_result=None):
+    self.since = since
+    self.until = until
+    self.event_type = event_type
+    self.event_result = event_result
+
+  def Matches(self, event_time, event_type, event_result):
+    if self.since is not None and event_time < self.since:
+      return False
+    if self.until is not None and event_time >= self.until:
+      return False
+    if self.event_type is not None and event_type != self.event_type:
+      return False
+    if self.event_result is not None and event_result != self.event_result:
+      return False
+    return True
+
+
+class HostLogRecord(object):
+  """A single host event.
+
+  The fields reported by update pings have a slot of their own; any other
+  field goes into a dictionary, which most records do without.
+  """
+
+  FIELDS = ('version', 'track', 'board', 'event_result', 'event_type',
+            'previous_version')
+
+  __slots__ = ('seq', 'time') + FIELDS + ('extra',)
+
+  def __init__(self, entry, seq, event_time=None):
+    """Initializes the record from an event dictionary.
+
+    Args:
+      entry: dictionary of event fields.
+      seq: sequence number of the event.
+      event_time: time of the event in seconds since the epoch, the current
+                  time if None.
+    """
+    self.seq = seq
+    self.time = time.time() if event_time is None else event_time
+    entry = dict(entry)
+    for field in self.FIELDS:
+      setattr(self, field, entry.pop(field, None))
+    self.extra = entry or None
+
+  def ToDict(self):
+    """Returns the event as a dictionary.
+
+    Besides the event fields, the dictionary holds the `timestamp' of the
+    event and its sequence number, `seq'.
+    """
+    entry = dict(self.extra or {})
+    for field in self.FIELDS:
+      value = getattr(self, field)
+      if value is not None:
+        entry[field] = value
+    entry['timestamp'] = time.strftime(_TIMESTAMP_FORMAT,
+                                       time.localtime(self.time))
+    entry['seq'] = self.seq
+    return entry
+
+
+class HostLogArchive(object):
+  """An append-only, rotated on-disk log of the events of all hosts.
+
+  Events are stored one per line as JSON dictionaries with additional `host'
+  and `time' fields, the line prefixed with the sequence number of the event
+  so that it can be skipped without being parsed. Once the log exceeds its
+  size, it is renamed with a .1 suffix, shifting older logs up to
+  |backup_count|, and a new one is started.
+
+  Events are archived as they drop out of memory, which is not in the order of
+  their sequence numbers across hosts.
+  """
+
+  def __init__(self, path, max_bytes=DEFAULT_MAX_FILE_BYTES,
+               backup_count=DEFAULT_BACKUP_COUNT):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self._lock = threading.Lock()
+    self._file = None
+    # The highest sequence number in each log and the hosts found in any, to
+    # skip logs and answer host queries without reading them. Read from disk
+    # on first use.
+    self._max_seqs = None
+    self._host_ids = None
+
+  def _GetPaths(self):
+    """Returns the paths of the logs, oldest first."""
+    return _GetLogPaths(self.path, self.backup_count)
+
+  def _ReadLines(self, log_file, size=None):
+    """Yields the (sequence number, line) pairs of an open log.
+
+    Args:
+      log_file: the log, open for reading from its start. It is closed once
+                read.
+      size: number of bytes to read, None to read the whole log.
+    """
+    with log_file:
+      for line in log_file:
+        if size is not None:
+          size -= len(line)
+          if size < 0:
+            break
+        seq, _, line = line.partition(' ')
+        try:
+          seq = int(seq)
+        except ValueError:
+          # Possibly a line cut short by a crash.
+          continue
+        yield seq, line
+
+  def _LoadSummary(self):
+    """Reads what the logs hold, if not done yet; call with _lock held."""
+    if self._max_seqs is not None:
+      return
+    self._max_seqs = {}
+    self._host_ids = set()
+    for path in self._GetPaths():
+      try:
+        log_file = open(path)
+      except IOError:
+        continue
+      for seq, line in self._ReadLines(log_file):
+        self._max_seqs[path] = max(self._max_seqs.get(path, 0), seq)
+        parsed = _ParseLine(line)
+        if parsed:
+          self._host_ids.add(parsed[0])
+
+  def _Rotate(self):
+    """Moves the current log aside; call with _lock held."""
+    self._file.close()
+    self._file = None
+    paths = self._GetPaths()
+    if self.backup_count:
+      self._max_seqs.pop(paths[0], None)
+    else:
+      os.remove(self.path)
+      self._max_seqs.pop(self.path, None)
+    for older, newer in zip(paths, paths[1:]):
+      if os.path.exists(newer):
+        os.rename(newer, older)
+        self._max_seqs[older] = self._max_seqs.pop(newer, 0)
+
+  def GetMaxSeq(self):
+    """Returns the highest sequence number archived, 0 if none."""
+    with self._lock:
+      self._LoadSummary()
+      return max(self._max_seqs.values() or [0])
+
+  def GetHostIds(self):
+    """Returns the set of hosts with archived events."""
+    with self._lock:
+      self._LoadSummary()
+      return set(self._host_ids)
+
+  def Append(self, host_id, records):
+    """Appends the events of |host_id| in |records| to the log."""
+    lines = []
+    for record in records:
+      entry = record.ToDict()
+      entry['host'] = host_id
+      entry['time'] = record.time
+      lines.append('%d %s\n' % (record.seq, json.dumps(entry)))
+
+    with self._lock:
+      self._LoadSummary()
+      try:
+        if not self._file:
+          self._file = open(self.path, 'a')
+        self._file.writelines(lines)
+        self._file.flush()
+        self._host_ids.add(host_id)
+        self._max_seqs[self.path] = max(
+            [self._max_seqs.get(self.path, 0)] +
+            [record.seq for record in records])
+        if self._file.tell() >= self.max_bytes:
+          self._Rotate()
+      except (IOError, OSError) as e:
+        _Log('Failed to write host log %s: %s', self.path, e)
+
+  def Query(self, host_id=None, after_seq=0, limit=None, log_filter=None,
+            until_seq=None):
+    """Returns archived events in the order of their sequence numbers.
+
+    Args:
+      host_id: only return the events of this host, all of them if None.
+      after_seq: only return events with a higher sequence number.
+      limit: maximum number of events to return, None for all of them.
+      log_filter: a LogFilter selecting the events to return, None for all.
+      until_seq: only return events with this sequence number or a lower one,
+                 None for no upper bound.
+    Returns:
+      A list of (sequence number, host, event dictionary) tuples.
+    """
+    def _Matching(log_file, size):
+      for seq, line in self._ReadLines(log_file, size):
+        if seq <= after_seq or (until_seq is not None and seq > until_seq):
+          continue
+        # Cheap filter before parsing.
+        if host_id is not None and host_id not in line:
+          continue
+        parsed = _ParseLine(line)
+        if not parsed:
+          continue
+        entry_host_id, event_time, entry = parsed
+        if host_id is not None and entry_host_id != host_id:
+          continue
+        if log_filter and not log_filter.Matches(
+            event_time, entry.get('event_type'), entry.get('event_result')):
+          continue
+        yield seq, entry_host_id, entry
+
+    # Only open the logs with the lock held, so that events can be appended
+    # while they are read. Open logs are unaffected by rotation, and reading
+    # stops where the logs ended when opened.
+    logs = []
+    with self._lock:
+      self._LoadSummary()
+      if self._file:
+        self._file.flush()
+      if host_id is not None and host_id not in self._host_ids:
+        return []
+      for path in self._GetPaths():
+        if self._max_seqs.get(path, 0) <= after_seq:
+          continue
+        try:
+          log_file = open(path)
+        except IOError:
+          continue
+        logs.append((log_file, os.fstat(log_file.fileno()).st_size))
+
+    matching = (event for log_file, size in logs
+                for event in _Matching(log_file, size))
+    try:
+      if limit is None:
+        return sorted(matching)
+      # Only keep |limit| events in memory, whatever the size of the logs.
+      return heapq.nsmallest(limit, matching)
+    finally:
+      for log_file, _ in logs:
+        log_file.close()
+
+  def Read(self, host_id=None):
+    """Returns the logged events, oldest first.
+
+    Args:
+      host_id: only return the events of this host, all of them if None.
+    Returns:
+      If |host_id| is given, a list of event dictionaries; otherwise, a
+      dictionary of such lists keyed by host identifier.
+    """
+    logs = {}
+    for _, entry_host_id, entry in self.Query(host_id=host_id):
+      logs.setdefault(entry_host_id, []).append(entry)
+    if host_id is not None:
+      return logs.get(host_id, [])
+    return logs
+
+
+class _HostIndex(object):
+  """Where the archived events of a host are, in sequence number order."""
+
+  __slots__ = ('seqs', 'logs', 'offsets', 'ordered')
+
+  def __init__(self):
+    self.seqs = array.array('l')
+    self.logs = array.array('H')
+    self.offsets = array.array('l')
+    self.ordered = True
+
+  def Add(self, seq, log_number, offset):
+    if self.seqs and seq < self.seqs[-1]:
+      self.ordered = False
+    self.seqs.append(seq)
+    self.logs.append(log_number)
+    self.offsets.append(offset)
+
+  def Sort(self):
+    events = sorted(zip(self.seqs, self.logs, self.offsets))
+    self.seqs = array.array('l', [seq for seq, _, _ in events])
+    self.logs = array.array('H', [log for _, log, _ in events])
+    self.offsets = array.array('l', [offset for _, _, offset in events])
+    self.ordered = True
+
+
+class HostLogReader(object):
+  """Reads a HostLogArchive, possibly being written by another process.
+
+  The logs are read once, noting where the events of each host are, after
+  which only the events queried are read again. CatchUp() only reads what was
+  appended since, so a reader kept across queries, e.g. those of the pages of
+  a long log, reads the archive once in all. Logs rotated meanwhile are
+  followed through the files the reader keeps open until closed.
+
+  Members:
+    path:         path of the archive.
+    backup_count: number of rotated logs the archive keeps.
+    host_id:      only read the events of this host, of all hosts if None.
+  """
+
+  def __init__(self, path, backup_count=DEFAULT_BACKUP_COUNT, host_id=None):
+    self.path = path
+    self.backup_count = backup_count
+    self.host_id = host_id
+    # The open logs, the number of bytes read of each and their identities.
+    self._logs = []
+    self._sizes = []
+    self._log_ids = set()
+    # A _HostIndex of the events read, keyed by host.
+    self._index = {}
+
+  def _ReadLog(self, log_number):
+    """Indexes the complete lines appended to a log since last read."""
+    log_file = self._logs[log_number]
+    offset = self._sizes[log_number]
+    log_file.seek(offset)
+    for line in iter(log_file.readline, ''):
+      if not line.endswith('\n'):
+        # Still being written, read it next time.
+        break
+      line_offset = offset
+      offset += len(line)
+      seq, _, line = line.partition(' ')
+      # Cheap filter before parsing.
+      if self.host_id is not None and self.host_id not in line:
+        continue
+      try:
+        seq = int(seq)
+      except ValueError:
+        continue
+      parsed = _ParseLine(line)
+      if not parsed or (self.host_id is not None and
+                        parsed[0] != self.host_id):
+        continue
+      host_index = self._index.get(parsed[0])
+      if not host_index:
+        host_index = self._index[parsed[0]] = _HostIndex()
+      host_index.Add(seq, log_number, line_offset)
+    self._sizes[log_number] = offset
+
+  def CatchUp(self):
+    """Reads the events appended to the archive since the last call."""
+    for log_number in range(len(self._logs)):
+      self._ReadLog(log_number)
+    # Logs not seen yet, e.g. started since by a rotation.
+    for path in _GetLogPaths(self.path, self.backup_count):
+      try:
+        log_file = open(path)
+      except IOError:
+        continue
+      file_stat = os.fstat(log_file.fileno())
+      log_id = (file_stat.st_dev, file_stat.st_ino)
+      if log_id in self._log_ids:
+        log_file.close()
+        continue
+      self._log_ids.add(log_id)
+      self._logs.append(log_file)
+      self._sizes.append(0)
+      self._ReadLog(len(self._logs) - 1)
+
+    # Only if the archive was rotated between opening two of its logs.
+    for host_index in self._index.itervalues():
+      if not host_index.ordered:
+        host_index.Sort()
+
+  def GetHostIds(self):
+    """Returns the set of hosts with events read."""
+    return set(self._index)
+
+  def _IterHost(self, host_id, after_seq, until_seq):
+    """Yields (seq, host, time, entry) for the events of a host."""
+    host_index = self._index.get(host_id)
+    if not host_index:
+      return
+    for position in xrange(bisect.bisect_right(host_index.seqs, after_seq),
+                           len(host_index.seqs)):
+      seq = host_index.seqs[position]
+      if until_seq is not None and seq > until_seq:
+        return
+      log_file = self._logs[host_index.logs[position]]
+      log_file.seek(host_index.offsets[position])
+      parsed = _ParseLine(log_file.readline().partition(' ')[2])
+      if parsed:
+        yield (seq,) + parsed
+
+  def Query(self, host_id=None, after_seq=0, limit=None, log_filter=None,
+            until_seq=None):
+    """Returns the events read, as HostLogArchive.Query() does."""
+    host_ids = self._index.keys() if host_id is None else [host_id]
+    events = heapq.merge(*[self._IterHost(entry_host_id, after_seq, until_seq)
+                           for entry_host_id in host_ids])
+    matching = ((seq, entry_host_id, entry)
+                for seq, entry_host_id, event_time, entry in events
+                if not log_filter or log_filter.Matches(
+                    event_time, entry.get('event_type'),
+                    entry.get('event_result')))
+    return list(itertools.islice(matching, limit))
+
+  def Close(self):
+    """Closes the logs."""
+    for log_file in self._logs:
+      log_file.close()
+    self._logs = []
+
+
+class _SeqView(object):
+  """A read-only sequence of the sequence numbers of a list of records."""
+
+  def __init__(self, records):
+    self._records = records
+
+  def __len__(self):
+    return len(self._records)
+
+  def __getitem__(self, index):
+    return self._records[index].seq
+
+
+class HostLog(object):
+  """The events of a single host, the most recent ones in a ring buffer."""
+
+  def __init__(self, host_id, max_entries=DEFAULT_MAX_ENTRIES, archive=None):
+    """Initializes the log.
+
+    Args:
+      host_id: identifier of the host.
+      max_entries: number of events kept in memory.
+      archive: a HostLogArchive receiving the events dropped from memory, or
+               None to forget them.
+    """
+    self.host_id = host_id
+    self.archive = archive
+    self._records = collections.deque(maxlen=max_entries)
+
+  def __len__(self):
+    return len(self._records)
+
+  def __repr__(self):
+    return repr(self.GetRecent())
+
+  def Append(self, entry, seq):
+    """Records an event described by dictionary |entry|.
+
+    Args:
+      entry: dictionary of event fields.
+      seq: sequence number of the event, higher than that of any event
+           recorded before.
+    """
+    record = HostLogRecord(entry, seq)
+    if len(self._records) == self._records.maxlen:
+      dropped = record
+      if self._records.maxlen:
+        dropped = self._records.popleft()
+        self._records.append(record)
+      if self.archive:
+        self.archive.Append(self.host_id, [dropped])
+    else:
+      self._records.append(record)
+
+  def GetRecent(self):
+    """Returns the events held in memory as dictionaries, oldest first."""
+    return [record.ToDict() for record in self._records]
+
+  def GetAll(self):
+    """Returns all events, from disk and memory, as dictionaries."""
+    entries = self.archive.Read(self.host_id) if self.archive else []
+    entries.extend(self.GetRecent())
+    return entries
+
+  def IterRecords(self, after_seq=0, log_filter=None):
+    """Yields the records in memory with a sequence number above |after_seq|.
+
+    Records come in the order of their sequence numbers. The log must not
+    change while iterating.
+    """
+    if not self._records or self._records[-1].seq <= after_seq:
+      return
+    start = bisect.bisect_right(_SeqView(self._records), after_seq)
+    for record in itertools.islice(self._records, start, None):
+      if not log_filter or log_filter.Matches(record.time, record.event_type,
+                                              record.event_result):
+        yield record
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_log module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import host_log
+
+
+class HostLogRecordTest(unittest.TestCase):
+
+  def testToDict(self):
+    record = host_log.HostLogRecord({'version': '1.0', 'event_type': 3,
+                                     'custom': 'value'}, 7)
+    entry = record.ToDict()
+    self.assertTrue(entry.pop('timestamp'))
+    self.assertEqual(entry, {'version': '1.0', 'event_type': 3,
+                             'custom': 'value', 'seq': 7})
+    self.assertFalse(hasattr(record, '__dict__'))
+
+
+class HostLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('host_log_unittest')
+    self.archive_path = os.path.join(self.test_dir, 'host.log')
+    self.seq = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Append(self, log, entry):
+    self.seq += 1
+    log.Append(entry, self.seq)
+
+  def _Versions(self, entries):
+    return [entry['version'] for entry in entries]
+
+  def testRingBuffer(self):
+    log = host_log.HostLog('host', max_entries=2)
+    for version in range(5):
+      self._Append(log, {'version': version})
+    self.assertEqual(len(log), 2)
+    self.assertEqual(self._Versions(log.GetAll()), [3, 4])
+
+  def testArchive(self):
+    archive = host_log.HostLogArchive(self.archive_path)
+    log = host_log.HostLog('host', max_entries=2, archive=archive)
+    other_log = host_log.HostLog('other', max_entries=1, archive=archive)
+    for version in range(5):
+      self._Append(log, {'version': version})
+      self._Append(other_log, {'version': version})
+    self.assertEqual(self._Versions(log.GetRecent()), [3, 4])
+    self.assertEqual(self._Versions(log.GetAll()), [0, 1, 2, 3, 4])
+    self.assertEqual(self._Versions(archive.Read()['other']), [0, 1, 2, 3])
+    self.assertEqual(archive.GetHostIds(), set(['host', 'other']))
+    self.assertEqual(archive.GetMaxSeq(), 8)
+
+    # The summary of the archive is read back from disk.
+    archive = host_log.HostLogArchive(self.archive_path)
+    self.assertEqual(archive.GetMaxSeq(), 8)
+    self.assertEqual(archive.GetHostIds(), set(['host', 'other']))
+
+  def testRotation(self):
+    archive = host_log.HostLogArchive(self.archive_path, max_bytes=1,
+                                      backup_count=2)
+    log = host_log.HostLog('host', max_entries=1, archive=archive)
+    for version in range(4):
+      self._Append(log, {'version': version})
+    # Every entry went to a log of its own; only two rotated logs are kept.
+    self.assertEqual(sorted(os.listdir(self.test_dir)),
+                     ['host.log.1', 'host.log.2'])
+    self.assertEqual(self._Versions(log.GetAll()), [1, 2, 3])
+
+    # Without room in memory, entries go straight to disk.
+    log = host_log.HostLog('other', max_entries=0, archive=archive)
+    self._Append(log, {'version': 4})
+    self.assertEqual(self._Versions(log.GetAll()), [4])
+
+  def testQuery(self):
+    archive = host_log.HostLogArchive(self.archive_path)
+    log = host_log.HostLog('host', max_entries=2, archive=archive)
+    for version in range(6):
+      self._Append(log, {'version': version, 'event_type': version % 2})
+
+    records = list(log.IterRecords(after_seq=4))
+    self.assertEqual([record.seq for record in records], [5, 6])
+    records = list(log.IterRecords(
+        log_filter=host_log.LogFilter(event_type=1)))
+    self.assertEqual([record.seq for record in records], [6])
+    self.assertEqual(list(log.IterRecords(after_seq=6)), [])
+
+    events = archive.Query(after_seq=1, limit=2)
+    self.assertEqual([(seq, host_id) for seq, host_id, _ in events],
+                     [(2, 'host'), (3, 'host')])
+    events = archive.Query(log_filter=host_log.LogFilter(event_type=0))
+    self.assertEqual([seq for seq, _, _ in events], [1, 3])
+    self.assertEqual(archive.Query(host_id='other'), [])
+    self.assertEqual(archive.Query(after_seq=4), [])
+    self.assertEqual([seq for seq, _, _ in archive.Query(until_seq=2)], [1, 2])
+    self.assertEqual(
+        archive.Query(log_filter=host_log.LogFilter(since=0, until=1)), [])
+
+  def testReader(self):
+    archive = host_log.HostLogArchive(self.archive_path, max_bytes=300,
+                                      backup_count=2)
+    log = host_log.HostLog('host', max_entries=0, archive=archive)
+    other_log = host_log.HostLog('other', max_entries=0, archive=archive)
+    for version in range(3):
+      self._Append(log, {'version': version, 'event_type': version % 2})
+      self._Append(other_log, {'version': version})
+
+    reader = host_log.HostLogReader(self.archive_path, backup_count=2)
+    host_reader = host_log.HostLogReader(self.archive_path, backup_count=2,
+                                         host_id='host')
+    try:
+      reader.CatchUp()
+      host_reader.CatchUp()
+      self.assertEqual(reader.GetHostIds(), set(['host', 'other']))
+      self.assertEqual(host_reader.GetHostIds(), set(['host']))
+      self.assertEqual(reader.Query(), archive.Query())
+      self.assertEqual(reader.Query(host_id='host', after_seq=1, limit=1),
+                       archive.Query(host_id='host', after_seq=1, limit=1))
+      self.assertEqual(
+          [seq for seq, _, _ in reader.Query(
+              log_filter=host_log.LogFilter(event_type=0), until_seq=5)],
+          [1, 5])
+
+      # Only the events appended since are read, across rotations.
+      for version in range(3, 6):
+        self._Append(log, {'version': version})
+      reader.CatchUp()
+      self.assertEqual([seq for seq, _, _ in reader.Query(after_seq=6)],
+                       [7, 8, 9])
+      # Events of logs rotated away are still read from the open logs.
+      self.assertEqual([seq for seq, _, _ in archive.Query(limit=1)], [4])
+      self.assertEqual([seq for seq, _, _ in reader.Query(limit=2)], [1, 2])
+    finally:
+      reader.Close()
+      host_reader.Close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,400 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Devserver metrics in the Prometheus text exposition format.
+
+Metrics are counters, gauges and histograms, optionally split by labels, kept
+in memory by the process recording them. Render() formats every metric for
+/metrics.
+
+When the devserver runs several worker processes, a scrape only reaches one
+of them. Each worker then periodically writes a snapshot of its metrics to a
+shared directory, and Render() adds up the snapshots of all workers. Gauges
+of workers that are gone are left out; their counters and histograms are not,
+so that totals never go backwards when a worker is restarted.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from cherrypy.process import plugins
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('METRICS', message, *args)
+
+
+# Default number of seconds between snapshots of a worker's metrics.
+DEFAULT_SNAPSHOT_INTERVAL = 5
+
+# Upper bounds, in seconds, of the buckets of request latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+# Upper bounds, in seconds, of the buckets of long-running job histograms.
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+_SNAPSHOT_SUFFIX = '.json'
+
+
+class MetricsError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def _FormatValue(value):
+  """Returns |value| as a sample value of the text format."""
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return repr(int(value))
+  return repr(value)
+
+
+def _FormatLabels(names, values):
+  """Returns the label set of a sample, e.g. '{handler="update"}'."""
+  if not names:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (name, str(value).replace('\\', r'\\').replace(
+          '"', r'\"').replace('\n', r'\n'))
+      for name, value in zip(names, values))
+
+
+class _Metric(object):
+  """A metric, with one value per combination of label values.
+
+  Members:
+    name:        name of the metric.
+    doc:         description of the metric.
+    label_names: names of the labels of the metric.
+  """
+
+  TYPE = None
+
+  def __init__(self, name, doc, label_names=()):
+    self.name = name
+    self.doc = doc
+    self.label_names = tuple(label_names)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def _CheckLabels(self, labels):
+    """Returns |labels| as a tuple of strings of the right length."""
+    labels = tuple(str(value) for value in labels)
+    if len(labels) != len(self.label_names):
+      raise MetricsError('%s takes labels %s, got %s' % (
+          self.name, self.label_names, labels))
+    return labels
+
+  def Snapshot(self):
+    """Returns a copy of the values of the metric, keyed by label values."""
+    with self._lock:
+      return dict((labels, self._CopyValue(value))
+                  for labels, value in self._values.iteritems())
+
+  def _CopyValue(self, value):
+    return value
+
+  @staticmethod
+  def Merge(values, other):
+    """Adds the values of one snapshot to another."""
+    for labels, value in other.iteritems():
+      values[labels] = values.get(labels, 0) + value
+
+  def Render(self, values):
+    """Returns the text format lines for the metric with |values|."""
+    lines = ['# HELP %s %s' % (self.name, self.doc),
+             '# TYPE %s %s' % (self.name, self.TYPE)]
+    for labels in sorted(values):
+      lines.append('%s%s %s' % (self.name,
+                                _FormatLabels(self.label_names, labels),
+                                _FormatValue(values[labels])))
+    return lines
+
+
+class Counter(_Metric):
+  """A value that only goes up, e.g. a number of requests."""
+
+  TYPE = 'counter'
+
+  def Inc(self, labels=(), amount=1):
+    """Adds |amount| to the counter of |labels|."""
+    labels = self._CheckLabels(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+  """A value that goes up and down, e.g. a number of active downloads."""
+
+  TYPE = 'gauge'
+
+  def Set(self, value, labels=()):
+    """Sets the gauge of |labels| to |value|."""
+    labels = self._CheckLabels(labels)
+    with self._lock:
+      self._values[labels] = value
+
+  def Inc(self, labels=(), amount=1):
+    """Adds |amount| to the gauge of |labels|."""
+    labels = self._CheckLabels(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def Dec(self, labels=(), amount=1):
+    """Subtracts |amount| from the gauge of |labels|."""
+    self.Inc(labels, -amount)
+
+  @contextlib.contextmanager
+  def TrackInProgress(self, labels=()):
+    """Returns a context raising the gauge of |labels| while it is entered."""
+    self.Inc(labels)
+    try:
+      yield
+    finally:
+      self.Dec(labels)
+
+
+class Histogram(_Metric):
+  """Counts observations, e.g. request latencies, in buckets.
+
+  Each value is a list of the number of observations in each bucket, followed
+  by the sum of all observations.
+  """
+
+  TYPE = 'histogram'
+
+  def __init__(self, name, doc, label_names=(), buckets=LATENCY_BUCKETS):
+    _Metric.__init__(self, name, doc, label_names)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def _CopyValue(self, value):
+    return list(value)
+
+  def Observe(self, amount, labels=()):
+    """Records an observation of |amount| for |labels|."""
+    labels = self._CheckLabels(labels)
+    index = bisect.bisect_left(self.buckets, amount)
+    with self._lock:
+      value = self._values.get(labels)
+      if value is None:
+        value = self._values[labels] = [0] * (len(self.buckets) + 1)
+      value[index] += 1
+      value[-1] += amount
+
+  @contextlib.contextmanager
+  def Time(self, labels=()):
+    """Returns a context observing the number of seconds it was entered for."""
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.Observe(time.time() - start_time, labels)
+
+  @staticmethod
+  def Merge(values, other):
+    """Adds the values of one snapshot to another."""
+    for labels, value in other.iteritems():
+      if labels in values:
+        values[labels] = [a + b for a, b in zip(values[labels], value)]
+      else:
+        values[labels] = list(value)
+
+  def Render(self, values):
+    lines = ['# HELP %s %s' % (self.name, self.doc),
+             '# TYPE %s %s' % (self.name, self.TYPE)]
+    for labels in sorted(values):
+      value = values[labels]
+      count = 0
+      for bound, bucket_count in zip(self.buckets, value):
+        count += bucket_count
+        lines.append('%s_bucket%s %d' % (
+            self.name,
+            _FormatLabels(self.label_names + ('le',),
+                          labels + (_FormatValue(float(bound)),)),
+            count))
+      label_text = _FormatLabels(self.label_names, labels)
+      lines.append('%s_sum%s %s' % (self.name, label_text,
+                                    _FormatValue(value[-1])))
+      lines.append('%s_count%s %d' % (self.name, label_text, count))
+    return lines
+
+
+# Every metric of the devserver, in the order they are rendered.
+_registry = []
+
+# Directory the snapshots of worker processes are shared in, if any.
+_shared_dir = None
+
+
+def _Register(metric):
+  _registry.append(metric)
+  return metric
+
+
+REQUESTS = _Register(Counter(
+    'devserver_requests_total', 'Number of HTTP requests handled.',
+    ('handler', 'code')))
+REQUEST_LATENCY = _Register(Histogram(
+    'devserver_request_duration_seconds',
+    'Time from receiving an HTTP request to sending the last of its '
+    'response.', ('handler',)))
+PAYLOAD_GENERATION = _Register(Histogram(
+    'devserver_payload_generation_seconds',
+    'Time spent generating update payloads.', ('type',), JOB_BUCKETS))
+HASH_COMPUTATION = _Register(Histogram(
+    'devserver_hash_duration_seconds',
+    'Time spent computing the digests of a file.'))
+HASHED_BYTES = _Register(Counter(
+    'devserver_hashed_bytes_total', 'Number of bytes of files digested.'))
+STATIC_BYTES = _Register(Counter(
+    'devserver_static_bytes_served_total',
+    'Number of bytes of static files, such as payloads, served.',
+    ('server',)))
+ACTIVE_DOWNLOADS = _Register(Gauge(
+    'devserver_active_downloads',
+    'Number of static file downloads in progress.', ('server',)))
+THREAD_POOL_SIZE = _Register(Gauge(
+    'devserver_thread_pool_size', 'Number of threads of a pool.', ('pool',)))
+THREAD_POOL_BUSY = _Register(Gauge(
+    'devserver_thread_pool_busy',
+    'Number of threads of a pool doing work; at the size of the pool, '
+    'further work waits.', ('pool',)))
+THREAD_POOL_QUEUED = _Register(Gauge(
+    'devserver_thread_pool_queued',
+    'Number of jobs waiting for a thread of a pool.', ('pool',)))
+
+# Metrics whose values only hold while the recording process runs.
+_GAUGE_NAMES = frozenset(metric.name for metric in _registry
+                         if isinstance(metric, Gauge))
+
+
+def _GetSnapshot():
+  """Returns the values of all metrics of this process, keyed by name."""
+  return dict((metric.name, metric.Snapshot()) for metric in _registry)
+
+
+def SetSharedDir(shared_dir):
+  """Shares metrics between the processes using |shared_dir|.
+
+  Any snapshots left in the directory by earlier runs are removed, so call
+  this once, before forking worker processes.
+  """
+  global _shared_dir
+  _shared_dir = shared_dir
+  if not os.path.isdir(shared_dir):
+    os.makedirs(shared_dir)
+  for name in os.listdir(shared_dir):
+    if name.endswith(_SNAPSHOT_SUFFIX):
+      os.remove(os.path.join(shared_dir, name))
+
+
+def WriteSnapshot():
+  """Writes the metrics of this process to the shared directory, if any."""
+  if not _shared_dir:
+    return
+  snapshot = dict((name, [[list(labels), value]
+                          for labels, value in values.iteritems()])
+                  for name, values in _GetSnapshot().iteritems())
+  try:
+    fd, temp_path = tempfile.mkstemp(dir=_shared_dir)
+    with os.fdopen(fd, 'w') as snapshot_file:
+      json.dump(snapshot, snapshot_file)
+    os.rename(temp_path, os.path.join(_shared_dir, '%d%s' % (
+        os.getpid(), _SNAPSHOT_SUFFIX)))
+  except (IOError, OSError) as e:
+    _Log('Failed to write metrics snapshot: %s', e)
+
+
+def _ReadSnapshots():
+  """Yields the (pid, snapshot) of each process in the shared directory."""
+  for name in os.listdir(_shared_dir):
+    if not name.endswith(_SNAPSHOT_SUFFIX):
+      continue
+    try:
+      pid = int(name[:-len(_SNAPSHOT_SUFFIX)])
+      with open(os.path.join(_shared_dir, name)) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    except (ValueError, IOError) as e:
+      _Log('Ignoring metrics snapshot %s: %s', name, e)
+      continue
+    yield pid, dict((metric_name, dict((tuple(labels), value)
+                                       for labels, value in values))
+                    for metric_name, values in snapshot.iteritems())
+
+
+def _GetAllSnapshots():
+  """Returns the snapshots of this process and, if shared, of the others."""
+  if not _shared_dir:
+    return [_GetSnapshot()]
+  WriteSnapshot()
+  snapshots = []
+  for pid, snapshot in _ReadSnapshots():
+    if pid != os.getpid() and not common_util.IsProcessAlive(pid):
+      snapshot = dict((name, values) for name, values in snapshot.iteritems()
+                      if name not in _GAUGE_NAMES)
+    snapshots.append(snapshot)
+  return snapshots
+
+
+def GetTotal(metric):
+  """Returns the sum of the values of counter or gauge |metric|.
+
+  With a shared directory, the values of all processes are added up.
+  """
+  values = {}
+  for snapshot in _GetAllSnapshots():
+    metric.Merge(values, snapshot.get(metric.name, {}))
+  return sum(values.itervalues())
+
+
+def Render():
+  """Returns all metrics in the text exposition format.
+
+  With a shared directory, the metrics of all processes are added up.
+  """
+  snapshots = _GetAllSnapshots()
+  lines = []
+  for metric in _registry:
+    values = {}
+    for snapshot in snapshots:
+      metric.Merge(values, snapshot.get(metric.name, {}))
+    lines.extend(metric.Render(values))
+  return '\n'.join(lines) + '\n'
+
+
+class SnapshotPlugin(plugins.SimplePlugin):
+  """Periodically writes the metrics of a worker to the shared directory."""
+
+  def __init__(self, bus, interval=DEFAULT_SNAPSHOT_INTERVAL):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.interval = interval
+    self._stopping = threading.Event()
+    self._thread = None
+
+  def _Run(self):
+    while not self._stopping.is_set():
+      WriteSnapshot()
+      self._stopping.wait(self.interval)
+
+  def start(self):
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._Run, name='MetricsSnapshot')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+    self._thread = None
+    WriteSnapshot()
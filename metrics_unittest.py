@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for metrics module."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+
+class MetricTest(unittest.TestCase):
+
+  def testCounter(self):
+    counter = metrics.Counter('requests_total', 'Requests.', ('handler',))
+    counter.Inc(('update',))
+    counter.Inc(('update',), 2)
+    counter.Inc(('say "hi"',))
+    self.assertEqual(counter.Render(counter.Snapshot()), [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{handler="say \\"hi\\""} 1',
+        'requests_total{handler="update"} 3'])
+    self.assertRaises(metrics.MetricsError, counter.Inc, ())
+
+  def testGauge(self):
+    gauge = metrics.Gauge('active', 'Active.')
+    with gauge.TrackInProgress():
+      self.assertEqual(gauge.Snapshot(), {(): 1})
+    self.assertEqual(gauge.Snapshot(), {(): 0})
+    gauge.Set(0.5)
+    self.assertEqual(gauge.Render(gauge.Snapshot())[-1], 'active 0.5')
+
+  def testHistogram(self):
+    histogram = metrics.Histogram('latency', 'Latency.', buckets=(0.1, 1))
+    for amount in (0.05, 0.1, 0.5, 2):
+      histogram.Observe(amount)
+    self.assertEqual(histogram.Render(histogram.Snapshot())[2:], [
+        'latency_bucket{le="0.1"} 2',
+        'latency_bucket{le="1"} 3',
+        'latency_bucket{le="+Inf"} 4',
+        'latency_sum 2.65',
+        'latency_count 4'])
+
+    values = histogram.Snapshot()
+    metrics.Histogram.Merge(values, histogram.Snapshot())
+    self.assertEqual(histogram.Render(values)[-1], 'latency_count 8')
+
+
+class SharedMetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('metrics_unittest')
+
+  def tearDown(self):
+    metrics._shared_dir = None
+    shutil.rmtree(self.test_dir)
+
+  def _WriteSnapshot(self, pid, snapshot):
+    with open(os.path.join(self.test_dir, '%d.json' % pid), 'w') as f:
+      json.dump(snapshot, f)
+
+  def _GetSample(self, text, sample):
+    for line in text.splitlines():
+      name, _, value = line.rpartition(' ')
+      if name == sample:
+        return value
+    return None
+
+  def testRenderAddsUpWorkers(self):
+    with open(os.path.join(self.test_dir, 'stale.json'), 'w') as f:
+      f.write('{}')
+    metrics.SetSharedDir(self.test_dir)
+    self.assertEqual(os.listdir(self.test_dir), [])
+
+    # A live worker and one that is gone; no process has pid 2**22 + 1.
+    self._WriteSnapshot(os.getppid(), {
+        'devserver_hashed_bytes_total': [[[], 10]],
+        'devserver_active_downloads': [[['static'], 2]]})
+    self._WriteSnapshot(2 ** 22 + 1, {
+        'devserver_hashed_bytes_total': [[[], 5]],
+        'devserver_active_downloads': [[['static'], 7]]})
+
+    before = metrics.HASHED_BYTES.Snapshot().get((), 0)
+    text = metrics.Render()
+    self.assertTrue(os.path.exists(
+        os.path.join(self.test_dir, '%d.json' % os.getpid())))
+    self.assertEqual(self._GetSample(text, 'devserver_hashed_bytes_total'),
+                     str(before + 15))
+    self.assertEqual(
+        self._GetSample(text, 'devserver_active_downloads{server="static"}'),
+        str(2 + metrics.ACTIVE_DOWNLOADS.Snapshot().get(('static',), 0)))
+    self.assertEqual(metrics.GetTotal(metrics.HASHED_BYTES), before + 15)
+    self.assertEqual(metrics.GetTotal(metrics.ACTIVE_DOWNLOADS),
+                     2 + sum(metrics.ACTIVE_DOWNLOADS.Snapshot().values()))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,398 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Microbenchmarks of the devserver hot paths.
+
+Measures the pieces that update checks and build queries go through:
+parsing update requests, rendering update responses, comparing versions,
+hashing payloads, finding the latest build and listing control files. Build
+and autotest trees are synthesized in a temporary directory.
+
+Each benchmark is timed over several repeats of enough calls to last at least
+--min_time seconds; the minimum and median time per call are reported. The
+results can be written as JSON and compared against an earlier run, in which
+case a slowdown beyond --threshold of any benchmark is an error.
+
+Example:
+  microbenchmarks.py --json before.json
+  (upgrade)
+  microbenchmarks.py --baseline before.json
+"""
+
+import json
+import optparse
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import cherrypy
+
+import autoupdate
+import autoupdate_lib
+import build_index
+import common_util
+import update_test
+
+
+# Default number of timed repeats of each benchmark.
+DEFAULT_REPEATS = 5
+
+# Default minimum number of seconds a repeat lasts.
+DEFAULT_MIN_TIME = 0.2
+
+# Default slowdown of a benchmark, in percent, reported as a regression.
+DEFAULT_THRESHOLD = 10.0
+
+# Sizes of the files hashed.
+_HASHED_FILE_SIZES = (('4KB', 4 * 1024), ('1MB', 1024 * 1024),
+                      ('64MB', 64 * 1024 * 1024))
+
+# Number of builds of the synthetic build target.
+_NUM_BUILDS = 10000
+
+# Shape of the synthetic autotest tree: test directories per suite directory,
+# and control files per test.
+_NUM_TEST_SUITES = 20
+_NUM_TESTS_PER_SUITE = 250
+_NUM_CONTROL_FILES_PER_TEST = 2
+
+_BUILD_TARGET = 'x86-generic-release'
+_AUTOTEST_BUILD = 'x86-generic-release/R20-2000.0.0-a1-b1'
+
+
+class BenchmarkError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def _ParseUpdateRequestBenchmarks(work_dir, scale):
+  """Benchmarks of autoupdate_lib.ParseUpdateRequest."""
+  benchmarks = []
+  for protocol in ('2.0', '3.0'):
+    update_check = update_test.BuildUpdateRequest(protocol, 'x86-generic',
+                                                  '1.2.3')
+    event = update_test.BuildUpdateRequest(
+        protocol, 'x86-generic', '1.2.3',
+        update_test.EVENT_TYPE_DOWNLOAD_STARTED)
+    benchmarks.append(
+        ('parse_update_request/%s' % protocol,
+         lambda data=update_check: autoupdate_lib.ParseUpdateRequest(data)))
+    benchmarks.append(
+        ('parse_update_request/%s/event' % protocol,
+         lambda data=event: autoupdate_lib.ParseUpdateRequest(data)))
+  return benchmarks
+
+
+def _GetUpdateResponseBenchmarks(work_dir, scale):
+  """Benchmarks of autoupdate_lib.GetUpdateResponse."""
+  benchmarks = []
+  url = 'http://devserver:8080/static/cache/0123456789abcdef/update.gz'
+  for protocol in ('2.0', '3.0'):
+    benchmarks.append(
+        ('get_update_response/%s' % protocol,
+         lambda protocol=protocol: autoupdate_lib.GetUpdateResponse(
+             'sha1', 'sha256', 123456789, url, False, protocol)))
+    benchmarks.append(
+        ('get_no_update_response/%s' % protocol,
+         lambda protocol=protocol: autoupdate_lib.GetNoUpdateResponse(
+             protocol)))
+  return benchmarks
+
+
+def _CanUpdateBenchmarks(work_dir, scale):
+  """Benchmarks of Autoupdate._CanUpdate."""
+  return [
+      ('can_update',
+       lambda: autoupdate.Autoupdate._CanUpdate('2000.0.0', '2000.1.0')),
+      ('can_update/long_versions',
+       lambda: autoupdate.Autoupdate._CanUpdate('R20-2000.10.123-a1-b1234',
+                                                'R20-2000.10.124-a1-b1235')),
+  ]
+
+
+def _GetFileHashesBenchmarks(work_dir, scale):
+  """Benchmarks of common_util.GetFileHashes, without a digest index."""
+  common_util.SetDigestIndex(None)
+  benchmarks = []
+  for size_name, size in _HASHED_FILE_SIZES:
+    path = os.path.join(work_dir, 'hashed_%s' % size_name)
+    with open(path, 'wb') as hashed_file:
+      remaining = max(int(size * scale), 1)
+      while remaining:
+        block = os.urandom(min(remaining, 1024 * 1024))
+        hashed_file.write(block)
+        remaining -= len(block)
+    benchmarks.append(
+        ('get_file_hashes/%s' % size_name,
+         lambda path=path: common_util.GetFileHashes(path, do_sha1=True,
+                                                     do_sha256=True)))
+  return benchmarks
+
+
+def _GetLatestBuildVersionBenchmarks(work_dir, scale):
+  """Benchmarks of latest build queries over a target with many builds."""
+  static_dir = os.path.join(work_dir, 'builds')
+  target_dir = os.path.join(static_dir, _BUILD_TARGET)
+  os.makedirs(target_dir)
+  for i in range(max(int(_NUM_BUILDS * scale), 1)):
+    os.mkdir(os.path.join(target_dir, 'R%d-%d.%d.0-a1-b%d' % (
+        10 + i % 20, 1000 + i / 10, i % 10, i)))
+  # The index rescans directories changed within the last second; staged
+  # targets are normally older than that.
+  settled = time.time() - 3600
+  os.utime(target_dir, (settled, settled))
+
+  index = build_index.BuildVersionIndex(static_dir, use_inotify=False)
+  return [
+      ('get_latest_build_version/scan',
+       lambda: common_util.GetLatestBuildVersion(static_dir, _BUILD_TARGET)),
+      ('get_latest_build_version/scan/milestone',
+       lambda: common_util.GetLatestBuildVersion(static_dir, _BUILD_TARGET,
+                                                 'R15')),
+      ('get_latest_build_version/index',
+       lambda: index.GetLatestBuildVersion(_BUILD_TARGET)),
+      ('get_latest_build_version/index/milestone',
+       lambda: index.GetLatestBuildVersion(_BUILD_TARGET, 'R15')),
+  ]
+
+
+def _GetControlFileListBenchmarks(work_dir, scale):
+  """Benchmarks of control file listings over a large autotest tree."""
+  static_dir = os.path.join(work_dir, 'autotest_builds')
+  build_dir = os.path.join(static_dir, _AUTOTEST_BUILD)
+  autotest_dir = os.path.join(build_dir, 'autotest')
+  num_tests = max(int(_NUM_TESTS_PER_SUITE * scale), 1)
+  for suite in range(_NUM_TEST_SUITES):
+    for test in range(num_tests):
+      test_dir = os.path.join(autotest_dir, 'suite%d' % suite, 'site_tests',
+                              'test%d_%d' % (suite, test))
+      os.makedirs(test_dir)
+      for control in range(_NUM_CONTROL_FILES_PER_TEST):
+        with open(os.path.join(test_dir, 'control.%d' % control), 'w') as f:
+          f.write('NAME = "test%d_%d"\n' % (suite, test))
+      with open(os.path.join(test_dir, 'test.py'), 'w') as f:
+        f.write('pass\n')
+  manifest = os.path.join(build_dir, common_util.CONTROL_FILE_MANIFEST)
+
+  def _Cold():
+    # Drop both the in-memory and the on-disk manifest.
+    common_util._control_file_manifests.clear()
+    if os.path.exists(manifest):
+      os.remove(manifest)
+    return common_util.GetControlFileList(static_dir, _AUTOTEST_BUILD)
+
+  return [
+      ('get_control_file_list/cold', _Cold),
+      ('get_control_file_list/warm',
+       lambda: common_util.GetControlFileList(static_dir, _AUTOTEST_BUILD)),
+      ('get_control_file_list/warm/prefix',
+       lambda: common_util.GetControlFileList(static_dir, _AUTOTEST_BUILD,
+                                              prefix='suite1/site_tests')),
+      ('get_control_file_list/warm/test_name',
+       lambda: common_util.GetControlFileList(static_dir, _AUTOTEST_BUILD,
+                                              test_name='test1_1')),
+  ]
+
+
+# Functions returning (name, function) pairs of benchmarks, given a work
+# directory and a scale factor for the size of the data.
+_BENCHMARK_GROUPS = (
+    _ParseUpdateRequestBenchmarks,
+    _GetUpdateResponseBenchmarks,
+    _CanUpdateBenchmarks,
+    _GetFileHashesBenchmarks,
+    _GetLatestBuildVersionBenchmarks,
+    _GetControlFileListBenchmarks,
+)
+
+
+def TimeFunction(func, repeats=DEFAULT_REPEATS, min_time=DEFAULT_MIN_TIME):
+  """Returns the minimum and median seconds per call of |func|.
+
+  The number of calls per repeat is doubled until a repeat lasts at least
+  |min_time| seconds.
+
+  Returns:
+    A dictionary with the 'min' and 'median' seconds per call and the number
+    of 'calls' per repeat.
+  """
+  calls = 1
+  while True:
+    start = timeit.default_timer()
+    for _ in xrange(calls):
+      func()
+    elapsed = timeit.default_timer() - start
+    if elapsed >= min_time:
+      break
+    calls *= 2
+
+  times = [elapsed / calls]
+  for _ in range(repeats - 1):
+    start = timeit.default_timer()
+    for _ in xrange(calls):
+      func()
+    times.append((timeit.default_timer() - start) / calls)
+  times.sort()
+  return {'min': times[0], 'median': times[len(times) / 2], 'calls': calls}
+
+
+def RunBenchmarks(name_filter=None, repeats=DEFAULT_REPEATS,
+                  min_time=DEFAULT_MIN_TIME, scale=1.0, output=None):
+  """Runs the benchmarks whose name matches |name_filter|.
+
+  Args:
+    name_filter: regular expression searched for in the benchmark names, or
+        None to run them all.
+    repeats: number of timed repeats of each benchmark.
+    min_time: minimum number of seconds a repeat lasts.
+    scale: factor applied to the size of the synthetic data.
+    output: file the progress is written to, if any.
+  Returns:
+    The results as a JSON-compatible dictionary.
+  """
+  pattern = re.compile(name_filter or '')
+  work_dir = tempfile.mkdtemp(prefix='microbenchmarks.')
+  results = {}
+  try:
+    for group in _BENCHMARK_GROUPS:
+      group_dir = os.path.join(work_dir, group.__name__)
+      os.mkdir(group_dir)
+      for name, func in group(group_dir, scale):
+        if not pattern.search(name):
+          continue
+        results[name] = TimeFunction(func, repeats, min_time)
+        if output:
+          output.write('%-45s %s\n' % (name, _FormatTime(
+              results[name]['median'])))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  return {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'scale': scale,
+      'benchmarks': results,
+  }
+
+
+def _FormatTime(seconds):
+  """Returns |seconds| in the most readable of s, ms, us and ns."""
+  for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+    if seconds * factor >= 1:
+      return '%.3f %s' % (seconds * factor, unit)
+  return '%.1f ns' % (seconds * 1e9)
+
+
+def CompareResults(baseline, current, threshold=DEFAULT_THRESHOLD):
+  """Compares the median times of two runs.
+
+  Args:
+    baseline: results of the earlier run, as returned by RunBenchmarks().
+    current: results of the later run.
+    threshold: slowdown, in percent, above which a benchmark regressed.
+  Returns:
+    A (lines, regressions) tuple: the comparison as lines of text and the
+    names of the benchmarks that regressed.
+  Raises:
+    BenchmarkError if the runs used synthetic data of different sizes.
+  """
+  if baseline.get('scale') != current.get('scale'):
+    raise BenchmarkError('Cannot compare runs with scales %s and %s' %
+                         (baseline.get('scale'), current.get('scale')))
+
+  lines = ['%-45s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                    'change')]
+  regressions = []
+  old_results = baseline['benchmarks']
+  new_results = current['benchmarks']
+  # Benchmarks left out of the current run, e.g. by a filter, are ignored.
+  for name in sorted(new_results):
+    if name not in old_results:
+      lines.append('%-45s %12s %12s' % (
+          name, '-', _FormatTime(new_results[name]['median'])))
+      continue
+
+    old_time = old_results[name]['median']
+    new_time = new_results[name]['median']
+    change = (new_time - old_time) * 100.0 / old_time if old_time else 0.0
+    marker = ''
+    if change > threshold:
+      regressions.append(name)
+      marker = ' REGRESSION'
+    lines.append('%-45s %12s %12s %+7.1f%%%s' % (
+        name, _FormatTime(old_time), _FormatTime(new_time), change, marker))
+  return lines, regressions
+
+
+def main():
+  usage = 'usage: %prog [options]'
+  parser = optparse.OptionParser(usage=usage,
+                                 description=__doc__.split('\n')[0])
+  parser.add_option('--baseline', metavar='PATH',
+                    help='compare against the JSON results of an earlier run; '
+                    'exit with an error if any benchmark regressed')
+  parser.add_option('--filter', metavar='REGEX',
+                    help='only run the benchmarks whose name matches')
+  parser.add_option('--json', metavar='PATH',
+                    help='write the results as JSON to this file')
+  parser.add_option('--min_time', metavar='SECONDS', type='float',
+                    default=DEFAULT_MIN_TIME,
+                    help='minimum duration of each repeat (default: '
+                    '%default)')
+  parser.add_option('--repeats', metavar='NUM', type='int',
+                    default=DEFAULT_REPEATS,
+                    help='timed repeats of each benchmark (default: '
+                    '%default)')
+  parser.add_option('--scale', metavar='FACTOR', type='float', default=1.0,
+                    help='size of the synthetic data relative to the default; '
+                    'only runs with the same scale can be compared '
+                    '(default: %default)')
+  parser.add_option('--threshold', metavar='PERCENT', type='float',
+                    default=DEFAULT_THRESHOLD,
+                    help='slowdown reported as a regression with --baseline '
+                    '(default: %default)')
+  (options, args) = parser.parse_args()
+  if args:
+    parser.error('Unexpected arguments: %s' % ' '.join(args))
+  if options.repeats < 1:
+    parser.error('--repeats must be at least 1')
+
+  # Keep the log lines of the code benchmarked off the results.
+  cherrypy.config.update({'log.screen': False})
+
+  baseline = None
+  if options.baseline:
+    with open(options.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+
+  results = RunBenchmarks(options.filter, options.repeats, options.min_time,
+                          options.scale, output=sys.stdout)
+  if options.json:
+    with open(options.json, 'w') as json_file:
+      json.dump(results, json_file, indent=2, sort_keys=True)
+
+  if baseline:
+    try:
+      lines, regressions = CompareResults(baseline, results,
+                                          options.threshold)
+    except BenchmarkError as e:
+      parser.error(str(e))
+    print
+    print '\n'.join(lines)
+    if regressions:
+      print '%d benchmark(s) regressed by more than %.1f%%' % (
+          len(regressions), options.threshold)
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
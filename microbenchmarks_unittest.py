@@ -0,0 +1,64 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for microbenchmarks module."""
+
+import unittest
+
+import microbenchmarks
+
+
+def _Results(scale=1.0, **medians):
+  return {'scale': scale,
+          'benchmarks': dict((name, {'min': median, 'median': median,
+                                     'calls': 1})
+                             for name, median in medians.iteritems())}
+
+
+class MicrobenchmarksTest(unittest.TestCase):
+
+  def testTimeFunction(self):
+    calls = []
+    result = microbenchmarks.TimeFunction(lambda: calls.append(1), repeats=3,
+                                          min_time=0.001)
+    self.assertTrue(result['calls'] >= 1)
+    self.assertTrue(result['min'] <= result['median'])
+    # Calibration doubles the calls, then each further repeat makes them once.
+    self.assertEqual(len(calls), 2 * result['calls'] - 1 + 2 * result['calls'])
+
+  def testRunBenchmarks(self):
+    results = microbenchmarks.RunBenchmarks(
+        name_filter='parse_update_request|get_latest_build_version|'
+        'get_control_file_list', repeats=1, min_time=0, scale=0.01)
+    names = set(results['benchmarks'])
+    self.assertTrue('parse_update_request/2.0' in names)
+    self.assertTrue('parse_update_request/3.0' in names)
+    self.assertTrue('get_latest_build_version/index' in names)
+    self.assertTrue('get_control_file_list/cold' in names)
+    self.assertFalse('can_update' in names)
+    self.assertEqual(results['scale'], 0.01)
+
+  def testCompareResults(self):
+    baseline = _Results(fast=1.0, slow=1.0, removed=1.0)
+    current = _Results(fast=0.5, slow=1.2, added=1.0)
+    lines, regressions = microbenchmarks.CompareResults(baseline, current,
+                                                        threshold=10)
+    self.assertEqual(regressions, ['slow'])
+    self.assertEqual(len(lines), 4)
+    self.assertTrue('REGRESSION' in [line for line in lines
+                                     if line.startswith('slow')][0])
+
+    _, regressions = microbenchmarks.CompareResults(baseline, current,
+                                                    threshold=25)
+    self.assertEqual(regressions, [])
+
+    self.assertRaises(microbenchmarks.BenchmarkError,
+                      microbenchmarks.CompareResults, _Results(scale=0.5),
+                      current)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,331 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Load-aware selection of the mirrors payloads are downloaded from.
+
+Mirrors are devservers serving the same payloads under the same paths, e.g.
+because they stage the same builds. Every devserver reports its load at
+/api/load: downloads in progress, egress bandwidth and the I/O queue depth of
+the disk payloads are on. A devserver answering update checks polls the
+reports of its mirrors, and of itself, and offers the least loaded first.
+
+Reports are only refreshed every few seconds. Each payload URL offered in the
+meantime is counted as one more download of its mirror, so that a burst of
+update checks is spread across the mirrors rather than all sent to the one
+that was least loaded.
+
+A mirror may not have generated or staged a payload yet, so it is only offered
+once a HEAD request found the payload there.
+"""
+
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+from cherrypy.process import plugins
+
+import devserver_client
+import log_util
+import metrics
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('MIRRORS', message, *args)
+
+
+# Default number of seconds between polls of the load reports of mirrors.
+DEFAULT_REFRESH_INTERVAL = 5
+
+# Default number of payload URLs offered to protocol 3.0 clients.
+DEFAULT_MAX_URLS = 3
+
+# Default number of seconds whether a mirror has a payload is remembered for.
+DEFAULT_FILE_CHECK_TTL = 60
+
+# Number of seconds the egress bandwidth is averaged over.
+DEFAULT_EGRESS_WINDOW = 30
+
+# Egress bandwidth, in bytes per second, weighing as much as one download.
+EGRESS_BYTES_PER_DOWNLOAD = 4 * 1024 * 1024
+
+# Weight of each I/O request queued on the payload disk.
+DISK_QUEUE_WEIGHT = 1.0
+
+# Seconds a mirror has to answer a poll within.
+_POLL_TIMEOUT = 5
+
+# Field of /proc/diskstats holding the number of I/Os in progress.
+_DISKSTATS_IN_PROGRESS = 11
+
+
+class MirrorSelectorError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def GetDiskQueueDepth(path, diskstats='/proc/diskstats'):
+  """Returns the number of I/Os in progress on the disk holding |path|.
+
+  Returns None if it is not known, e.g. not on Linux or not on a block device.
+  """
+  try:
+    device = os.stat(path).st_dev
+    with open(diskstats) as stats_file:
+      for line in stats_file:
+        fields = line.split()
+        if (len(fields) > _DISKSTATS_IN_PROGRESS and
+            int(fields[0]) == os.major(device) and
+            int(fields[1]) == os.minor(device)):
+          return int(fields[_DISKSTATS_IN_PROGRESS])
+  except (IOError, OSError, ValueError):
+    pass
+  return None
+
+
+def GetLoadScore(report):
+  """Returns the load of a mirror as a number of download equivalents."""
+  return (report.get('active_downloads', 0) +
+          float(report.get('egress_bytes_per_sec', 0)) /
+          EGRESS_BYTES_PER_DOWNLOAD +
+          DISK_QUEUE_WEIGHT * (report.get('disk_queue_depth') or 0))
+
+
+class LoadMonitor(object):
+  """The load of this devserver, as reported at /api/load.
+
+  Egress bandwidth is that of downloads completed within the last
+  egress_window seconds, as measured by successive reports.
+
+  Members:
+    static_dir:    directory payloads are served from.
+    egress_window: number of seconds the egress bandwidth is averaged over.
+  """
+
+  def __init__(self, static_dir, egress_window=DEFAULT_EGRESS_WINDOW):
+    self.static_dir = static_dir
+    self.egress_window = egress_window
+    self._lock = threading.Lock()
+    self._samples = collections.deque()
+
+  def _GetEgressRate(self, now, bytes_served):
+    """Records the bytes served so far and returns the recent rate."""
+    with self._lock:
+      self._samples.append((now, bytes_served))
+      while (len(self._samples) > 2 and
+             self._samples[1][0] <= now - self.egress_window):
+        self._samples.popleft()
+      start_time, start_bytes = self._samples[0]
+    if now <= start_time:
+      return 0
+    return max(0, bytes_served - start_bytes) / (now - start_time)
+
+  def GetReport(self):
+    """Returns the current load report, a dictionary."""
+    return {
+        'active_downloads': metrics.GetTotal(metrics.ACTIVE_DOWNLOADS),
+        'egress_bytes_per_sec': self._GetEgressRate(
+            time.time(), metrics.GetTotal(metrics.STATIC_BYTES)),
+        'disk_queue_depth': GetDiskQueueDepth(self.static_dir),
+    }
+
+
+class _MirrorState(object):
+  """The last known load of a mirror."""
+
+  def __init__(self):
+    self.report = None
+    self.report_time = None
+    self.assigned = 0
+    self.errors = 0
+
+
+class MirrorSelector(object):
+  """Ranks this devserver and its mirrors by their load.
+
+  This devserver is represented by None among the mirrors.
+
+  Members:
+    mirrors:          base URLs of the mirrors, not including this devserver.
+    max_urls:         default number of mirrors ranked.
+    max_report_age:   number of seconds after which a mirror whose report
+                      could not be refreshed is only offered last.
+    file_check_ttl:   number of seconds whether a mirror has a file is
+                      remembered for.
+  """
+
+  def __init__(self, mirrors, load_monitor, connection_pool=None,
+               max_urls=DEFAULT_MAX_URLS,
+               max_report_age=3 * DEFAULT_REFRESH_INTERVAL,
+               file_check_ttl=DEFAULT_FILE_CHECK_TTL):
+    if max_urls < 1:
+      raise MirrorSelectorError('At least one payload URL must be offered')
+    self.mirrors = [mirror.rstrip('/') for mirror in mirrors]
+    self.max_urls = max_urls
+    self.max_report_age = max_report_age
+    self.file_check_ttl = file_check_ttl
+    self._load_monitor = load_monitor
+    self._connections = (connection_pool or
+                         devserver_client.ConnectionPool(
+                             max_idle=1, timeout=_POLL_TIMEOUT))
+    self._lock = threading.Lock()
+    self._states = dict((mirror, _MirrorState())
+                        for mirror in [None] + self.mirrors)
+    self._random = random.Random()
+    # (time checked, whether found) of files on mirrors, keyed by (mirror,
+    # path, size).
+    self._file_checks = {}
+
+  def _FetchReport(self, mirror):
+    """Returns the load report of |mirror|.
+
+    Raises:
+      MirrorSelectorError if it could not be obtained.
+    """
+    if mirror is None:
+      return self._load_monitor.GetReport()
+    try:
+      response = self._connections.Request('GET', mirror + '/api/load')
+      if response.status != 200:
+        raise MirrorSelectorError('returned %d' % response.status)
+      report = json.loads(response.body)
+    except (devserver_client.DevserverClientError, MirrorSelectorError,
+            ValueError) as e:
+      raise MirrorSelectorError('Failed to get the load of %s: %s' %
+                                (mirror, e))
+    if not isinstance(report, dict):
+      raise MirrorSelectorError('Invalid load report from %s' % mirror)
+    return report
+
+  def RefreshReports(self):
+    """Polls the load reports of all mirrors."""
+    for mirror in self._states:
+      try:
+        report = self._FetchReport(mirror)
+      except MirrorSelectorError as e:
+        _Log('%s', e)
+        with self._lock:
+          self._states[mirror].errors += 1
+        continue
+      with self._lock:
+        state = self._states[mirror]
+        state.report = report
+        state.report_time = time.time()
+        state.assigned = 0
+
+    # Forget file checks that expired, so that they do not pile up.
+    now = time.time()
+    with self._lock:
+      for key, (check_time, _) in self._file_checks.items():
+        if now - check_time >= self.file_check_ttl:
+          del self._file_checks[key]
+
+  def _IsAvailable(self, mirror, state, now):
+    return mirror is None or (state.report_time is not None and
+                              now - state.report_time <= self.max_report_age)
+
+  def _HasFile(self, mirror, path, size):
+    """Returns whether |mirror| serves a file of |size| bytes at |path|."""
+    if mirror is None:
+      return True
+    key = (mirror, path, size)
+    now = time.time()
+    with self._lock:
+      check = self._file_checks.get(key)
+    if check and now - check[0] < self.file_check_ttl:
+      return check[1]
+
+    try:
+      response = self._connections.Request('HEAD', mirror + path)
+      found = (response.status == 200 and
+               (size is None or
+                response.headers.get('content-length') == str(size)))
+    except devserver_client.DevserverClientError as e:
+      _Log('Failed to look for %s on %s: %s', path, mirror, e)
+      found = False
+    with self._lock:
+      self._file_checks[key] = (now, found)
+    return found
+
+  def RankMirrors(self, max_urls=None, path=None, size=None):
+    """Returns up to |max_urls| (default: max_urls) mirrors, least loaded first.
+
+    Mirrors without a recent report come after all others. The first mirror
+    is counted as serving one more download until its next report.
+
+    Args:
+      max_urls: maximum number of mirrors returned.
+      path: if given, only return the mirrors serving a file at this path of
+            their base URL; mirrors without a recent report are left out.
+            This devserver is assumed to serve it.
+      size: if given with |path|, the size in bytes the file must have.
+    """
+    max_urls = max_urls or self.max_urls
+    now = time.time()
+    with self._lock:
+      ranked = []
+      for mirror, state in self._states.iteritems():
+        score = GetLoadScore(state.report or {}) + state.assigned
+        ranked.append((not self._IsAvailable(mirror, state, now), score,
+                       self._random.random(), mirror))
+    ranked.sort()
+
+    # Mirrors are checked outside the lock, and only as far as needed.
+    mirrors = []
+    for unavailable, _, _, mirror in ranked:
+      if len(mirrors) == max_urls:
+        break
+      if path is None or (not unavailable and
+                          self._HasFile(mirror, path, size)):
+        mirrors.append(mirror)
+    with self._lock:
+      self._states[mirrors[0]].assigned += 1
+    return mirrors
+
+  def GetStatus(self):
+    """Returns the last report, score and availability of each mirror."""
+    now = time.time()
+    status = {}
+    with self._lock:
+      for mirror, state in self._states.iteritems():
+        status[mirror or 'local'] = {
+            'report': state.report,
+            'report_age': (now - state.report_time
+                           if state.report_time is not None else None),
+            'score': GetLoadScore(state.report or {}) + state.assigned,
+            'assigned': state.assigned,
+            'available': self._IsAvailable(mirror, state, now),
+            'errors': state.errors}
+    return status
+
+
+class MirrorSelectorPlugin(plugins.SimplePlugin):
+  """Refreshes the load reports of a MirrorSelector alongside the engine."""
+
+  def __init__(self, bus, selector, interval=DEFAULT_REFRESH_INTERVAL):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.selector = selector
+    self.interval = interval
+    self._stopping = threading.Event()
+    self._thread = None
+
+  def _Run(self):
+    while not self._stopping.is_set():
+      self.selector.RefreshReports()
+      self._stopping.wait(self.interval)
+
+  def start(self):
+    _Log('Polling the load of %s every %d seconds',
+         ', '.join(self.selector.mirrors), self.interval)
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._Run, name='MirrorSelector')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+    self._thread = None
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for mirror_selector module."""
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import mirror_selector
+
+
+class _LoadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the load report of the server at /api/load, and its files."""
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    body = json.dumps(self.server.report)
+    self.send_response(200 if self.path == '/api/load' else 404)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.server.heads += 1
+    size = self.server.files.get(self.path)
+    self.send_response(404 if size is None else 200)
+    self.send_header('Content-Length', str(size or 0))
+    self.end_headers()
+
+
+class _LoadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class _FakeLoadMonitor(object):
+
+  def __init__(self, report):
+    self.report = report
+
+  def GetReport(self):
+    return self.report
+
+
+class LoadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('mirror_selector_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def testGetDiskQueueDepth(self):
+    device = os.stat(self.test_dir).st_dev
+    diskstats = os.path.join(self.test_dir, 'diskstats')
+    with open(diskstats, 'w') as f:
+      f.write('   1       0 ram0 0 0 0 0 0 0 0 0 9 0 0\n')
+      f.write('%4d %7d sda1 10 0 80 5 20 0 160 30 3 35 35\n' %
+              (os.major(device), os.minor(device)))
+    self.assertEqual(
+        mirror_selector.GetDiskQueueDepth(self.test_dir, diskstats), 3)
+    self.assertEqual(mirror_selector.GetDiskQueueDepth(
+        self.test_dir, os.path.join(self.test_dir, 'missing')), None)
+
+  def testGetLoadScore(self):
+    self.assertEqual(mirror_selector.GetLoadScore({}), 0)
+    self.assertEqual(mirror_selector.GetLoadScore(
+        {'active_downloads': 2,
+         'egress_bytes_per_sec': mirror_selector.EGRESS_BYTES_PER_DOWNLOAD,
+         'disk_queue_depth': None}), 3)
+
+  def testEgressRate(self):
+    monitor = mirror_selector.LoadMonitor(self.test_dir, egress_window=10)
+    self.assertEqual(monitor._GetEgressRate(100, 0), 0)
+    self.assertEqual(monitor._GetEgressRate(105, 500), 100)
+    self.assertEqual(monitor._GetEgressRate(110, 1000), 100)
+    # Samples older than the window are dropped.
+    self.assertEqual(monitor._GetEgressRate(120, 1000), 0)
+    report = monitor.GetReport()
+    self.assertEqual(set(report), set(['active_downloads',
+                                       'egress_bytes_per_sec',
+                                       'disk_queue_depth']))
+
+
+class MirrorSelectorTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = _LoadServer(('127.0.0.1', 0), _LoadHandler)
+    self._server.report = {'active_downloads': 1}
+    self._server.files = {}
+    self._server.heads = 0
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.start()
+    self._mirror = 'http://127.0.0.1:%d' % self._server.server_address[1]
+    self._dead_mirror = 'http://127.0.0.1:1'
+    self._local = _FakeLoadMonitor({'active_downloads': 3})
+    self._selector = mirror_selector.MirrorSelector(
+        [self._mirror + '/', self._dead_mirror], self._local)
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+  def testRankMirrors(self):
+    # Without reports, only this devserver is known to be up.
+    self.assertEqual(self._selector.RankMirrors(1), [None])
+
+    self._selector.RefreshReports()
+    self.assertEqual(self._selector.RankMirrors(),
+                     [self._mirror, None, self._dead_mirror])
+    # URLs offered count as downloads until the next report, which spreads
+    # further update checks across the mirrors.
+    self.assertEqual(self._selector.RankMirrors(1), [self._mirror])
+    first = [self._selector.RankMirrors(1)[0] for _ in range(10)]
+    self.assertEqual(set(first), set([self._mirror, None]))
+    status = self._selector.GetStatus()
+    self.assertTrue(abs(status[self._mirror]['score'] -
+                        status['local']['score']) <= 1)
+
+    self.assertEqual(status[self._mirror]['report'], {'active_downloads': 1})
+    self.assertFalse(status[self._dead_mirror]['available'])
+    self.assertEqual(status[self._dead_mirror]['errors'], 1)
+    self.assertEqual(status['local']['score'],
+                     3 + status['local']['assigned'])
+
+    # A new report replaces the estimate.
+    self._server.report = {'active_downloads': 5}
+    self._selector.RefreshReports()
+    self.assertEqual(self._selector.RankMirrors(2), [None, self._mirror])
+
+  def testStaleReports(self):
+    self._selector.RefreshReports()
+    self._selector.max_report_age = -1
+    self.assertEqual(self._selector.RankMirrors(1), [None])
+
+  def testOnlyMirrorsWithFile(self):
+    self.assertRaises(mirror_selector.MirrorSelectorError,
+                      mirror_selector.MirrorSelector, [self._mirror],
+                      self._local, max_urls=0)
+    self._selector.RefreshReports()
+    path = '/static/archive/update.gz'
+    self.assertEqual(self._selector.RankMirrors(path=path, size=10), [None])
+    self._server.files[path] = 5
+    self._selector.file_check_ttl = 0
+    self.assertEqual(self._selector.RankMirrors(path=path, size=10), [None])
+    self._server.files[path] = 10
+    self.assertEqual(self._selector.RankMirrors(path=path, size=10),
+                     [self._mirror, None])
+
+    # Checks are remembered for a while.
+    self._selector.file_check_ttl = 60
+    heads = self._server.heads
+    self._server.files.clear()
+    self.assertEqual(self._selector.RankMirrors(path=path, size=10),
+                     [self._mirror, None])
+    self.assertEqual(self._server.heads, heads)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,431 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A dedicated HTTP server for serving large static update payloads.
+
+CherryPy's staticdir tool copies every payload through Python userspace on one
+of the threads of the (fixed size) server thread pool, so a few hundred clients
+downloading multi-GB payloads can starve update pings. This module provides a
+standalone threaded server that serves the same /static tree using zero-copy
+sendfile(2) where available, honors Range/If-Range so interrupted downloads can
+be resumed, and keeps per-payload transfer statistics.
+"""
+
+import BaseHTTPServer
+import contextlib
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import mimetypes
+import os
+import posixpath
+import select
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+import time
+import urllib
+
+from cherrypy.process import plugins
+
+import log_util
+import metrics
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD', message, *args)
+
+
+def _GetLibcSendfile():
+  """Returns a wrapper of the C library's sendfile(2), or None on failure.
+
+  The wrapper has the same interface as os.sendfile() in newer Pythons.
+  """
+  if not sys.platform.startswith('linux'):
+    return None
+
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc_sendfile = libc.sendfile64
+  except (OSError, AttributeError):
+    return None
+
+  libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  libc_sendfile.restype = ctypes.c_ssize_t
+
+  def _LibcSendfile(out_fd, in_fd, offset, count):
+    c_offset = ctypes.c_int64(offset)
+    num_bytes = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if num_bytes < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return num_bytes
+
+  return _LibcSendfile
+
+
+try:
+  # Python 3.3+.
+  from os import sendfile as _sendfile
+except ImportError:
+  try:
+    # The pysendfile module, which provides the same interface.
+    from sendfile import sendfile as _sendfile
+  except ImportError:
+    _sendfile = _GetLibcSendfile()
+
+
+STATIC_URL_PREFIX = '/static/'
+
+# Maximum number of bytes handed to a single sendfile/read call.
+_CHUNK_SIZE = 1024 * 1024
+
+
+class PayloadServerError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+class RangeNotSatisfiable(PayloadServerError):
+  """Raised when a requested byte range lies beyond the end of the file."""
+  pass
+
+
+def ParseRange(range_header, file_size):
+  """Parses an HTTP Range header for a file of a given size.
+
+  Only a single byte range is supported; multiple ranges (and malformed
+  headers) are ignored, which per RFC 2616 means the full entity is served.
+
+  Args:
+    range_header: value of the Range header, e.g. 'bytes=100-199'.
+    file_size: size of the requested file in bytes.
+  Returns:
+    A tuple (first, last) of inclusive byte offsets, or None if the whole file
+    should be served.
+  Raises:
+    RangeNotSatisfiable: if the range starts beyond the end of the file.
+  """
+  if not range_header:
+    return None
+
+  units, _, byte_range = range_header.strip().partition('=')
+  if units.strip() != 'bytes' or ',' in byte_range:
+    return None
+
+  first, sep, last = byte_range.strip().partition('-')
+  if not sep:
+    return None
+
+  try:
+    if not first:
+      # Suffix range: the final |last| bytes of the file.
+      suffix_length = int(last)
+      if suffix_length <= 0:
+        raise RangeNotSatisfiable(range_header)
+      return max(0, file_size - suffix_length), file_size - 1
+
+    first = int(first)
+    last = int(last) if last else file_size - 1
+  except ValueError:
+    return None
+
+  if first >= file_size:
+    raise RangeNotSatisfiable(range_header)
+  if last < first:
+    return None
+
+  return first, min(last, file_size - 1)
+
+
+def GetETag(file_stat):
+  """Returns a strong entity tag for a file given its os.stat() result."""
+  return '"%x-%x-%x"' % (file_stat.st_ino, file_stat.st_size,
+                         int(file_stat.st_mtime))
+
+
+def _WaitWritable(sock_fd, timeout):
+  """Blocks until |sock_fd| is writable, raises socket.timeout otherwise."""
+  _, writable, _ = select.select([], [sock_fd], [], timeout)
+  if not writable:
+    raise socket.timeout('timed out sending payload')
+
+
+def SendFileRange(sock, file_obj, offset, count, timeout=None):
+  """Copies |count| bytes of |file_obj| starting at |offset| to |sock|.
+
+  Uses sendfile(2) when available so the data never enters userspace, and
+  falls back to a plain read/send loop otherwise.
+
+  Args:
+    sock: a connected socket object.
+    file_obj: a file object opened for reading.
+    offset: offset within the file to start sending from.
+    count: number of bytes to send.
+    timeout: seconds to wait for the socket to become writable.
+  Returns:
+    The number of bytes actually sent.
+  """
+  sent = 0
+  if _sendfile:
+    sock_fd = sock.fileno()
+    file_fd = file_obj.fileno()
+    while sent < count:
+      try:
+        num_bytes = _sendfile(sock_fd, file_fd, offset + sent,
+                              min(_CHUNK_SIZE, count - sent))
+      except (OSError, IOError) as e:
+        if e.errno == errno.EAGAIN:
+          _WaitWritable(sock_fd, timeout)
+          continue
+        raise
+      if not num_bytes:
+        # The file got truncated underneath us.
+        break
+      sent += num_bytes
+  else:
+    file_obj.seek(offset)
+    while sent < count:
+      block = file_obj.read(min(_CHUNK_SIZE, count - sent))
+      if not block:
+        break
+      sock.sendall(block)
+      sent += len(block)
+
+  return sent
+
+
+class PayloadStats(object):
+  """Thread-safe per-payload transfer statistics.
+
+  Members:
+    payloads: dictionary of statistics keyed by payload path relative to the
+              static directory.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.payloads = {}
+
+  def _Get(self, path):
+    return self.payloads.setdefault(
+        path, {'requests': 0, 'bytes_served': 0, 'active': 0})
+
+  def StartDownload(self, path):
+    """Records the start of a transfer of |path|."""
+    with self._lock:
+      entry = self._Get(path)
+      entry['requests'] += 1
+      entry['active'] += 1
+    metrics.ACTIVE_DOWNLOADS.Inc(('payload',))
+
+  def EndDownload(self, path, bytes_served):
+    """Records the end of a transfer of |path|."""
+    with self._lock:
+      entry = self._Get(path)
+      entry['active'] -= 1
+      entry['bytes_served'] += bytes_served
+    metrics.ACTIVE_DOWNLOADS.Dec(('payload',))
+    metrics.STATIC_BYTES.Inc(('payload',), bytes_served)
+
+  def GetActiveDownloads(self):
+    """Returns the total number of transfers currently in progress."""
+    with self._lock:
+      return sum(entry['active'] for entry in self.payloads.itervalues())
+
+  def GetStats(self):
+    """Returns a copy of the statistics, keyed by payload path."""
+    with self._lock:
+      return dict((path, dict(entry))
+                  for path, entry in self.payloads.iteritems())
+
+
+class PayloadRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves GET and HEAD requests for files under the static directory."""
+
+  protocol_version = 'HTTP/1.1'
+  server_version = 'DevServerPayload/1.0'
+
+  # Seconds of inactivity after which an idle or stalled connection is closed.
+  timeout = 60
+
+  def log_message(self, fmt, *args):
+    _Log('%s %s', self.client_address[0], fmt % args)
+
+  def _ResolvePath(self):
+    """Maps the request path onto a file, returns (relative, full) paths."""
+    path = urllib.unquote(self.path.split('?', 1)[0].split('#', 1)[0])
+    if not path.startswith(STATIC_URL_PREFIX):
+      return None, None
+
+    rel_path = posixpath.normpath(path[len(STATIC_URL_PREFIX):]).lstrip('/')
+    if (not rel_path or rel_path == '.' or rel_path == os.pardir or
+        rel_path.startswith(os.pardir + '/')):
+      return None, None
+
+    return rel_path, os.path.join(self.server.static_dir, rel_path)
+
+  def _SendError(self, code, extra_headers=None):
+    """Sends a body-less error response that keeps the connection usable."""
+    self.send_response(code)
+    for name, value in (extra_headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def _IsRangeValid(self, etag, last_modified):
+    """Returns True iff the If-Range precondition (if any) holds."""
+    if_range = self.headers.getheader('If-Range')
+    if not if_range:
+      return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+      return if_range == etag
+    return if_range == last_modified
+
+  @contextlib.contextmanager
+  def _Pinned(self, file_path):
+    """Keeps the payload cache entry of |file_path|, if any, from eviction."""
+    if self.server.cache_manager:
+      with self.server.cache_manager.Pinned(file_path):
+        yield
+    else:
+      yield
+
+  def _ServeFile(self, send_body):
+    rel_path, file_path = self._ResolvePath()
+    if not file_path:
+      self._SendError(404)
+      return
+
+    try:
+      file_obj = open(file_path, 'rb')
+    except IOError as e:
+      self._SendError(403 if e.errno == errno.EACCES else 404)
+      return
+
+    with file_obj, self._Pinned(file_path):
+      file_stat = os.fstat(file_obj.fileno())
+      if not stat.S_ISREG(file_stat.st_mode):
+        self._SendError(404)
+        return
+
+      file_size = file_stat.st_size
+      etag = GetETag(file_stat)
+      last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+
+      byte_range = None
+      if self._IsRangeValid(etag, last_modified):
+        try:
+          byte_range = ParseRange(self.headers.getheader('Range'), file_size)
+        except RangeNotSatisfiable:
+          self._SendError(416, {'Content-Range': 'bytes */%d' % file_size})
+          return
+
+      if byte_range:
+        first, last = byte_range
+        self.send_response(206)
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (first, last, file_size))
+      else:
+        first, last = 0, file_size - 1
+        self.send_response(200)
+
+      count = last - first + 1
+      content_type = (mimetypes.guess_type(file_path)[0] or
+                      'application/octet-stream')
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(count))
+      self.send_header('Accept-Ranges', 'bytes')
+      self.send_header('ETag', etag)
+      self.send_header('Last-Modified', last_modified)
+      self.end_headers()
+      self.wfile.flush()
+
+      if not send_body or not count:
+        return
+
+      self.server.stats.StartDownload(rel_path)
+      sent = 0
+      start_time = time.time()
+      try:
+        sent = SendFileRange(self.connection, file_obj, first, count,
+                             timeout=self.timeout)
+      finally:
+        self.server.stats.EndDownload(rel_path, sent)
+        _Log('Served %d/%d bytes of %s to %s in %.1f seconds', sent, count,
+             rel_path, self.client_address[0], time.time() - start_time)
+
+      if sent < count:
+        # We can't pad the response, so the connection must not be reused.
+        self.close_connection = 1
+
+  def do_GET(self):
+    self._ServeFile(send_body=True)
+
+  def do_HEAD(self):
+    self._ServeFile(send_body=False)
+
+
+class PayloadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A thread-per-connection HTTP server for the static payload directory.
+
+  Each download gets its own thread rather than a slot from a shared, fixed
+  size pool, so long transfers never block other requests.
+
+  Members:
+    static_dir:    directory that /static/ URLs are mapped onto.
+    stats:         PayloadStats object recording transfers.
+    cache_manager: CacheManager of the payload cache, if any; cached payloads
+                   are not evicted while being downloaded.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, server_address, static_dir, cache_manager=None):
+    if ':' in server_address[0]:
+      self.address_family = socket.AF_INET6
+    BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                       PayloadRequestHandler)
+    self.static_dir = static_dir
+    self.stats = PayloadStats()
+    self.cache_manager = cache_manager
+
+  def handle_error(self, request, client_address):
+    # Clients dropping out mid-transfer are routine, don't dump tracebacks.
+    _Log('Error while serving %s, connection dropped', client_address[0])
+
+
+class PayloadServerPlugin(plugins.SimplePlugin):
+  """Runs a PayloadServer alongside the CherryPy engine."""
+
+  def __init__(self, bus, server):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.server = server
+    self._thread = None
+
+  def start(self):
+    _Log('Serving payloads from %s on port %d (sendfile %s)',
+         self.server.static_dir, self.server.server_address[1],
+         'enabled' if _sendfile else 'unavailable')
+    self._thread = threading.Thread(target=self.server.serve_forever,
+                                    name='PayloadServer')
+    self._thread.daemon = True
+    self._thread.start()
+  # Start before the main HTTP server so payload URLs are valid immediately.
+  start.priority = 70
+
+  def stop(self):
+    if self._thread:
+      self.server.shutdown()
+      self._thread.join()
+      self._thread = None
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_server module."""
+
+import httplib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import payload_server
+
+
+_PAYLOAD = ''.join(chr(i % 256) for i in range(100000))
+
+
+class ParseRangeTest(unittest.TestCase):
+
+  def testNoRange(self):
+    self.assertEqual(payload_server.ParseRange(None, 100), None)
+    self.assertEqual(payload_server.ParseRange('', 100), None)
+
+  def testSimpleRanges(self):
+    self.assertEqual(payload_server.ParseRange('bytes=0-9', 100), (0, 9))
+    self.assertEqual(payload_server.ParseRange('bytes=90-', 100), (90, 99))
+    self.assertEqual(payload_server.ParseRange('bytes=90-200', 100), (90, 99))
+    self.assertEqual(payload_server.ParseRange('bytes=-10', 100), (90, 99))
+    self.assertEqual(payload_server.ParseRange('bytes=-200', 100), (0, 99))
+
+  def testIgnoredRanges(self):
+    self.assertEqual(payload_server.ParseRange('bytes=0-1,5-6', 100), None)
+    self.assertEqual(payload_server.ParseRange('items=0-1', 100), None)
+    self.assertEqual(payload_server.ParseRange('bytes=a-b', 100), None)
+    self.assertEqual(payload_server.ParseRange('bytes=9-1', 100), None)
+
+  def testUnsatisfiableRanges(self):
+    self.assertRaises(payload_server.RangeNotSatisfiable,
+                      payload_server.ParseRange, 'bytes=100-', 100)
+    self.assertRaises(payload_server.RangeNotSatisfiable,
+                      payload_server.ParseRange, 'bytes=-0', 100)
+
+
+class PayloadServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._static_dir = tempfile.mkdtemp('payload_server_unittest')
+    os.makedirs(os.path.join(self._static_dir, 'some', 'build'))
+    with open(os.path.join(self._static_dir, 'some', 'build', 'update.gz'),
+              'wb') as f:
+      f.write(_PAYLOAD)
+
+    self._server = payload_server.PayloadServer(('127.0.0.1', 0),
+                                                self._static_dir)
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.start()
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+    shutil.rmtree(self._static_dir)
+
+  def _Request(self, path, headers=None, method='GET'):
+    conn = httplib.HTTPConnection('127.0.0.1', self._server.server_address[1])
+    try:
+      conn.request(method, path, headers=headers or {})
+      response = conn.getresponse()
+      return response, response.read()
+    finally:
+      conn.close()
+
+  def testFullDownload(self):
+    response, body = self._Request('/static/some/build/update.gz')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, _PAYLOAD)
+    self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+    # The server thread ends the download after the client has read it all.
+    for _ in range(500):
+      stats = self._server.stats.GetStats()
+      if stats.get('some/build/update.gz', {}).get('active') == 0:
+        break
+      time.sleep(0.01)
+    self.assertEqual(
+        stats,
+        {'some/build/update.gz':
+         {'requests': 1, 'bytes_served': len(_PAYLOAD), 'active': 0}})
+
+  def testHead(self):
+    response, body = self._Request('/static/some/build/update.gz',
+                                   method='HEAD')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, '')
+    self.assertEqual(int(response.getheader('Content-Length')), len(_PAYLOAD))
+
+  def testResumeDownload(self):
+    response, _ = self._Request('/static/some/build/update.gz', method='HEAD')
+    etag = response.getheader('ETag')
+
+    response, body = self._Request('/static/some/build/update.gz',
+                                   {'Range': 'bytes=1000-', 'If-Range': etag})
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, _PAYLOAD[1000:])
+    self.assertEqual(response.getheader('Content-Range'),
+                     'bytes 1000-%d/%d' % (len(_PAYLOAD) - 1, len(_PAYLOAD)))
+
+  def testStaleIfRange(self):
+    response, body = self._Request('/static/some/build/update.gz',
+                                   {'Range': 'bytes=1000-',
+                                    'If-Range': '"stale"'})
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, _PAYLOAD)
+
+  def testUnsatisfiableRange(self):
+    response, _ = self._Request('/static/some/build/update.gz',
+                                {'Range': 'bytes=%d-' % len(_PAYLOAD)})
+    self.assertEqual(response.status, 416)
+    self.assertEqual(response.getheader('Content-Range'),
+                     'bytes */%d' % len(_PAYLOAD))
+
+  def testBadPaths(self):
+    for path in ['/static/missing', '/static/some/build', '/other/update.gz',
+                 '/static/../payload_server.py', '/static/some/../..']:
+      response, _ = self._Request(path)
+      self.assertEqual(response.status, 404)
+
+
+if __name__ == '__main__':
+  unittest.main()
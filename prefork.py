@@ -0,0 +1,144 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Pre-forked, multi-process serving of a CherryPy application.
+
+A single CherryPy process can only use one core for request processing. This
+module binds the listening socket once and then forks a number of worker
+processes that each run a full CherryPy engine accepting connections on that
+shared socket. The parent process only supervises the workers, restarting any
+that die unexpectedly.
+"""
+
+import multiprocessing
+import signal
+import socket
+import time
+
+import cherrypy
+from cherrypy import _cpwsgi_server
+from cherrypy.process import servers
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREFORK', message, *args)
+
+
+# Seconds between checks of the workers' health.
+_SUPERVISE_INTERVAL = 1
+
+
+def BindSocket(host, port, backlog=socket.SOMAXCONN):
+  """Returns a listening TCP socket bound to (host, port).
+
+  If |host| is the IPv6 wildcard address, the socket also accepts IPv4
+  connections.
+  """
+  family = socket.AF_INET6 if ':' in host else socket.AF_INET
+  sock = socket.socket(family, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if family == socket.AF_INET6 and host in ('::', '::0', '::0.0.0.0'):
+    try:
+      sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    except (AttributeError, socket.error):
+      pass
+  sock.bind((host, port))
+  sock.listen(backlog)
+  return sock
+
+
+class _PreboundWSGIServer(_cpwsgi_server.CPWSGIServer):
+  """A CherryPy WSGI server that accepts on an inherited, bound socket."""
+
+  def __init__(self, listen_socket):
+    _cpwsgi_server.CPWSGIServer.__init__(self, cherrypy.server)
+    self._listen_socket = listen_socket
+
+  def bind(self, family, type, proto=0):
+    # pylint: disable=W0622
+    self.socket = self._listen_socket
+
+
+def _RunWorker(root, config, listen_socket, plugins):
+  """Runs a CherryPy engine serving |root| on |listen_socket| until stopped.
+
+  |plugins| are subscribed to the engine of this worker only.
+  """
+  cherrypy.config.update(config)
+  # Restarting in place makes no sense for a forked worker.
+  cherrypy.config.update({'engine.autoreload.on': False})
+  cherrypy.tree.mount(root, '', config)
+
+  # Replace the default server, which would try to bind its own socket.
+  cherrypy.server.unsubscribe()
+  servers.ServerAdapter(cherrypy.engine,
+                        _PreboundWSGIServer(listen_socket)).subscribe()
+  for plugin in plugins:
+    plugin.subscribe()
+
+  def _Exit(_signum, _frame):
+    # Both the supervisor and the terminal may signal us; exit only once.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cherrypy.engine.exit()
+
+  signal.signal(signal.SIGTERM, _Exit)
+  signal.signal(signal.SIGINT, _Exit)
+
+  cherrypy.engine.start()
+  cherrypy.engine.block()
+
+
+def Serve(root, config, num_workers, first_worker_plugins=()):
+  """Serves a CherryPy application from |num_workers| processes.
+
+  Plugins subscribed to cherrypy.engine before calling this are started in
+  every worker, so any sockets they listen on must be bound beforehand.
+
+  Args:
+    root: the root object of the application.
+    config: the application configuration, as for cherrypy.quickstart().
+    num_workers: number of worker processes to run.
+    first_worker_plugins: plugins, not subscribed yet, to only start in the
+                          first worker, e.g. background jobs that must not run
+                          in several processes at once.
+  """
+  global_config = config['global']
+  listen_socket = BindSocket(global_config['server.socket_host'],
+                             global_config['server.socket_port'])
+  stopping = []
+
+  def _StartWorker(index):
+    plugins = first_worker_plugins if index == 0 else ()
+    worker = multiprocessing.Process(
+        target=_RunWorker, args=(root, config, listen_socket, plugins))
+    worker.start()
+    _Log('Started worker process %d', worker.pid)
+    return worker
+
+  def _Stop(signum, _frame):
+    _Log('Received signal %d, stopping workers', signum)
+    stopping.append(signum)
+
+  signal.signal(signal.SIGTERM, _Stop)
+  signal.signal(signal.SIGINT, _Stop)
+
+  workers = [_StartWorker(index) for index in range(num_workers)]
+  while not stopping:
+    time.sleep(_SUPERVISE_INTERVAL)
+    for index, worker in enumerate(workers):
+      if not worker.is_alive() and not stopping:
+        _Log('Worker process %d exited with code %s, restarting', worker.pid,
+             worker.exitcode)
+        workers[index] = _StartWorker(index)
+
+  for worker in workers:
+    if worker.is_alive():
+      worker.terminate()
+  for worker in workers:
+    worker.join()
+  listen_socket.close()
@@ -0,0 +1,294 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Profiling of a running devserver.
+
+Two tools find where request time goes under real traffic:
+  - A single request can be run under cProfile, and its profile saved to a
+    directory for later inspection with pstats.
+  - A sampling profiler periodically records the Python stack of every
+    thread. It can be started and stopped at runtime, costs little while
+    running and nothing otherwise, and reports how often each stack was seen
+    in the collapsed format used by flame graph tools.
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import StringIO
+import sys
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PROFILE', message, *args)
+
+
+# Default number of seconds between stack samples.
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+# Default number of distinct stacks recorded; others are counted together.
+DEFAULT_MAX_STACKS = 10000
+
+# Default number of request profiles kept.
+DEFAULT_MAX_PROFILES = 100
+
+_PROFILE_SUFFIX = '.prof'
+
+# Stack that samples go under once the maximum number of stacks is reached.
+_OTHER_STACK = ('(other)',)
+
+
+class ProfilingError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+class ProfileStore(object):
+  """A directory of saved request profiles, the oldest removed first.
+
+  Members:
+    profile_dir:  directory holding the profiles.
+    max_profiles: number of profiles kept.
+  """
+
+  def __init__(self, profile_dir, max_profiles=DEFAULT_MAX_PROFILES):
+    self.profile_dir = profile_dir
+    self.max_profiles = max_profiles
+    self._lock = threading.Lock()
+    self._count = 0
+
+  def NewName(self, label):
+    """Returns a unique name for the profile of a request to |label|."""
+    with self._lock:
+      self._count += 1
+      count = self._count
+    return '%s-%d-%d-%s%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                              count, label.replace('/', '_'), _PROFILE_SUFFIX)
+
+  def _GetPath(self, name):
+    """Returns the path of profile |name|.
+
+    Raises:
+      ProfilingError if |name| is not that of a profile.
+    """
+    if (os.path.basename(name) != name or not name.endswith(_PROFILE_SUFFIX)
+        or name.startswith('.')):
+      raise ProfilingError('Invalid profile name %s' % name)
+    return os.path.join(self.profile_dir, name)
+
+  def List(self):
+    """Returns the names of the saved profiles, oldest first."""
+    try:
+      names = os.listdir(self.profile_dir)
+    except OSError:
+      return []
+    paths = [os.path.join(self.profile_dir, name) for name in names
+             if name.endswith(_PROFILE_SUFFIX)]
+    mtimes = []
+    for path in paths:
+      try:
+        mtimes.append((os.path.getmtime(path), os.path.basename(path)))
+      except OSError:
+        # Removed in the meantime.
+        pass
+    return [name for _, name in sorted(mtimes)]
+
+  def Save(self, name, profile):
+    """Saves |profile|, a cProfile.Profile, as |name|."""
+    if not os.path.isdir(self.profile_dir):
+      try:
+        os.makedirs(self.profile_dir)
+      except OSError:
+        # Created by another worker in the meantime.
+        pass
+    profile.dump_stats(self._GetPath(name))
+    for old_name in self.List()[:-self.max_profiles]:
+      try:
+        os.remove(self._GetPath(old_name))
+      except OSError:
+        pass
+
+  def Format(self, name, sort='cumulative', limit=50):
+    """Returns the statistics of profile |name| as text.
+
+    Args:
+      name: name of the profile.
+      sort: pstats sort key, e.g. cumulative, time or calls.
+      limit: number of functions to include.
+    Raises:
+      ProfilingError if there is no such profile or sort key.
+    """
+    path = self._GetPath(name)
+    if not os.path.exists(path):
+      raise ProfilingError('No profile %s' % name)
+    output = StringIO.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    try:
+      stats.sort_stats(sort)
+    except KeyError:
+      raise ProfilingError('Invalid sort key %s' % sort)
+    stats.print_stats(limit)
+    return output.getvalue()
+
+
+class _ProfiledIterator(object):
+  """Iterates under a profiler, saving the profile once exhausted."""
+
+  def __init__(self, profile, iterable, on_done):
+    self._profile = profile
+    self._iterator = iter(iterable)
+    self._on_done = on_done
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    self._profile.enable()
+    try:
+      return self._iterator.next()
+    except StopIteration:
+      self._Done()
+      raise
+    finally:
+      self._profile.disable()
+
+  def close(self):
+    # Called when the client goes away before the end of the response.
+    if hasattr(self._iterator, 'close'):
+      self._iterator.close()
+    self._Done()
+
+  def _Done(self):
+    if self._on_done:
+      on_done, self._on_done = self._on_done, None
+      on_done(self._profile)
+
+
+def ProfileCall(func, on_done):
+  """Calls |func| under cProfile.
+
+  If |func| returns an iterator, such as a generator streaming a response,
+  the profile covers its iteration too.
+
+  Args:
+    func: callable taking no arguments.
+    on_done: callable taking the cProfile.Profile, called once the profile is
+             complete.
+  Returns:
+    What |func| returns, or an iterator over what it returns.
+  """
+  profile = cProfile.Profile()
+  result = profile.runcall(func)
+  if hasattr(result, 'next'):
+    return _ProfiledIterator(profile, result, on_done)
+  on_done(profile)
+  return result
+
+
+def _GetFrameName(frame):
+  """Returns the name of |frame| in a collapsed stack."""
+  code = frame.f_code
+  return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler(object):
+  """Periodically records the stacks of all threads of this process."""
+
+  def __init__(self, max_stacks=DEFAULT_MAX_STACKS):
+    """Initializes the profiler, which is not running.
+
+    Args:
+      max_stacks: number of distinct stacks recorded; samples of further
+                  stacks are counted as (other).
+    """
+    self._max_stacks = max_stacks
+    self._lock = threading.Lock()
+    self._counts = collections.Counter()
+    self._samples = 0
+    self._interval = None
+    self._thread = None
+    self._stopping = None
+
+  def _Sample(self):
+    """Records the current stack of every other thread."""
+    own_id = threading.current_thread().ident
+    stacks = []
+    for thread_id, frame in sys._current_frames().iteritems():
+      if thread_id == own_id:
+        continue
+      stack = []
+      while frame:
+        stack.append(_GetFrameName(frame))
+        frame = frame.f_back
+      stack.reverse()
+      stacks.append(tuple(stack))
+
+    with self._lock:
+      self._samples += 1
+      for stack in stacks:
+        if stack not in self._counts and len(self._counts) >= self._max_stacks:
+          stack = _OTHER_STACK
+        self._counts[stack] += 1
+
+  def _Run(self, interval, stopping):
+    while not stopping.wait(interval):
+      self._Sample()
+
+  def Start(self, interval=DEFAULT_SAMPLE_INTERVAL):
+    """Starts sampling every |interval| seconds, or changes the interval."""
+    if interval <= 0:
+      raise ProfilingError('Invalid sampling interval %s' % interval)
+    with self._lock:
+      if self._thread:
+        self._stopping.set()
+      self._interval = interval
+      self._stopping = threading.Event()
+      self._thread = threading.Thread(target=self._Run,
+                                      args=(interval, self._stopping),
+                                      name='SamplingProfiler')
+      self._thread.daemon = True
+      self._thread.start()
+    _Log('Sampling stacks every %s seconds', interval)
+
+  def Stop(self):
+    """Stops sampling, keeping the samples recorded so far."""
+    with self._lock:
+      if not self._thread:
+        return
+      self._stopping.set()
+      self._thread = None
+      self._interval = None
+    _Log('Stopped sampling stacks')
+
+  def Clear(self):
+    """Forgets the samples recorded so far."""
+    with self._lock:
+      self._counts.clear()
+      self._samples = 0
+
+  def GetStatus(self):
+    """Returns a dictionary describing the state of the profiler."""
+    with self._lock:
+      return {'running': self._thread is not None,
+              'interval': self._interval,
+              'samples': self._samples,
+              'stacks': len(self._counts)}
+
+  def Dump(self):
+    """Returns the recorded stacks in the collapsed format.
+
+    Each line holds the frames of a stack, outermost first and separated by
+    semicolons, followed by the number of times it was seen; the most frequent
+    stacks come first.
+    """
+    with self._lock:
+      counts = self._counts.most_common()
+    return ''.join('%s %d\n' % (';'.join(stack), count)
+                   for stack, count in counts)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for profiling module."""
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import profiling
+
+
+def _Busy():
+  return sum(range(1000))
+
+
+class ProfileStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp('profiling_unittest')
+    self.store = profiling.ProfileStore(self.test_dir, max_profiles=2)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Save(self, profile):
+    name = self.store.NewName('api/fileinfo')
+    self.store.Save(name, profile)
+    self.saved.append(name)
+
+  def testProfileCall(self):
+    self.saved = []
+    self.assertEqual(profiling.ProfileCall(_Busy, self._Save), 499500)
+
+    def _Stream():
+      yield 'a'
+      _Busy()
+      yield 'b'
+
+    chunks = profiling.ProfileCall(_Stream, self._Save)
+    self.assertEqual(len(self.saved), 1)
+    self.assertEqual(list(chunks), ['a', 'b'])
+    self.assertEqual(len(self.saved), 2)
+    self.assertTrue(self.saved[1].endswith('api_fileinfo.prof'))
+    self.assertEqual(self.store.List(), self.saved)
+    self.assertTrue('_Busy' in self.store.Format(self.saved[1], sort='time'))
+
+    # Only the most recent profiles are kept.
+    time.sleep(0.01)
+    profiling.ProfileCall(_Busy, self._Save)
+    self.assertEqual(self.store.List(), self.saved[1:])
+
+  def testInvalidNames(self):
+    self.assertRaises(profiling.ProfilingError, self.store.Format,
+                      '../secret.prof')
+    self.assertRaises(profiling.ProfilingError, self.store.Format,
+                      'devserver.py')
+    self.assertRaises(profiling.ProfilingError, self.store.Format,
+                      'missing.prof')
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+  def testSampling(self):
+    stopping = threading.Event()
+
+    def _Spin():
+      while not stopping.is_set():
+        _Busy()
+
+    spinner = threading.Thread(target=_Spin)
+    spinner.start()
+    sampler = profiling.SamplingProfiler(max_stacks=100)
+    try:
+      sampler.Start(0.001)
+      for _ in range(1000):
+        if sampler.GetStatus()['samples'] >= 10:
+          break
+        time.sleep(0.01)
+      sampler.Stop()
+    finally:
+      stopping.set()
+      spinner.join()
+
+    status = sampler.GetStatus()
+    self.assertFalse(status['running'])
+    self.assertTrue(status['samples'] >= 10)
+    self.assertTrue('profiling_unittest.py:_Spin' in sampler.Dump())
+
+    sampler.Clear()
+    self.assertEqual(sampler.Dump(), '')
+    self.assertRaises(profiling.ProfilingError, sampler.Start, 0)
+
+  def testMaxStacks(self):
+    stopping = threading.Event()
+    waiter = threading.Thread(target=stopping.wait)
+    waiter.start()
+    try:
+      sampler = profiling.SamplingProfiler(max_stacks=0)
+      sampler._Sample()
+    finally:
+      stopping.set()
+      waiter.join()
+    self.assertEqual(sampler.Dump(), '(other) 1\n')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,192 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Symbolication of minidumps using pre-downloaded symbols.
+
+Symbolicating a minidump runs minidump_stackwalk, which takes a while, and
+crashing tests tend to upload the same dump many times over. Dumps are
+symbolicated on a bounded pool of workers, at most once at a time per dump
+content, and the resulting stack traces are cached by the digest of the dump
+for as long as the symbols do not change.
+"""
+
+import collections
+import hashlib
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+from multiprocessing import pool
+
+import generation_scheduler
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('SYMBOLICATE', message, *args)
+
+
+# Default number of minidump_stackwalk processes running at the same time.
+DEFAULT_MAX_WORKERS = multiprocessing.cpu_count()
+
+# Default number of stack traces kept in the cache.
+DEFAULT_MAX_CACHED_TRACES = 256
+
+_READ_BLOCK_SIZE = 65536
+
+
+class SymbolicatorError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def _GetDigest(dump_file):
+  """Returns the SHA-1 hex digest of |dump_file|, from its start."""
+  digest = hashlib.sha1()
+  dump_file.seek(0)
+  while True:
+    data = dump_file.read(_READ_BLOCK_SIZE)
+    if not data:
+      break
+    digest.update(data)
+  dump_file.seek(0)
+  return digest.hexdigest()
+
+
+class Symbolicator(object):
+  """Symbolicates minidumps on a worker pool, caching the stack traces.
+
+  Members:
+    symbols_dir: directory holding the breakpad symbols.
+  """
+
+  def __init__(self, symbols_dir, max_workers=DEFAULT_MAX_WORKERS,
+               max_cached_traces=DEFAULT_MAX_CACHED_TRACES):
+    self.symbols_dir = symbols_dir
+    self._max_workers = max_workers
+    self._max_cached_traces = max_cached_traces
+    self._scheduler = generation_scheduler.GenerationScheduler(
+        max_workers, pool_name='symbolicate')
+    self._lock = threading.Lock()
+    self._traces = collections.OrderedDict()
+    self._hits = 0
+    self._misses = 0
+
+  def _GetSymbolsVersion(self):
+    """Returns a value that changes whenever symbols are added or removed.
+
+    Symbols are stored as <module>/<id>/<module>.sym, so staging new symbols
+    changes the modification time of the symbols dir or of a module dir.
+    """
+    try:
+      latest = os.stat(self.symbols_dir).st_mtime
+      for module in os.listdir(self.symbols_dir):
+        latest = max(latest,
+                     os.stat(os.path.join(self.symbols_dir, module)).st_mtime)
+    except OSError:
+      return None
+    return latest
+
+  def _RunStackwalk(self, dump_path):
+    """Runs minidump_stackwalk on |dump_path|; called on a worker thread."""
+    stackwalk = subprocess.Popen(['minidump_stackwalk', dump_path,
+                                  self.symbols_dir],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+    stack_trace, error_text = stackwalk.communicate()
+    if stackwalk.returncode != 0:
+      raise SymbolicatorError("Can't generate stack trace: %s (rc=%d)" % (
+          error_text, stackwalk.returncode))
+    return stack_trace
+
+  def _Symbolicate(self, dump_file):
+    """Symbolicates the minidump in |dump_file|; called on a worker thread."""
+    try:
+      fileno = dump_file.fileno()
+    except (AttributeError, IOError):
+      fileno = None
+    if fileno is not None:
+      # Let minidump_stackwalk open the uploaded file itself rather than
+      # copying it. Temporary files are not inherited by child processes and
+      # may be unlinked, so go through this process' file descriptor.
+      dump_path = '/proc/%d/fd/%d' % (os.getpid(), fileno)
+      if os.path.exists(dump_path):
+        return self._RunStackwalk(dump_path)
+
+    # Small uploads are kept in memory.
+    with tempfile.NamedTemporaryFile() as local:
+      local.write(dump_file.read())
+      local.flush()
+      return self._RunStackwalk(local.name)
+
+  def Symbolicate(self, dump_file):
+    """Returns the stack trace of a minidump.
+
+    Args:
+      dump_file: file object holding the binary minidump. It must stay open
+                 until this returns.
+    Returns:
+      The symbolicated stack trace, as printed by minidump_stackwalk.
+    Raises:
+      SymbolicatorError if minidump_stackwalk failed.
+    """
+    key = (_GetDigest(dump_file), self._GetSymbolsVersion())
+    with self._lock:
+      stack_trace = self._traces.pop(key, None)
+      if stack_trace is not None:
+        self._hits += 1
+        # Most recently used traces go last.
+        self._traces[key] = stack_trace
+        return stack_trace
+      self._misses += 1
+
+    def _SymbolicateAndCache():
+      stack_trace = self._Symbolicate(dump_file)
+      # Cache the trace before the job completes, so that no request for the
+      # same dump runs another job in between.
+      with self._lock:
+        self._traces[key] = stack_trace
+        while len(self._traces) > self._max_cached_traces:
+          self._traces.popitem(last=False)
+      return stack_trace
+
+    return self._scheduler.Run(key, 'symbolicating minidump %s' % key[0],
+                               _SymbolicateAndCache)
+
+  def SymbolicateAll(self, dumps):
+    """Symbolicates many minidumps in parallel.
+
+    Args:
+      dumps: list of (name, file object) pairs, one per minidump. The files
+             must stay open until the generator is exhausted.
+    Yields:
+      A (name, stack trace, error message) tuple for each minidump, in the
+      order they complete. Either the stack trace or the error message is
+      None.
+    """
+    def _Symbolicate(dump):
+      name, dump_file = dump
+      try:
+        return name, self.Symbolicate(dump_file), None
+      except (SymbolicatorError, EnvironmentError) as e:
+        return name, None, str(e)
+
+    if not dumps:
+      return
+    waiters = pool.ThreadPool(min(len(dumps), self._max_workers))
+    try:
+      for result in waiters.imap_unordered(_Symbolicate, dumps):
+        yield result
+    finally:
+      waiters.terminate()
+
+  def GetStats(self):
+    """Returns a dictionary of symbolication statistics."""
+    with self._lock:
+      return {'cached_traces': len(self._traces),
+              'hits': self._hits,
+              'misses': self._misses,
+              'jobs': self._scheduler.GetStatus()}
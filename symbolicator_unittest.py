@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for symbolicator module."""
+
+import os
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mox
+
+import symbolicator
+
+
+class SymbolicatorTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.symbols_dir = tempfile.mkdtemp('symbolicator_unittest')
+    self.symbolicator = symbolicator.Symbolicator(self.symbols_dir)
+    self.mox.StubOutWithMock(subprocess, 'Popen')
+
+  def tearDown(self):
+    shutil.rmtree(self.symbols_dir)
+
+  def _Dump(self, contents):
+    dump_file = tempfile.TemporaryFile()
+    dump_file.write(contents)
+    dump_file.seek(0)
+    return dump_file
+
+  def _ExpectStackwalk(self, contents, stack_trace, returncode=0):
+    def _ReadsDump(path):
+      with open(path) as dump_file:
+        return dump_file.read() == contents
+
+    process = self.mox.CreateMock(subprocess.Popen)
+    process.returncode = returncode
+    subprocess.Popen(['minidump_stackwalk', mox.Func(_ReadsDump),
+                      self.symbols_dir], stdout=subprocess.PIPE,
+                     stderr=subprocess.PIPE).AndReturn(process)
+    process.communicate().AndReturn((stack_trace, 'error'))
+
+  def testCachesStackTraces(self):
+    self._ExpectStackwalk('dump', 'trace')
+    self._ExpectStackwalk('other dump', 'other trace')
+    # Staging symbols invalidates the cached traces.
+    self._ExpectStackwalk('dump', 'better trace')
+    self.mox.ReplayAll()
+
+    self.assertEqual(self.symbolicator.Symbolicate(self._Dump('dump')),
+                     'trace')
+    self.assertEqual(self.symbolicator.Symbolicate(self._Dump('dump')),
+                     'trace')
+    self.assertEqual(
+        self.symbolicator.Symbolicate(StringIO.StringIO('other dump')),
+        'other trace')
+
+    module_dir = os.path.join(self.symbols_dir, 'chrome')
+    os.mkdir(module_dir)
+    mtime = time.time() + 10
+    os.utime(module_dir, (mtime, mtime))
+    self.assertEqual(self.symbolicator.Symbolicate(self._Dump('dump')),
+                     'better trace')
+    self.mox.VerifyAll()
+
+    stats = self.symbolicator.GetStats()
+    self.assertEqual((stats['cached_traces'], stats['hits'], stats['misses']),
+                     (3, 1, 3))
+
+  def testFailure(self):
+    self._ExpectStackwalk('dump', '', returncode=1)
+    self._ExpectStackwalk('dump', 'trace')
+    self.mox.ReplayAll()
+
+    self.assertRaises(symbolicator.SymbolicatorError,
+                      self.symbolicator.Symbolicate, self._Dump('dump'))
+    # Failures are not cached.
+    self.assertEqual(self.symbolicator.Symbolicate(self._Dump('dump')),
+                     'trace')
+    self.mox.VerifyAll()
+
+  def testSymbolicateAll(self):
+    self._ExpectStackwalk('dump', 'trace')
+    self._ExpectStackwalk('bad dump', '', returncode=1)
+    self.mox.ReplayAll()
+
+    results = self.symbolicator.SymbolicateAll(
+        [('a.dmp', self._Dump('dump')), ('b.dmp', self._Dump('bad dump')),
+         ('c.dmp', self._Dump('dump'))])
+    results = sorted(results)
+    self.mox.VerifyAll()
+    self.assertEqual([result[:2] for result in results],
+                     [('a.dmp', 'trace'), ('b.dmp', None), ('c.dmp', 'trace')])
+    self.assertTrue(results[1][2].startswith("Can't generate stack trace"))
+    self.assertEqual(list(self.symbolicator.SymbolicateAll([])), [])
+
+if __name__ == '__main__':
+  unittest.main()
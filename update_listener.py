@@ -0,0 +1,362 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An event-driven listener for Omaha update and event pings.
+
+The CherryPy front end dedicates a thread to every open connection, so a burst
+of update checks (e.g. a whole lab rebooting at once) competes with long running
+payload downloads for the same fixed size thread pool. This listener multiplexes
+any number of keep-alive connections on a single asyncore loop and only hands
+the actual ping processing (which may generate or hash payloads) to a bounded
+pool of worker threads.
+"""
+
+import asynchat
+import asyncore
+import collections
+import os
+import socket
+import threading
+import urllib
+from multiprocessing import pool
+
+import cherrypy
+from cherrypy._cprequest import Request
+from cherrypy._cprequest import Response
+from cherrypy.lib import httputil
+from cherrypy.process import plugins
+
+import autoupdate_lib
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('LISTENER', message, *args)
+
+
+UPDATE_URL_PREFIX = '/update'
+
+# Default upper bound for the size of a request body.
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+
+# Upper bound for the size of the request line and headers.
+_MAX_HEADER_SIZE = 64 * 1024
+
+_STATUS_MESSAGES = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Request Entity Too Large',
+    500: 'Internal Server Error',
+}
+
+
+def _StripIPv6Mapping(ip):
+  """Returns the IPv4 address for IPv4-mapped IPv6 addresses, |ip| otherwise."""
+  if ip.startswith('::ffff:') and '.' in ip:
+    return ip[len('::ffff:'):]
+  return ip
+
+
+def HandleUpdateRequest(updater, static_port, data, label, client_address,
+                        headers):
+  """Processes an update ping on behalf of the listener.
+
+  Autoupdate derives the client address and the payload URL base from the
+  current CherryPy request, so a request object describing this ping is bound
+  to the calling (worker) thread for the duration of the call.
+
+  Args:
+    updater: the Autoupdate object processing pings.
+    static_port: port of the main devserver, which serves /static.
+    data: the XML body of the ping.
+    label: optional label for the update.
+    client_address: (ip, port) tuple of the client.
+    headers: dictionary of request headers.
+  Returns:
+    The response body.
+  """
+  request = Request(httputil.Host('0.0.0.0', static_port),
+                    httputil.Host(client_address[0], client_address[1]))
+  request.headers = httputil.HeaderMap()
+  request.headers.update(headers)
+  host = headers.get('Host', socket.getfqdn()).rsplit(':', 1)[0]
+  if ':' in host and not host.startswith('['):
+    host = '[%s]' % host
+  request.base = 'http://%s:%d' % (host, static_port)
+  cherrypy.serving.load(request, Response())
+  try:
+    return updater.HandleUpdatePing(data, label)
+  finally:
+    cherrypy.serving.clear()
+
+
+class _Trigger(asyncore.file_dispatcher):
+  """Wakes up the asyncore loop from other threads."""
+
+  def __init__(self, socket_map):
+    self._read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self._read_fd, map=socket_map)
+    os.close(self._read_fd)
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(8192)
+    except (OSError, socket.error):
+      pass
+
+  def Pull(self):
+    """Wakes up the loop; safe to call from any thread."""
+    try:
+      os.write(self._write_fd, 'x')
+    except OSError:
+      pass
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self._write_fd)
+
+
+class UpdateChannel(asynchat.async_chat):
+  """A single, possibly keep-alive, client connection."""
+
+  def __init__(self, server, sock, client_address):
+    asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+    self._server = server
+    self.client_address = client_address
+    self._buffer = []
+    self._buffered = 0
+    self._method = None
+    self._path = None
+    self._version = None
+    self._headers = None
+    # True while a request of this connection is being processed.
+    self._busy = False
+    self.set_terminator('\r\n\r\n')
+
+  def readable(self):
+    return not self._busy and asynchat.async_chat.readable(self)
+
+  def collect_incoming_data(self, data):
+    self._buffered += len(data)
+    if self._headers is None and self._buffered > _MAX_HEADER_SIZE:
+      self._SendResponse(400, '', close=True)
+      return
+    self._buffer.append(data)
+
+  def _TakeBuffer(self):
+    data = ''.join(self._buffer)
+    self._buffer = []
+    self._buffered = 0
+    return data
+
+  def found_terminator(self):
+    if self._headers is None:
+      self._ParseHead(self._TakeBuffer())
+    else:
+      self._Dispatch(self._TakeBuffer())
+
+  def _ParseHead(self, head):
+    lines = head.lstrip('\r\n').split('\r\n')
+    try:
+      self._method, self._path, self._version = lines[0].split()
+    except ValueError:
+      self._SendResponse(400, '', close=True)
+      return
+
+    self._headers = {}
+    for line in lines[1:]:
+      name, _, value = line.partition(':')
+      self._headers[name.strip().title()] = value.strip()
+
+    if self._method != 'POST':
+      self._SendResponse(405, '', close=True)
+      return
+    if 'Content-Length' not in self._headers:
+      self._SendResponse(411, '')
+      return
+    try:
+      body_length = int(self._headers['Content-Length'])
+    except ValueError:
+      body_length = -1
+    if body_length < 0:
+      self._SendResponse(400, '', close=True)
+      return
+    if body_length > self._server.max_body_size:
+      self._SendResponse(413, '', close=True)
+      return
+
+    if body_length:
+      self.set_terminator(body_length)
+    else:
+      self._Dispatch('')
+
+  def _Dispatch(self, body):
+    path = urllib.unquote(self._path.split('?', 1)[0])
+    if path != UPDATE_URL_PREFIX and not path.startswith(
+        UPDATE_URL_PREFIX + '/'):
+      self._SendResponse(404, '')
+      return
+
+    label = path[len(UPDATE_URL_PREFIX):].strip('/')
+    self._busy = True
+    self._server.Submit(self, body, label, self._headers)
+
+  def _KeepAlive(self):
+    connection = (self._headers or {}).get('Connection', '').lower()
+    if self._version == 'HTTP/1.0':
+      return connection == 'keep-alive'
+    return connection != 'close'
+
+  def _SendResponse(self, status, body, close=False):
+    """Queues a response and resets the channel for the next request."""
+    close = close or not self._KeepAlive()
+    head = ['HTTP/1.1 %d %s' % (status, _STATUS_MESSAGES.get(status, '')),
+            'Content-Type: text/xml',
+            'Content-Length: %d' % len(body)]
+    if close:
+      head.append('Connection: close')
+    self.push('\r\n'.join(head) + '\r\n\r\n' + body)
+
+    # Stop reading from connections that are about to be closed.
+    self._busy = close
+    self._headers = None
+    self._buffer = []
+    self._buffered = 0
+    self.set_terminator('\r\n\r\n')
+    if close:
+      self.close_when_done()
+
+  def CompleteRequest(self, status, body):
+    """Sends the result of a dispatched request; called from the loop thread."""
+    if self.connected:
+      self._SendResponse(status, body)
+
+  def handle_error(self):
+    _Log('Error on connection from %s, closing', self.client_address[0])
+    self.close()
+
+
+class AsyncUpdateServer(asyncore.dispatcher):
+  """Accepts update ping connections and dispatches them to worker threads.
+
+  Members:
+    socket_map:    private asyncore socket map of this server.
+    max_body_size: largest request body accepted, in bytes.
+  """
+
+  def __init__(self, server_address, handler, num_threads,
+               max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """Creates and binds the listener.
+
+    Args:
+      server_address: (host, port) tuple to listen on.
+      handler: callable taking (data, label, client_address, headers) and
+               returning the response body.
+      num_threads: number of worker threads processing pings.
+      max_body_size: largest request body accepted, in bytes.
+    """
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+    family = socket.AF_INET6 if ':' in server_address[0] else socket.AF_INET
+    self.create_socket(family, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(server_address)
+    self.listen(socket.SOMAXCONN)
+
+    self.max_body_size = max_body_size
+    self._handler = handler
+    self._num_threads = num_threads
+    # The worker pool and the loop trigger are created by ServeForever(), so
+    # that a listener created before forking works in every child process.
+    self._pool = None
+    self._trigger = None
+    self._completed_lock = threading.Lock()
+    self._completed = collections.deque()
+    self._stopping = False
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair:
+      sock, client_address = pair
+      UpdateChannel(self, sock,
+                    (_StripIPv6Mapping(client_address[0]), client_address[1]))
+
+  def handle_error(self):
+    _Log('Error while accepting a connection')
+
+  def _Run(self, channel, body, label, headers):
+    """Processes a request; runs on a worker thread."""
+    try:
+      result = 200, self._handler(body, label, channel.client_address, headers)
+    except autoupdate_lib.InvalidUpdateRequestException as e:
+      # As the /update handler of the devserver does.
+      result = 400, str(e)
+    except Exception as e:
+      _Log('Failed to handle update ping from %s: %r',
+           channel.client_address[0], e)
+      result = 500, ''
+
+    with self._completed_lock:
+      self._completed.append((channel, result))
+    self._trigger.Pull()
+
+  def Submit(self, channel, body, label, headers):
+    """Hands a request to the worker pool."""
+    self._pool.apply_async(self._Run, (channel, body, label, headers))
+
+  def _FlushCompleted(self):
+    while True:
+      with self._completed_lock:
+        if not self._completed:
+          return
+        channel, (status, body) = self._completed.popleft()
+      channel.CompleteRequest(status, body)
+
+  def ServeForever(self):
+    """Runs the event loop until Shutdown() is called."""
+    self._pool = pool.ThreadPool(self._num_threads)
+    self._trigger = _Trigger(self.socket_map)
+    while not self._stopping:
+      asyncore.loop(timeout=1.0, use_poll=True, map=self.socket_map, count=1)
+      self._FlushCompleted()
+
+    asyncore.close_all(map=self.socket_map)
+    self._pool.terminate()
+
+  def Shutdown(self):
+    """Stops the event loop; safe to call from any thread."""
+    self._stopping = True
+    if self._trigger:
+      self._trigger.Pull()
+
+
+class AsyncUpdateServerPlugin(plugins.SimplePlugin):
+  """Runs an AsyncUpdateServer alongside the CherryPy engine."""
+
+  def __init__(self, bus, server):
+    plugins.SimplePlugin.__init__(self, bus)
+    self.server = server
+    self._thread = None
+
+  def start(self):
+    _Log('Handling update pings asynchronously on port %d',
+         self.server.socket.getsockname()[1])
+    self._thread = threading.Thread(target=self.server.ServeForever,
+                                    name='AsyncUpdateServer')
+    self._thread.daemon = True
+    self._thread.start()
+  start.priority = 70
+
+  def stop(self):
+    if self._thread:
+      self.server.Shutdown()
+      self._thread.join()
+      self._thread = None
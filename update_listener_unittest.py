@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for update_listener module."""
+
+import httplib
+import threading
+import unittest
+
+import cherrypy
+
+import autoupdate_lib
+import update_listener
+
+
+class _FakeUpdater(object):
+  """Records the request context HandleUpdatePing is called in."""
+
+  def __init__(self):
+    self.calls = []
+
+  def HandleUpdatePing(self, data, label=None):
+    self.calls.append((data, label, cherrypy.request.remote.ip,
+                       cherrypy.request.base))
+    return 'response for %s' % label
+
+
+class HandleUpdateRequestTest(unittest.TestCase):
+
+  def testRequestContext(self):
+    updater = _FakeUpdater()
+    response = update_listener.HandleUpdateRequest(
+        updater, 8080, '<xml/>', 'some/label', ('1.2.3.4', 5678),
+        {'Host': 'myhost:9090'})
+    self.assertEqual(response, 'response for some/label')
+    self.assertEqual(updater.calls,
+                     [('<xml/>', 'some/label', '1.2.3.4',
+                       'http://myhost:8080')])
+
+
+class AsyncUpdateServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.requests = []
+    self._server = update_listener.AsyncUpdateServer(
+        ('127.0.0.1', 0), self._Handler, 4, max_body_size=1024)
+    self._thread = threading.Thread(target=self._server.ServeForever)
+    self._thread.start()
+    self._port = self._server.socket.getsockname()[1]
+
+  def tearDown(self):
+    self._server.Shutdown()
+    self._thread.join()
+
+  def _Handler(self, data, label, client_address, headers):
+    self.requests.append((data, label, client_address[0]))
+    if label == 'fail':
+      raise Exception('failed')
+    if label == 'invalid':
+      raise autoupdate_lib.InvalidUpdateRequestException('invalid request')
+    return '<response>%s</response>' % data
+
+  def _Post(self, conn, path, body):
+    conn.request('POST', path, body)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+  def testKeepAlive(self):
+    conn = httplib.HTTPConnection('127.0.0.1', self._port)
+    try:
+      self.assertEqual(self._Post(conn, '/update', 'one'),
+                       (200, '<response>one</response>'))
+      self.assertEqual(self._Post(conn, '/update/a/label', 'two'),
+                       (200, '<response>two</response>'))
+    finally:
+      conn.close()
+    self.assertEqual(self.requests, [('one', '', '127.0.0.1'),
+                                     ('two', 'a/label', '127.0.0.1')])
+
+  def testErrors(self):
+    conn = httplib.HTTPConnection('127.0.0.1', self._port)
+    try:
+      self.assertEqual(self._Post(conn, '/other', 'body')[0], 404)
+      self.assertEqual(self._Post(conn, '/update/fail', 'body')[0], 500)
+      self.assertEqual(self._Post(conn, '/update/invalid', 'body'),
+                       (400, 'invalid request'))
+      self.assertEqual(self._Post(conn, '/update', 'x' * 2048)[0], 413)
+    finally:
+      conn.close()
+
+    conn = httplib.HTTPConnection('127.0.0.1', self._port)
+    try:
+      conn.putrequest('POST', '/update')
+      conn.putheader('Content-Length', '-5')
+      conn.endheaders('body')
+      response = conn.getresponse()
+      self.assertEqual(response.status, 400)
+      self.assertTrue(response.will_close)
+    finally:
+      conn.close()
+
+  def testConcurrentClients(self):
+    results = []
+
+    def _Client(index):
+      conn = httplib.HTTPConnection('127.0.0.1', self._port)
+      try:
+        results.append(self._Post(conn, '/update', str(index)))
+      finally:
+        conn.close()
+
+    threads = [threading.Thread(target=_Client, args=(i,)) for i in range(50)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(sorted(results),
+                     sorted((200, '<response>%d</response>' % i)
+                            for i in range(50)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,106 +4,639 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-from xml.dom import minidom
+"""Load test of a devserver through the update protocol.
+
+Simulates concurrent virtual DUTs. Each one repeatedly sends an update check,
+optionally downloads the payload it is offered, possibly resuming it with a
+Range request, and reports the download and update events. Throughput and
+latency percentiles are reported per endpoint.
+
+The devserver is either an existing one (--server) or a local one started with
+a stub payload generator (--local), so that regressions of the devserver
+itself can be measured without building images. Clients are spread across
+several devservers, e.g. the members of a devserver pool, if more than one is
+given or started (--local_pool).
+
+Example:
+  update_test.py --local --clients 2000 --duration 60 --download --events
+  update_test.py --local --local_pool 3 --board a,b,c,d --clients 100
+"""
+
+import httplib
+import json
+import math
+import optparse
+import os
+import random
+import shutil
+import socket
+import stat
+import subprocess
 import sys
+import tempfile
 import threading
+import time
 import urllib2
+import urlparse
+from xml.dom import minidom
+
+import autoupdate_lib
+
+
+# Default devserver to load.
+DEFAULT_SERVER = 'http://localhost:8080'
 
+# Update engine event types and results reported by the virtual DUTs.
+EVENT_TYPE_UPDATE_COMPLETE = 3
+EVENT_TYPE_DOWNLOAD_STARTED = 13
+EVENT_TYPE_DOWNLOAD_FINISHED = 14
+EVENT_RESULT_SUCCESS = 1
 
-UPDATE_BLOB="""\
+# Endpoints latencies are reported for.
+UPDATE_ENDPOINT = 'update'
+EVENT_ENDPOINT = 'event'
+DOWNLOAD_ENDPOINT = 'download'
+
+# Size of the chunks payloads are read in.
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Stack size of the virtual DUT threads, so that thousands of them fit.
+_THREAD_STACK_SIZE = 256 * 1024
+
+# Seconds to wait for a local devserver to answer requests.
+_LOCAL_STARTUP_TIMEOUT = 60
+
+UPDATE_REQUEST = {}
+UPDATE_REQUEST['2.0'] = """\
 <?xml version="1.0" encoding="UTF-8"?>
 <o:gupdate
   xmlns:o="http://www.google.com/update2/request"
   version="MementoSoftwareUpdate-0.1.0.0"
   protocol="2.0"
-  machineid="{1B0A13AC-7004-638C-3CA6-EC082E8F5DE9}"
+  machineid="{%(machine_id)s}"
   ismachine="0"
   userid="{bogus}">
 <o:os version="Memento"
    platform="memento"
    sp="ForcedUpdate_i686">
 </o:os>
-<o:app appid="{87efface-864d-49a5-9bb3-4b050a7c227a}"
-   version="ForcedUpdate"
+<o:app appid="{%(appid)s}"
+   version="%(version)s"
    lang="en-us"
    brand="GGLG"
    track="developer-build"
-   board="x86-generic">
-<o:ping active="0"></o:ping>
-<o:updatecheck></o:updatecheck>
+   board="%(board)s">
+%(body)s
 </o:app>
 </o:gupdate>
 """
 
-UPDATE_URL = 'http://localhost:8080/update/'
-
-def do_ping():
-  update_ping = urllib2.Request(UPDATE_URL, update_blob)
-  update_ping.add_header('Content-Type', 'text/xml')
-  print urllib2.urlopen(update_ping).read()
-  #TODO assert noupdate
-
-def do_version_ping():
-  url = UPDATE_URL + 'LATEST'
-  update_ping = urllib2.Request(url, UPDATE_BLOB)
-  update_ping.add_header('Content-Type', 'text/xml')
-  response = urllib2.urlopen(update_ping).read()
-  assert _verify_response(response), 'couldn\'t fetch update file'
-  print 'Successfully pinged updateserver.'
-
-def do_badversion_ping():
-  url = UPDATE_URL + 'BADVERSION'
-  update_ping = urllib2.Request(url, UPDATE_BLOB)
-  update_ping.add_header('Content-Type', 'text/xml')
-  response = urllib2.urlopen(update_ping).read()
-  assert ('noupdate' in response)
-  print 'requesting bogus version returns noupdate.'
-
-def _verify_download(url, content_length):
-  # Eventually, verify something about the update. For now,
-  # sanity-check its size.
-  f = urllib2.urlopen(url)
-  data = f.read(1024 * 1024)
-  length = len(data)
-  while data:
-    data = f.read(1024 * 1024)
-    length += len(data)
-  assert content_length == length
-  print 'Got a valid download.'
-  return True
-
-def _verify_response(data):
-  update_dom = minidom.parseString(data)
-  print data
-  root = update_dom.firstChild
-  update_info = root.getElementsByTagName('updatecheck')[0]
-  update_url = update_info.getAttribute('codebase')
-  hash = update_info.getAttribute('hash')
-  head_request = urllib2.Request(update_url)
-  head_request.get_method = lambda: 'HEAD'
-  try:
-    fd = urllib2.urlopen(head_request)
-  except urllib2.HTTPError, e:
-    # HTTP error
-    print 'FAILED: unable to retrieve %s\n\t%s' % (update_url, e)
-    length = 0
+UPDATE_REQUEST['3.0'] = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<request
+  protocol="3.0"
+  version="ChromeOSUpdateEngine-0.1.0.0"
+  updaterversion="ChromeOSUpdateEngine-0.1.0.0"
+  installsource="ondemandupdate"
+  ismachine="1">
+<os version="Indy" platform="Chrome OS" sp="ForcedUpdate_x86_64"></os>
+<app appid="{%(appid)s}"
+   version="%(version)s"
+   track="developer-build"
+   board="%(board)s"
+   lang="en-US"
+   delta_okay="true">
+%(body)s
+</app>
+</request>
+"""
+
+# Elements of an update check and an event ping, indexed by protocol.
+_UPDATE_CHECK = {'2.0': '<o:ping active="0"></o:ping>\n'
+                        '<o:updatecheck></o:updatecheck>',
+                 '3.0': '<ping active="0"></ping>\n'
+                        '<updatecheck></updatecheck>'}
+_EVENT = {'2.0': '<o:event eventtype="%d" eventresult="%d"></o:event>',
+          '3.0': '<event eventtype="%d" eventresult="%d"></event>'}
+
+# Generates payloads of a fixed size in place of cros_generate_update_payload.
+_STUB_GENERATOR = """\
+#!/bin/sh
+while [ $# -gt 0 ]; do
+  if [ "$1" = "--output" ]; then
+    output="$2"
+  fi
+  shift
+done
+sleep %(delay)s
+head -c %(size)d /dev/urandom > "${output}"
+"""
+
+
+class LoadTestError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def BuildUpdateRequest(protocol, board, version, event_type=None,
+                       machine_id='0'):
+  """Returns the XML of an update check, or of an event if |event_type| is set.
+  """
+  if event_type is None:
+    body = _UPDATE_CHECK[protocol]
   else:
-    # HTTP succeeded
-    length = int(fd.headers.getheaders('Content-Length')[0])
+    body = _EVENT[protocol] % (event_type, EVENT_RESULT_SUCCESS)
+  return UPDATE_REQUEST[protocol] % {
+      'appid': autoupdate_lib.APP_ID,
+      'board': board,
+      'version': version,
+      'machine_id': machine_id,
+      'body': body,
+  }
+
+
+def ParseUpdateResponse(data):
+  """Returns the payload URL and size of an update response.
+
+  Returns:
+    A (url, size) tuple, or None if there is no update.
+  Raises:
+    LoadTestError if the response is invalid.
+  """
+  try:
+    response_dom = minidom.parseString(data)
+  except Exception as e:
+    raise LoadTestError('Invalid update response: %s' % e)
+  update_checks = response_dom.getElementsByTagName('updatecheck')
+  if not update_checks:
+    raise LoadTestError('No updatecheck in update response')
+  update_check = update_checks[0]
+  if update_check.getAttribute('status') != 'ok':
+    return None
+
+  if update_check.hasAttribute('codebase'):
+    # Protocol 2.0.
+    return (update_check.getAttribute('codebase'),
+            int(update_check.getAttribute('size')))
+
+  urls = update_check.getElementsByTagName('url')
+  packages = update_check.getElementsByTagName('package')
+  if not urls or not packages:
+    raise LoadTestError('No payload in update response')
+  return (urls[0].getAttribute('codebase') + packages[0].getAttribute('name'),
+          int(packages[0].getAttribute('size')))
+
+
+def Percentile(sorted_values, percent):
+  """Returns the nearest-rank |percent| percentile of sorted_values."""
+  if not sorted_values:
+    return None
+  rank = int(math.ceil(len(sorted_values) * percent / 100.0))
+  return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class LoadStats(object):
+  """Latencies, errors and bytes transferred per endpoint, thread-safe."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._latencies = {}
+    self._errors = {}
+    self._bytes = {}
+
+  def Record(self, endpoint, seconds, num_bytes=0, error=False):
+    """Records a request to |endpoint| that took |seconds|."""
+    with self._lock:
+      if error:
+        self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+      else:
+        self._latencies.setdefault(endpoint, []).append(seconds)
+      self._bytes[endpoint] = self._bytes.get(endpoint, 0) + num_bytes
+
+  def Summary(self, elapsed):
+    """Returns the statistics per endpoint over |elapsed| seconds.
+
+    Latencies are in milliseconds, throughput in requests and bytes per
+    second; failed requests count as errors only.
+    """
+    with self._lock:
+      endpoints = set(self._latencies) | set(self._errors)
+      summary = {}
+      for endpoint in sorted(endpoints):
+        latencies = sorted(self._latencies.get(endpoint, []))
+        num_bytes = self._bytes.get(endpoint, 0)
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': self._errors.get(endpoint, 0),
+            'requests_per_second': len(latencies) / elapsed,
+            'bytes_per_second': num_bytes / elapsed,
+        }
+        for percent in (50, 95, 99):
+          latency = Percentile(latencies, percent)
+          summary[endpoint]['p%d_ms' % percent] = (
+              latency * 1000 if latency is not None else None)
+      return summary
+
+
+def FormatSummary(summary, elapsed):
+  """Returns |summary|, as returned by LoadStats.Summary, as a text table."""
+  lines = ['%-10s %9s %7s %9s %9s %9s %9s %9s' % (
+      'endpoint', 'requests', 'errors', 'req/s', 'MB/s', 'p50 ms', 'p95 ms',
+      'p99 ms')]
+  for endpoint, stats in sorted(summary.iteritems()):
+    latencies = [('%9.1f' % stats[key] if stats[key] is not None
+                  else '%9s' % '-') for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+    lines.append('%-10s %9d %7d %9.1f %9.2f %s' % (
+        endpoint, stats['requests'], stats['errors'],
+        stats['requests_per_second'],
+        stats['bytes_per_second'] / (1024.0 * 1024), ' '.join(latencies)))
+  lines.append('Elapsed: %.1f seconds' % elapsed)
+  return '\n'.join(lines)
+
+
+class VirtualDut(object):
+  """A simulated device going through update checks, downloads and events.
+
+  Members:
+    update_url: URL update checks are sent to.
+    protocol:   Omaha protocol version of the requests.
+    board:      board reported by the device.
+    version:    version reported by the device.
+    options:    load test options, as parsed by main().
+    stats:      LoadStats requests are recorded in.
+  """
+
+  def __init__(self, dut_id, update_url, protocol, board, version, options,
+               stats):
+    self.dut_id = dut_id
+    self.update_url = update_url
+    self.protocol = protocol
+    self.board = board
+    self.version = version
+    self.options = options
+    self.stats = stats
+    self._random = random.Random(dut_id)
+    # Keep-alive connections, keyed by host and port.
+    self._connections = {}
+
+  def _GetConnection(self, netloc):
+    conn = self._connections.get(netloc)
+    if conn is None:
+      conn = httplib.HTTPConnection(netloc, timeout=self.options.timeout)
+      self._connections[netloc] = conn
+    return conn
+
+  def _Close(self, netloc):
+    conn = self._connections.pop(netloc, None)
+    if conn:
+      conn.close()
+
+  def _Request(self, method, url, body=None, headers=None, read=True):
+    """Sends a request, reusing the connection to its server.
+
+    Returns:
+      The response status and, if |read| is set, its body; otherwise the
+      number of bytes in its body, which is read and discarded.
+    Raises:
+      LoadTestError if the request failed.
+    """
+    split_url = urlparse.urlsplit(url)
+    path = split_url.path or '/'
+    if split_url.query:
+      path += '?' + split_url.query
+    conn = self._GetConnection(split_url.netloc)
+    try:
+      conn.request(method, path, body, headers or {})
+      response = conn.getresponse()
+      if read:
+        result = response.read()
+      else:
+        result = 0
+        chunk = response.read(_DOWNLOAD_CHUNK_SIZE)
+        while chunk:
+          result += len(chunk)
+          chunk = response.read(_DOWNLOAD_CHUNK_SIZE)
+      if response.getheader('connection', '').lower() == 'close':
+        self._Close(split_url.netloc)
+      return response.status, result
+    except (httplib.HTTPException, socket.error) as e:
+      self._Close(split_url.netloc)
+      raise LoadTestError('%s %s failed: %r' % (method, url, e))
+
+  def _Ping(self, endpoint, event_type=None):
+    """Sends an update check or an event and returns the response."""
+    body = BuildUpdateRequest(self.protocol, self.board, self.version,
+                              event_type, machine_id=self.dut_id)
+    start = time.time()
+    try:
+      status, data = self._Request('POST', self.update_url, body,
+                                   {'Content-Type': 'text/xml'})
+      if status != httplib.OK:
+        raise LoadTestError('%s ping returned %d' % (endpoint, status))
+    except LoadTestError:
+      self.stats.Record(endpoint, time.time() - start, error=True)
+      raise
+    self.stats.Record(endpoint, time.time() - start, len(body) + len(data))
+    return data
+
+  def _Download(self, url, size):
+    """Downloads a payload, resuming it part-way through some of the time."""
+    headers = {}
+    expected_status = httplib.OK
+    expected_size = size
+    if size > 1 and self._random.random() < self.options.range_share:
+      offset = self._random.randint(1, size - 1)
+      headers['Range'] = 'bytes=%d-' % offset
+      expected_status = httplib.PARTIAL_CONTENT
+      expected_size = size - offset
+
+    start = time.time()
+    try:
+      status, num_bytes = self._Request('GET', url, headers=headers,
+                                        read=False)
+      if status != expected_status or num_bytes != expected_size:
+        raise LoadTestError('Download of %s returned %d with %d bytes, '
+                            'expected %d with %d bytes' %
+                            (url, status, num_bytes, expected_status,
+                             expected_size))
+    except LoadTestError:
+      self.stats.Record(DOWNLOAD_ENDPOINT, time.time() - start, error=True)
+      raise
+    self.stats.Record(DOWNLOAD_ENDPOINT, time.time() - start, num_bytes)
+
+  def RunOnce(self):
+    """Goes through one update check and what follows it."""
+    payload = ParseUpdateResponse(self._Ping(UPDATE_ENDPOINT))
+    if not payload:
+      return
+
+    url, size = payload
+    if self.options.events:
+      self._Ping(EVENT_ENDPOINT, EVENT_TYPE_DOWNLOAD_STARTED)
+    if self.options.download:
+      self._Download(url, size)
+    if self.options.events:
+      self._Ping(EVENT_ENDPOINT, EVENT_TYPE_DOWNLOAD_FINISHED)
+      self._Ping(EVENT_ENDPOINT, EVENT_TYPE_UPDATE_COMPLETE)
+
+  def Run(self, deadline, max_cycles, stop_event):
+    """Runs update cycles until |deadline| or |max_cycles|, or until stopped.
+    """
+    cycles = 0
+    try:
+      while not stop_event.is_set() and time.time() < deadline:
+        if max_cycles and cycles >= max_cycles:
+          break
+        cycles += 1
+        try:
+          self.RunOnce()
+        except LoadTestError as e:
+          if self.options.verbose:
+            print >> sys.stderr, 'DUT %s: %s' % (self.dut_id, e)
+        if self.options.think_time:
+          stop_event.wait(
+              self._random.uniform(0, 2 * self.options.think_time))
+    finally:
+      for netloc in self._connections.keys():
+        self._Close(netloc)
+
+
+class LocalDevserver(object):
+  """A devserver started locally, generating payloads with a stub generator.
+
+  The stub writes random payloads of a fixed size after an optional delay,
+  standing in for cros_generate_update_payload.
+  """
+
+  def __init__(self, port, payload_size, generation_delay=0, extra_args=()):
+    self.port = port
+    self.payload_size = payload_size
+    self.generation_delay = generation_delay
+    self.extra_args = list(extra_args)
+    self.work_dir = None
+    self._process = None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d' % self.port
+
+  def _WriteStubGenerator(self, bin_dir):
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, 'cros_generate_update_payload')
+    with open(path, 'w') as stub:
+      stub.write(_STUB_GENERATOR % {'size': self.payload_size,
+                                    'delay': self.generation_delay})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+  def Start(self):
+    """Starts the devserver and waits until it answers requests.
+
+    Raises:
+      LoadTestError if the devserver did not start.
+    """
+    self.work_dir = tempfile.mkdtemp(prefix='update_test.')
+    bin_dir = os.path.join(self.work_dir, 'bin')
+    self._WriteStubGenerator(bin_dir)
+    image = os.path.join(self.work_dir, 'coreos_developer_image.bin')
+    with open(image, 'w') as image_file:
+      image_file.write(os.urandom(4096))
+
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    devserver = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'devserver.py')
+    cmd = [sys.executable, devserver,
+           '--port', str(self.port),
+           '--data_dir', self.work_dir,
+           '--image', image,
+           '--private_key', '',
+           '--digest_index', '',
+           '--logfile', os.path.join(self.work_dir, 'devserver.log'),
+          ] + self.extra_args
+    self._process = subprocess.Popen(cmd, env=env)
+
+    deadline = time.time() + _LOCAL_STARTUP_TIMEOUT
+    while time.time() < deadline:
+      if self._process.poll() is not None:
+        raise LoadTestError('Devserver exited with %d' %
+                            self._process.returncode)
+      try:
+        urllib2.urlopen(self.url, timeout=1).read()
+        return
+      except (urllib2.URLError, socket.error):
+        time.sleep(0.2)
+    raise LoadTestError('Devserver did not start within %d seconds' %
+                        _LOCAL_STARTUP_TIMEOUT)
+
+  def Stop(self):
+    """Stops the devserver and removes its files."""
+    if self._process and self._process.poll() is None:
+      self._process.terminate()
+      self._process.wait()
+    if self.work_dir:
+      shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def RunLoad(servers, options):
+  """Runs the virtual DUTs against |servers| and returns their LoadStats.
+
+  Clients are spread evenly across the servers and the boards of
+  options.board, a comma separated list.
+
+  Returns:
+    A (stats, elapsed seconds) tuple.
+  """
+  boards = options.board.split(',')
+  rand = random.Random(options.seed)
+  stats = LoadStats()
+  stop_event = threading.Event()
+  start = time.time()
+  deadline = start + options.duration if options.duration else float('inf')
+
+  threading.stack_size(_THREAD_STACK_SIZE)
+  threads = []
+  try:
+    for dut_index in range(options.clients):
+      protocol = '3.0' if rand.random() < options.protocol_3_share else '2.0'
+      update_url = '%s/update/%s' % (
+          servers[dut_index % len(servers)].rstrip('/'), options.label)
+      dut = VirtualDut('%08x-%d' % (rand.getrandbits(32), dut_index),
+                       update_url, protocol, boards[dut_index % len(boards)],
+                       options.version, options, stats)
+      thread = threading.Thread(target=dut.Run,
+                                args=(deadline, options.cycles, stop_event))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+      if options.ramp_up:
+        time.sleep(float(options.ramp_up) / options.clients)
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(1)
+  except KeyboardInterrupt:
+    stop_event.set()
+    for thread in threads:
+      thread.join()
+  return stats, time.time() - start
+
+
+def main():
+  usage = 'usage: %prog [options] [num_clients]'
+  parser = optparse.OptionParser(usage=usage,
+                                 description=__doc__.split('\n')[0])
+  parser.add_option('--board', default='x86-generic',
+                    help='board reported by the clients, or a comma separated '
+                    'list of boards to spread them across (default: '
+                    '%default)')
+  parser.add_option('--clients', metavar='NUM', type='int', default=1,
+                    help='number of concurrent virtual DUTs (default: 1)')
+  parser.add_option('--cycles', metavar='NUM', type='int', default=1,
+                    help='update checks per client, 0 for no limit within '
+                    '--duration (default: 1)')
+  parser.add_option('--devserver_arg', metavar='ARG', action='append',
+                    default=[],
+                    help='extra argument of the --local devserver, e.g. '
+                    '--devserver_arg=--workers=4; may be repeated')
+  parser.add_option('--download', action='store_true', default=False,
+                    help='download the payloads offered')
+  parser.add_option('--duration', metavar='SECONDS', type='float', default=0,
+                    help='stop after this long (default: when all cycles '
+                    'are done)')
+  parser.add_option('--events', action='store_true', default=False,
+                    help='report download and update events')
+  parser.add_option('--generation_delay', metavar='SECONDS', type='float',
+                    default=0,
+                    help='time the stub payload generator of the --local '
+                    'devserver takes (default: 0)')
+  parser.add_option('--json', metavar='PATH',
+                    help='also write the results as JSON to this file')
+  parser.add_option('--label', default='',
+                    help='payload path appended to the update URL')
+  parser.add_option('--local', action='store_true', default=False,
+                    help='start a local devserver with a stub payload '
+                    'generator instead of using --server')
+  parser.add_option('--local_pool', metavar='NUM', type='int', default=1,
+                    help='start this many --local devservers on consecutive '
+                    'ports, forming a --pool (default: %default)')
+  parser.add_option('--local_port', metavar='PORT', type='int', default=18080,
+                    help='port of the (first) --local devserver (default: '
+                    '%default)')
+  parser.add_option('--payload_kb', metavar='KB', type='int', default=1024,
+                    help='size of the payloads of the --local devserver '
+                    '(default: %default)')
+  parser.add_option('--protocol_3_share', metavar='FRACTION', type='float',
+                    default=0.5,
+                    help='fraction of clients using protocol 3.0 rather than '
+                    '2.0 (default: %default)')
+  parser.add_option('--ramp_up', metavar='SECONDS', type='float', default=0,
+                    help='spread the start of the clients over this long')
+  parser.add_option('--range_share', metavar='FRACTION', type='float',
+                    default=0,
+                    help='fraction of downloads resumed part-way through '
+                    'with a Range request (default: 0)')
+  parser.add_option('--seed', type='int', default=0,
+                    help='seed of the random client choices (default: 0)')
+  parser.add_option('--server', default=DEFAULT_SERVER,
+                    help='devserver to load, or a comma separated list of '
+                    'devservers to spread the clients across (default: '
+                    '%default)')
+  parser.add_option('--think_time', metavar='SECONDS', type='float',
+                    default=0,
+                    help='average pause of a client between update cycles')
+  parser.add_option('--timeout', metavar='SECONDS', type='float', default=60,
+                    help='timeout of each request (default: %default)')
+  parser.add_option('--verbose', action='store_true', default=False,
+                    help='print every failed request')
+  parser.add_option('--version', default='ForcedUpdate',
+                    help='version reported by the clients (default: '
+                    '%default)')
+  (options, args) = parser.parse_args()
+
+  # Like the original smoke test, a bare number is a number of clients.
+  if len(args) > 1:
+    parser.error('Too many arguments')
+  if args:
+    options.clients = int(args[0])
+  if options.clients < 1:
+    parser.error('--clients must be at least 1')
+  if not options.cycles and not options.duration:
+    parser.error('--cycles 0 requires --duration')
+  if options.local_pool < 1:
+    parser.error('--local_pool must be at least 1')
+
+  local_servers = []
+  servers = options.server.split(',')
+  if options.local:
+    ports = range(options.local_port, options.local_port + options.local_pool)
+    pool_args = []
+    if len(ports) > 1:
+      pool_args = ['--pool',
+                   ','.join('http://127.0.0.1:%d' % port for port in ports)]
+    local_servers = [LocalDevserver(port, options.payload_kb * 1024,
+                                    options.generation_delay,
+                                    pool_args + options.devserver_arg)
+                     for port in ports]
+  try:
+    for local_server in local_servers:
+      local_server.Start()
+    if local_servers:
+      servers = [local_server.url for local_server in local_servers]
+    stats, elapsed = RunLoad(servers, options)
   finally:
-    fd.close()
-    return (length > 0)
+    for local_server in local_servers:
+      local_server.Stop()
+
+  summary = stats.Summary(elapsed)
+  print FormatSummary(summary, elapsed)
+  if options.json:
+    with open(options.json, 'w') as json_file:
+      json.dump({'elapsed': elapsed, 'clients': options.clients,
+                 'endpoints': summary}, json_file, indent=2, sort_keys=True)
+
+  if any(endpoint_stats['errors'] for endpoint_stats in summary.itervalues()):
+    return 1
+  return 0
 
-def test(num_clients):
-  # Fake some concurrent requests for each autoupdate operation.
-  for clients in range(num_clients):
-    for op in (do_version_ping, do_badversion_ping):
-      t = threading.Thread(target=op)
-      t.start()
 
 if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    num_clients = int(sys.argv[1])
-  else:
-    num_clients = 1
-  test(num_clients)
+  sys.exit(main())
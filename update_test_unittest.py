@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for update_test module."""
+
+import BaseHTTPServer
+import SocketServer
+import optparse
+import threading
+import unittest
+
+import autoupdate_lib
+import update_test
+
+
+_PAYLOAD = 'x' * 1000
+
+
+class _FakeDevserverHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers update checks with _PAYLOAD, which it serves with Range support."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def _Respond(self, status, body, headers=()):
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    for header in headers:
+      self.send_header(*header)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    data = self.rfile.read(int(self.headers['Content-Length']))
+    protocol, _, event, update_check = autoupdate_lib.ParseUpdateRequest(data)
+    self.server.pings.append((protocol, bool(update_check), len(event)))
+    if update_check:
+      url = 'http://%s:%d/static/update.gz' % self.server.server_address
+      response = autoupdate_lib.GetUpdateResponse(
+          'sha1', 'sha256', len(_PAYLOAD), url, False, protocol)
+    else:
+      response = autoupdate_lib.GetNoUpdateResponse(protocol)
+    self._Respond(200, response)
+
+  def do_GET(self):
+    range_header = self.headers.get('Range')
+    if range_header:
+      offset = int(range_header[len('bytes='):-1])
+      self._Respond(206, _PAYLOAD[offset:], [
+          ('Content-Range', 'bytes %d-%d/%d' % (offset, len(_PAYLOAD) - 1,
+                                                len(_PAYLOAD)))])
+    else:
+      self._Respond(200, _PAYLOAD)
+
+
+class _FakeDevserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class UpdateRequestTest(unittest.TestCase):
+
+  def testRequestsParse(self):
+    for protocol in ('2.0', '3.0'):
+      request = update_test.BuildUpdateRequest(protocol, 'x86-generic',
+                                               '1.2.3')
+      parsed_protocol, app, event, update_check = (
+          autoupdate_lib.ParseUpdateRequest(request))
+      self.assertEqual(parsed_protocol, protocol)
+      self.assertEqual(app.getAttribute('board'), 'x86-generic')
+      self.assertEqual(app.getAttribute('version'), '1.2.3')
+      self.assertTrue(update_check)
+      self.assertFalse(event)
+
+      request = update_test.BuildUpdateRequest(
+          protocol, 'x86-generic', '1.2.3',
+          update_test.EVENT_TYPE_DOWNLOAD_STARTED)
+      _, _, event, update_check = autoupdate_lib.ParseUpdateRequest(request)
+      self.assertFalse(update_check)
+      self.assertEqual(event[0].getAttribute('eventtype'), '13')
+
+  def testParseUpdateResponse(self):
+    for protocol in ('2.0', '3.0'):
+      response = autoupdate_lib.GetUpdateResponse(
+          'sha1', 'sha256', 1234, 'http://host:8080/static/update.gz', False,
+          protocol)
+      self.assertEqual(update_test.ParseUpdateResponse(response),
+                       ('http://host:8080/static/update.gz', 1234))
+      self.assertEqual(update_test.ParseUpdateResponse(
+          autoupdate_lib.GetNoUpdateResponse(protocol)), None)
+    self.assertRaises(update_test.LoadTestError,
+                      update_test.ParseUpdateResponse, '<invalid')
+
+
+class LoadStatsTest(unittest.TestCase):
+
+  def testPercentile(self):
+    values = range(1, 101)
+    self.assertEqual(update_test.Percentile(values, 50), 50)
+    self.assertEqual(update_test.Percentile(values, 99), 99)
+    self.assertEqual(update_test.Percentile([7], 95), 7)
+    self.assertEqual(update_test.Percentile([], 95), None)
+
+  def testSummary(self):
+    stats = update_test.LoadStats()
+    for latency in range(1, 5):
+      stats.Record('update', latency / 1000.0, 100)
+    stats.Record('update', 10, error=True)
+    summary = stats.Summary(2.0)
+    self.assertEqual(summary['update']['requests'], 4)
+    self.assertEqual(summary['update']['errors'], 1)
+    self.assertEqual(summary['update']['requests_per_second'], 2.0)
+    self.assertEqual(summary['update']['bytes_per_second'], 200.0)
+    self.assertAlmostEqual(summary['update']['p50_ms'], 2)
+    self.assertAlmostEqual(summary['update']['p99_ms'], 4)
+    self.assertTrue('update' in update_test.FormatSummary(summary, 2.0))
+
+
+class RunLoadTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = _FakeDevserver(('127.0.0.1', 0), _FakeDevserverHandler)
+    self._server.pings = []
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.start()
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+  def testRunLoad(self):
+    options = optparse.Values({
+        'label': '', 'seed': 0, 'duration': 0, 'clients': 10, 'cycles': 2,
+        'protocol_3_share': 0.5, 'board': 'x86-generic',
+        'version': 'ForcedUpdate', 'ramp_up': 0, 'think_time': 0,
+        'timeout': 10, 'events': True, 'download': True, 'range_share': 0.5,
+        'verbose': True})
+    stats, elapsed = update_test.RunLoad(
+        ['http://%s:%d' % self._server.server_address], options)
+    summary = stats.Summary(elapsed)
+
+    self.assertEqual(summary['update']['requests'], 20)
+    self.assertEqual(summary['event']['requests'], 60)
+    self.assertEqual(summary['download']['requests'], 20)
+    for endpoint_stats in summary.itervalues():
+      self.assertEqual(endpoint_stats['errors'], 0)
+    protocols = set(protocol for protocol, _, _ in self._server.pings)
+    self.assertEqual(protocols, set(['2.0', '3.0']))
+
+
+if __name__ == '__main__':
+  unittest.main()